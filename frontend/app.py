@@ -1,6 +1,5 @@
 import streamlit as st
 import requests
-import json
 from datetime import datetime
 from typing import List, Dict, Optional
 import time
@@ -50,6 +49,39 @@ def get_headers():
         return {"Authorization": f"Bearer {st.session_state.token}"}
     return {}
 
+PREFERENCE_KEYS = ["important_contacts", "ignored_senders", "work_schedule", "response_templates"]
+
+def load_preferences():
+    """Загрузка настроек пользователя с сервера"""
+    try:
+        response = requests.get(
+            f"{API_GATEWAY_URL}/preferences",
+            headers=get_headers()
+        )
+        if response.status_code == 200:
+            prefs = response.json()
+            for key in PREFERENCE_KEYS:
+                if key in prefs:
+                    st.session_state[key] = prefs[key]
+    except Exception as e:
+        st.error(f"Ошибка загрузки настроек: {e}")
+
+def save_preferences(**changes):
+    """Сохранение изменённых настроек на сервере"""
+    try:
+        response = requests.put(
+            f"{API_GATEWAY_URL}/preferences",
+            headers=get_headers(),
+            json=changes
+        )
+        if response.status_code == 200:
+            return True
+        st.error("Не удалось сохранить настройки")
+        return False
+    except Exception as e:
+        st.error(f"Ошибка сохранения настроек: {e}")
+        return False
+
 def login(email: str, password: str):
     """Вход пользователя"""
     try:
@@ -61,6 +93,7 @@ def login(email: str, password: str):
             data = response.json()
             st.session_state.token = data["token"]
             st.session_state.user = data["user"]
+            load_preferences()
             return True
         return False
     except Exception as e:
@@ -78,6 +111,7 @@ def register(email: str, password: str, name: str):
             data = response.json()
             st.session_state.token = data["token"]
             st.session_state.user = data["user"]
+            load_preferences()
             return True
         return False
     except Exception as e:
@@ -107,20 +141,14 @@ def get_calendar_events():
 def get_email_messages():
     """Получение писем"""
     try:
-        important_contacts_json = json.dumps(st.session_state.important_contacts)
+        # Важные контакты и игнорируемые отправители применяются на сервере
         response = requests.get(
             f"{API_GATEWAY_URL}/email/messages",
             headers=get_headers(),
-            params={"important_contacts": important_contacts_json, "limit": 20}
+            params={"limit": 20}
         )
         if response.status_code == 200:
-            messages = response.json().get("messages", [])
-            # Фильтрация игнорируемых отправителей
-            filtered = [
-                msg for msg in messages
-                if msg.get("from", "").lower() not in [s.lower() for s in st.session_state.ignored_senders]
-            ]
-            return filtered
+            return response.json().get("messages", [])
         return []
     except Exception as e:
         st.error(f"Ошибка получения писем: {e}")
@@ -193,7 +221,8 @@ def send_email(to: str, subject: str, body: str):
             headers=get_headers(),
             json={"to": to, "subject": subject, "body": body}
         )
-        return response.status_code in [200, 201]
+        # Письмо ставится в очередь и доставляется в фоне
+        return response.status_code in [200, 201, 202]
     except Exception as e:
         st.error(f"Ошибка отправки письма: {e}")
         return False
@@ -324,7 +353,7 @@ def main_page():
                         
                         if st.form_submit_button("Отправить"):
                             if send_email(sender, reply_subject, reply_body):
-                                st.success("Письмо отправлено!")
+                                st.success("Письмо поставлено в очередь на отправку!")
                                 st.session_state[f"reply_to_{msg_id}"] = False
                                 st.rerun()
                         if st.form_submit_button("Отмена"):
@@ -391,6 +420,7 @@ def settings_page():
     if st.button("➕ Добавить"):
         if new_contact and new_contact not in st.session_state.important_contacts:
             st.session_state.important_contacts.append(new_contact)
+            save_preferences(important_contacts=st.session_state.important_contacts)
             st.success(f"Контакт {new_contact} добавлен")
             st.rerun()
     
@@ -402,6 +432,7 @@ def settings_page():
             with col_remove:
                 if st.button("❌", key=f"remove_contact_{contact}"):
                     st.session_state.important_contacts.remove(contact)
+                    save_preferences(important_contacts=st.session_state.important_contacts)
                     st.rerun()
     
     st.divider()
@@ -414,6 +445,7 @@ def settings_page():
     if st.button("➕ Добавить в игнор"):
         if new_ignored and new_ignored not in st.session_state.ignored_senders:
             st.session_state.ignored_senders.append(new_ignored)
+            save_preferences(ignored_senders=st.session_state.ignored_senders)
             st.success(f"Адрес {new_ignored} добавлен в игнор")
             st.rerun()
     
@@ -425,6 +457,7 @@ def settings_page():
             with col_remove:
                 if st.button("❌", key=f"remove_ignored_{sender}"):
                     st.session_state.ignored_senders.remove(sender)
+                    save_preferences(ignored_senders=st.session_state.ignored_senders)
                     st.rerun()
     
     st.divider()
@@ -451,7 +484,8 @@ def settings_page():
             "start_time": start_time.strftime("%H:%M"),
             "end_time": end_time.strftime("%H:%M")
         }
-        st.success("Расписание сохранено!")
+        if save_preferences(work_schedule=st.session_state.work_schedule):
+            st.success("Расписание сохранено!")
     
     st.divider()
     
@@ -473,7 +507,8 @@ def settings_page():
             "accept": accept_template,
             "decline": decline_template
         }
-        st.success("Шаблоны сохранены!")
+        if save_preferences(response_templates=st.session_state.response_templates):
+            st.success("Шаблоны сохранены!")
 
 # Главная логика приложения
 def main():
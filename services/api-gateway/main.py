@@ -1,6 +1,7 @@
 from fastapi import FastAPI, Request, HTTPException, Depends
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse, Response
+from starlette.background import BackgroundTask
 import httpx
 import os
 from typing import Optional
@@ -23,6 +24,14 @@ EMAIL_SERVICE_URL = os.getenv("EMAIL_SERVICE_URL", "http://localhost:8003")
 NEWS_SERVICE_URL = os.getenv("NEWS_SERVICE_URL", "http://localhost:8004")
 LLM_AGENT_SERVICE_URL = os.getenv("LLM_AGENT_SERVICE_URL", "http://localhost:8005")
 
+# Заголовки потокового ответа, которые передаются клиенту как есть
+STREAM_PASSTHROUGH_HEADERS = [
+    "content-type", "content-length", "content-encoding", "content-disposition", "cache-control",
+    "content-range", "accept-ranges", "etag", "last-modified"
+]
+# Таймаут пакетных запросов: сервис выполняет сотни операций за один вызов
+BATCH_TIMEOUT = float(os.getenv("BATCH_TIMEOUT", "300"))
+
 async def get_token(request: Request) -> Optional[str]:
     """Извлечение токена из заголовков"""
     authorization = request.headers.get("Authorization")
@@ -44,6 +53,36 @@ async def verify_token(token: str) -> dict:
         except httpx.RequestError:
             raise HTTPException(status_code=503, detail="Auth service unavailable")
 
+async def close_stream(response: httpx.Response, client: httpx.AsyncClient):
+    """Закрытие потокового ответа сервиса и его клиента"""
+    await response.aclose()
+    await client.aclose()
+
+async def proxy_stream(method: str, url: str, token: str, **kwargs) -> StreamingResponse:
+    """Проксирование потокового ответа сервиса без буферизации"""
+    client = httpx.AsyncClient(timeout=None)
+    headers = {"Authorization": f"Bearer {token}", **kwargs.pop("headers", {})}
+    try:
+        response = await client.send(
+            client.build_request(method, url, headers=headers, **kwargs),
+            stream=True
+        )
+    except httpx.RequestError:
+        await client.aclose()
+        raise HTTPException(status_code=503, detail="Service unavailable")
+    
+    passthrough = {
+        name: response.headers[name]
+        for name in STREAM_PASSTHROUGH_HEADERS
+        if name in response.headers
+    }
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=passthrough,
+        background=BackgroundTask(close_stream, response, client)
+    )
+
 # Публичные маршруты (не требуют аутентификации)
 @app.post("/auth/register")
 async def register(request: Request):
@@ -67,12 +106,55 @@ async def login(request: Request):
             content=response.json()
         )
 
+@app.get("/preferences")
+async def get_preferences(request: Request, token: str = Depends(get_token)):
+    """Получение настроек пользователя"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    
+    headers = {"Authorization": f"Bearer {token}"}
+    if request.headers.get("if-none-match"):
+        headers["If-None-Match"] = request.headers["if-none-match"]
+    
+    async with httpx.AsyncClient() as client:
+        response = await client.get(f"{AUTH_SERVICE_URL}/preferences", headers=headers)
+        etag = {"ETag": response.headers["etag"]} if "etag" in response.headers else {}
+        if response.status_code == 304:
+            return Response(status_code=304, headers=etag)
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json(),
+            headers=etag
+        )
+
+@app.put("/preferences")
+async def update_preferences(request: Request, token: str = Depends(get_token)):
+    """Сохранение настроек пользователя"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    body = await request.json()
+    
+    async with httpx.AsyncClient() as client:
+        response = await client.put(
+            f"{AUTH_SERVICE_URL}/preferences",
+            headers={"Authorization": f"Bearer {token}"},
+            json=body
+        )
+        etag = {"ETag": response.headers["etag"]} if "etag" in response.headers else {}
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json(),
+            headers=etag
+        )
+
 @app.get("/auth/yandex/authorize")
-async def yandex_authorize(service: str = "calendar"):
+async def yandex_authorize(service: str = "calendar", token: str = Depends(get_token)):
     """Получение URL для авторизации через Яндекс"""
     service_url = CALENDAR_SERVICE_URL if service == "calendar" else EMAIL_SERVICE_URL
+    # Токен пользователя нужен сервису, чтобы привязать Яндекс аккаунт к user_id
+    headers = {"Authorization": f"Bearer {token}"} if token else {}
     async with httpx.AsyncClient() as client:
-        response = await client.get(f"{service_url}/oauth/authorize")
+        response = await client.get(f"{service_url}/oauth/authorize", headers=headers)
         return JSONResponse(
             status_code=response.status_code,
             content=response.json()
@@ -111,6 +193,56 @@ async def get_events(request: Request, token: str = Depends(get_token)):
             content=response.json()
         )
 
+@app.get("/calendar/events/stream")
+async def stream_events(request: Request, token: str = Depends(get_token)):
+    """Потоковая выгрузка событий календаря"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    return await proxy_stream(
+        "GET",
+        f"{CALENDAR_SERVICE_URL}/events/stream",
+        token,
+        params=dict(request.query_params)
+    )
+
+@app.post("/calendar/events/import")
+async def import_events(request: Request, token: str = Depends(get_token)):
+    """Импорт событий из .ics файла"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    # Тело передается сервису по частям, не загружаясь в память целиком
+    async with httpx.AsyncClient(timeout=BATCH_TIMEOUT) as client:
+        response = await client.post(
+            f"{CALENDAR_SERVICE_URL}/events/import",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": request.headers.get("content-type", "text/calendar")
+            },
+            content=request.stream()
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
+@app.get("/calendar/events/export.ics")
+async def export_events(request: Request, token: str = Depends(get_token)):
+    """Выгрузка событий календаря в формате iCalendar"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    return await proxy_stream(
+        "GET",
+        f"{CALENDAR_SERVICE_URL}/events/export.ics",
+        token,
+        params=dict(request.query_params)
+    )
+
 @app.post("/calendar/events")
 async def create_event(request: Request, token: str = Depends(get_token)):
     """Создание события в календаре"""
@@ -130,6 +262,45 @@ async def create_event(request: Request, token: str = Depends(get_token)):
             content=response.json()
         )
 
+@app.post("/calendar/events/batch")
+async def create_events_batch(request: Request, token: str = Depends(get_token)):
+    """Пакетное создание событий в календаре"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    body = await request.json()
+    
+    async with httpx.AsyncClient(timeout=BATCH_TIMEOUT) as client:
+        response = await client.post(
+            f"{CALENDAR_SERVICE_URL}/events/batch",
+            headers={"Authorization": f"Bearer {token}"},
+            json=body
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
+@app.delete("/calendar/events/batch")
+async def delete_events_batch(request: Request, token: str = Depends(get_token)):
+    """Пакетное удаление событий"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    body = await request.json()
+    
+    async with httpx.AsyncClient(timeout=BATCH_TIMEOUT) as client:
+        response = await client.request(
+            "DELETE",
+            f"{CALENDAR_SERVICE_URL}/events/batch",
+            headers={"Authorization": f"Bearer {token}"},
+            json=body
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
 @app.delete("/calendar/events/{event_id}")
 async def delete_event(event_id: str, request: Request, token: str = Depends(get_token)):
     """Удаление события"""
@@ -201,18 +372,166 @@ async def get_messages(request: Request, token: str = Depends(get_token)):
             content=response.json()
         )
 
+@app.get("/email/messages/search")
+async def search_messages(request: Request, token: str = Depends(get_token)):
+    """Поиск по почте"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    async with httpx.AsyncClient() as client:
+        response = await client.get(
+            f"{EMAIL_SERVICE_URL}/messages/search",
+            headers={"Authorization": f"Bearer {token}"},
+            params=dict(request.query_params)
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
+@app.get("/email/messages/{message_id}/attachments/{attachment_id}")
+async def download_attachment(message_id: str, attachment_id: str, request: Request,
+                              token: str = Depends(get_token)):
+    """Скачивание вложения письма (поток без буферизации, поддерживается Range)"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    headers = {"Range": request.headers["range"]} if "range" in request.headers else {}
+    return await proxy_stream(
+        "GET",
+        f"{EMAIL_SERVICE_URL}/messages/{message_id}/attachments/{attachment_id}",
+        token,
+        headers=headers
+    )
+
+@app.get("/email/changes")
+async def get_changes(request: Request, token: str = Depends(get_token)):
+    """Лента изменений почтового ящика (long-poll или Server-Sent Events)"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    headers = {
+        name: request.headers[name]
+        for name in ["accept", "last-event-id"]
+        if name in request.headers
+    }
+    return await proxy_stream(
+        "GET",
+        f"{EMAIL_SERVICE_URL}/changes",
+        token,
+        params=dict(request.query_params),
+        headers=headers
+    )
+
+@app.get("/email/threads")
+async def get_threads(request: Request, token: str = Depends(get_token)):
+    """Получение цепочек писем"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    async with httpx.AsyncClient() as client:
+        response = await client.get(
+            f"{EMAIL_SERVICE_URL}/threads",
+            headers={"Authorization": f"Bearer {token}"},
+            params=dict(request.query_params)
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
+@app.get("/email/threads/{thread_id}")
+async def get_thread(thread_id: str, request: Request, token: str = Depends(get_token)):
+    """Получение цепочки писем"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    async with httpx.AsyncClient() as client:
+        response = await client.get(
+            f"{EMAIL_SERVICE_URL}/threads/{thread_id}",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
+@app.post("/email/messages/batch")
+async def get_messages_batch(request: Request, token: str = Depends(get_token)):
+    """Пакетное получение полных писем (NDJSON по мере готовности)"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    return await proxy_stream(
+        "POST",
+        f"{EMAIL_SERVICE_URL}/messages/batch",
+        token,
+        content=await request.body(),
+        headers={"Content-Type": "application/json"}
+    )
+
+@app.post("/email/import")
+async def import_mail(request: Request, token: str = Depends(get_token)):
+    """Импорт архива почты (mbox или .eml)"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    # Архив передается сервису по частям, не загружаясь в память целиком
+    async with httpx.AsyncClient(timeout=BATCH_TIMEOUT) as client:
+        response = await client.post(
+            f"{EMAIL_SERVICE_URL}/import",
+            headers={
+                "Authorization": f"Bearer {token}",
+                "Content-Type": request.headers.get("content-type", "application/mbox")
+            },
+            params=dict(request.query_params),
+            content=request.stream()
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
+@app.get("/email/import/{import_id}")
+async def get_import_status(import_id: str, request: Request, token: str = Depends(get_token)):
+    """Ход импорта архива почты"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    async with httpx.AsyncClient() as client:
+        response = await client.get(
+            f"{EMAIL_SERVICE_URL}/import/{import_id}",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
 @app.post("/email/send")
 async def send_email(request: Request, token: str = Depends(get_token)):
-    """Отправка письма"""
+    """Постановка письма в очередь отправки"""
     if not token:
         raise HTTPException(status_code=401, detail="Token required")
     user_data = await verify_token(token)
     body = await request.json()
     
+    headers = {"Authorization": f"Bearer {token}"}
+    if request.headers.get("idempotency-key"):
+        headers["Idempotency-Key"] = request.headers["idempotency-key"]
+    
     async with httpx.AsyncClient() as client:
         response = await client.post(
             f"{EMAIL_SERVICE_URL}/send",
-            headers={"Authorization": f"Bearer {token}"},
+            headers=headers,
             json=body
         )
         return JSONResponse(
@@ -220,6 +539,23 @@ async def send_email(request: Request, token: str = Depends(get_token)):
             content=response.json()
         )
 
+@app.get("/email/send/{job_id}")
+async def get_send_status(job_id: str, request: Request, token: str = Depends(get_token)):
+    """Статус отправки письма"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    async with httpx.AsyncClient() as client:
+        response = await client.get(
+            f"{EMAIL_SERVICE_URL}/send/{job_id}",
+            headers={"Authorization": f"Bearer {token}"}
+        )
+        return JSONResponse(
+            status_code=response.status_code,
+            content=response.json()
+        )
+
 @app.get("/news")
 async def get_news(request: Request, token: str = Depends(get_token)):
     """Получение новостей"""
@@ -240,7 +576,7 @@ async def get_news(request: Request, token: str = Depends(get_token)):
 
 @app.post("/agent/analyze-email")
 async def analyze_email(request: Request, token: str = Depends(get_token)):
-    """Анализ письма агентом"""
+    """Постановка письма в конвейер анализа агентом"""
     if not token:
         raise HTTPException(status_code=401, detail="Token required")
     user_data = await verify_token(token)
@@ -257,6 +593,41 @@ async def analyze_email(request: Request, token: str = Depends(get_token)):
             content=response.json()
         )
 
+@app.get("/agent/analyze-email/jobs/{job_id}")
+async def get_analysis_job(job_id: str, request: Request, token: str = Depends(get_token)):
+    """Статус задания анализа письма (long-poll или Server-Sent Events)"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    headers = {
+        name: request.headers[name]
+        for name in ["accept"]
+        if name in request.headers
+    }
+    return await proxy_stream(
+        "GET",
+        f"{LLM_AGENT_SERVICE_URL}/analyze-email/jobs/{job_id}",
+        token,
+        params=dict(request.query_params),
+        headers=headers
+    )
+
+@app.post("/agent/analyze-emails")
+async def analyze_emails(request: Request, token: str = Depends(get_token)):
+    """Пакетный анализ писем агентом (NDJSON по мере готовности)"""
+    if not token:
+        raise HTTPException(status_code=401, detail="Token required")
+    user_data = await verify_token(token)
+    
+    return await proxy_stream(
+        "POST",
+        f"{LLM_AGENT_SERVICE_URL}/analyze-emails",
+        token,
+        content=await request.body(),
+        headers={"Content-Type": "application/json"}
+    )
+
 @app.get("/agent/recommendations")
 async def get_recommendations(request: Request, token: str = Depends(get_token)):
     """Получение рекомендаций агента"""
@@ -267,7 +638,8 @@ async def get_recommendations(request: Request, token: str = Depends(get_token))
     async with httpx.AsyncClient() as client:
         response = await client.get(
             f"{LLM_AGENT_SERVICE_URL}/recommendations",
-            headers={"Authorization": f"Bearer {token}"}
+            headers={"Authorization": f"Bearer {token}"},
+            params=dict(request.query_params)
         )
         return JSONResponse(
             status_code=response.status_code,
@@ -1,12 +1,13 @@
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Response
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime, timedelta
+import asyncio
 import jwt
 import os
 import json
 from pathlib import Path
-from typing import Optional
+from typing import Optional, List, Dict
 
 app = FastAPI(title="Auth Service")
 
@@ -16,9 +17,27 @@ JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-producti
 JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
 JWT_EXPIRATION_HOURS = int(os.getenv("JWT_EXPIRATION_HOURS", "24"))
 
-DATA_DIR = Path("/app/data")
-DATA_DIR.mkdir(exist_ok=True)
+DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
 USERS_FILE = DATA_DIR / "users.json"
+PREFERENCES_FILE = DATA_DIR / "preferences.json"
+# Время рабочего графика: сервисы сравнивают его строками, поэтому только HH:MM
+TIME_PATTERN = r"^([01]\d|2[0-3]):[0-5]\d$"
+
+# Настройки нового пользователя
+DEFAULT_PREFERENCES = {
+    "important_contacts": [],
+    "ignored_senders": [],
+    "work_schedule": {
+        "days": ["Пн", "Вт", "Ср", "Чт", "Пт"],
+        "start_time": "10:00",
+        "end_time": "18:00"
+    },
+    "response_templates": {
+        "accept": "Спасибо за предложение! Я подтверждаю встречу.",
+        "decline": "К сожалению, в это время я занят."
+    }
+}
 
 def load_users():
     """Загрузка пользователей из файла"""
@@ -32,6 +51,50 @@ def save_users(users):
     with open(USERS_FILE, "w", encoding="utf-8") as f:
         json.dump(users, f, ensure_ascii=False, indent=2)
 
+def load_preferences():
+    """Загрузка настроек пользователей из файла"""
+    if PREFERENCES_FILE.exists():
+        with open(PREFERENCES_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    return {}
+
+def save_preferences(preferences):
+    """Сохранение настроек пользователей в файл.
+
+    Пишется временный файл и подменяет прежний: сбой посреди записи
+    не оставляет испорченный файл.
+    """
+    temp_file = PREFERENCES_FILE.with_suffix(".json.tmp")
+    with open(temp_file, "w", encoding="utf-8") as f:
+        json.dump(preferences, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_file, PREFERENCES_FILE)
+
+def user_preferences(preferences: dict, user_id: str) -> dict:
+    """Настройки пользователя поверх значений по умолчанию, с номером версии"""
+    stored = preferences.get(user_id, {})
+    result = {key: stored.get(key, value) for key, value in DEFAULT_PREFERENCES.items()}
+    result["version"] = stored.get("version", 0)
+    return result
+
+def apply_preferences_update(user_id: str, changes: dict) -> dict:
+    """Изменение настроек пользователя с новым номером версии"""
+    preferences = load_preferences()
+    prefs = user_preferences(preferences, user_id)
+    prefs.update(changes)
+    prefs["version"] += 1
+    prefs["updated_at"] = datetime.utcnow().isoformat()
+    preferences[user_id] = prefs
+    save_preferences(preferences)
+    return user_preferences(preferences, user_id)
+
+def preferences_etag(prefs: dict) -> str:
+    return f'"{prefs["version"]}"'
+
+# Изменения настроек идут по одному: иначе одно из двух одновременных потеряется
+preferences_lock = asyncio.Lock()
+
 class UserRegister(BaseModel):
     email: EmailStr
     password: str
@@ -41,6 +104,17 @@ class UserLogin(BaseModel):
     email: EmailStr
     password: str
 
+class WorkSchedule(BaseModel):
+    days: List[str]
+    start_time: str = Field(pattern=TIME_PATTERN)  # HH:MM
+    end_time: str = Field(pattern=TIME_PATTERN)  # HH:MM
+
+class PreferencesUpdate(BaseModel):
+    important_contacts: Optional[List[str]] = None
+    ignored_senders: Optional[List[str]] = None
+    work_schedule: Optional[WorkSchedule] = None
+    response_templates: Optional[Dict[str, str]] = None
+
 def create_token(user_id: str, email: str) -> str:
     """Создание JWT токена"""
     expiration = datetime.utcnow() + timedelta(hours=JWT_EXPIRATION_HOURS)
@@ -140,6 +214,45 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         "name": user["name"]
     }
 
+@app.get("/preferences")
+async def get_preferences(
+    response: Response,
+    if_none_match: Optional[str] = Header(None),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Получение настроек пользователя.
+
+    Сервисы кэшируют настройки и перепроверяют их по ETag: пока версия не менялась,
+    ответ 304 без тела.
+    """
+    payload = verify_token(credentials.credentials)
+    prefs = user_preferences(await asyncio.to_thread(load_preferences), str(payload.get("user_id")))
+    etag = preferences_etag(prefs)
+    
+    if if_none_match == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    response.headers["ETag"] = etag
+    return prefs
+
+@app.put("/preferences")
+async def update_preferences(
+    update: PreferencesUpdate,
+    response: Response,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Обновление настроек пользователя (передаются только изменяемые поля)"""
+    payload = verify_token(credentials.credentials)
+    user_id = str(payload.get("user_id"))
+    
+    async with preferences_lock:
+        prefs = await asyncio.to_thread(
+            apply_preferences_update, user_id, update.model_dump(exclude_none=True)
+        )
+    
+    response.headers["ETag"] = preferences_etag(prefs)
+    return prefs
+
 @app.get("/health")
 async def health():
     """Проверка здоровья сервиса"""
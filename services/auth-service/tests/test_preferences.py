@@ -0,0 +1,84 @@
+"""Настройки пользователя: версии и ETag, одновременные изменения, надежная запись"""
+import asyncio
+import json
+import uuid
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+
+def auth_headers(service):
+    user_id = uuid.uuid4().hex
+    return {"Authorization": f"Bearer {service.create_token(user_id, f'{user_id}@example.com')}"}
+
+
+def test_get_put_and_not_modified(service):
+    headers = auth_headers(service)
+    with TestClient(service.app) as client:
+        initial = client.get("/preferences", headers=headers)
+        assert initial.json()["version"] == 0
+        assert initial.json()["work_schedule"] == service.DEFAULT_PREFERENCES["work_schedule"]
+
+        updated = client.put("/preferences", headers=headers, json={"ignored_senders": ["spam@example.com"]})
+        assert updated.json()["version"] == 1
+        assert updated.headers["etag"] == '"1"'
+
+        cached = client.get("/preferences", headers={**headers, "If-None-Match": '"1"'})
+        assert cached.status_code == 304
+        assert cached.headers["etag"] == '"1"'
+
+        stale = client.get("/preferences", headers={**headers, "If-None-Match": '"0"'})
+        assert stale.status_code == 200
+        assert stale.json()["ignored_senders"] == ["spam@example.com"]
+        assert stale.json()["important_contacts"] == []
+
+
+@pytest.mark.parametrize("start_time", ["9:00", "24:00", "10:60", "10-00", ""])
+def test_schedule_time_must_be_hh_mm(service, start_time):
+    with TestClient(service.app) as client:
+        response = client.put("/preferences", headers=auth_headers(service), json={
+            "work_schedule": {"days": ["Пн"], "start_time": start_time, "end_time": "18:00"}
+        })
+    assert response.status_code == 422
+
+
+def test_concurrent_updates_are_not_lost(service):
+    headers = auth_headers(service)
+
+    async def run():
+        transport = httpx.ASGITransport(app=service.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://auth") as client:
+            responses = await asyncio.gather(*(
+                client.put("/preferences", headers=headers, json={"response_templates": {"accept": f"Да {index}"}})
+                for index in range(10)
+            ), client.put("/preferences", headers=headers, json={"ignored_senders": ["spam@example.com"]}))
+            final = await client.get("/preferences", headers=headers)
+        return responses, final.json()
+
+    responses, final = asyncio.run(run())
+
+    assert sorted(response.json()["version"] for response in responses) == list(range(1, 12))
+    assert len({response.headers["etag"] for response in responses}) == 11
+    assert final["version"] == 11
+    assert final["ignored_senders"] == ["spam@example.com"]
+
+
+def test_failed_write_keeps_previous_file(service, monkeypatch):
+    headers = auth_headers(service)
+    with TestClient(service.app) as client:
+        client.put("/preferences", headers=headers, json={"ignored_senders": ["a@example.com"]})
+        saved = service.PREFERENCES_FILE.read_text(encoding="utf-8")
+
+        def broken_dump(data, file, **kwargs):
+            file.write('{"partial": ')
+            raise OSError("No space left on device")
+
+        monkeypatch.setattr(service.json, "dump", broken_dump)
+        with pytest.raises(OSError):
+            client.put("/preferences", headers=headers, json={"ignored_senders": ["b@example.com"]})
+        monkeypatch.undo()
+
+        assert service.PREFERENCES_FILE.read_text(encoding="utf-8") == saved
+        assert json.loads(saved)
+        assert client.get("/preferences", headers=headers).json()["ignored_senders"] == ["a@example.com"]
@@ -1,23 +1,70 @@
-from fastapi import FastAPI, HTTPException, Depends, Header, Query
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from datetime import datetime, timedelta
-from typing import Optional, List
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional, List, Dict, Tuple, AsyncIterator
+from pathlib import Path
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+import asyncio
+import base64
+import random
+import sys
 import httpx
+import jwt
+import logging
 import os
 import json
+import re
 from urllib.parse import urlencode
 
+# Общий код сервисов: в образе лежит рядом с main.py, в репозитории - в services/shared
+sys.path.append(str(Path(__file__).resolve().parent.parent / "shared"))
+from preferences import DEFAULT_PREFERENCES, PREFERENCES_CACHE_TTL, PreferencesCache, within_work_schedule
+from token_store import TokenStore
+
 app = FastAPI(title="Calendar Service")
 
+logger = logging.getLogger("calendar-service")
+
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 CLIENT_ID = os.getenv("YANDEX_CALENDAR_CLIENT_ID")
 CLIENT_SECRET = os.getenv("YANDEX_CALENDAR_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("YANDEX_CALENDAR_REDIRECT_URI", "http://localhost:8000/auth/yandex/callback")
 
-# Хранилище токенов (в продакшене использовать БД)
-tokens_storage = {}
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+
+DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+TOKENS_DB = DATA_DIR / "tokens.db"
+# Сколько секунд токен живет в кэше процесса до перечитывания из БД
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "30"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+OAUTH_STATE_TTL_MINUTES = 10
+
+# Фоновое обновление токенов: период прохода, размер пакета и аренда обновления
+TOKEN_REFRESH_INTERVAL = float(os.getenv("TOKEN_REFRESH_INTERVAL", "60"))
+TOKEN_REFRESH_BATCH = 50
+TOKEN_REFRESH_LEASE = 120
+# Размер окна (в днях), которым события читаются из Яндекса при потоковой выгрузке
+EVENTS_STREAM_WINDOW_DAYS = int(os.getenv("EVENTS_STREAM_WINDOW_DAYS", "7"))
+# Пакетные операции: максимальный размер пакета и число параллельных запросов к Яндексу
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "500"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "10"))
+# Импорт .ics: сколько событий создавать за один пакет и сколько ошибок возвращать
+IMPORT_BATCH_SIZE = int(os.getenv("IMPORT_BATCH_SIZE", "100"))
+MAX_IMPORT_ERRORS = 50
+FREE_SLOTS_LIMIT = 5
+
+# Хранилище токенов
+token_store = TokenStore(TOKENS_DB, TOKEN_CACHE_TTL)
+
+# Кэш пользовательских настроек
+preferences_cache = PreferencesCache(PREFERENCES_CACHE_TTL)
 
 class EventCreate(BaseModel):
     summary: str
@@ -26,16 +73,128 @@ class EventCreate(BaseModel):
     end: str  # ISO format
     attendees: Optional[List[str]] = []
 
-def get_user_token(user_id: str) -> Optional[str]:
+class EventBatchCreate(BaseModel):
+    events: List[EventCreate] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+
+class EventBatchDelete(BaseModel):
+    event_ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+
+def get_user_id(credentials: HTTPAuthorizationCredentials) -> str:
+    """Получение user_id из JWT токена"""
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user_id = payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return str(user_id)
+
+def create_oauth_state(user_id: str) -> str:
+    """Подписанный state для OAuth, связывающий Яндекс аккаунт с пользователем"""
+    payload = {
+        "sub": user_id,
+        "purpose": "oauth_state",
+        "exp": datetime.utcnow() + timedelta(minutes=OAUTH_STATE_TTL_MINUTES)
+    }
+    return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+def parse_oauth_state(state: Optional[str]) -> Optional[str]:
+    """Извлечение user_id из state, если он был выдан этим сервисом"""
+    if not state:
+        return None
+    try:
+        payload = jwt.decode(state, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    if payload.get("purpose") != "oauth_state":
+        return None
+    return payload.get("sub")
+
+async def get_user_token(user_id: str) -> Optional[str]:
     """Получение токена пользователя"""
-    return tokens_storage.get(user_id)
+    return await token_store.get(user_id)
 
-def save_user_token(user_id: str, token: str):
+async def save_user_token(user_id: str, token: str, refresh_token: Optional[str] = None,
+                          expires_in: Optional[int] = None):
     """Сохранение токена пользователя"""
-    tokens_storage[user_id] = token
+    await token_store.set(user_id, token, refresh_token, expires_in)
+
+async def refresh_user_token(client: httpx.AsyncClient, user_id: str, refresh_token: str):
+    """Обновление access_token по refresh_token"""
+    if not await token_store.claim_refresh(user_id, TOKEN_REFRESH_LEASE):
+        # Токен уже обновляет другой воркер или реплика
+        return
+    
+    try:
+        response = await client.post(
+            "https://oauth.yandex.ru/token",
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET
+            }
+        )
+    except httpx.RequestError:
+        await token_store.postpone_refresh(user_id)
+        return
+    
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        # invalid_grant и т.п.: повтор с тем же refresh_token бесполезен до нового входа
+        await token_store.drop_refresh(user_id)
+        return
+    
+    try:
+        token_data = response.json() if response.status_code == 200 else {}
+    except ValueError:
+        token_data = {}
+    if not isinstance(token_data, dict) or not token_data.get("access_token"):
+        await token_store.postpone_refresh(user_id)
+        return
+    
+    await save_user_token(
+        user_id,
+        token_data.get("access_token"),
+        token_data.get("refresh_token"),
+        token_data.get("expires_in")
+    )
+
+async def token_refresh_loop():
+    """Фоновое обновление токенов до истечения их срока"""
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        while True:
+            try:
+                due = await token_store.due_for_refresh(TOKEN_REFRESH_BATCH)
+                results = await asyncio.gather(
+                    *(refresh_user_token(client, user_id, refresh_token) for user_id, refresh_token in due),
+                    return_exceptions=True
+                )
+                for (user_id, _), result in zip(due, results):
+                    if isinstance(result, Exception):
+                        logger.error("Token refresh failed for user %s", user_id, exc_info=result)
+            except Exception:
+                logger.exception("Token refresh pass failed")
+            await asyncio.sleep(TOKEN_REFRESH_INTERVAL + random.uniform(0, TOKEN_REFRESH_INTERVAL / 2))
+
+@app.on_event("startup")
+async def start_token_refresh():
+    """Запуск планировщика обновления токенов"""
+    if CLIENT_ID and CLIENT_SECRET:
+        app.state.token_refresh_task = asyncio.create_task(token_refresh_loop())
+
+@app.on_event("shutdown")
+async def stop_token_refresh():
+    """Остановка планировщика обновления токенов"""
+    task = getattr(app.state, "token_refresh_task", None)
+    if task:
+        task.cancel()
 
 @app.get("/oauth/authorize")
-async def authorize():
+async def authorize(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
     """Получение URL для авторизации"""
     if not CLIENT_ID:
         raise HTTPException(status_code=500, detail="Yandex Calendar API not configured")
@@ -46,6 +205,9 @@ async def authorize():
         "redirect_uri": REDIRECT_URI,
         "scope": "calendar:read calendar:write"
     }
+    if credentials:
+        # Привязываем будущий токен Яндекса к пользователю из JWT
+        params["state"] = create_oauth_state(get_user_id(credentials))
     auth_url = f"https://oauth.yandex.ru/authorize?{urlencode(params)}"
     
     return {"auth_url": auth_url}
@@ -73,6 +235,8 @@ async def callback(code: str, state: Optional[str] = None):
         
         token_data = response.json()
         access_token = token_data.get("access_token")
+        refresh_token = token_data.get("refresh_token")
+        expires_in = token_data.get("expires_in")
         
         # Получение информации о пользователе
         user_info_response = await client.get(
@@ -82,10 +246,10 @@ async def callback(code: str, state: Optional[str] = None):
         
         if user_info_response.status_code == 200:
             user_info = user_info_response.json()
-            user_id = user_info.get("id")
+            user_id = parse_oauth_state(state) or str(user_info.get("id"))
             
             # Сохранение токена
-            save_user_token(user_id, access_token)
+            await save_user_token(user_id, access_token, refresh_token, expires_in)
             
             return {
                 "access_token": access_token,
@@ -102,13 +266,9 @@ async def get_events(
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """Получение списка событий"""
-    token = credentials.credentials
-    
-    # Получение user_id из токена (упрощенная версия)
-    # В реальности нужно декодировать JWT и получить user_id
-    user_id = "default"  # Заглушка
+    user_id = get_user_id(credentials)
     
-    yandex_token = get_user_token(user_id)
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
         # Если нет токена Яндекс, возвращаем заглушку
         return {
@@ -166,16 +326,205 @@ async def get_events(
                 ]
             }
 
+def parse_iso(value: str) -> datetime:
+    """Разбор ISO даты; даты без часового пояса считаются UTC"""
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed
+
+def encode_cursor(window_start: datetime, after: Tuple[float, str]) -> str:
+    """Курсор потока событий: начало окна и ключ последнего отданного события в нем"""
+    raw = json.dumps({"from": window_start.isoformat(), "after": list(after)})
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[datetime, Tuple[float, str]]:
+    """Разбор курсора потока событий"""
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        after_start, after_id = data["after"]
+        return parse_iso(data["from"]), (float(after_start), str(after_id))
+    except (ValueError, KeyError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def event_start(event: Dict) -> Optional[datetime]:
+    """Время начала события, если его удается разобрать"""
+    start = event.get("start")
+    if isinstance(start, dict):
+        start = start.get("dateTime") or start.get("date")
+    if not isinstance(start, str):
+        return None
+    try:
+        return parse_iso(start)
+    except ValueError:
+        return None
+
+def event_key(event: Dict) -> Tuple[float, str]:
+    """Ключ порядка событий в окне: время начала и идентификатор.
+
+    Курсор хранит ключ, а не номер события, поэтому события, добавленные
+    или удаленные в окне между страницами, не сдвигают продолжение.
+    """
+    started = event_start(event)
+    return started.timestamp() if started else float("-inf"), str(event.get("id") or "")
+
+class UpstreamError(Exception):
+    """Ошибка Яндекс Календаря посреди потока"""
+
+async def iter_event_windows(
+    yandex_token: str, start: datetime, end: datetime, resume_from: Optional[datetime] = None
+) -> AsyncIterator[Tuple[datetime, List[Dict]]]:
+    """Постраничное чтение событий из Яндекс Календаря окнами по несколько дней"""
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        window_start = resume_from or start
+        while window_start < end:
+            window_end = min(window_start + timedelta(days=EVENTS_STREAM_WINDOW_DAYS), end)
+            try:
+                response = await client.get(
+                    "https://calendar.yandex.ru/api/v1/events",
+                    headers={"Authorization": f"OAuth {yandex_token}"},
+                    params={"from": window_start.isoformat(), "to": window_end.isoformat()}
+                )
+            except httpx.RequestError as e:
+                raise UpstreamError(str(e))
+            if response.status_code != 200:
+                raise UpstreamError(f"Yandex Calendar returned {response.status_code}")
+            
+            try:
+                events = response.json().get("events", [])
+            except (ValueError, AttributeError):
+                raise UpstreamError("Yandex Calendar returned invalid JSON")
+            # Событие, пересекающее границу окон, отдаем только в окне его начала,
+            # а начавшиеся до периода выгрузки - только в первом окне
+            window_events = []
+            for event in events:
+                started = event_start(event)
+                if (
+                    started is None
+                    or window_start <= started < window_end
+                    or (started < start and window_start == start)
+                ):
+                    window_events.append(event)
+            window_events.sort(key=event_key)
+            yield window_start, window_events
+            window_start = window_end
+
+async def iter_events(
+    windows: AsyncIterator[Tuple[datetime, List[Dict]]], after: Optional[Tuple[float, str]]
+) -> AsyncIterator[Tuple[Dict, str]]:
+    """События по одному вместе с курсором для продолжения после каждого из них.
+
+    В первом окне пропускаются события с ключом не больше after (уже отданные).
+    """
+    async for window_start, events in windows:
+        for event in events:
+            key = event_key(event)
+            if after is None or key > after:
+                yield event, encode_cursor(window_start, key)
+        after = None
+
+async def iter_stub_events(after: Optional[Tuple[float, str]] = None) -> AsyncIterator[Tuple[Dict, str]]:
+    """Заглушка потока, если нет токена Яндекс.
+
+    Курсор учитывается так же, как в настоящем потоке: после примера событий нет.
+    """
+    event = {
+        "id": "1",
+        "summary": "Пример встречи",
+        "start": "2024-01-15T10:00:00",
+        "end": "2024-01-15T11:00:00",
+        "description": "Это пример события из календаря"
+    }
+    key = event_key(event)
+    if after is None or key > after:
+        yield event, encode_cursor(datetime(2024, 1, 15, tzinfo=timezone.utc), key)
+
+async def render_ndjson(events: AsyncIterator[Tuple[Dict, str]], limit: Optional[int]) -> AsyncIterator[bytes]:
+    """Поток событий в формате NDJSON: одно событие на строку"""
+    count = 0
+    cursor = None
+    try:
+        async for event, cursor in events:
+            yield json.dumps(event, ensure_ascii=False).encode() + b"\n"
+            count += 1
+            if limit and count >= limit:
+                yield json.dumps({"next_cursor": cursor}).encode() + b"\n"
+                return
+    except UpstreamError as e:
+        yield json.dumps({"error": str(e), "next_cursor": cursor}, ensure_ascii=False).encode() + b"\n"
+
+async def render_json(events: AsyncIterator[Tuple[Dict, str]], limit: Optional[int]) -> AsyncIterator[bytes]:
+    """Поток событий одним JSON документом, отдаваемым по частям"""
+    yield b'{"events": ['
+    count = 0
+    cursor = None
+    next_cursor = None
+    error = None
+    try:
+        async for event, cursor in events:
+            if count:
+                yield b","
+            yield json.dumps(event, ensure_ascii=False).encode()
+            count += 1
+            if limit and count >= limit:
+                next_cursor = cursor
+                break
+    except UpstreamError as e:
+        next_cursor, error = cursor, str(e)
+    tail = f'], "next_cursor": {json.dumps(next_cursor)}'
+    if error:
+        tail += f', "error": {json.dumps(error, ensure_ascii=False)}'
+    yield (tail + "}").encode()
+
+@app.get("/events/stream")
+async def stream_events(
+    start_date: str = Query(...),
+    end_date: str = Query(...),
+    format: str = Query("ndjson", pattern="^(ndjson|json)$"),
+    cursor: Optional[str] = Query(None),
+    limit: Optional[int] = Query(None, ge=1),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Потоковая выгрузка событий за большой период с курсорной пагинацией"""
+    user_id = get_user_id(credentials)
+    
+    try:
+        start, end = parse_iso(start_date), parse_iso(end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    resume_from, after = decode_cursor(cursor) if cursor else (None, None)
+    
+    yandex_token = await get_user_token(user_id)
+    if not yandex_token:
+        events = iter_stub_events(after)
+    else:
+        events = iter_events(iter_event_windows(yandex_token, start, end, resume_from), after)
+    
+    if format == "json":
+        return StreamingResponse(render_json(events, limit), media_type="application/json")
+    return StreamingResponse(render_ndjson(events, limit), media_type="application/x-ndjson")
+
+def event_payload(event: EventCreate) -> Dict:
+    """Тело запроса на создание события в Яндекс Календаре"""
+    event_data = {
+        "summary": event.summary,
+        "description": event.description or "",
+        "start": event.start,
+        "end": event.end
+    }
+    if event.attendees:
+        event_data["attendees"] = event.attendees
+    return event_data
+
 @app.post("/events")
 async def create_event(
     event: EventCreate,
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """Создание нового события"""
-    token = credentials.credentials
-    user_id = "default"
+    user_id = get_user_id(credentials)
     
-    yandex_token = get_user_token(user_id)
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
         # Заглушка
         return {
@@ -186,15 +535,7 @@ async def create_event(
             "status": "created"
         }
     
-    event_data = {
-        "summary": event.summary,
-        "description": event.description or "",
-        "start": event.start,
-        "end": event.end
-    }
-    
-    if event.attendees:
-        event_data["attendees"] = event.attendees
+    event_data = event_payload(event)
     
     async with httpx.AsyncClient() as client:
         try:
@@ -225,16 +566,370 @@ async def create_event(
                 "status": "created"
             }
 
+async def run_batch(items: List, action) -> List[Dict]:
+    """Выполнение операций над элементами пакета с ограничением параллельности.
+
+    Ошибка одного элемента не прерывает остальные, результаты идут в порядке элементов.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    
+    async def run_one(index: int, item) -> Dict:
+        async with semaphore:
+            try:
+                result = await action(item)
+            except Exception as e:
+                # Сетевые сбои, битый JSON в ответе и прочее - в результат этого элемента
+                result = {"status": "error", "error": str(e) or type(e).__name__}
+        return {"index": index, **result}
+    
+    return await asyncio.gather(*(run_one(index, item) for index, item in enumerate(items)))
+
+async def create_events(yandex_token: str, events: List[EventCreate]) -> List[Dict]:
+    """Создание пакета событий в Яндекс Календаре"""
+    limits = httpx.Limits(max_connections=BATCH_CONCURRENCY)
+    async with httpx.AsyncClient(timeout=30.0, limits=limits) as client:
+        async def create_one(event: EventCreate) -> Dict:
+            response = await client.post(
+                "https://calendar.yandex.ru/api/v1/events",
+                headers={"Authorization": f"OAuth {yandex_token}"},
+                json=event_payload(event)
+            )
+            if response.status_code in [200, 201]:
+                return {"status": "created", "event": response.json()}
+            return {"status": "error", "error": f"Yandex Calendar returned {response.status_code}"}
+        
+        return await run_batch(events, create_one)
+
+@app.post("/events/batch")
+async def create_events_batch(
+    batch: EventBatchCreate,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Пакетное создание событий"""
+    user_id = get_user_id(credentials)
+    
+    yandex_token = await get_user_token(user_id)
+    if not yandex_token:
+        # Заглушка
+        results = [
+            {
+                "index": index,
+                "status": "created",
+                "event": {"id": f"new_event_{index + 1}", "summary": event.summary,
+                          "start": event.start, "end": event.end}
+            }
+            for index, event in enumerate(batch.events)
+        ]
+        return {"results": results, "created": len(results), "failed": 0}
+    
+    results = await create_events(yandex_token, batch.events)
+    created = sum(1 for result in results if result["status"] == "created")
+    return {"results": results, "created": created, "failed": len(results) - created}
+
+@app.delete("/events/batch")
+async def delete_events_batch(
+    batch: EventBatchDelete,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Пакетное удаление событий"""
+    user_id = get_user_id(credentials)
+    
+    yandex_token = await get_user_token(user_id)
+    if not yandex_token:
+        results = [
+            {"index": index, "status": "deleted", "event_id": event_id}
+            for index, event_id in enumerate(batch.event_ids)
+        ]
+        return {"results": results, "deleted": len(results), "failed": 0}
+    
+    limits = httpx.Limits(max_connections=BATCH_CONCURRENCY)
+    async with httpx.AsyncClient(timeout=30.0, limits=limits) as client:
+        async def delete_one(event_id: str) -> Dict:
+            response = await client.delete(
+                f"https://calendar.yandex.ru/api/v1/events/{event_id}",
+                headers={"Authorization": f"OAuth {yandex_token}"}
+            )
+            # Уже удаленное событие считаем успешно удаленным
+            if response.status_code in [200, 204, 404]:
+                return {"status": "deleted", "event_id": event_id}
+            return {
+                "status": "error",
+                "event_id": event_id,
+                "error": f"Yandex Calendar returned {response.status_code}"
+            }
+        
+        results = await run_batch(batch.event_ids, delete_one)
+    
+    deleted = sum(1 for result in results if result["status"] == "deleted")
+    return {"results": results, "deleted": deleted, "failed": len(results) - deleted}
+
+def ics_unescape(value: str) -> str:
+    """Снятие экранирования текстовых значений iCalendar"""
+    return re.sub(r"\\([\\;,nN])", lambda m: "\n" if m.group(1) in "nN" else m.group(1), value)
+
+def ics_escape(value: str) -> str:
+    """Экранирование текстовых значений iCalendar"""
+    return (
+        value.replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,")
+        .replace("\r\n", "\\n").replace("\n", "\\n")
+    )
+
+@lru_cache(maxsize=256)
+def ics_zone(tzid: str) -> Optional[ZoneInfo]:
+    """Часовой пояс по TZID; None для неизвестных (например, имен поясов Windows)"""
+    try:
+        return ZoneInfo(tzid.strip('"'))
+    except (ZoneInfoNotFoundError, ValueError):
+        return None
+
+def ics_parse_datetime(value: str, params: Dict[str, str]) -> Tuple[str, bool]:
+    """Перевод DTSTART/DTEND в ISO формат; второй элемент - признак события на весь день.
+
+    Время с TZID переводится в UTC; время без пояса (или с неизвестным TZID)
+    остается локальным, как в файле.
+    """
+    # Разбор вручную: strptime на сотнях тысяч событий заметно медленнее
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        return date(int(value[0:4]), int(value[4:6]), int(value[6:8])).isoformat(), True
+    if len(value) < 15 or value[8] != "T":
+        raise ValueError(f"Invalid iCalendar date-time: {value}")
+    zone = ics_zone(params["TZID"]) if "TZID" in params and not value.endswith("Z") else None
+    parsed = datetime(
+        int(value[0:4]), int(value[4:6]), int(value[6:8]),
+        int(value[9:11]), int(value[11:13]), int(value[13:15]),
+        tzinfo=timezone.utc if value.endswith("Z") else zone
+    )
+    if zone is not None:
+        parsed = parsed.astimezone(timezone.utc)
+    return parsed.isoformat(), False
+
+def ics_format_datetime(value) -> Optional[str]:
+    """Перевод времени события в формат iCalendar"""
+    if isinstance(value, dict):
+        value = value.get("dateTime") or value.get("date")
+    if not isinstance(value, str):
+        return None
+    if len(value) == 10:
+        return ";VALUE=DATE:" + value.replace("-", "")
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        return ":" + parsed.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    return ":" + parsed.strftime("%Y%m%dT%H%M%S")
+
+def ics_fold(line: str) -> bytes:
+    """Перенос строки iCalendar по 75 октетов без разрыва символов UTF-8"""
+    data = line.encode()
+    if len(data) <= 75:
+        return data + b"\r\n"
+    parts = []
+    start = 0
+    limit = 75
+    while start < len(data):
+        end = min(start + limit, len(data))
+        # Не режем многобайтовый символ: байты продолжения имеют вид 10xxxxxx
+        while end < len(data) and data[end] & 0xC0 == 0x80:
+            end -= 1
+        parts.append(data[start:end])
+        start = end
+        limit = 74  # после переноса строка начинается с пробела
+    return b"\r\n ".join(parts) + b"\r\n"
+
+class ICSParser:
+    """Потоковый разбор iCalendar: принимает байты по частям и отдает готовые VEVENT.
+
+    В памяти держится только незавершенная строка и текущее событие.
+    """
+
+    def __init__(self):
+        self._buffer = b""
+        self._pending: Optional[str] = None
+        self._event: Optional[Dict] = None
+        self.skipped = 0
+
+    def feed(self, chunk: bytes) -> List[EventCreate]:
+        self._buffer += chunk
+        *lines, self._buffer = self._buffer.split(b"\n")
+        return self._consume(lines)
+
+    def close(self) -> List[EventCreate]:
+        lines, self._buffer = [self._buffer], b""
+        events = self._consume(lines)
+        if self._pending is not None:
+            events.extend(self._handle_line(self._pending))
+            self._pending = None
+        return events
+
+    def _consume(self, raw_lines: List[bytes]) -> List[EventCreate]:
+        events = []
+        for raw in raw_lines:
+            line = raw.rstrip(b"\r").decode("utf-8", errors="replace")
+            if line[:1] in (" ", "\t"):
+                # Продолжение свернутой строки
+                if self._pending is not None:
+                    self._pending += line[1:]
+                continue
+            if self._pending is not None:
+                events.extend(self._handle_line(self._pending))
+            self._pending = line or None
+        return events
+
+    def _handle_line(self, line: str) -> List[EventCreate]:
+        head, _, value = line.partition(":")
+        name, *raw_params = head.split(";")
+        name = name.upper()
+        
+        if name == "BEGIN" and value.upper() == "VEVENT":
+            self._event = {"attendees": []}
+            return []
+        if self._event is None:
+            return []
+        if name == "END" and value.upper() == "VEVENT":
+            event, self._event = self._event, None
+            built = self._build(event)
+            if built is None:
+                self.skipped += 1
+                return []
+            return [built]
+        
+        params = {}
+        for param in raw_params:
+            key, _, param_value = param.partition("=")
+            params[key.upper()] = param_value
+        if name in ("SUMMARY", "DESCRIPTION"):
+            self._event[name.lower()] = ics_unescape(value)
+        elif name in ("DTSTART", "DTEND"):
+            self._event[name.lower()] = (value, params)
+        elif name == "ATTENDEE":
+            self._event["attendees"].append(re.sub(r"^mailto:", "", value, flags=re.IGNORECASE))
+        return []
+
+    def _build(self, event: Dict) -> Optional[EventCreate]:
+        if "dtstart" not in event:
+            return None
+        try:
+            start, all_day = ics_parse_datetime(*event["dtstart"])
+            if "dtend" in event:
+                end, _ = ics_parse_datetime(*event["dtend"])
+            else:
+                step = timedelta(days=1) if all_day else timedelta(hours=1)
+                end = (datetime.fromisoformat(start) + step).isoformat()
+                if all_day:
+                    end = end[:10]
+        except ValueError:
+            return None
+        return EventCreate(
+            summary=event.get("summary") or "Без темы",
+            description=event.get("description"),
+            start=start,
+            end=end,
+            attendees=event["attendees"]
+        )
+
+async def render_ics(events: AsyncIterator[Tuple[Dict, str]]) -> AsyncIterator[bytes]:
+    """Поток событий в формате iCalendar"""
+    yield b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//ALHA//Calendar Service//RU\r\n"
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    # Ошибка Яндекса посреди выгрузки обрывает ответ, чтобы не отдать неполный календарь как целый
+    async for event, _ in events:
+        start = ics_format_datetime(event.get("start"))
+        if start is None:
+            continue
+        lines = ["BEGIN:VEVENT", f"UID:{event.get('id')}", f"DTSTAMP:{stamp}", f"DTSTART{start}"]
+        end = ics_format_datetime(event.get("end"))
+        if end:
+            lines.append(f"DTEND{end}")
+        lines.append(f"SUMMARY:{ics_escape(event.get('summary') or '')}")
+        if event.get("description"):
+            lines.append(f"DESCRIPTION:{ics_escape(event['description'])}")
+        for attendee in event.get("attendees") or []:
+            email = attendee.get("email") if isinstance(attendee, dict) else attendee
+            if email:
+                lines.append(f"ATTENDEE:mailto:{email}")
+        lines.append("END:VEVENT")
+        yield b"".join(ics_fold(line) for line in lines)
+    yield b"END:VCALENDAR\r\n"
+
+@app.post("/events/import")
+async def import_events(
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Импорт событий из .ics файла (тело запроса - text/calendar).
+
+    Файл разбирается по мере получения и создается пакетами через пакетный путь.
+    """
+    user_id = get_user_id(credentials)
+    yandex_token = await get_user_token(user_id)
+    
+    parser = ICSParser()
+    imported = 0
+    failed = 0
+    errors = []
+    pending: List[EventCreate] = []
+    
+    async def flush(batch: List[EventCreate]):
+        nonlocal imported, failed
+        if not yandex_token:
+            # Заглушка: события считаются созданными
+            imported += len(batch)
+            return
+        for result in await create_events(yandex_token, batch):
+            if result["status"] == "created":
+                imported += 1
+            else:
+                failed += 1
+                if len(errors) < MAX_IMPORT_ERRORS:
+                    errors.append({"summary": batch[result["index"]].summary, "error": result["error"]})
+    
+    async for chunk in request.stream():
+        pending.extend(parser.feed(chunk))
+        while len(pending) >= IMPORT_BATCH_SIZE:
+            await flush(pending[:IMPORT_BATCH_SIZE])
+            pending = pending[IMPORT_BATCH_SIZE:]
+    pending.extend(parser.close())
+    if pending:
+        await flush(pending)
+    
+    return {"imported": imported, "failed": failed, "skipped": parser.skipped, "errors": errors}
+
+@app.get("/events/export.ics")
+async def export_events(
+    start_date: str = Query(...),
+    end_date: str = Query(...),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Потоковая выгрузка событий за период в формате iCalendar"""
+    user_id = get_user_id(credentials)
+    
+    try:
+        start, end = parse_iso(start_date), parse_iso(end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date format")
+    
+    yandex_token = await get_user_token(user_id)
+    if not yandex_token:
+        events = iter_stub_events()
+    else:
+        events = iter_events(iter_event_windows(yandex_token, start, end), None)
+    
+    return StreamingResponse(
+        render_ics(events),
+        media_type="text/calendar; charset=utf-8",
+        headers={"Content-Disposition": 'attachment; filename="calendar.ics"'}
+    )
+
 @app.delete("/events/{event_id}")
 async def delete_event(
     event_id: str,
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """Удаление события"""
-    token = credentials.credentials
-    user_id = "default"
+    user_id = get_user_id(credentials)
     
-    yandex_token = get_user_token(user_id)
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
         return {"status": "deleted", "event_id": event_id}
     
@@ -255,10 +950,9 @@ async def check_conflict(
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """Проверка конфликтов по времени"""
-    token = credentials.credentials
-    user_id = "default"
+    user_id = get_user_id(credentials)
     
-    yandex_token = get_user_token(user_id)
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
         return {"has_conflict": False}
     
@@ -280,6 +974,34 @@ async def check_conflict(
         except Exception:
             return {"has_conflict": False}
 
+def event_end(event: Dict) -> Optional[datetime]:
+    """Время окончания события, если его удается разобрать"""
+    return event_start({"start": event.get("end")})
+
+def as_utc(value: datetime) -> datetime:
+    """Время без часового пояса считается UTC (как в parse_iso)"""
+    return value if value.tzinfo else value.replace(tzinfo=timezone.utc)
+
+def find_free_slots(
+    start: datetime, end: datetime, duration_minutes: int, schedule: Dict,
+    busy: List[Tuple[datetime, datetime]], limit: int
+) -> List[Dict]:
+    """Свободные слоты с шагом в час в рабочем расписании, не пересекающиеся с занятыми интервалами"""
+    busy = sorted((as_utc(busy_start), as_utc(busy_end)) for busy_start, busy_end in busy)
+    slots = []
+    current = start
+    while current < end and len(slots) < limit:
+        slot_end = current + timedelta(minutes=duration_minutes)
+        if slot_end <= end and within_work_schedule(current, slot_end, schedule):
+            slot = (as_utc(current), as_utc(slot_end))
+            if not any(busy_start < slot[1] and slot[0] < busy_end for busy_start, busy_end in busy):
+                slots.append({
+                    "start": current.isoformat(),
+                    "end": slot_end.isoformat()
+                })
+        current += timedelta(hours=1)
+    return slots
+
 @app.get("/free-slots")
 async def get_free_slots(
     start_date: str = Query(...),
@@ -287,30 +1009,19 @@ async def get_free_slots(
     duration_minutes: int = Query(60),
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
-    """Получение свободных слотов"""
-    token = credentials.credentials
-    user_id = "default"
+    """Получение свободных слотов в рабочем расписании пользователя"""
+    user_id = get_user_id(credentials)
     
-    yandex_token = get_user_token(user_id)
+    prefs = await preferences_cache.get(user_id, credentials.credentials)
+    schedule = prefs.get("work_schedule", DEFAULT_PREFERENCES["work_schedule"])
+    current = datetime.fromisoformat(start_date.replace("Z", "+00:00"))
+    end = datetime.fromisoformat(end_date.replace("Z", "+00:00"))
+    
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
-        # Заглушка - возвращаем несколько слотов
-        slots = []
-        current = datetime.fromisoformat(start_date.replace("Z", "+00:00"))
-        end = datetime.fromisoformat(end_date.replace("Z", "+00:00"))
-        
-        while current < end:
-            if current.hour >= 10 and current.hour < 18:  # Рабочие часы
-                slot_end = current + timedelta(minutes=duration_minutes)
-                if slot_end <= end:
-                    slots.append({
-                        "start": current.isoformat(),
-                        "end": slot_end.isoformat()
-                    })
-            current += timedelta(hours=1)
-        
-        return {"free_slots": slots[:5]}  # Возвращаем первые 5
+        # Заглушка - календарь считается пустым
+        return {"free_slots": find_free_slots(current, end, duration_minutes, schedule, [], FREE_SLOTS_LIMIT)}
     
-    # Реальная логика получения свободных слотов
     async with httpx.AsyncClient() as client:
         try:
             response = await client.get(
@@ -321,9 +1032,12 @@ async def get_free_slots(
             
             if response.status_code == 200:
                 events = response.json().get("events", [])
-                # Логика вычисления свободных слотов
-                # Упрощенная версия
-                return {"free_slots": []}
+                busy = []
+                for event in events:
+                    busy_start, busy_end = event_start(event), event_end(event)
+                    if busy_start and busy_end:
+                        busy.append((busy_start, busy_end))
+                return {"free_slots": find_free_slots(current, end, duration_minutes, schedule, busy, FREE_SLOTS_LIMIT)}
             else:
                 return {"free_slots": []}
         except Exception:
@@ -336,5 +1050,5 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8002)
+    uvicorn.run("main:app", host="0.0.0.0", port=8002, workers=WORKERS)
 
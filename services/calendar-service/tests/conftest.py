@@ -0,0 +1,18 @@
+"""Фикстуры тестов calendar-service: сервис загружается с данными во временном каталоге"""
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def service(tmp_path_factory):
+    """Модуль main.py сервиса"""
+    os.environ["DATA_DIR"] = str(tmp_path_factory.mktemp("data"))
+    spec = importlib.util.spec_from_file_location("calendar_service_main", SERVICE_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,52 @@
+"""Пакетные операции: сбой одного элемента не ломает пакет"""
+import asyncio
+
+import httpx
+
+
+def test_run_batch_reports_any_error_per_item(service):
+    async def action(item):
+        if item == "bad-json":
+            raise ValueError("Expecting value: line 1 column 1 (char 0)")
+        if item == "bug":
+            raise KeyError("id")
+        if item == "network":
+            raise httpx.ConnectError("connection refused")
+        return {"status": "created", "item": item}
+
+    results = asyncio.run(service.run_batch(["ok", "bad-json", "bug", "network", "ok2"], action))
+
+    assert [r["index"] for r in results] == [0, 1, 2, 3, 4]
+    assert [r["status"] for r in results] == ["created", "error", "error", "error", "created"]
+    assert results[1]["error"].startswith("Expecting value")
+    assert results[2]["error"] == "'id'"
+    assert results[3]["error"] == "connection refused"
+
+
+def test_create_events_survives_malformed_response(service, monkeypatch):
+    def handler(request):
+        summary = request.read().decode()
+        if "broken" in summary:
+            return httpx.Response(201, content=b"<html>oops</html>")
+        if "down" in summary:
+            return httpx.Response(503)
+        return httpx.Response(201, json={"id": "evt"})
+
+    transport = httpx.MockTransport(handler)
+    real_client = httpx.AsyncClient
+
+    class Client(real_client):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, transport=transport, **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", Client)
+    events = [
+        service.EventCreate(summary=summary, start="2025-01-15T10:00:00", end="2025-01-15T11:00:00")
+        for summary in ["fine", "broken", "down"]
+    ]
+
+    results = asyncio.run(service.create_events("token", events))
+
+    assert [r["status"] for r in results] == ["created", "error", "error"]
+    assert results[0]["event"] == {"id": "evt"}
+    assert results[2]["error"] == "Yandex Calendar returned 503"
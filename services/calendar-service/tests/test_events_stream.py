@@ -0,0 +1,135 @@
+"""Потоковая выгрузка событий: окна, курсор и продолжение, ошибки Яндекс Календаря"""
+import json
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+START = datetime(2025, 1, 1, tzinfo=timezone.utc)
+
+
+class Yandex:
+    """Яндекс Календарь: события из self.events за запрошенный период"""
+
+    def __init__(self, events):
+        self.events = events
+        self.broken = False
+
+    def __call__(self, request):
+        if self.broken:
+            return httpx.Response(200, content=b"<html>maintenance</html>")
+        start = datetime.fromisoformat(request.url.params["from"])
+        end = datetime.fromisoformat(request.url.params["to"])
+        return httpx.Response(200, json={"events": [
+            event for event in self.events
+            if start <= datetime.fromisoformat(event["start"]) < end
+        ]})
+
+
+def make_event(event_id, day, hour=10):
+    start = START + timedelta(days=day, hours=hour)
+    return {"id": event_id, "summary": event_id, "start": start.isoformat(),
+            "end": (start + timedelta(hours=1)).isoformat()}
+
+
+@pytest.fixture
+def client(service, monkeypatch):
+    yandex = Yandex([make_event(f"e{day:02d}", day) for day in range(20)])
+    real_client = httpx.AsyncClient
+
+    class MockClient(real_client):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, transport=httpx.MockTransport(yandex), **kwargs)
+
+    async def get_user_token(user_id):
+        return "yandex-token"
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    monkeypatch.setattr(service, "get_user_token", get_user_token)
+    token = jwt.encode({"user_id": uuid.uuid4().hex}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+    with TestClient(service.app, headers={"Authorization": f"Bearer {token}"}) as client:
+        client.yandex = yandex
+        yield client
+
+
+def page(client, cursor=None, limit=4, format="ndjson"):
+    params = {"start_date": START.isoformat(), "end_date": (START + timedelta(days=20)).isoformat(),
+              "limit": limit, "format": format}
+    if cursor:
+        params["cursor"] = cursor
+    response = client.get("/events/stream", params=params)
+    assert response.status_code == 200
+    if format == "json":
+        return response.json()
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    events = [line["id"] for line in lines if "id" in line]
+    tail = lines[-1] if lines and "id" not in lines[-1] else {}
+    return events, tail
+
+
+def test_pages_cover_all_events_once(client):
+    seen, cursor = [], None
+    while True:
+        events, tail = page(client, cursor)
+        seen += events
+        cursor = tail.get("next_cursor")
+        if not cursor:
+            break
+
+    assert seen == [f"e{day:02d}" for day in range(20)]
+
+
+@pytest.mark.parametrize("change", ["insert", "delete"])
+def test_changes_between_pages_do_not_skip_or_repeat(client, change):
+    client.yandex.events.append(make_event("e00-late", 0, hour=20))
+    first, tail = page(client, limit=2)
+    assert first == ["e00", "e00-late"]
+
+    # Между страницами в уже отданной части окна добавили или удалили событие
+    if change == "insert":
+        client.yandex.events.insert(0, make_event("e00-early", 0, hour=8))
+    else:
+        client.yandex.events[:] = [event for event in client.yandex.events if event["id"] != "e00"]
+    second, _ = page(client, tail["next_cursor"], limit=3)
+
+    assert second == ["e01", "e02", "e03"]
+
+
+def test_invalid_json_from_yandex_ends_stream_with_error(client):
+    events, tail = page(client, limit=100)
+    assert len(events) == 20
+
+    client.yandex.broken = True
+    events, tail = page(client, limit=100)
+    assert events == []
+    assert tail == {"error": "Yandex Calendar returned invalid JSON", "next_cursor": None}
+
+    document = page(client, limit=100, format="json")
+    assert document == {"events": [], "next_cursor": None, "error": "Yandex Calendar returned invalid JSON"}
+
+
+def test_invalid_cursor(client):
+    response = client.get("/events/stream", params={
+        "start_date": START.isoformat(), "end_date": START.isoformat(), "cursor": "garbage"
+    })
+    assert response.status_code == 400
+
+
+def test_stub_stream_ends_after_its_cursor(service):
+    """Без токена Яндекса обход по next_cursor завершается, а не повторяет пример"""
+    token = jwt.encode({"user_id": f"user-{uuid.uuid4().hex}"}, service.JWT_SECRET_KEY,
+                       algorithm=service.JWT_ALGORITHM)
+    with TestClient(service.app, headers={"Authorization": f"Bearer {token}"}) as client:
+        seen, cursor = [], None
+        for _ in range(5):
+            events, tail = page(client, cursor, limit=1)
+            seen += events
+            cursor = tail.get("next_cursor")
+            if not cursor:
+                break
+
+    assert seen == ["1"]
+    assert cursor is None
@@ -0,0 +1,163 @@
+"""Импорт и выгрузка iCalendar: разбор времени, потоковый парсер, эндпоинты"""
+import tracemalloc
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+ZONED_CALENDAR = (
+    b"BEGIN:VCALENDAR\r\n"
+    b"VERSION:2.0\r\n"
+    b"BEGIN:VEVENT\r\n"
+    b"SUMMARY:\xd0\x9f\xd0\xbb\xd0\xb0\xd0\xbd\xd0\xb5\xd1\x80\xd0\xba\xd0\xb0\r\n"
+    b"DTSTART;TZID=Europe/Moscow:20250115T140000\r\n"
+    b"DTEND;TZID=\"Europe/Moscow\":20250115T150000\r\n"
+    b"ATTENDEE:mailto:ivan@example.com\r\n"
+    b"END:VEVENT\r\n"
+    b"BEGIN:VEVENT\r\n"
+    b"SUMMARY:Long summary that is folded\r\n"
+    b"  across two lines\r\n"
+    b"DTSTART:20250116T090000Z\r\n"
+    b"END:VEVENT\r\n"
+    b"BEGIN:VEVENT\r\n"
+    b"SUMMARY:Day off\r\n"
+    b"DTSTART;VALUE=DATE:20250117\r\n"
+    b"END:VEVENT\r\n"
+    b"BEGIN:VEVENT\r\n"
+    b"SUMMARY:Broken\r\n"
+    b"DTSTART:2025-01-18\r\n"
+    b"END:VEVENT\r\n"
+    b"END:VCALENDAR\r\n"
+)
+
+
+def auth_headers(service, user_id="ics-user"):
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.mark.parametrize("value, params, expected", [
+    ("20250115T140000", {"TZID": "Europe/Moscow"}, ("2025-01-15T11:00:00+00:00", False)),
+    ("20250715T140000", {"TZID": '"Europe/Berlin"'}, ("2025-07-15T12:00:00+00:00", False)),
+    ("20250115T140000Z", {}, ("2025-01-15T14:00:00+00:00", False)),
+    ("20250115T140000", {}, ("2025-01-15T14:00:00", False)),
+    ("20250115T140000", {"TZID": "Russian Standard Time"}, ("2025-01-15T14:00:00", False)),
+    ("20250115", {"VALUE": "DATE"}, ("2025-01-15", True)),
+])
+def test_parse_datetime(service, value, params, expected):
+    assert service.ics_parse_datetime(value, params) == expected
+
+
+def test_parse_datetime_rejects_garbage(service):
+    with pytest.raises(ValueError):
+        service.ics_parse_datetime("2025-01-15", {})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 64, len(ZONED_CALENDAR)])
+def test_parser_is_independent_of_chunking(service, chunk_size):
+    parser = service.ICSParser()
+    events = []
+    for offset in range(0, len(ZONED_CALENDAR), chunk_size):
+        events.extend(parser.feed(ZONED_CALENDAR[offset:offset + chunk_size]))
+    events.extend(parser.close())
+
+    assert [(e.summary, e.start, e.end) for e in events] == [
+        ("Планерка", "2025-01-15T11:00:00+00:00", "2025-01-15T12:00:00+00:00"),
+        ("Long summary that is folded across two lines", "2025-01-16T09:00:00+00:00", "2025-01-16T10:00:00+00:00"),
+        ("Day off", "2025-01-17", "2025-01-18"),
+    ]
+    assert events[0].attendees == ["ivan@example.com"]
+    assert parser.skipped == 1
+
+
+def test_import_converts_zoned_events_to_utc(service, monkeypatch):
+    created = []
+
+    async def fake_token(user_id):
+        return "yandex-token"
+
+    async def fake_create(yandex_token, events):
+        created.extend(events)
+        return [{"index": i, "status": "created"} for i in range(len(events))]
+
+    monkeypatch.setattr(service, "get_user_token", fake_token)
+    monkeypatch.setattr(service, "create_events", fake_create)
+    monkeypatch.setattr(service, "IMPORT_BATCH_SIZE", 2)
+
+    with TestClient(service.app) as client:
+        response = client.post("/events/import", content=ZONED_CALENDAR, headers=auth_headers(service))
+
+    assert response.status_code == 200
+    assert response.json() == {"imported": 3, "failed": 0, "skipped": 1, "errors": []}
+    assert created[0].start == "2025-01-15T11:00:00+00:00"
+    assert created[0].end == "2025-01-15T12:00:00+00:00"
+
+
+def test_import_without_yandex_token_uses_stub(service):
+    with TestClient(service.app) as client:
+        response = client.post("/events/import", content=ZONED_CALENDAR, headers=auth_headers(service))
+
+    assert response.status_code == 200
+    assert response.json()["imported"] == 3
+
+
+def test_export_round_trips_through_import(service):
+    with TestClient(service.app) as client:
+        response = client.get(
+            "/events/export.ics",
+            params={"start_date": "2024-01-01", "end_date": "2024-02-01"},
+            headers=auth_headers(service)
+        )
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/calendar")
+    body = response.content
+    assert body.startswith(b"BEGIN:VCALENDAR\r\n")
+    assert body.endswith(b"END:VCALENDAR\r\n")
+
+    parser = service.ICSParser()
+    events = parser.feed(body) + parser.close()
+    assert [(e.summary, e.start, e.end) for e in events] == [
+        ("Пример встречи", "2024-01-15T10:00:00", "2024-01-15T11:00:00")
+    ]
+
+
+def generated_calendar(count):
+    """Календарь из count событий, отдаваемый кусками по 64 КБ"""
+    event = (
+        "BEGIN:VEVENT\r\n"
+        "UID:event-{i}@example.com\r\n"
+        "SUMMARY:Встреча номер {i} с довольно длинным названием, которое переносится на сле\r\n"
+        " дующую строку\r\n"
+        "DESCRIPTION:Описание\\, с экранированием\\nи переводом строки\r\n"
+        "DTSTART;TZID=Europe/Moscow:2025{month:02d}{day:02d}T{hour:02d}0000\r\n"
+        "DTEND;TZID=Europe/Moscow:2025{month:02d}{day:02d}T{hour:02d}3000\r\n"
+        "ATTENDEE:mailto:user{i}@example.com\r\n"
+        "END:VEVENT\r\n"
+    )
+    buffer = b"BEGIN:VCALENDAR\r\nVERSION:2.0\r\n"
+    for i in range(count):
+        buffer += event.format(i=i, month=i % 12 + 1, day=i % 28 + 1, hour=i % 24).encode()
+        if len(buffer) >= 65536:
+            yield buffer
+            buffer = b""
+    yield buffer + b"END:VCALENDAR\r\n"
+
+
+def test_large_import_parses_in_constant_memory(service):
+    """10 тысяч событий (около 4,5 МБ): память парсера не зависит от размера файла"""
+    parser = service.ICSParser()
+    parsed = 0
+    tracemalloc.start()
+    try:
+        for chunk in generated_calendar(10000):
+            parsed += len(parser.feed(chunk))
+        parsed += len(parser.close())
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    assert parsed == 10000
+    assert parser.skipped == 0
+    # Пик - один кусок входа и события одного куска, а не весь файл
+    assert peak < 2 * 1024 * 1024
@@ -0,0 +1,143 @@
+"""Плановое обновление OAuth токенов календаря: ошибки refresh_token, дедупликация и фоновый цикл"""
+import asyncio
+import logging
+import time
+import uuid
+from contextlib import closing
+
+import httpx
+
+
+def refresh(service, handler):
+    """Сохраняет токен, который уже пора обновить, и выполняет одно обновление"""
+    user_id = f"user-{uuid.uuid4().hex}"
+
+    async def run():
+        await service.save_user_token(user_id, "old-access", "refresh-1", expires_in=1)
+        assert user_id in dict(await service.token_store.due_for_refresh(1000))
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await service.refresh_user_token(client, user_id, "refresh-1")
+        due = dict(await service.token_store.due_for_refresh(1000))
+        return user_id, due, await service.get_user_token(user_id)
+
+    return asyncio.run(run())
+
+
+def refresh_state(service, user_id):
+    with closing(service.token_store._connect()) as conn:
+        return conn.execute(
+            "SELECT refresh_at, refresh_failures FROM tokens WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+
+def test_success_reschedules(service):
+    user_id, due, token = refresh(
+        service,
+        lambda request: httpx.Response(
+            200, json={"access_token": "new-access", "refresh_token": "refresh-2", "expires_in": 86400}
+        )
+    )
+
+    assert token == "new-access"
+    assert user_id not in due
+    assert refresh_state(service, user_id)[1] == 0
+
+
+def test_revoked_refresh_token_needs_reauth(service):
+    user_id, due, token = refresh(
+        service, lambda request: httpx.Response(400, json={"error": "invalid_grant"})
+    )
+
+    assert user_id not in due
+    assert token == "old-access"
+    # Из расписания снят, пока пользователь не войдет заново
+    assert refresh_state(service, user_id)[0] is None
+
+    asyncio.run(service.save_user_token(user_id, "fresh", "refresh-3", expires_in=1))
+    assert user_id in dict(asyncio.run(service.token_store.due_for_refresh(1000)))
+
+
+def test_server_error_backs_off(service, monkeypatch):
+    monkeypatch.setattr(service.token_store, "retry_base", 60.0)
+    monkeypatch.setattr(service.token_store, "retry_max", 600.0)
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(503)
+
+    user_id, due, token = refresh(service, handler)
+
+    assert len(calls) == 1
+    assert user_id not in due
+    refresh_at, failures = refresh_state(service, user_id)
+    assert failures == 1
+    assert refresh_at > time.time() + 25
+
+    # Следующие сбои увеличивают задержку до предела
+    for _ in range(6):
+        asyncio.run(service.token_store.postpone_refresh(user_id))
+    refresh_at, failures = refresh_state(service, user_id)
+    assert failures == 7
+    assert refresh_at <= time.time() + 600
+
+
+def test_network_error_and_bad_body_back_off(service):
+    def unreachable(request):
+        raise httpx.ConnectError("connection refused")
+
+    for handler in [unreachable, lambda request: httpx.Response(200, text="<html></html>"),
+                    lambda request: httpx.Response(429)]:
+        user_id, due, token = refresh(service, handler)
+        assert user_id not in due
+        assert token == "old-access"
+        assert refresh_state(service, user_id)[1] == 1
+
+
+def test_stale_due_entry_is_not_refreshed_again(service):
+    """Воркер со старым списком due не повторяет уже выполненное обновление"""
+    calls = []
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={"access_token": "new-access", "expires_in": 86400})
+
+    user_id, _, _ = refresh(service, handler)
+
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            await service.refresh_user_token(client, user_id, "refresh-1")
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def test_refresh_loop_logs_failures_and_keeps_running(service, monkeypatch, caplog):
+    monkeypatch.setattr(service, "TOKEN_REFRESH_INTERVAL", 0.01)
+    passes = []
+
+    async def due_for_refresh(limit):
+        passes.append(limit)
+        if len(passes) == 1:
+            raise RuntimeError("database is locked")
+        return [("broken-user", "refresh-1")]
+
+    async def refresh_user_token(client, user_id, refresh_token):
+        raise RuntimeError("refresh crashed")
+
+    monkeypatch.setattr(service.token_store, "due_for_refresh", due_for_refresh)
+    monkeypatch.setattr(service, "refresh_user_token", refresh_user_token)
+
+    async def run():
+        task = asyncio.create_task(service.token_refresh_loop())
+        # Третий проход начинается после того, как второй записал ошибки в лог
+        while len(passes) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+
+    with caplog.at_level(logging.ERROR, logger="calendar-service"):
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert "Token refresh pass failed" in messages
+    assert "Token refresh failed for user broken-user" in messages
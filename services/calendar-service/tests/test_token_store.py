@@ -0,0 +1,42 @@
+"""Токен пользователя из JWT: запросы к Яндексу идут с его OAuth токеном.
+
+Само хранилище проверяется в services/shared/tests/test_token_store.py.
+"""
+import asyncio
+import uuid
+
+import httpx
+import jwt
+from fastapi.testclient import TestClient
+
+
+def new_user():
+    return f"user-{uuid.uuid4().hex}"
+
+
+def test_request_uses_token_of_jwt_user(service, monkeypatch):
+    alice, bob = new_user(), new_user()
+    asyncio.run(service.save_user_token(alice, "alice-token"))
+    asyncio.run(service.save_user_token(bob, "bob-token"))
+    seen = []
+
+    def handler(request):
+        seen.append(request.headers["authorization"])
+        return httpx.Response(201, json={"id": "created"})
+
+    transport = httpx.MockTransport(handler)
+
+    class MockClient(httpx.AsyncClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, transport=transport, **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    event = {"summary": "Встреча", "start": "2025-01-15T10:00:00Z", "end": "2025-01-15T11:00:00Z"}
+
+    with TestClient(service.app) as client:
+        for user_id in (bob, alice):
+            token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+            response = client.post("/events", json=event, headers={"Authorization": f"Bearer {token}"})
+            assert response.json() == {"id": "created"}
+
+    assert seen == ["OAuth bob-token", "OAuth alice-token"]
@@ -1,48 +1,1706 @@
-from fastapi import FastAPI, HTTPException, Depends, Query
+from fastapi import FastAPI, HTTPException, Depends, Query, Header, Request
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from typing import Optional, List
+from pydantic import BaseModel, Field
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Dict, Tuple, Iterable, AsyncIterator
+from functools import lru_cache
+from pathlib import Path
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor
+from email.header import decode_header, make_header
+from email.message import Message
+from email.parser import BytesParser
+from email.utils import parseaddr, parsedate_to_datetime
+import asyncio
+import functools
+import mmap
+import multiprocessing
+import random
+import sqlite3
+import sys
+import time
+import hashlib
+import uuid
+import zlib
 import httpx
+import json
+import jwt
+import logging
 import os
-from urllib.parse import urlencode
+from urllib.parse import urlencode, quote
 import re
 
+# Общий код сервисов: в образе лежит рядом с main.py, в репозитории - в services/shared
+sys.path.append(str(Path(__file__).resolve().parent.parent / "shared"))
+from preferences import PREFERENCES_CACHE_TTL, PreferencesCache
+from token_store import TokenStore
+
 app = FastAPI(title="Email Service")
 
+logger = logging.getLogger("email-service")
+
 security = HTTPBearer()
+optional_security = HTTPBearer(auto_error=False)
 
 CLIENT_ID = os.getenv("YANDEX_EMAIL_CLIENT_ID")
 CLIENT_SECRET = os.getenv("YANDEX_EMAIL_CLIENT_SECRET")
 REDIRECT_URI = os.getenv("YANDEX_EMAIL_REDIRECT_URI", "http://localhost:8000/auth/yandex/callback")
+# API почты; для разработки можно указать локальную заглушку с тем же интерфейсом
+MAIL_API_URL = os.getenv("YANDEX_MAIL_API_URL", "https://mail.yandex.ru/api/v1")
+
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+
+DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+TOKENS_DB = DATA_DIR / "tokens.db"
+# Сколько секунд токен живет в кэше процесса до перечитывания из БД
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "30"))
+WORKERS = int(os.getenv("WORKERS", "1"))
+OAUTH_STATE_TTL_MINUTES = 10
+
+# Фоновое обновление токенов: период прохода, размер пакета и аренда обновления
+TOKEN_REFRESH_INTERVAL = float(os.getenv("TOKEN_REFRESH_INTERVAL", "60"))
+TOKEN_REFRESH_BATCH = 50
+TOKEN_REFRESH_LEASE = 120
+
+MESSAGES_DB = DATA_DIR / "messages.db"
+# Фоновая синхронизация почты: период, размер страницы и предел писем за один проход
+SYNC_INTERVAL = float(os.getenv("MAIL_SYNC_INTERVAL", "60"))
+SYNC_PAGE_SIZE = 100
+SYNC_MAX_MESSAGES = int(os.getenv("MAIL_SYNC_MAX_MESSAGES", "1000"))
+SYNC_CONCURRENCY = 5
+SYNC_LEASE = 300
+# Перестройка индексов по уже сохраненным письмам: идет в фоне пакетами,
+# выполняет ее один процесс (захват на MIGRATION_LEASE секунд)
+MIGRATIONS = ("fts_index", "threads")
+MIGRATION_BATCH = 500
+MIGRATION_LEASE = 60
+# Лента изменений ящика
+CHANGES_TIMEOUT = float(os.getenv("CHANGES_TIMEOUT", "30"))
+# Как часто ожидающий запрос перечитывает ленту (изменения от других процессов)
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "2"))
+CHANGES_RETENTION_DAYS = int(os.getenv("CHANGES_RETENTION_DAYS", "7"))
+CHANGES_PAGE_SIZE = 100
+SSE_KEEPALIVE = 15
+BODY_COMPRESSION_LEVEL = 6
+# Пакетная загрузка писем
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "200"))
+FETCH_CONCURRENCY = int(os.getenv("MESSAGE_FETCH_CONCURRENCY", "8"))
+
+# Импорт архивов почты (mbox, .eml)
+# Каталог на сервере, из которого можно импортировать по пути
+IMPORT_DIR = Path(os.getenv("MAIL_IMPORT_DIR", str(DATA_DIR / "import")))
+UPLOADS_DIR = DATA_DIR / "uploads"
+IMPORT_WORKERS = int(os.getenv("IMPORT_WORKERS", str(os.cpu_count() or 2)))
+# Размер задания для процесса пула
+IMPORT_CHUNK_BYTES = int(os.getenv("IMPORT_CHUNK_BYTES", str(8 * 1024 * 1024)))
+IMPORT_CHUNK_FILES = 500
+IMPORT_MAX_BODY_CHARS = 200_000
+IMPORT_SNIPPET_CHARS = 200
+# Строка-разделитель mbox: "From адрес дата", например "From a@b.ru Mon Jan 15 10:00:00 2024"
+MBOX_FROM_LINE_RE = re.compile(rb"From \S+ .*\d\d:\d\d.*\d{4}\s*$")
+# Заголовки, сохраняемые у импортированных писем (нужны для цепочек и классификации)
+IMPORT_HEADERS = [
+    "Message-ID", "In-Reply-To", "References", "From", "To", "Cc", "Subject", "Date",
+    "List-Id", "List-Unsubscribe", "Precedence", "Auto-Submitted"
+]
+
+# Вложения
+# Вложения импортированных писем хранятся на диске по SHA-256 содержимого
+ATTACHMENTS_DIR = DATA_DIR / "attachments"
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+# Поля, в которых API может вернуть содержимое вложения прямо в письме
+ATTACHMENT_CONTENT_KEYS = {"content", "data", "body"}
+ATTACHMENT_PASSTHROUGH_HEADERS = [
+    "content-type", "content-length", "content-range", "content-encoding", "accept-ranges",
+    "content-disposition", "etag", "last-modified"
+]
+
+# Очередь исходящих писем
+OUTBOX_DB = DATA_DIR / "outbox.db"
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "4"))
+SEND_POLL_INTERVAL = float(os.getenv("SEND_POLL_INTERVAL", "5"))
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "8"))
+SEND_RETRY_BASE = float(os.getenv("SEND_RETRY_BASE", "2"))
+SEND_RETRY_MAX = float(os.getenv("SEND_RETRY_MAX", "600"))
+SEND_LEASE = 120
+# Ответы Яндекса, после которых повтор имеет смысл
+RETRYABLE_STATUSES = {401, 408, 429, 500, 502, 503, 504}
+# Полнотекстовый поиск: unicode61 приводит кириллицу к нижнему регистру
+# (диакритику он снимает только с латиницы, ё -> е делает fts_text); веса BM25
+# для темы, отправителя и тела
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+FTS_WEIGHTS = "5.0, 3.0, 1.0"
+# Версия содержимого индекса: при ее смене индекс перестраивается в фоне после старта
+FTS_INDEX_VERSION = 1
+HTML_TAG_RE = re.compile(r"<[^>]+>")
+
+# Цепочки писем
+# Префиксы ответов и пересылок: Re:, Fwd:, RE[2]:, Ответ:, Пересл: и т.п.
+REPLY_PREFIX_RE = re.compile(
+    r"^(?:\s*(?:re|fwd?|aw|sv|tr|отв|ответ|пересл)\s*(?:\[\d+\]|\(\d+\))?\s*:)+\s*",
+    re.IGNORECASE
+)
+MESSAGE_ID_RE = re.compile(r"<([^<>\s]+)>")
+# Письма без заголовков цепочки объединяются по теме только в пределах окна
+THREAD_SUBJECT_WINDOW_DAYS = int(os.getenv("THREAD_SUBJECT_WINDOW_DAYS", "30"))
+THREAD_MAX_PARTICIPANTS = 20
+
+# Признаки адресов рассылок и роботов, проверяются одним регулярным выражением
+AUTOMATED_SENDER_MARKERS = [
+    "noreply", "no-reply", "donotreply", "mailer", "newsletter",
+    "notifications", "alerts", "system", "automated"
+]
+AUTOMATED_SENDER_RE = re.compile("|".join(re.escape(marker) for marker in AUTOMATED_SENDER_MARKERS))
+BULK_PRECEDENCE = {"bulk", "list", "junk"}
+SENDER_CACHE_SIZE = 65536
 
 # Хранилище токенов
-tokens_storage = {}
+token_store = TokenStore(TOKENS_DB, TOKEN_CACHE_TTL)
+
+# Кэш пользовательских настроек
+preferences_cache = PreferencesCache(PREFERENCES_CACHE_TTL)
+
+def attachment_metadata(message: Dict) -> List[Dict]:
+    """Описания вложений письма без их содержимого"""
+    attachments = message.get("attachments")
+    if not isinstance(attachments, list):
+        return []
+    return [
+        {key: value for key, value in attachment.items() if key not in ATTACHMENT_CONTENT_KEYS}
+        for attachment in attachments if isinstance(attachment, dict)
+    ]
+
+def strip_attachment_content(message: Dict) -> Dict:
+    """Письмо, в котором от вложений остались только описания: содержимое отдается отдельно"""
+    if "attachments" not in message:
+        return message
+    attachments = attachment_metadata(message)
+    return {**message, "attachments": attachments, "has_attachments": bool(attachments)}
+
+def compress_message(message: Dict) -> bytes:
+    """Сжатое полное письмо для хранения в messages.body"""
+    return zlib.compress(json.dumps(message, ensure_ascii=False).encode(), BODY_COMPRESSION_LEVEL)
+
+def sender_email(message: Dict) -> str:
+    """Адрес отправителя письма (поле from бывает строкой или объектом)"""
+    sender = message.get("from") or ""
+    if isinstance(sender, dict):
+        sender = sender.get("email") or ""
+    return sender.lower()
+
+def message_text(message: Dict) -> str:
+    """Текст письма для полнотекстового индекса: тело без HTML разметки или сниппет"""
+    text = message.get("body") or message.get("snippet") or ""
+    if not isinstance(text, str):
+        return ""
+    return HTML_TAG_RE.sub(" ", text)
+
+def sender_text(message: Dict) -> str:
+    """Имя и адрес отправителя для полнотекстового индекса"""
+    sender = message.get("from") or ""
+    if isinstance(sender, dict):
+        return f"{sender.get('name') or ''} {sender.get('email') or ''}"
+    return sender
+
+def fts_text(text: str) -> str:
+    """Текст для индекса и запроса: ё и е не различаются"""
+    return text.replace("ё", "е").replace("Ё", "Е")
+
+def fts_query(query: str) -> Optional[str]:
+    """Запрос FTS5 из пользовательской строки: все слова по префиксу.
+
+    Поиск по префиксу покрывает окончания русских словоформ (встреч* - встреча, встречу).
+    """
+    terms = re.findall(r"\w+", fts_text(query.lower()))
+    if not terms:
+        return None
+    return " ".join(f'"{term}"*' for term in terms)
+
+def message_headers(message: Dict) -> Dict[str, str]:
+    """Заголовки письма с именами в нижнем регистре"""
+    headers = message.get("headers")
+    if isinstance(headers, dict):
+        return {str(name).lower(): str(value) for name, value in headers.items()}
+    if isinstance(headers, list):
+        return {
+            str(header.get("name", "")).lower(): str(header.get("value", ""))
+            for header in headers if isinstance(header, dict)
+        }
+    return {}
+
+def normalize_subject(subject: str) -> Tuple[str, str, bool]:
+    """Тема без префиксов ответа: (ключ для сравнения, тема для показа, был ли префикс)"""
+    match = REPLY_PREFIX_RE.match(subject)
+    display = subject[match.end():] if match else subject
+    display = " ".join(display.split())
+    return display.lower(), display, match is not None
+
+def message_ids(value) -> List[str]:
+    """Идентификаторы из Message-ID/In-Reply-To/References (с угловыми скобками или без)"""
+    if not value:
+        return []
+    if isinstance(value, list):
+        value = " ".join(str(item) for item in value)
+    value = str(value)
+    found = MESSAGE_ID_RE.findall(value) or value.split()
+    return [message_id.strip().lower() for message_id in found if message_id.strip()]
+
+def thread_keys(message: Dict) -> Tuple[Optional[str], List[str]]:
+    """Собственный Message-ID письма и идентификаторы писем, на которые оно отвечает"""
+    headers = message_headers(message)
+    own = message_ids(headers.get("message-id") or message.get("message_id"))
+    parents = message_ids(headers.get("references") or message.get("references")) + \
+        message_ids(headers.get("in-reply-to") or message.get("in_reply_to"))
+    return (own[0] if own else None), list(dict.fromkeys(parents))
+
+def shift_date(date: str, days: int) -> Optional[str]:
+    """Дата письма, сдвинутая на days дней, в том же строковом формате для сравнения"""
+    try:
+        return (datetime.fromisoformat(date[:19]) + timedelta(days=days)).isoformat()
+    except ValueError:
+        return None
+
+class MessageStore:
+    """Локальное хранилище писем (SQLite): метаданные для списков и сжатые тела.
+
+    Заполняется инкрементальной синхронизацией с Яндекс Почтой, списки и тела
+    писем отдаются из него без обращения к Яндексу. Конструктор только создает
+    схему; полнотекстовый индекс и цепочки для писем, сохраненных до их
+    появления, строит migrate() пакетами в фоне.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self.owner = uuid.uuid4().hex
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS messages (
+                    user_id TEXT NOT NULL,
+                    id TEXT NOT NULL,
+                    sender TEXT NOT NULL,
+                    date TEXT NOT NULL,
+                    data TEXT NOT NULL,
+                    body BLOB,
+                    PRIMARY KEY (user_id, id)
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_user_date ON messages (user_id, date DESC)")
+            # Полнотекстовый индекс: rowid совпадает с rowid письма в messages
+            conn.execute(
+                f"""CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    subject, sender, body,
+                    tokenize = '{FTS_TOKENIZER}',
+                    prefix = '2 3'
+                )"""
+            )
+            # Индекс цепочек: ключи (Message-ID) -> цепочка, сводка по цепочке
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS thread_keys (
+                    user_id TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    thread_id TEXT NOT NULL,
+                    PRIMARY KEY (user_id, key)
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS threads (
+                    user_id TEXT NOT NULL,
+                    thread_id TEXT NOT NULL,
+                    subject_key TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    has_reply INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    participants TEXT NOT NULL,
+                    first_date TEXT NOT NULL,
+                    last_date TEXT NOT NULL,
+                    last_message TEXT NOT NULL,
+                    PRIMARY KEY (user_id, thread_id)
+                )"""
+            )
+            conn.execute("DROP INDEX IF EXISTS threads_user_date")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS threads_user_date_id ON threads (user_id, last_date DESC, thread_id DESC)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS threads_user_subject ON threads (user_id, subject_key, last_date)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(messages)")}
+            if "thread_id" not in columns:
+                conn.execute("ALTER TABLE messages ADD COLUMN thread_id TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS messages_user_thread ON messages (user_id, thread_id)")
+            # Лента изменений: номер записи служит курсором для потребителей
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS changes (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS changes_user_seq ON changes (user_id, seq)")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS changes_meta (
+                    key TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS imports (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    bytes_total INTEGER NOT NULL,
+                    bytes_done INTEGER NOT NULL DEFAULT 0,
+                    messages INTEGER NOT NULL DEFAULT 0,
+                    imported INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    error TEXT,
+                    started_at REAL NOT NULL,
+                    finished_at REAL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS sync_state (
+                    user_id TEXT PRIMARY KEY,
+                    last_message_id TEXT,
+                    last_date TEXT,
+                    synced_at REAL,
+                    claimed_until REAL
+                )"""
+            )
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS migrations (
+                    name TEXT PRIMARY KEY,
+                    position INTEGER NOT NULL DEFAULT 0,
+                    done INTEGER NOT NULL DEFAULT 0,
+                    owner TEXT,
+                    claimed_until REAL
+                )"""
+            )
+            # Непустой индекс при первом запуске с миграциями построен прежним кодом целиком
+            conn.execute(
+                "INSERT OR IGNORE INTO migrations (name, done) VALUES ('fts_index', EXISTS (SELECT 1 FROM messages_fts))"
+            )
+            conn.execute("INSERT OR IGNORE INTO migrations (name) VALUES ('threads')")
+            if conn.execute("PRAGMA user_version").fetchone()[0] < FTS_INDEX_VERSION:
+                conn.execute("UPDATE migrations SET position = 0, done = 0 WHERE name = 'fts_index'")
+                conn.execute(f"PRAGMA user_version = {FTS_INDEX_VERSION}")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _migrate_fts_index(self, conn: sqlite3.Connection, position: int) -> Optional[int]:
+        """Индексация писем с rowid после position; None - все письма проиндексированы"""
+        rows = conn.execute(
+            "SELECT rowid, data, body FROM messages WHERE rowid > ? ORDER BY rowid LIMIT ?",
+            (position, MIGRATION_BATCH)
+        ).fetchall()
+        for rowid, data, body in rows:
+            message = json.loads(zlib.decompress(body)) if body else json.loads(data)
+            self._index(conn, rowid, message)
+        if len(rows) == MIGRATION_BATCH:
+            return rows[-1][0]
+        # Записи индекса старой версии для писем, которых уже нет
+        conn.execute("DELETE FROM messages_fts WHERE rowid NOT IN (SELECT rowid FROM messages)")
+        return None
+
+    def _migrate_threads(self, conn: sqlite3.Connection, position: int) -> Optional[int]:
+        """Раскладка писем без цепочки, от старых к новым; None - таких писем не осталось"""
+        rows = conn.execute(
+            "SELECT rowid, user_id, data, body FROM messages WHERE thread_id IS NULL ORDER BY date LIMIT ?",
+            (MIGRATION_BATCH,)
+        ).fetchall()
+        for rowid, user_id, data, body in rows:
+            message = json.loads(zlib.decompress(body)) if body else json.loads(data)
+            self._thread(conn, user_id, rowid, message)
+        return position if len(rows) == MIGRATION_BATCH else None
+
+    def _migrate_step(self, name: str, now: float) -> Optional[bool]:
+        """Один пакет миграции в своей транзакции.
+
+        None - миграция завершена, False - ее выполняет другой процесс.
+        """
+        with closing(self._connect()) as conn, conn:
+            claimed = conn.execute(
+                """UPDATE migrations SET owner = ?, claimed_until = ?
+                WHERE name = ? AND done = 0 AND (owner = ? OR claimed_until IS NULL OR claimed_until < ?)""",
+                (self.owner, now + MIGRATION_LEASE, name, self.owner, now)
+            ).rowcount
+            if not claimed:
+                done = conn.execute("SELECT done FROM migrations WHERE name = ?", (name,)).fetchone()[0]
+                return None if done else False
+            position = conn.execute("SELECT position FROM migrations WHERE name = ?", (name,)).fetchone()[0]
+            position = getattr(self, f"_migrate_{name}")(conn, position)
+            if position is None:
+                conn.execute(
+                    "UPDATE migrations SET done = 1, owner = NULL, claimed_until = NULL WHERE name = ?", (name,)
+                )
+            else:
+                conn.execute("UPDATE migrations SET position = ? WHERE name = ?", (position, name))
+            return True
+
+    def _index(self, conn: sqlite3.Connection, rowid: int, message: Dict):
+        conn.execute("DELETE FROM messages_fts WHERE rowid = ?", (rowid,))
+        conn.execute(
+            "INSERT INTO messages_fts (rowid, subject, sender, body) VALUES (?, ?, ?, ?)",
+            (rowid, fts_text(message.get("subject") or ""), fts_text(sender_text(message)),
+             fts_text(message_text(message)))
+        )
+
+    def _thread(self, conn: sqlite3.Connection, user_id: str, rowid: int, message: Dict) -> str:
+        """Отнесение письма к цепочке и обновление ее сводки.
+
+        Сначала ищем цепочку по Message-ID письма и по In-Reply-To/References;
+        если заголовков нет или они не знакомы - по теме без префиксов Re:/Fwd:,
+        когда письмо или цепочка является ответом и даты близки.
+        Идентификаторы родителей запоминаются сразу, поэтому ответ, пришедший раньше
+        исходного письма (синхронизация идет от новых к старым), тоже его найдет.
+        """
+        own, parents = thread_keys(message)
+        keys = ([own] if own else []) + parents
+        subject_key, subject, is_reply = normalize_subject(str(message.get("subject") or ""))
+        is_reply = is_reply or bool(parents)
+        date = str(message.get("date") or "")
+        
+        thread_id = None
+        if keys:
+            row = conn.execute(
+                f"SELECT thread_id FROM thread_keys WHERE user_id = ? AND key IN ({', '.join('?' * len(keys))}) LIMIT 1",
+                [user_id, *keys]
+            ).fetchone()
+            thread_id = row[0] if row else None
+        if thread_id is None and subject_key:
+            conditions = ["user_id = ?", "subject_key = ?", "(has_reply = 1 OR ?)"]
+            params: List = [user_id, subject_key, int(is_reply)]
+            window_start = shift_date(date, -THREAD_SUBJECT_WINDOW_DAYS)
+            window_end = shift_date(date, THREAD_SUBJECT_WINDOW_DAYS)
+            if window_start and window_end:
+                conditions += ["last_date >= ?", "first_date <= ?"]
+                params += [window_start, window_end]
+            row = conn.execute(
+                f"SELECT thread_id FROM threads WHERE {' AND '.join(conditions)} ORDER BY last_date DESC LIMIT 1",
+                params
+            ).fetchone()
+            thread_id = row[0] if row else None
+        if thread_id is None:
+            seed = own or str(message.get("id"))
+            thread_id = "t" + hashlib.sha1(f"{user_id}:{seed}".encode()).hexdigest()[:16]
+        
+        conn.executemany(
+            "INSERT OR IGNORE INTO thread_keys (user_id, key, thread_id) VALUES (?, ?, ?)",
+            [(user_id, key, thread_id) for key in keys]
+        )
+        
+        listing = {key: value for key, value in message.items() if key not in ("body", "headers")}
+        row = conn.execute(
+            """SELECT subject, has_reply, message_count, participants, first_date, last_date
+            FROM threads WHERE user_id = ? AND thread_id = ?""",
+            (user_id, thread_id)
+        ).fetchone()
+        if row:
+            thread_subject, has_reply, count, participants, first_date, last_date = row
+            participants = json.loads(participants)
+            # Тема цепочки - тема самого раннего письма
+            if date < first_date or not thread_subject:
+                thread_subject = subject or thread_subject
+            conn.execute(
+                """UPDATE threads SET subject = ?, has_reply = ?, message_count = ?, participants = ?,
+                first_date = ?, last_date = ?, last_message = CASE WHEN ? >= last_date THEN ? ELSE last_message END
+                WHERE user_id = ? AND thread_id = ?""",
+                (thread_subject, int(has_reply or is_reply), count + 1,
+                 json.dumps(self._participants(participants, message)),
+                 min(first_date, date), max(last_date, date), date,
+                 json.dumps(listing, ensure_ascii=False), user_id, thread_id)
+            )
+        else:
+            conn.execute(
+                """INSERT INTO threads (user_id, thread_id, subject_key, subject, has_reply, message_count,
+                participants, first_date, last_date, last_message) VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?)""",
+                (user_id, thread_id, subject_key, subject, int(is_reply),
+                 json.dumps(self._participants([], message)), date, date,
+                 json.dumps(listing, ensure_ascii=False))
+            )
+        conn.execute("UPDATE messages SET thread_id = ? WHERE rowid = ?", (thread_id, rowid))
+        return thread_id
+
+    @staticmethod
+    def _participants(participants: List[str], message: Dict) -> List[str]:
+        sender = sender_email(message)
+        if sender and sender not in participants and len(participants) < THREAD_MAX_PARTICIPANTS:
+            participants = participants + [sender]
+        return participants
+
+    def _record_change(self, conn: sqlite3.Connection, user_id: str, change_type: str, message_id: str):
+        conn.execute(
+            "INSERT INTO changes (user_id, type, message_id, created_at) VALUES (?, ?, ?, ?)",
+            (user_id, change_type, message_id, time.time())
+        )
+
+    def _insert(self, user_id: str, messages: List[Dict], record_changes: bool,
+                bodies: Optional[List[bytes]]) -> List[Dict]:
+        added = []
+        with closing(self._connect()) as conn, conn:
+            for index, message in enumerate(messages):
+                message = strip_attachment_content(message)
+                message_id = message.get("id")
+                if not message_id:
+                    continue
+                listing = {key: value for key, value in message.items() if key != "body"}
+                # Импортированные письма приходят сразу с телом (иногда уже сжатым)
+                if bodies:
+                    body = bodies[index]
+                elif message.get("body") is not None:
+                    body = compress_message(message)
+                else:
+                    body = None
+                cursor = conn.execute(
+                    """INSERT OR IGNORE INTO messages (user_id, id, sender, date, data, body)
+                    VALUES (?, ?, ?, ?, ?, ?)""",
+                    (user_id, str(message_id), sender_email(message), message.get("date") or "",
+                     json.dumps(listing, ensure_ascii=False), body)
+                )
+                if cursor.rowcount:
+                    self._index(conn, cursor.lastrowid, message)
+                    listing["thread_id"] = self._thread(conn, user_id, cursor.lastrowid, message)
+                    if record_changes:
+                        self._record_change(conn, user_id, "message_added", str(message_id))
+                    added.append(listing)
+        return added
+
+    def _select_listing(self, user_id: str, limit: int, predicate) -> List[Dict]:
+        result = []
+        with closing(self._connect()) as conn:
+            # Курсор SQLite ленивый: читаем ровно столько строк, сколько прошло фильтр
+            rows = conn.execute(
+                "SELECT data, thread_id FROM messages WHERE user_id = ? ORDER BY date DESC", (user_id,)
+            )
+            for data, thread_id in rows:
+                message = json.loads(data)
+                message["thread_id"] = thread_id
+                if predicate(message):
+                    result.append(message)
+                    if len(result) >= limit:
+                        break
+        return result
+
+    @staticmethod
+    def _thread_summary(row: Tuple) -> Dict:
+        thread_id, subject, count, participants, first_date, last_date, last_message = row
+        return {
+            "thread_id": thread_id,
+            "subject": subject,
+            "message_count": count,
+            "participants": json.loads(participants),
+            "first_date": first_date,
+            "last_date": last_date,
+            "last_message": json.loads(last_message)
+        }
+
+    def _select_threads(self, user_id: str, limit: int, before: Optional[Tuple[str, str]]) -> List[Dict]:
+        conditions = ["user_id = ?"]
+        params: List = [user_id]
+        if before:
+            # Ключ (last_date, thread_id): цепочки с той же датой, что у последней
+            # на предыдущей странице, не теряются
+            conditions.append("(last_date, thread_id) < (?, ?)")
+            params.extend(before)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"""SELECT thread_id, subject, message_count, participants, first_date, last_date, last_message
+                FROM threads WHERE {' AND '.join(conditions)} ORDER BY last_date DESC, thread_id DESC LIMIT ?""",
+                [*params, limit]
+            ).fetchall()
+        return [self._thread_summary(row) for row in rows]
+
+    def _select_thread(self, user_id: str, thread_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                """SELECT thread_id, subject, message_count, participants, first_date, last_date, last_message
+                FROM threads WHERE user_id = ? AND thread_id = ?""",
+                (user_id, thread_id)
+            ).fetchone()
+            if not row:
+                return None
+            rows = conn.execute(
+                "SELECT data FROM messages WHERE user_id = ? AND thread_id = ? ORDER BY date",
+                (user_id, thread_id)
+            ).fetchall()
+        thread = self._thread_summary(row)
+        thread["messages"] = [json.loads(data) for (data,) in rows]
+        return thread
+
+    def _select_body(self, user_id: str, message_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT body FROM messages WHERE user_id = ? AND id = ?", (user_id, message_id)
+            ).fetchone()
+        if not row or row[0] is None:
+            return None
+        return json.loads(zlib.decompress(row[0]))
+
+    def _select_bodies(self, user_id: str, message_ids: List[str]) -> Dict[str, Dict]:
+        placeholders = ", ".join("?" * len(message_ids))
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"SELECT id, body FROM messages WHERE user_id = ? AND id IN ({placeholders}) AND body IS NOT NULL",
+                [user_id, *message_ids]
+            ).fetchall()
+        return {message_id: json.loads(zlib.decompress(body)) for message_id, body in rows}
+
+    def _update_body(self, user_id: str, message_id: str, message: Dict):
+        message = strip_attachment_content(message)
+        listing = {key: value for key, value in message.items() if key != "body"}
+        body = compress_message(message)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """INSERT INTO messages (user_id, id, sender, date, data, body) VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, id) DO UPDATE SET body = excluded.body""",
+                (user_id, message_id, sender_email(message), message.get("date") or "",
+                 json.dumps(listing, ensure_ascii=False), body)
+            )
+            rowid, thread_id = conn.execute(
+                "SELECT rowid, thread_id FROM messages WHERE user_id = ? AND id = ?", (user_id, message_id)
+            ).fetchone()
+            self._index(conn, rowid, message)
+            if thread_id is None:
+                # Письма еще не было в хранилище
+                self._thread(conn, user_id, rowid, message)
+                self._record_change(conn, user_id, "message_added", message_id)
+
+    def _search(self, user_id: str, match: str, sender: Optional[str], date_from: Optional[str],
+                date_to: Optional[str], limit: int) -> List[Dict]:
+        conditions = ["messages_fts MATCH ?", "m.user_id = ?"]
+        params: List = [match, user_id]
+        if sender:
+            conditions.append("m.sender = ?")
+            params.append(sender.lower())
+        if date_from:
+            conditions.append("m.date >= ?")
+            params.append(date_from)
+        if date_to:
+            conditions.append("m.date <= ?")
+            params.append(date_to)
+        params.append(limit)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"""SELECT m.data,
+                        bm25(messages_fts, {FTS_WEIGHTS}) AS rank,
+                        snippet(messages_fts, 2, '[', ']', '...', 12)
+                FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid
+                WHERE {" AND ".join(conditions)}
+                ORDER BY rank LIMIT ?""",
+                params
+            ).fetchall()
+        results = []
+        for data, rank, snippet in rows:
+            message = json.loads(data)
+            # bm25 в SQLite отрицательный: чем меньше, тем релевантнее
+            message["score"] = round(-rank, 4)
+            message["highlight"] = snippet
+            results.append(message)
+        return results
+
+    def _select_changes(self, user_id: str, since: int, limit: int) -> Tuple[List[Dict], bool]:
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                """SELECT c.seq, c.type, c.message_id, c.created_at, m.data, m.thread_id
+                FROM changes c LEFT JOIN messages m ON m.user_id = c.user_id AND m.id = c.message_id
+                WHERE c.user_id = ? AND c.seq > ? ORDER BY c.seq LIMIT ?""",
+                (user_id, since, limit)
+            ).fetchall()
+            # Курсор старше хранимой истории: часть изменений после него уже удалена
+            row = conn.execute("SELECT value FROM changes_meta WHERE key = 'pruned_seq'").fetchone()
+        expired = row is not None and since < row[0]
+        changes = [
+            {
+                "seq": seq,
+                "type": change_type,
+                "message_id": message_id,
+                "thread_id": thread_id,
+                "created_at": datetime.utcfromtimestamp(created_at).isoformat(),
+                "message": json.loads(data) if data else None
+            }
+            for seq, change_type, message_id, created_at, data, thread_id in rows
+        ]
+        return changes, expired
+
+    def _latest_seq(self) -> int:
+        with closing(self._connect()) as conn:
+            (seq,) = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM changes").fetchone()
+        return seq
+
+    def _prune_changes(self, before: float):
+        with closing(self._connect()) as conn, conn:
+            (pruned,) = conn.execute("SELECT MAX(seq) FROM changes WHERE created_at < ?", (before,)).fetchone()
+            if pruned is None:
+                return
+            conn.execute("DELETE FROM changes WHERE seq <= ?", (pruned,))
+            conn.execute(
+                """INSERT INTO changes_meta (key, value) VALUES ('pruned_seq', ?)
+                ON CONFLICT(key) DO UPDATE SET value = excluded.value""",
+                (pruned,)
+            )
+
+    def _insert_import(self, import_id: str, user_id: str, source: str, bytes_total: int):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """INSERT INTO imports (id, user_id, source, status, bytes_total, started_at)
+                VALUES (?, ?, ?, 'running', ?, ?)""",
+                (import_id, user_id, source, bytes_total, time.time())
+            )
+
+    def _update_import(self, import_id: str, fields: Dict):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(f"UPDATE imports SET {assignments} WHERE id = ?", [*fields.values(), import_id])
+
+    def _select_import(self, user_id: str, import_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute(
+                "SELECT * FROM imports WHERE user_id = ? AND id = ?", (user_id, import_id)
+            ).fetchone()
+        return dict(row) if row else None
+
+    def _select_state(self, user_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT last_message_id, last_date, synced_at FROM sync_state WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+        if not row or row[2] is None:
+            return None
+        return {"last_message_id": row[0], "last_date": row[1], "synced_at": row[2]}
+
+    def _save_state(self, user_id: str, last_message_id: Optional[str], last_date: Optional[str]):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """INSERT INTO sync_state (user_id, last_message_id, last_date, synced_at, claimed_until)
+                VALUES (?, ?, ?, ?, NULL)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    last_message_id = COALESCE(excluded.last_message_id, sync_state.last_message_id),
+                    last_date = COALESCE(excluded.last_date, sync_state.last_date),
+                    synced_at = excluded.synced_at,
+                    claimed_until = NULL""",
+                (user_id, last_message_id, last_date, time.time())
+            )
+
+    def _claim(self, user_id: str, now: float, until: float) -> bool:
+        with closing(self._connect()) as conn, conn:
+            conn.execute("INSERT OR IGNORE INTO sync_state (user_id) VALUES (?)", (user_id,))
+            cursor = conn.execute(
+                """UPDATE sync_state SET claimed_until = ?
+                WHERE user_id = ? AND (claimed_until IS NULL OR claimed_until < ?)""",
+                (until, user_id, now)
+            )
+            return cursor.rowcount == 1
+
+    async def add_messages(self, user_id: str, messages: List[Dict], record_changes: bool = True,
+                           bodies: Optional[List[bytes]] = None) -> List[Dict]:
+        """Добавление писем из списка; возвращает только ранее неизвестные.
+
+        Новые письма попадают в ленту изменений, если record_changes.
+        bodies - заранее сжатые тела (compress_message) в порядке писем.
+        """
+        return await asyncio.to_thread(self._insert, user_id, messages, record_changes, bodies)
+
+    async def changes(self, user_id: str, since: int, limit: int) -> Tuple[List[Dict], bool]:
+        """Изменения ящика после курсора since и признак того, что курсор устарел"""
+        return await asyncio.to_thread(self._select_changes, user_id, since, limit)
+
+    async def latest_seq(self) -> int:
+        """Текущая позиция ленты изменений"""
+        return await asyncio.to_thread(self._latest_seq)
+
+    async def prune_changes(self, retention_days: int):
+        await asyncio.to_thread(self._prune_changes, time.time() - retention_days * 86400)
+
+    async def list_messages(self, user_id: str, limit: int, predicate) -> List[Dict]:
+        """Последние письма пользователя, прошедшие фильтр"""
+        return await asyncio.to_thread(self._select_listing, user_id, limit, predicate)
+
+    async def list_threads(self, user_id: str, limit: int, before: Optional[Tuple[str, str]] = None) -> List[Dict]:
+        """Цепочки пользователя, начиная с самой свежей, со сводкой по последнему письму"""
+        return await asyncio.to_thread(self._select_threads, user_id, limit, before)
+
+    async def get_thread(self, user_id: str, thread_id: str) -> Optional[Dict]:
+        """Цепочка со всеми ее письмами в хронологическом порядке"""
+        return await asyncio.to_thread(self._select_thread, user_id, thread_id)
+
+    async def get_message(self, user_id: str, message_id: str) -> Optional[Dict]:
+        """Полное письмо, если его тело уже загружено"""
+        return await asyncio.to_thread(self._select_body, user_id, message_id)
+
+    async def get_messages(self, user_id: str, message_ids: List[str]) -> Dict[str, Dict]:
+        """Уже загруженные полные письма из списка, одним запросом"""
+        if not message_ids:
+            return {}
+        return await asyncio.to_thread(self._select_bodies, user_id, message_ids)
+
+    async def save_message(self, user_id: str, message_id: str, message: Dict):
+        """Сохранение полного письма со сжатым телом"""
+        await asyncio.to_thread(self._update_body, user_id, message_id, message)
+
+    async def search(self, user_id: str, match: str, sender: Optional[str] = None,
+                     date_from: Optional[str] = None, date_to: Optional[str] = None,
+                     limit: int = 20) -> List[Dict]:
+        """Полнотекстовый поиск по теме, отправителю и телу с ранжированием BM25"""
+        return await asyncio.to_thread(self._search, user_id, match, sender, date_from, date_to, limit)
+
+    async def create_import(self, import_id: str, user_id: str, source: str, bytes_total: int):
+        await asyncio.to_thread(self._insert_import, import_id, user_id, source, bytes_total)
+
+    async def update_import(self, import_id: str, **fields):
+        await asyncio.to_thread(self._update_import, import_id, fields)
+
+    async def get_import(self, user_id: str, import_id: str) -> Optional[Dict]:
+        return await asyncio.to_thread(self._select_import, user_id, import_id)
+
+    async def sync_state(self, user_id: str) -> Optional[Dict]:
+        """Состояние синхронизации; None, если ящик еще ни разу не синхронизировался"""
+        return await asyncio.to_thread(self._select_state, user_id)
+
+    async def mark_synced(self, user_id: str, last_message_id: Optional[str], last_date: Optional[str]):
+        await asyncio.to_thread(self._save_state, user_id, last_message_id, last_date)
+
+    async def claim_sync(self, user_id: str, lease: float) -> bool:
+        """Захват синхронизации ящика одним воркером"""
+        now = time.time()
+        return await asyncio.to_thread(self._claim, user_id, now, now + lease)
+
+    async def migrate(self):
+        """Фоновые миграции: пакет за пакетом, пока все не завершатся.
+
+        Каждый пакет - отдельная короткая транзакция, поэтому запись в хранилище
+        (и запуск соседних процессов) не ждет перестройки всего индекса.
+        """
+        for name in MIGRATIONS:
+            while True:
+                step = await asyncio.to_thread(self._migrate_step, name, time.time())
+                if step is None:
+                    break
+                if step is False:
+                    # Процесс, захвативший миграцию, мог упасть: проверяем по истечении захвата
+                    await asyncio.sleep(MIGRATION_LEASE)
+
+# Локальное хранилище писем
+message_store = MessageStore(MESSAGES_DB)
+
+class SendQueue:
+    """Надежная очередь исходящих писем (SQLite).
+
+    Задание создается один раз на пару (user_id, ключ идемпотентности) и
+    доставляется фоновыми воркерами с экспоненциальной задержкой между попытками.
+    Воркер захватывает задание на SEND_LEASE секунд, поэтому несколько процессов
+    сервиса не отправят одно письмо одновременно.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS send_jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    idempotency_key TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    claimed_until REAL,
+                    last_error TEXT,
+                    result TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    UNIQUE (user_id, idempotency_key)
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS send_jobs_due ON send_jobs (status, next_attempt_at)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def _insert(self, user_id: str, idempotency_key: Optional[str], payload: Dict) -> Tuple[Dict, bool]:
+        job_id = f"send_{uuid.uuid4().hex}"
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                """INSERT OR IGNORE INTO send_jobs
+                (id, user_id, idempotency_key, payload, status, next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)""",
+                (job_id, user_id, idempotency_key or job_id, json.dumps(payload, ensure_ascii=False),
+                 now, now, now)
+            )
+            row = conn.execute(
+                "SELECT * FROM send_jobs WHERE user_id = ? AND idempotency_key = ?",
+                (user_id, idempotency_key or job_id)
+            ).fetchone()
+        return self._job(row), cursor.rowcount == 1
+
+    def _select(self, user_id: str, job_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM send_jobs WHERE user_id = ? AND id = ?", (user_id, job_id)
+            ).fetchone()
+        return self._job(row) if row else None
+
+    def _claim(self, now: float, until: float) -> Optional[Dict]:
+        with closing(self._connect()) as conn, conn:
+            candidates = conn.execute(
+                """SELECT id FROM send_jobs
+                WHERE status IN ('queued', 'sending') AND next_attempt_at <= ?
+                AND (claimed_until IS NULL OR claimed_until < ?)
+                ORDER BY next_attempt_at LIMIT 10""",
+                (now, now)
+            ).fetchall()
+            for (job_id,) in candidates:
+                # Задание мог перехватить воркер другого процесса
+                cursor = conn.execute(
+                    """UPDATE send_jobs SET status = 'sending', claimed_until = ?, updated_at = ?
+                    WHERE id = ? AND (claimed_until IS NULL OR claimed_until < ?)""",
+                    (until, now, job_id, now)
+                )
+                if cursor.rowcount == 1:
+                    return self._job(conn.execute("SELECT * FROM send_jobs WHERE id = ?", (job_id,)).fetchone())
+        return None
+
+    def _finish(self, job_id: str, status: str, attempts: int, next_attempt_at: float,
+                error: Optional[str], result: Optional[Dict]):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """UPDATE send_jobs SET status = ?, attempts = ?, next_attempt_at = ?, claimed_until = NULL,
+                last_error = ?, result = ?, updated_at = ? WHERE id = ?""",
+                (status, attempts, next_attempt_at, error,
+                 json.dumps(result, ensure_ascii=False) if result is not None else None, time.time(), job_id)
+            )
+
+    async def enqueue(self, user_id: str, idempotency_key: Optional[str], payload: Dict) -> Tuple[Dict, bool]:
+        """Постановка письма в очередь; для повторного ключа возвращает существующее задание"""
+        return await asyncio.to_thread(self._insert, user_id, idempotency_key, payload)
+
+    async def get(self, user_id: str, job_id: str) -> Optional[Dict]:
+        return await asyncio.to_thread(self._select, user_id, job_id)
+
+    async def claim(self, lease: float) -> Optional[Dict]:
+        """Захват ближайшего готового к отправке задания"""
+        now = time.time()
+        return await asyncio.to_thread(self._claim, now, now + lease)
+
+    async def mark_sent(self, job: Dict, result: Dict):
+        await asyncio.to_thread(self._finish, job["id"], "sent", job["attempts"] + 1, time.time(), None, result)
+
+    async def mark_failed(self, job: Dict, error: str, retryable: bool):
+        """Повтор с экспоненциальной задержкой или окончательная ошибка"""
+        attempts = job["attempts"] + 1
+        if retryable and attempts < SEND_MAX_ATTEMPTS:
+            delay = min(SEND_RETRY_BASE * 2 ** (attempts - 1), SEND_RETRY_MAX)
+            next_attempt_at = time.time() + delay * random.uniform(0.8, 1.2)
+            await asyncio.to_thread(self._finish, job["id"], "queued", attempts, next_attempt_at, error, None)
+        else:
+            await asyncio.to_thread(self._finish, job["id"], "failed", attempts, time.time(), error, None)
+
+send_queue = SendQueue(OUTBOX_DB)
+# Будит воркеров, когда задание поставлено в очередь этим процессом
+send_queue_event = asyncio.Event()
+
+class MessageBatch(BaseModel):
+    message_ids: List[str] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
 
 class EmailSend(BaseModel):
     to: str
     subject: str
     body: str
 
-def get_user_token(user_id: str) -> Optional[str]:
+def get_user_id(credentials: HTTPAuthorizationCredentials) -> str:
+    """Получение user_id из JWT токена"""
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user_id = payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return str(user_id)
+
+def create_oauth_state(user_id: str) -> str:
+    """Подписанный state для OAuth, связывающий Яндекс аккаунт с пользователем"""
+    payload = {
+        "sub": user_id,
+        "purpose": "oauth_state",
+        "exp": datetime.utcnow() + timedelta(minutes=OAUTH_STATE_TTL_MINUTES)
+    }
+    return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+def parse_oauth_state(state: Optional[str]) -> Optional[str]:
+    """Извлечение user_id из state, если он был выдан этим сервисом"""
+    if not state:
+        return None
+    try:
+        payload = jwt.decode(state, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.InvalidTokenError:
+        return None
+    if payload.get("purpose") != "oauth_state":
+        return None
+    return payload.get("sub")
+
+async def get_user_token(user_id: str) -> Optional[str]:
     """Получение токена пользователя"""
-    return tokens_storage.get(user_id)
+    return await token_store.get(user_id)
 
-def save_user_token(user_id: str, token: str):
+async def save_user_token(user_id: str, token: str, refresh_token: Optional[str] = None,
+                          expires_in: Optional[int] = None):
     """Сохранение токена пользователя"""
-    tokens_storage[user_id] = token
-
-def is_human_email(email: str) -> bool:
-    """Проверка, является ли письмо от человека (не рассылка)"""
-    # Простая эвристика: исключаем известные домены рассылок
-    mailing_domains = [
-        "noreply", "no-reply", "donotreply", "mailer", "newsletter",
-        "notifications", "alerts", "system", "automated"
+    await token_store.set(user_id, token, refresh_token, expires_in)
+
+async def refresh_user_token(client: httpx.AsyncClient, user_id: str, refresh_token: str):
+    """Обновление access_token по refresh_token"""
+    if not await token_store.claim_refresh(user_id, TOKEN_REFRESH_LEASE):
+        # Токен уже обновляет другой воркер или реплика
+        return
+    
+    try:
+        response = await client.post(
+            "https://oauth.yandex.ru/token",
+            data={
+                "grant_type": "refresh_token",
+                "refresh_token": refresh_token,
+                "client_id": CLIENT_ID,
+                "client_secret": CLIENT_SECRET
+            }
+        )
+    except httpx.RequestError:
+        await token_store.postpone_refresh(user_id)
+        return
+    
+    if 400 <= response.status_code < 500 and response.status_code != 429:
+        # invalid_grant и т.п.: повтор с тем же refresh_token бесполезен до нового входа
+        await token_store.drop_refresh(user_id)
+        return
+    
+    try:
+        token_data = response.json() if response.status_code == 200 else {}
+    except ValueError:
+        token_data = {}
+    if not isinstance(token_data, dict) or not token_data.get("access_token"):
+        await token_store.postpone_refresh(user_id)
+        return
+    
+    await save_user_token(
+        user_id,
+        token_data.get("access_token"),
+        token_data.get("refresh_token"),
+        token_data.get("expires_in")
+    )
+
+async def token_refresh_loop():
+    """Фоновое обновление токенов до истечения их срока"""
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        while True:
+            try:
+                due = await token_store.due_for_refresh(TOKEN_REFRESH_BATCH)
+                results = await asyncio.gather(
+                    *(refresh_user_token(client, user_id, refresh_token) for user_id, refresh_token in due),
+                    return_exceptions=True
+                )
+                for (user_id, _), result in zip(due, results):
+                    if isinstance(result, Exception):
+                        logger.error("Token refresh failed for user %s", user_id, exc_info=result)
+            except Exception:
+                logger.exception("Token refresh pass failed")
+            await asyncio.sleep(TOKEN_REFRESH_INTERVAL + random.uniform(0, TOKEN_REFRESH_INTERVAL / 2))
+
+@app.on_event("startup")
+async def start_token_refresh():
+    """Запуск планировщика обновления токенов"""
+    if CLIENT_ID and CLIENT_SECRET:
+        app.state.token_refresh_task = asyncio.create_task(token_refresh_loop())
+
+@app.on_event("shutdown")
+async def stop_token_refresh():
+    """Остановка планировщика обновления токенов"""
+    task = getattr(app.state, "token_refresh_task", None)
+    if task:
+        task.cancel()
+
+class UpstreamError(Exception):
+    """Ошибка ответа Яндекс Почты"""
+
+async def sync_mailbox(client: httpx.AsyncClient, user_id: str, yandex_token: str) -> List[Dict]:
+    """Инкрементальная синхронизация ящика: забираем только письма новее последнего увиденного.
+
+    Возвращает новые письма.
+    """
+    state = await message_store.sync_state(user_id)
+    last_message_id = state["last_message_id"] if state else None
+    last_date = state["last_date"] if state else None
+    
+    added: List[Dict] = []
+    newest: Optional[Dict] = None
+    offset = 0
+    while offset < SYNC_MAX_MESSAGES:
+        params = {"limit": SYNC_PAGE_SIZE, "offset": offset}
+        if last_date:
+            params["since"] = last_date
+        response = await client.get(
+            f"{MAIL_API_URL}/messages",
+            headers={"Authorization": f"OAuth {yandex_token}"},
+            params=params
+        )
+        if response.status_code != 200:
+            raise UpstreamError(f"Yandex Mail returned {response.status_code}")
+        
+        try:
+            page = response.json().get("messages", [])
+        except (ValueError, AttributeError):
+            raise UpstreamError("Yandex Mail returned invalid JSON")
+        if newest is None and page:
+            newest = page[0]
+        # Письма идут от новых к старым: дошли до последнего увиденного - дальше все известно
+        known_index = next(
+            (index for index, message in enumerate(page) if str(message.get("id")) == last_message_id),
+            None
+        )
+        # Первичная загрузка ящика - не изменения, в ленту попадает только новая почта
+        added.extend(await message_store.add_messages(user_id, page[:known_index], record_changes=state is not None))
+        if known_index is not None or len(page) < SYNC_PAGE_SIZE:
+            break
+        offset += SYNC_PAGE_SIZE
+    
+    await message_store.mark_synced(
+        user_id,
+        str(newest.get("id")) if newest else None,
+        newest.get("date") if newest else None
+    )
+    if added:
+        await notify_changes()
+    return added
+
+# Будит ожидающие запросы ленты изменений этого процесса
+changes_condition = asyncio.Condition()
+
+async def notify_changes():
+    async with changes_condition:
+        changes_condition.notify_all()
+
+async def wait_for_changes(timeout: float):
+    """Ожидание новых изменений в этом процессе, не дольше timeout"""
+    async with changes_condition:
+        try:
+            await asyncio.wait_for(changes_condition.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+async def ensure_synced(user_id: str, yandex_token: str) -> bool:
+    """Синхронизация ящика при первом обращении; дальше почту подтягивает фоновый цикл.
+
+    Возвращает False, если ящик не синхронизирован и Яндекс недоступен.
+    """
+    if await message_store.sync_state(user_id) is not None:
+        return True
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        try:
+            await sync_mailbox(client, user_id, yandex_token)
+        except (UpstreamError, httpx.RequestError):
+            return False
+    return True
+
+async def sync_user(client: httpx.AsyncClient, user_id: str):
+    """Фоновая синхронизация ящика одного пользователя"""
+    if not await message_store.claim_sync(user_id, SYNC_LEASE):
+        # Ящик уже синхронизирует другой воркер или реплика
+        return
+    yandex_token = await get_user_token(user_id)
+    if yandex_token:
+        await sync_mailbox(client, user_id, yandex_token)
+
+async def mailbox_sync_loop():
+    """Периодическая синхронизация ящиков всех пользователей с токеном"""
+    semaphore = asyncio.Semaphore(SYNC_CONCURRENCY)
+    
+    async def run(client: httpx.AsyncClient, user_id: str):
+        async with semaphore:
+            await sync_user(client, user_id)
+    
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        while True:
+            try:
+                user_ids = await token_store.user_ids()
+                results = await asyncio.gather(*(run(client, user_id) for user_id in user_ids), return_exceptions=True)
+                for user_id, result in zip(user_ids, results):
+                    if isinstance(result, Exception):
+                        logger.error("Mailbox sync failed for user %s", user_id, exc_info=result)
+                await message_store.prune_changes(CHANGES_RETENTION_DAYS)
+            except Exception:
+                logger.exception("Mailbox sync pass failed")
+            await asyncio.sleep(SYNC_INTERVAL + random.uniform(0, SYNC_INTERVAL / 2))
+
+@app.on_event("startup")
+async def start_migrations():
+    """Запуск фоновых миграций хранилища писем"""
+    app.state.migration_task = asyncio.create_task(message_store.migrate())
+
+@app.on_event("shutdown")
+async def stop_migrations():
+    """Остановка миграций; следующий запуск продолжит с сохраненной позиции"""
+    task = getattr(app.state, "migration_task", None)
+    if task:
+        task.cancel()
+
+@app.on_event("startup")
+async def start_mailbox_sync():
+    """Запуск фоновой синхронизации почты"""
+    app.state.mailbox_sync_task = asyncio.create_task(mailbox_sync_loop())
+
+@app.on_event("shutdown")
+async def stop_mailbox_sync():
+    """Остановка фоновой синхронизации почты"""
+    task = getattr(app.state, "mailbox_sync_task", None)
+    if task:
+        task.cancel()
+
+def decode_mime_header(value) -> str:
+    """Заголовок письма с раскодированными RFC 2047 вставками (=?utf-8?B?...?=)"""
+    if value is None:
+        return ""
+    value = str(value)
+    try:
+        # Неперекодированные 8-битные заголовки (обычно UTF-8) парсер отдает как surrogateescape
+        value = value.encode("ascii", "surrogateescape").decode("utf-8", "replace")
+    except UnicodeEncodeError:
+        pass
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return str(value)
+
+def mail_text(mail: Message) -> str:
+    """Текст письма: первая text/plain часть, иначе text/html без разметки"""
+    html = None
+    for part in mail.walk():
+        content_type = part.get_content_type()
+        if part.is_multipart() or part.get_filename() or content_type not in ("text/plain", "text/html"):
+            continue
+        payload = part.get_payload(decode=True) or b""
+        text = payload.decode(part.get_content_charset() or "utf-8", errors="replace")
+        if content_type == "text/plain":
+            return text
+        if html is None:
+            html = HTML_TAG_RE.sub(" ", text)
+    return html or ""
+
+def mail_date(value: str) -> str:
+    """Дата письма в UTC в формате ISO, как у писем из Яндекс Почты"""
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError, IndexError):
+        return ""
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+    return date.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+def attachment_path(sha256: str) -> Path:
+    return ATTACHMENTS_DIR / sha256[:2] / sha256
+
+def save_attachment(payload: bytes) -> str:
+    """Запись вложения в хранилище по SHA-256; одинаковые вложения хранятся один раз"""
+    sha256 = hashlib.sha256(payload).hexdigest()
+    path = attachment_path(sha256)
+    if not path.exists():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary = path.with_name(f"{sha256}.{os.getpid()}.tmp")
+        temporary.write_bytes(payload)
+        temporary.replace(path)
+    return sha256
+
+def mail_attachments(mail: Message) -> List[Dict]:
+    """Вложения письма: содержимое сохраняется на диск, в письме остаются описания"""
+    attachments = []
+    for part in mail.walk():
+        filename = part.get_filename()
+        if part.is_multipart() or not (filename or part.get_content_disposition() == "attachment"):
+            continue
+        payload = part.get_payload(decode=True) or b""
+        attachments.append({
+            "id": str(len(attachments) + 1),
+            "filename": decode_mime_header(filename) if filename else f"attachment-{len(attachments) + 1}",
+            "content_type": part.get_content_type(),
+            "size": len(payload),
+            "sha256": save_attachment(payload)
+        })
+    return attachments
+
+def parse_mail(raw: bytes) -> Dict:
+    """Разбор одного письма RFC 822 в формат хранилища"""
+    mail = BytesParser().parsebytes(raw)
+    raw_headers: Dict[str, str] = {}
+    for name, value in mail.raw_items():
+        raw_headers.setdefault(name.lower(), value)
+    headers = {
+        name: decode_mime_header(raw_headers[name.lower()])
+        for name in IMPORT_HEADERS
+        if name.lower() in raw_headers
+    }
+    message_id = headers.get("Message-ID") or hashlib.sha1(raw).hexdigest()
+    name, address = parseaddr(headers.get("From", ""))
+    body = mail_text(mail)[:IMPORT_MAX_BODY_CHARS]
+    attachments = mail_attachments(mail)
+    return {
+        # Идентификатор из Message-ID: повторный импорт того же архива не дублирует письма
+        "id": "imp_" + hashlib.sha1(message_id.encode()).hexdigest()[:20],
+        "from": {"name": name, "email": address} if name else address,
+        "subject": headers.get("Subject", ""),
+        "date": mail_date(headers.get("Date", "")),
+        "snippet": " ".join(body[:IMPORT_SNIPPET_CHARS].split()),
+        "body": body,
+        "headers": headers,
+        "attachments": attachments,
+        "has_attachments": bool(attachments)
+    }
+
+def parse_mbox_spans(path: str, spans: List[Tuple[int, int]]) -> Tuple[List[Dict], List[bytes], int]:
+    """Разбор писем mbox по смещениям (выполняется в процессе пула).
+
+    Файл отображается в память, письмо копируется только на время разбора,
+    прочитанные страницы сразу отдаются системе. Возвращает письма, их сжатые
+    тела и число ошибок: сжатие тоже делается здесь, а не в процессе сервиса.
+    """
+    messages = []
+    failed = 0
+    with open(path, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        for start, end in spans:
+            try:
+                messages.append(parse_mail(mm[start:end]))
+            except Exception:
+                failed += 1
+        page_start = spans[0][0] - spans[0][0] % mmap.PAGESIZE
+        mm.madvise(mmap.MADV_DONTNEED, page_start, spans[-1][1] - page_start)
+    return messages, [compress_message(message) for message in messages], failed
+
+def parse_eml_files(paths: List[str]) -> Tuple[List[Dict], List[bytes], int]:
+    """Разбор .eml файлов (выполняется в процессе пула)"""
+    messages = []
+    failed = 0
+    for path in paths:
+        try:
+            with open(path, "rb") as file:
+                messages.append(parse_mail(file.read()))
+        except Exception:
+            failed += 1
+    return messages, [compress_message(message) for message in messages], failed
+
+def is_mbox_from_line(mm: mmap.mmap, position: int) -> bool:
+    """Начинается ли с position строка-разделитель mbox"""
+    line_end = mm.find(b"\n", position, position + 1024)
+    return MBOX_FROM_LINE_RE.match(mm[position:line_end if line_end != -1 else position + 1024]) is not None
+
+def iter_mbox_chunks(path: Path) -> Iterable[Tuple[List[Tuple[int, int]], int]]:
+    """Границы писем в mbox (без строки-разделителя "From "), сгруппированные
+    в задания примерно по IMPORT_CHUNK_BYTES.
+
+    Файл не читается целиком: поиск разделителей идет по отображению в память,
+    просмотренные страницы освобождаются. Файл без строки "From " в начале
+    считается одним письмом (.eml).
+    """
+    with open(path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+            size = len(mm)
+            if not mm[:5] == b"From ":
+                yield [(0, size)], size
+                return
+            spans: List[Tuple[int, int]] = []
+            chunk_start = start = 0
+            released = 0
+            while start < size:
+                # "From " в начале строки тела (неэкранированное) - не разделитель
+                end = mm.find(b"\nFrom ", start + 1)
+                while end != -1 and not is_mbox_from_line(mm, end + 1):
+                    end = mm.find(b"\nFrom ", end + 1)
+                end = size if end == -1 else end + 1
+                # Первая строка письма - разделитель "From отправитель дата"
+                body_start = mm.find(b"\n", start, end) + 1 or end
+                spans.append((body_start, end))
+                start = end
+                if start - chunk_start >= IMPORT_CHUNK_BYTES or start >= size:
+                    yield spans, start - chunk_start
+                    spans = []
+                    chunk_start = start
+                    page = start - start % mmap.PAGESIZE
+                    if page > released:
+                        mm.madvise(mmap.MADV_DONTNEED, released, page - released)
+                        released = page
+
+def iter_eml_chunks(directory: Path) -> Iterable[Tuple[List[str], int]]:
+    """Файлы .eml каталога (рекурсивно), сгруппированные в задания"""
+    paths: List[str] = []
+    size = 0
+    for path in sorted(directory.rglob("*.eml")):
+        paths.append(str(path))
+        size += path.stat().st_size
+        if size >= IMPORT_CHUNK_BYTES or len(paths) >= IMPORT_CHUNK_FILES:
+            yield paths, size
+            paths, size = [], 0
+    if paths:
+        yield paths, size
+
+# Не больше одного импорта в процессе одновременно: пул и так занимает все ядра
+import_semaphore = asyncio.Semaphore(1)
+# Ссылки на фоновые задачи импорта, чтобы их не собрал сборщик мусора
+import_tasks = set()
+
+async def run_mail_import(import_id: str, user_id: str, source: Path, remove_source: bool):
+    """Импорт архива в хранилище писем.
+
+    Разбор идет в пуле процессов; в работе не больше двух заданий на процесс,
+    поэтому память ограничена независимо от размера архива. Результаты пишутся
+    в хранилище пакетами по мере готовности, прогресс - в таблицу imports.
+    """
+    loop = asyncio.get_running_loop()
+    if source.is_dir():
+        chunks = iter(iter_eml_chunks(source))
+        parse = parse_eml_files
+    else:
+        chunks = iter(iter_mbox_chunks(source))
+        parse = functools.partial(parse_mbox_spans, str(source))
+    
+    progress = {"bytes_done": 0, "messages": 0, "imported": 0, "failed": 0}
+    
+    async def store(future: asyncio.Future):
+        messages, bodies, failed = future.result()
+        added = await message_store.add_messages(user_id, messages, record_changes=False, bodies=bodies)
+        progress["bytes_done"] += future.chunk_size
+        progress["messages"] += len(messages) + failed
+        progress["imported"] += len(added)
+        progress["failed"] += failed
+        await message_store.update_import(import_id, **progress)
+    
+    try:
+        async with import_semaphore:
+            # fork из многопоточного процесса (потоки to_thread, соединения SQLite)
+            # может оставить процесс пула с захваченной блокировкой
+            pool = ProcessPoolExecutor(
+                max_workers=IMPORT_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+            )
+            pending = set()
+            try:
+                while True:
+                    chunk = await asyncio.to_thread(next, chunks, None)
+                    if chunk is None:
+                        break
+                    future = loop.run_in_executor(pool, parse, chunk[0])
+                    future.chunk_size = chunk[1]
+                    pending.add(future)
+                    if len(pending) >= IMPORT_WORKERS * 2:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for future in done:
+                            await store(future)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        await store(future)
+            finally:
+                # После ошибки оставшиеся задания не нужны; ожидание пула не держит цикл событий
+                for future in pending:
+                    future.cancel()
+                await asyncio.to_thread(pool.shutdown, cancel_futures=True)
+        await message_store.update_import(import_id, status="done", finished_at=time.time())
+    except Exception as e:
+        await message_store.update_import(
+            import_id, status="failed", error=str(e) or type(e).__name__, finished_at=time.time()
+        )
+    finally:
+        if remove_source:
+            source.unlink(missing_ok=True)
+
+def import_status(job: Dict) -> Dict:
+    """Публичное представление импорта с пропускной способностью"""
+    elapsed = (job["finished_at"] or time.time()) - job["started_at"]
+    return {
+        "import_id": job["id"],
+        "status": job["status"],
+        "source": job["source"],
+        "bytes_total": job["bytes_total"],
+        "bytes_done": job["bytes_done"],
+        "messages": job["messages"],
+        "imported": job["imported"],
+        "duplicates": job["messages"] - job["imported"] - job["failed"],
+        "failed": job["failed"],
+        "error": job["error"],
+        "elapsed_seconds": round(elapsed, 1),
+        "messages_per_second": round(job["messages"] / elapsed, 1) if elapsed > 0 else None,
+        "mb_per_second": round(job["bytes_done"] / 1024 / 1024 / elapsed, 2) if elapsed > 0 else None
+    }
+
+def send_job_status(job: Dict) -> Dict:
+    """Публичное представление задания отправки"""
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "attempts": job["attempts"],
+        "to": job["payload"]["to"],
+        "subject": job["payload"]["subject"],
+        "last_error": job["last_error"],
+        "result": job["result"],
+        "created_at": datetime.utcfromtimestamp(job["created_at"]).isoformat(),
+        "updated_at": datetime.utcfromtimestamp(job["updated_at"]).isoformat()
+    }
+
+async def deliver(client: httpx.AsyncClient, job: Dict):
+    """Одна попытка отправки письма через Яндекс Почту.
+
+    Любой исход попытки записывается в задание: иначе оно осталось бы в sending
+    и после аренды ушло бы повторно, не увеличив счетчик попыток.
+    """
+    accepted = False
+    try:
+        yandex_token = await get_user_token(job["user_id"])
+        if not yandex_token:
+            await send_queue.mark_failed(job, "Yandex Mail account is not connected", retryable=False)
+            return
+        
+        try:
+            response = await client.post(
+                f"{MAIL_API_URL}/messages/send",
+                headers={"Authorization": f"OAuth {yandex_token}"},
+                json=job["payload"]
+            )
+        except httpx.RequestError as e:
+            await send_queue.mark_failed(job, str(e) or type(e).__name__, retryable=True)
+            return
+        
+        if not response.is_success:
+            await send_queue.mark_failed(
+                job, f"Yandex Mail returned {response.status_code}",
+                retryable=response.status_code in RETRYABLE_STATUSES
+            )
+            return
+        
+        # Письмо принято; тело ответа может быть не JSON, но повторять отправку нельзя
+        accepted = True
+        try:
+            result = response.json()
+        except ValueError:
+            result = {"status_code": response.status_code}
+        await send_queue.mark_sent(job, result)
+    except Exception as e:
+        if accepted:
+            # Письмо уже ушло: повтор отправил бы его второй раз
+            await send_queue.mark_failed(job, f"Sent, but the result was not saved: {e!r}", retryable=False)
+        else:
+            await send_queue.mark_failed(job, repr(e), retryable=True)
+
+async def send_worker(client: httpx.AsyncClient):
+    """Воркер очереди: забирает готовые задания, пока они есть, затем ждет сигнала или опроса"""
+    while True:
+        send_queue_event.clear()
+        try:
+            job = await send_queue.claim(SEND_LEASE)
+            if job:
+                await deliver(client, job)
+                continue
+        except Exception:
+            # Сбой базы очереди не останавливает воркер: следующая попытка - после ожидания
+            logger.exception("Send worker pass failed")
+        
+        try:
+            await asyncio.wait_for(send_queue_event.wait(), SEND_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+@app.on_event("startup")
+async def start_send_workers():
+    """Запуск пула воркеров отправки"""
+    app.state.send_client = httpx.AsyncClient(timeout=30.0)
+    app.state.send_workers = [
+        asyncio.create_task(send_worker(app.state.send_client)) for _ in range(SEND_WORKERS)
     ]
-    email_lower = email.lower()
-    return not any(domain in email_lower for domain in mailing_domains)
+
+@app.on_event("shutdown")
+async def stop_send_workers():
+    """Остановка воркеров; незавершенные задания подхватит следующий запуск по истечении аренды"""
+    for task in getattr(app.state, "send_workers", []):
+        task.cancel()
+    client = getattr(app.state, "send_client", None)
+    if client:
+        await client.aclose()
+
+@lru_cache(maxsize=SENDER_CACHE_SIZE)
+def is_automated_address(email: str) -> bool:
+    """Адрес рассылки или робота (noreply, newsletter и т.п.); вердикт кэшируется по адресу"""
+    return AUTOMATED_SENDER_RE.search(email) is not None
+
+def is_bulk_message(message: Dict) -> bool:
+    """Признаки массовой рассылки в заголовках письма"""
+    headers = message_headers(message)
+    if not headers:
+        return False
+    if "list-unsubscribe" in headers or "list-id" in headers:
+        return True
+    if headers.get("precedence", "").strip().lower() in BULK_PRECEDENCE:
+        return True
+    auto_submitted = headers.get("auto-submitted", "").strip().lower()
+    return bool(auto_submitted) and auto_submitted != "no"
+
+class SenderClassifier:
+    """Классификатор отправителей, собираемый один раз на запрос.
+
+    Важные и игнорируемые адреса - множества с поиском за O(1), адреса рассылок
+    проверяются одним скомпилированным регулярным выражением с кэшем по адресу.
+    """
+
+    def __init__(self, important: Iterable[str] = (), ignored: Iterable[str] = ()):
+        self.important = frozenset(address.strip().lower() for address in important)
+        self.ignored = frozenset(address.strip().lower() for address in ignored)
+
+    def is_important(self, message: Dict) -> bool:
+        return sender_email(message) in self.important
+
+    def is_human(self, message: Dict) -> bool:
+        """Письмо от человека: не из игнора, не с адреса рассылки и без признаков рассылки"""
+        sender = sender_email(message)
+        if sender in self.ignored:
+            return False
+        if sender in self.important:
+            return True
+        return not is_automated_address(sender) and not is_bulk_message(message)
+
+# Классификатор на пользователя: пересобирается, только когда изменились настройки
+sender_classifiers: Dict[str, Tuple[Dict, SenderClassifier]] = {}
+
+async def get_sender_classifier(user_id: str, token: str) -> SenderClassifier:
+    """Классификатор отправителей по сохраненным настройкам пользователя"""
+    prefs = await preferences_cache.get(user_id, token)
+    cached = sender_classifiers.get(user_id)
+    if cached and cached[0] is prefs:
+        return cached[1]
+    classifier = SenderClassifier(prefs.get("important_contacts", []), prefs.get("ignored_senders", []))
+    sender_classifiers[user_id] = (prefs, classifier)
+    return classifier
 
 @app.get("/oauth/authorize")
-async def authorize():
+async def authorize(credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security)):
     """Получение URL для авторизации"""
     if not CLIENT_ID:
         raise HTTPException(status_code=500, detail="Yandex Email API not configured")
@@ -53,6 +1711,9 @@ async def authorize():
         "redirect_uri": REDIRECT_URI,
         "scope": "mail:read mail:write"
     }
+    if credentials:
+        # Привязываем будущий токен Яндекса к пользователю из JWT
+        params["state"] = create_oauth_state(get_user_id(credentials))
     auth_url = f"https://oauth.yandex.ru/authorize?{urlencode(params)}"
     
     return {"auth_url": auth_url}
@@ -79,6 +1740,8 @@ async def callback(code: str, state: Optional[str] = None):
         
         token_data = response.json()
         access_token = token_data.get("access_token")
+        refresh_token = token_data.get("refresh_token")
+        expires_in = token_data.get("expires_in")
         
         user_info_response = await client.get(
             "https://login.yandex.ru/info",
@@ -87,8 +1750,8 @@ async def callback(code: str, state: Optional[str] = None):
         
         if user_info_response.status_code == 200:
             user_info = user_info_response.json()
-            user_id = user_info.get("id")
-            save_user_token(user_id, access_token)
+            user_id = parse_oauth_state(state) or str(user_info.get("id"))
+            await save_user_token(user_id, access_token, refresh_token, expires_in)
             
             return {
                 "access_token": access_token,
@@ -105,10 +1768,9 @@ async def get_messages(
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """Получение списка писем"""
-    token = credentials.credentials
-    user_id = "default"
+    user_id = get_user_id(credentials)
     
-    yandex_token = get_user_token(user_id)
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
         # Заглушка
         return {
@@ -124,65 +1786,330 @@ async def get_messages(
             ]
         }
     
-    # Парсинг списка важных контактов
-    important_list = []
+    classifier = await get_sender_classifier(user_id, credentials.credentials)
+    
+    # Список важных контактов в запросе (устаревший способ) дополняет сохраненные настройки
     if important_contacts:
         try:
-            import json
             important_list = json.loads(important_contacts)
         except:
-            pass
-    
-    async with httpx.AsyncClient() as client:
-        try:
-            # Получение писем через Яндекс Mail API
-            response = await client.get(
-                "https://mail.yandex.ru/api/v1/messages",
-                headers={"Authorization": f"OAuth {yandex_token}"},
-                params={"limit": limit}
+            important_list = []
+        if not isinstance(important_list, list):
+            important_list = []
+        # Из списка в запросе берутся только строки с адресами
+        important_list = [contact for contact in important_list if isinstance(contact, str)]
+        if important_list:
+            classifier = SenderClassifier(
+                classifier.important | {contact.lower() for contact in important_list},
+                classifier.ignored
             )
-            
-            if response.status_code == 200:
-                data = response.json()
-                messages = data.get("messages", [])
-                
-                # Фильтрация: только от людей
-                filtered_messages = []
-                for msg in messages:
-                    sender = msg.get("from", {}).get("email", "")
-                    if is_human_email(sender):
-                        msg["is_important"] = sender.lower() in [c.lower() for c in important_list]
-                        filtered_messages.append(msg)
-                
-                return {"messages": filtered_messages[:limit]}
-            else:
-                # Заглушка
-                return {
-                    "messages": [
-                        {
-                            "id": "1",
-                            "from": "example@mail.ru",
-                            "subject": "Пример письма",
-                            "snippet": "Это пример письма",
-                            "date": "2024-01-15T10:00:00Z",
-                            "is_important": False
-                        }
-                    ]
+    
+    if not await ensure_synced(user_id, yandex_token):
+        # Заглушка
+        return {
+            "messages": [
+                {
+                    "id": "1",
+                    "from": "example@mail.ru",
+                    "subject": "Пример письма (заглушка)",
+                    "snippet": "Это пример письма",
+                    "date": "2024-01-15T10:00:00Z",
+                    "is_important": False
                 }
-        except Exception as e:
-            # Заглушка
-            return {
-                "messages": [
-                    {
+            ]
+        }
+    
+    # Фильтрация: только от людей
+    messages = await message_store.list_messages(user_id, limit, classifier.is_human)
+    for msg in messages:
+        msg["is_important"] = classifier.is_important(msg)
+    
+    return {"messages": messages}
+
+@app.get("/messages/search")
+async def search_messages(
+    q: str = Query(..., min_length=1),
+    sender: Optional[str] = Query(None),
+    date_from: Optional[str] = Query(None),
+    date_to: Optional[str] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Полнотекстовый поиск по почте (тема, отправитель, тело)"""
+    user_id = get_user_id(credentials)
+    
+    match = fts_query(q)
+    if not match:
+        raise HTTPException(status_code=400, detail="Empty search query")
+    
+    yandex_token = await get_user_token(user_id)
+    if yandex_token:
+        await ensure_synced(user_id, yandex_token)
+    
+    messages = await message_store.search(user_id, match, sender, date_from, date_to, limit)
+    return {"messages": messages}
+
+def parse_changes_cursor(cursor: Optional[str]) -> Optional[int]:
+    if cursor is None:
+        return None
+    try:
+        return int(cursor)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+async def next_changes(user_id: str, since: int, deadline: float) -> Tuple[List[Dict], bool]:
+    """Изменения после since; если их нет - ждем до deadline.
+
+    Изменения этого процесса будят ожидание сразу, изменения других
+    процессов замечаются при перечитывании ленты раз в CHANGES_POLL_INTERVAL.
+    """
+    while True:
+        changes, expired = await message_store.changes(user_id, since, CHANGES_PAGE_SIZE)
+        remaining = deadline - time.monotonic()
+        if changes or expired or remaining <= 0:
+            return changes, expired
+        await wait_for_changes(min(remaining, CHANGES_POLL_INTERVAL))
+
+async def stream_changes(user_id: str, since: int) -> AsyncIterator[bytes]:
+    """Лента изменений в формате Server-Sent Events"""
+    yield b"retry: 5000\n\n"
+    while True:
+        changes, expired = await next_changes(user_id, since, time.monotonic() + SSE_KEEPALIVE)
+        if expired:
+            yield b"event: reset\ndata: {}\n\n"
+        for change in changes:
+            since = change["seq"]
+            yield (
+                f"id: {since}\nevent: {change['type']}\n"
+                f"data: {json.dumps(change, ensure_ascii=False)}\n\n"
+            ).encode()
+        if not changes:
+            # Комментарий не дает прокси закрыть простаивающее соединение
+            yield b": keepalive\n\n"
+
+@app.get("/changes")
+async def get_changes(
+    request: Request,
+    since: Optional[str] = Query(None, description="Курсор из предыдущего ответа"),
+    timeout: float = Query(CHANGES_TIMEOUT, ge=0, le=120),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Лента изменений ящика (новые письма).
+
+    Long-poll: отвечает сразу, если после since есть изменения, иначе ждет
+    их до timeout секунд и возвращает пустой список с тем же курсором.
+    Без since возвращает текущий курсор - с него потребитель начинает следить.
+    reset=true означает, что курсор старше хранимой истории и ящик нужно
+    перечитать через /messages.
+
+    С заголовком Accept: text/event-stream отдает поток Server-Sent Events;
+    курсор берется из since или Last-Event-ID.
+    """
+    user_id = get_user_id(credentials)
+    cursor = parse_changes_cursor(since or request.headers.get("last-event-id"))
+    
+    if "text/event-stream" in request.headers.get("accept", ""):
+        if cursor is None:
+            cursor = await message_store.latest_seq()
+        return StreamingResponse(
+            stream_changes(user_id, cursor),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+    
+    if cursor is None:
+        return {"changes": [], "cursor": str(await message_store.latest_seq()), "reset": False}
+    
+    changes, expired = await next_changes(user_id, cursor, time.monotonic() + timeout)
+    return {
+        "changes": changes,
+        "cursor": str(changes[-1]["seq"] if changes else cursor),
+        "reset": expired
+    }
+
+def encode_thread_cursor(thread: Dict) -> str:
+    """Курсор списка цепочек: дата и идентификатор последней цепочки страницы"""
+    return f"{thread['last_date']}|{thread['thread_id']}"
+
+def decode_thread_cursor(cursor: str) -> Tuple[str, str]:
+    """Разбор курсора; одна дата (прежний формат курсора) - все цепочки до нее"""
+    last_date, _, thread_id = cursor.rpartition("|")
+    return (last_date, thread_id) if last_date else (cursor, "")
+
+@app.get("/threads")
+async def get_threads(
+    limit: int = Query(20, ge=1, le=100),
+    before: Optional[str] = Query(None, description="next_before из ответа с предыдущей страницей"),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Список цепочек писем, от самой свежей"""
+    user_id = get_user_id(credentials)
+    
+    yandex_token = await get_user_token(user_id)
+    if not yandex_token or not await ensure_synced(user_id, yandex_token):
+        # Заглушка
+        return {
+            "threads": [
+                {
+                    "thread_id": "t1",
+                    "subject": "Пример письма",
+                    "message_count": 1,
+                    "participants": ["example@mail.ru"],
+                    "first_date": "2024-01-15T10:00:00Z",
+                    "last_date": "2024-01-15T10:00:00Z",
+                    "last_message": {
                         "id": "1",
                         "from": "example@mail.ru",
-                        "subject": "Пример письма (заглушка)",
-                        "snippet": "Это пример письма",
-                        "date": "2024-01-15T10:00:00Z",
-                        "is_important": False
+                        "subject": "Пример письма",
+                        "snippet": "Это пример письма от человека",
+                        "date": "2024-01-15T10:00:00Z"
                     }
-                ]
-            }
+                }
+            ],
+            "next_before": None
+        }
+    
+    threads = await message_store.list_threads(user_id, limit, decode_thread_cursor(before) if before else None)
+    return {
+        "threads": threads,
+        "next_before": encode_thread_cursor(threads[-1]) if len(threads) == limit else None
+    }
+
+@app.get("/threads/{thread_id}")
+async def get_thread(
+    thread_id: str,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Цепочка писем со всеми письмами"""
+    user_id = get_user_id(credentials)
+    
+    thread = await message_store.get_thread(user_id, thread_id)
+    if not thread:
+        raise HTTPException(status_code=404, detail="Thread not found")
+    return thread
+
+def parse_range(header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """Диапазон из заголовка Range (один, в байтах): (начало, конец включительно) или None"""
+    if not header or not header.startswith("bytes=") or "," in header:
+        return None
+    start, _, end = header[len("bytes="):].strip().partition("-")
+    try:
+        if not start:
+            # bytes=-N: последние N байт
+            start, end = max(size - int(end), 0), size - 1
+        else:
+            start, end = int(start), min(int(end), size - 1) if end else size - 1
+    except ValueError:
+        return None
+    if start > end or start >= size:
+        raise HTTPException(
+            status_code=416, detail="Range not satisfiable", headers={"Content-Range": f"bytes */{size}"}
+        )
+    return start, end
+
+async def iter_file(path: Path, start: int, length: int) -> AsyncIterator[bytes]:
+    """Чтение части файла кусками по ATTACHMENT_CHUNK_SIZE"""
+    with open(path, "rb") as file:
+        file.seek(start)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(ATTACHMENT_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+def local_attachment_response(attachment: Dict, path: Path, range_header: Optional[str]) -> StreamingResponse:
+    """Вложение из локального хранилища с поддержкой Range"""
+    size = path.stat().st_size
+    byte_range = parse_range(range_header, size)
+    start, end = byte_range or (0, size - 1)
+    filename = quote(attachment.get("filename") or "attachment")
+    headers = {
+        "Accept-Ranges": "bytes",
+        "Content-Length": str(end - start + 1 if size else 0),
+        "Content-Disposition": f"attachment; filename*=UTF-8''{filename}",
+        "ETag": f'"{attachment["sha256"]}"'
+    }
+    if byte_range:
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return StreamingResponse(
+        iter_file(path, start, end - start + 1 if size else 0),
+        status_code=206 if byte_range else 200,
+        media_type=attachment.get("content_type") or "application/octet-stream",
+        headers=headers
+    )
+
+async def close_upstream(response: httpx.Response, client: httpx.AsyncClient):
+    await response.aclose()
+    await client.aclose()
+
+@app.get("/messages/{message_id}/attachments/{attachment_id}")
+async def download_attachment(
+    message_id: str,
+    attachment_id: str,
+    request: Request,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Скачивание вложения потоком, с поддержкой Range.
+
+    Вложения импортированных писем отдаются с диска, остальные проксируются
+    из Яндекс Почты кусками по мере получения, не загружаясь в память целиком.
+    """
+    user_id = get_user_id(credentials)
+    range_header = request.headers.get("range")
+    
+    message = await message_store.get_message(user_id, message_id)
+    attachment = next(
+        (item for item in attachment_metadata(message or {}) if str(item.get("id")) == attachment_id),
+        None
+    )
+    if attachment and attachment.get("sha256"):
+        path = attachment_path(attachment["sha256"])
+        if path.exists():
+            return local_attachment_response(attachment, path, range_header)
+    
+    yandex_token = await get_user_token(user_id)
+    if not yandex_token:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    
+    # Байты отдаются клиенту как есть (aiter_raw), поэтому сжатие не запрашивается:
+    # иначе Range и Content-Length относились бы к сжатому телу
+    headers = {"Authorization": f"OAuth {yandex_token}", "Accept-Encoding": "identity"}
+    if range_header:
+        headers["Range"] = range_header
+    client = httpx.AsyncClient(timeout=30.0)
+    try:
+        response = await client.send(
+            client.build_request(
+                "GET", f"{MAIL_API_URL}/messages/{message_id}/attachments/{attachment_id}", headers=headers
+            ),
+            stream=True
+        )
+    except httpx.RequestError:
+        await client.aclose()
+        raise HTTPException(status_code=502, detail="Yandex Mail unavailable")
+    
+    if response.status_code not in [200, 206]:
+        await close_upstream(response, client)
+        if response.status_code == 416:
+            raise HTTPException(status_code=416, detail="Range not satisfiable")
+        raise HTTPException(
+            status_code=404 if response.status_code == 404 else 502,
+            detail=f"Yandex Mail returned {response.status_code}"
+        )
+    
+    # Если Яндекс все же сжал ответ, Content-Encoding уходит вместе со сжатым телом
+    passthrough = {
+        name: response.headers[name]
+        for name in ATTACHMENT_PASSTHROUGH_HEADERS
+        if name in response.headers
+    }
+    return StreamingResponse(
+        response.aiter_raw(),
+        status_code=response.status_code,
+        headers=passthrough,
+        background=BackgroundTask(close_upstream, response, client)
+    )
 
 @app.get("/messages/{message_id}")
 async def get_message(
@@ -190,10 +2117,9 @@ async def get_message(
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
     """Получение полного текста письма"""
-    token = credentials.credentials
-    user_id = "default"
+    user_id = get_user_id(credentials)
     
-    yandex_token = get_user_token(user_id)
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
         return {
             "id": message_id,
@@ -203,15 +2129,21 @@ async def get_message(
             "date": "2024-01-15T10:00:00Z"
         }
     
+    stored = await message_store.get_message(user_id, message_id)
+    if stored:
+        return stored
+    
     async with httpx.AsyncClient() as client:
         try:
             response = await client.get(
-                f"https://mail.yandex.ru/api/v1/messages/{message_id}",
+                f"{MAIL_API_URL}/messages/{message_id}",
                 headers={"Authorization": f"OAuth {yandex_token}"}
             )
             
             if response.status_code == 200:
-                return response.json()
+                message = strip_attachment_content(response.json())
+                await message_store.save_message(user_id, message_id, message)
+                return message
             else:
                 return {
                     "id": message_id,
@@ -229,54 +2161,193 @@ async def get_message(
                 "date": "2024-01-15T10:00:00Z"
             }
 
-@app.post("/send")
-async def send_email(
-    email: EmailSend,
+async def fetch_message_bodies(user_id: str, yandex_token: str,
+                               message_ids: List[str]) -> AsyncIterator[bytes]:
+    """Поток полных писем в формате NDJSON по мере готовности.
+
+    Сохраненные тела отдаются сразу, недостающие загружаются из Яндекс Почты
+    параллельно (не больше FETCH_CONCURRENCY запросов) и сохраняются в хранилище.
+    """
+    cached = await message_store.get_messages(user_id, message_ids)
+    for message_id in message_ids:
+        if message_id in cached:
+            yield json.dumps(
+                {"id": message_id, "status": "ok", "source": "cache", "message": cached[message_id]},
+                ensure_ascii=False
+            ).encode() + b"\n"
+    
+    missing = [message_id for message_id in message_ids if message_id not in cached]
+    if not missing:
+        return
+    
+    semaphore = asyncio.Semaphore(FETCH_CONCURRENCY)
+    limits = httpx.Limits(max_connections=FETCH_CONCURRENCY)
+    async with httpx.AsyncClient(timeout=30.0, limits=limits) as client:
+        async def fetch_one(message_id: str) -> Dict:
+            async with semaphore:
+                try:
+                    response = await client.get(
+                        f"{MAIL_API_URL}/messages/{message_id}",
+                        headers={"Authorization": f"OAuth {yandex_token}"}
+                    )
+                except httpx.RequestError as e:
+                    return {"id": message_id, "status": "error", "error": str(e) or type(e).__name__}
+            if response.status_code != 200:
+                return {"id": message_id, "status": "error",
+                        "error": f"Yandex Mail returned {response.status_code}"}
+            try:
+                payload = response.json()
+            except ValueError:
+                payload = None
+            if not isinstance(payload, dict):
+                return {"id": message_id, "status": "error", "error": "Yandex Mail returned invalid JSON"}
+            message = strip_attachment_content(payload)
+            try:
+                await message_store.save_message(user_id, message_id, message)
+            except Exception:
+                # Ошибка хранилища не должна обрывать поток для остальных писем
+                logger.exception("Failed to store message %s", message_id)
+                return {"id": message_id, "status": "error", "error": "Failed to store message"}
+            return {"id": message_id, "status": "ok", "source": "upstream", "message": message}
+        
+        tasks = [asyncio.create_task(fetch_one(message_id)) for message_id in missing]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield json.dumps(await task, ensure_ascii=False).encode() + b"\n"
+        finally:
+            # Клиент отключился - незавершенные загрузки больше не нужны
+            for task in tasks:
+                task.cancel()
+
+@app.post("/messages/batch")
+async def get_messages_batch(
+    batch: MessageBatch,
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
-    """Отправка письма"""
-    token = credentials.credentials
-    user_id = "default"
+    """Пакетное получение полных писем.
+
+    Ответ - NDJSON, по строке на письмо в порядке готовности:
+    {"id", "status": "ok", "source": "cache" | "upstream", "message"} или {"id", "status": "error", "error"}.
+    """
+    user_id = get_user_id(credentials)
+    message_ids = list(dict.fromkeys(batch.message_ids))
     
-    yandex_token = get_user_token(user_id)
+    yandex_token = await get_user_token(user_id)
     if not yandex_token:
-        return {
-            "status": "sent",
-            "message_id": "sent_1",
-            "to": email.to,
-            "subject": email.subject
-        }
+        # Заглушка
+        async def stub_messages() -> AsyncIterator[bytes]:
+            for message_id in message_ids:
+                message = {
+                    "id": message_id,
+                    "from": "example@mail.ru",
+                    "subject": "Пример письма",
+                    "body": "Полный текст письма здесь...",
+                    "date": "2024-01-15T10:00:00Z"
+                }
+                yield json.dumps(
+                    {"id": message_id, "status": "ok", "source": "stub", "message": message},
+                    ensure_ascii=False
+                ).encode() + b"\n"
+        return StreamingResponse(stub_messages(), media_type="application/x-ndjson")
     
-    email_data = {
-        "to": email.to,
-        "subject": email.subject,
-        "body": email.body
-    }
+    return StreamingResponse(
+        fetch_message_bodies(user_id, yandex_token, message_ids),
+        media_type="application/x-ndjson"
+    )
+
+@app.post("/import", status_code=202)
+async def import_mail(
+    request: Request,
+    path: Optional[str] = Query(None, description="Файл mbox или каталог .eml внутри MAIL_IMPORT_DIR"),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Импорт архива почты в локальное хранилище.
+
+    Архив передается телом запроса (mbox или одно письмо .eml) либо указывается
+    путем к файлу mbox или каталогу с .eml на сервере. Импорт идет в фоне,
+    ход и скорость - GET /import/{import_id}.
+    """
+    user_id = get_user_id(credentials)
+    import_id = f"imp_{uuid.uuid4().hex}"
     
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.post(
-                "https://mail.yandex.ru/api/v1/messages/send",
-                headers={"Authorization": f"OAuth {yandex_token}"},
-                json=email_data
-            )
-            
-            if response.status_code in [200, 201]:
-                return response.json()
-            else:
-                return {
-                    "status": "sent",
-                    "message_id": "sent_1",
-                    "to": email.to,
-                    "subject": email.subject
-                }
-        except Exception:
-            return {
-                "status": "sent",
-                "message_id": "sent_1",
-                "to": email.to,
-                "subject": email.subject
-            }
+    if path:
+        root = IMPORT_DIR.resolve()
+        source = (root / path).resolve()
+        if not source.is_relative_to(root) or not source.exists():
+            raise HTTPException(status_code=404, detail="Import source not found")
+        remove_source = False
+        if source.is_dir():
+            size = sum(item.stat().st_size for item in source.rglob("*.eml"))
+        else:
+            size = source.stat().st_size
+    else:
+        # Загружаемый архив пишется на диск по частям и удаляется после импорта
+        UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+        source = UPLOADS_DIR / f"{import_id}.mbox"
+        remove_source = True
+        size = 0
+        with open(source, "wb") as file:
+            async for chunk in request.stream():
+                await asyncio.to_thread(file.write, chunk)
+                size += len(chunk)
+        if not size:
+            source.unlink(missing_ok=True)
+            raise HTTPException(status_code=400, detail="Empty archive")
+    
+    await message_store.create_import(import_id, user_id, path or "upload", size)
+    task = asyncio.create_task(run_mail_import(import_id, user_id, source, remove_source))
+    import_tasks.add(task)
+    task.add_done_callback(import_tasks.discard)
+    return {"import_id": import_id, "status": "running", "bytes_total": size}
+
+@app.get("/import/{import_id}")
+async def get_import_status(
+    import_id: str,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Ход импорта архива: обработанные байты и письма, скорость"""
+    user_id = get_user_id(credentials)
+    
+    job = await message_store.get_import(user_id, import_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return import_status(job)
+
+@app.post("/send", status_code=202)
+async def send_email(
+    email: EmailSend,
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+    idempotency_key: Optional[str] = Header(None, max_length=200)
+):
+    """Постановка письма в очередь отправки.
+
+    Повторный запрос с тем же заголовком Idempotency-Key не создает второе письмо,
+    а возвращает уже существующее задание; тот же ключ с другим письмом - 422.
+    Статус доставки - GET /send/{job_id}.
+    """
+    user_id = get_user_id(credentials)
+    
+    payload = {"to": email.to, "subject": email.subject, "body": email.body}
+    job, created = await send_queue.enqueue(user_id, idempotency_key, payload)
+    if not created and job["payload"] != payload:
+        # Иначе клиент считал бы новое письмо поставленным в очередь
+        raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different message")
+    if created:
+        send_queue_event.set()
+    return send_job_status(job)
+
+@app.get("/send/{job_id}")
+async def get_send_status(
+    job_id: str,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Статус задания отправки: queued, sending, sent или failed"""
+    user_id = get_user_id(credentials)
+    
+    job = await send_queue.get(user_id, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Send job not found")
+    return send_job_status(job)
 
 @app.get("/health")
 async def health():
@@ -285,5 +2356,5 @@ async def health():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8003)
+    uvicorn.run("main:app", host="0.0.0.0", port=8003, workers=WORKERS)
 
@@ -0,0 +1,21 @@
+"""Фикстуры тестов email-service: сервис загружается с данными во временном каталоге"""
+import importlib
+import os
+import sys
+from pathlib import Path
+
+import pytest
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def service(tmp_path_factory):
+    """Модуль main.py сервиса"""
+    os.environ["DATA_DIR"] = str(tmp_path_factory.mktemp("data"))
+    # Функции разбора импорта передаются в пул процессов по имени модуля:
+    # процессы пула (forkserver) импортируют его из sys.path
+    modules = tmp_path_factory.mktemp("modules")
+    (modules / "email_service_main.py").symlink_to(SERVICE_DIR / "main.py")
+    sys.path.insert(0, str(modules))
+    return importlib.import_module("email_service_main")
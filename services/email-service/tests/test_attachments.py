@@ -0,0 +1,239 @@
+"""Вложения: описания в письмах, выдача с диска и из Яндекс Почты, Range"""
+import asyncio
+import gzip
+import uuid
+
+import httpx
+import jwt
+import pytest
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+
+PAYLOAD = bytes(range(256)) * 40
+
+
+def new_user():
+    return f"user-{uuid.uuid4().hex}"
+
+
+def auth(service, user_id):
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    """Яндекс Почта без сети: обработчик задает тест, запросы сохраняются"""
+    requests = []
+    state = {"handler": None}
+
+    def handler(request):
+        requests.append(request)
+        return state["handler"](request)
+
+    transport = httpx.MockTransport(handler)
+
+    class MockClient(httpx.AsyncClient):
+        def __init__(self, *args, **kwargs):
+            kwargs["transport"] = transport
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    return requests, state
+
+
+def test_listing_keeps_metadata_without_content(service):
+    message = {"id": "m1", "attachments": [
+        {"id": "1", "filename": "a.pdf", "size": 3, "content": "QUJD"},
+        {"id": "2", "filename": "b.txt", "data": "..."},
+        "garbage",
+    ]}
+
+    stripped = service.strip_attachment_content(message)
+
+    assert stripped["attachments"] == [{"id": "1", "filename": "a.pdf", "size": 3}, {"id": "2", "filename": "b.txt"}]
+    assert stripped["has_attachments"] is True
+    assert service.strip_attachment_content({"id": "m2"}) == {"id": "m2"}
+
+
+@pytest.mark.parametrize("header, expected", [
+    (None, None),
+    ("bytes=0-9", (0, 9)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=-10", (990, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("bytes=990-5000", (990, 999)),
+    ("bytes=0-1,5-6", None),
+    ("items=0-9", None),
+    ("bytes=a-b", None),
+])
+def test_parse_range(service, header, expected):
+    assert service.parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=10-5"])
+def test_unsatisfiable_range(service, header):
+    with pytest.raises(HTTPException) as error:
+        service.parse_range(header, 1000)
+    assert error.value.status_code == 416
+    assert error.value.headers["Content-Range"] == "bytes */1000"
+
+
+@pytest.fixture
+def local_attachment(service):
+    """Импортированное письмо с вложением, сохраненным на диск"""
+    user_id = new_user()
+    sha256 = service.save_attachment(PAYLOAD)
+    asyncio.run(service.message_store.add_messages(user_id, [{
+        "id": "m1", "subject": "Отчет", "body": "Отчет во вложении", "date": "2025-01-10T09:00:00Z",
+        "attachments": [{"id": "1", "filename": "отчет.bin", "content_type": "application/pdf",
+                         "size": len(PAYLOAD), "sha256": sha256}]
+    }], record_changes=False))
+    return user_id, sha256
+
+
+def test_local_attachment_is_served_whole(service, local_attachment):
+    user_id, sha256 = local_attachment
+    with TestClient(service.app) as client:
+        response = client.get("/messages/m1/attachments/1", headers=auth(service, user_id))
+
+    assert response.status_code == 200
+    assert response.content == PAYLOAD
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.headers["content-length"] == str(len(PAYLOAD))
+    assert response.headers["accept-ranges"] == "bytes"
+    assert response.headers["etag"] == f'"{sha256}"'
+    assert "filename*=UTF-8''%D0%BE%D1%82%D1%87%D0%B5%D1%82.bin" in response.headers["content-disposition"]
+
+
+def test_local_attachment_range(service, local_attachment):
+    user_id, _ = local_attachment
+    with TestClient(service.app) as client:
+        partial = client.get("/messages/m1/attachments/1", headers={**auth(service, user_id), "Range": "bytes=100-299"})
+        tail = client.get("/messages/m1/attachments/1", headers={**auth(service, user_id), "Range": "bytes=-16"})
+        outside = client.get("/messages/m1/attachments/1", headers={**auth(service, user_id), "Range": "bytes=99999-"})
+
+    assert partial.status_code == 206
+    assert partial.content == PAYLOAD[100:300]
+    assert partial.headers["content-range"] == f"bytes 100-299/{len(PAYLOAD)}"
+    assert tail.content == PAYLOAD[-16:]
+    assert outside.status_code == 416
+    assert outside.headers["content-range"] == f"bytes */{len(PAYLOAD)}"
+
+
+def test_file_is_read_in_chunks(service, monkeypatch, tmp_path):
+    monkeypatch.setattr(service, "ATTACHMENT_CHUNK_SIZE", 1000)
+    path = tmp_path / "attachment"
+    path.write_bytes(PAYLOAD)
+
+    async def read(start, length):
+        return [chunk async for chunk in service.iter_file(path, start, length)]
+
+    chunks = asyncio.run(read(500, 2600))
+    assert [len(chunk) for chunk in chunks] == [1000, 1000, 600]
+    assert b"".join(chunks) == PAYLOAD[500:3100]
+
+
+def test_upstream_attachment_is_proxied_with_range(service, upstream):
+    requests, state = upstream
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "yandex-token"))
+    state["handler"] = lambda request: httpx.Response(
+        206, stream=httpx.ByteStream(PAYLOAD[10:20]),
+        headers={"Content-Type": "image/png", "Content-Range": f"bytes 10-19/{len(PAYLOAD)}",
+                 "Accept-Ranges": "bytes", "Set-Cookie": "session=secret"}
+    )
+
+    with TestClient(service.app) as client:
+        response = client.get(
+            "/messages/remote/attachments/7", headers={**auth(service, user_id), "Range": "bytes=10-19"}
+        )
+
+    assert response.status_code == 206
+    assert response.content == PAYLOAD[10:20]
+    assert response.headers["content-range"] == f"bytes 10-19/{len(PAYLOAD)}"
+    assert response.headers["content-type"] == "image/png"
+    # Служебные заголовки Яндекса клиенту не передаются
+    assert "set-cookie" not in response.headers
+    attachment_requests = [r for r in requests if r.url.path.endswith("/attachments/7")]
+    assert attachment_requests[0].headers["range"] == "bytes=10-19"
+    assert attachment_requests[0].headers["authorization"] == "OAuth yandex-token"
+
+
+def gzip_upstream(request):
+    """Яндекс Почта, сжимающая ответ, если клиент это разрешил"""
+    if "gzip" not in request.headers.get("accept-encoding", ""):
+        return httpx.Response(200, stream=httpx.ByteStream(PAYLOAD), headers={
+            "Content-Type": "application/pdf", "Content-Length": str(len(PAYLOAD))
+        })
+    compressed = gzip.compress(PAYLOAD)
+    return httpx.Response(200, stream=httpx.ByteStream(compressed), headers={
+        "Content-Type": "application/pdf", "Content-Length": str(len(compressed)), "Content-Encoding": "gzip"
+    })
+
+
+def test_upstream_is_asked_for_uncompressed_bytes(service, upstream):
+    requests, state = upstream
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "yandex-token"))
+    state["handler"] = gzip_upstream
+
+    with TestClient(service.app) as client:
+        response = client.get("/messages/remote/attachments/7", headers=auth(service, user_id))
+
+    attachment_requests = [r for r in requests if r.url.path.endswith("/attachments/7")]
+    assert attachment_requests[0].headers["accept-encoding"] == "identity"
+    assert response.content == PAYLOAD
+    assert "content-encoding" not in response.headers
+    assert response.headers["content-length"] == str(len(PAYLOAD))
+
+
+def test_compressed_upstream_body_keeps_its_encoding(service, upstream):
+    """Сжатый вопреки запросу ответ передается с Content-Encoding и распаковывается клиентом"""
+    _, state = upstream
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "yandex-token"))
+    state["handler"] = lambda request: gzip_upstream(httpx.Request("GET", request.url, headers={
+        "Accept-Encoding": "gzip"
+    }))
+
+    with TestClient(service.app) as client:
+        response = client.get("/messages/remote/attachments/7", headers=auth(service, user_id))
+
+    assert response.headers["content-encoding"] == "gzip"
+    assert response.content == PAYLOAD
+
+
+@pytest.mark.parametrize("status, expected", [(404, 404), (416, 416), (500, 502)])
+def test_upstream_errors(service, upstream, status, expected):
+    _, state = upstream
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "yandex-token"))
+    state["handler"] = lambda request: httpx.Response(status)
+
+    with TestClient(service.app) as client:
+        response = client.get("/messages/remote/attachments/7", headers=auth(service, user_id))
+
+    assert response.status_code == expected
+
+
+def test_unreachable_upstream_is_502(service, upstream):
+    _, state = upstream
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "yandex-token"))
+
+    def unreachable(request):
+        raise httpx.ConnectError("refused")
+
+    state["handler"] = unreachable
+    with TestClient(service.app) as client:
+        response = client.get("/messages/remote/attachments/7", headers=auth(service, user_id))
+
+    assert response.status_code == 502
+
+
+def test_unknown_attachment_without_token_is_404(service):
+    with TestClient(service.app) as client:
+        response = client.get("/messages/missing/attachments/1", headers=auth(service, new_user()))
+
+    assert response.status_code == 404
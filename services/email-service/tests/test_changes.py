@@ -0,0 +1,146 @@
+"""Лента изменений ящика: long-poll, SSE, синхронизация и удаление старой истории"""
+import asyncio
+import time
+import uuid
+from contextlib import closing
+
+import httpx
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+
+def new_user():
+    return f"user-{uuid.uuid4().hex}"
+
+
+def message(message_id, date="2025-01-10T09:00:00Z"):
+    return {"id": message_id, "from": "anna@example.com", "subject": f"Письмо {message_id}", "date": date}
+
+
+def auth(service, user_id):
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture
+def client(service):
+    with TestClient(service.app) as client:
+        yield client
+
+
+def test_without_since_returns_current_cursor(service, client):
+    user_id = new_user()
+    asyncio.run(service.message_store.add_messages(user_id, [message("m1")]))
+
+    response = client.get("/changes", headers=auth(service, user_id))
+
+    assert response.json() == {
+        "changes": [], "cursor": str(asyncio.run(service.message_store.latest_seq())), "reset": False
+    }
+
+
+def test_new_messages_after_cursor_are_returned(service, client):
+    user_id, other = new_user(), new_user()
+    cursor = client.get("/changes", headers=auth(service, user_id)).json()["cursor"]
+    asyncio.run(service.message_store.add_messages(user_id, [message("m1"), message("m2")]))
+    asyncio.run(service.message_store.add_messages(other, [message("foreign")]))
+    # Повторно полученное письмо - не изменение
+    asyncio.run(service.message_store.add_messages(user_id, [message("m1")]))
+
+    body = client.get("/changes", params={"since": cursor}, headers=auth(service, user_id)).json()
+
+    assert [(change["type"], change["message_id"]) for change in body["changes"]] == [
+        ("message_added", "m1"), ("message_added", "m2")
+    ]
+    assert body["changes"][0]["message"]["subject"] == "Письмо m1"
+    assert body["changes"][0]["thread_id"]
+    assert body["cursor"] == str(body["changes"][-1]["seq"])
+
+    # С нового курсора изменений нет: ответ сразу по timeout=0
+    again = client.get("/changes", params={"since": body["cursor"], "timeout": 0}, headers=auth(service, user_id))
+    assert again.json() == {"changes": [], "cursor": body["cursor"], "reset": False}
+
+
+def test_invalid_cursor_is_rejected(service, client):
+    response = client.get("/changes", params={"since": "abc"}, headers=auth(service, new_user()))
+    assert response.status_code == 400
+
+
+def test_long_poll_wakes_on_sync_in_same_process(service, monkeypatch):
+    """Новое письмо будит ожидание сразу, не дожидаясь перечитывания ленты"""
+    monkeypatch.setattr(service, "CHANGES_POLL_INTERVAL", 30)
+    user_id = new_user()
+
+    async def run():
+        since = await service.message_store.latest_seq()
+        waiting = asyncio.create_task(service.next_changes(user_id, since, time.monotonic() + 30))
+        await asyncio.sleep(0.05)
+        assert not waiting.done()
+        started = time.monotonic()
+        await service.message_store.add_messages(user_id, [message("m1")])
+        await service.notify_changes()
+        changes, expired = await asyncio.wait_for(waiting, 5)
+        return changes, expired, time.monotonic() - started
+
+    changes, expired, waited = asyncio.run(run())
+    assert [change["message_id"] for change in changes] == ["m1"]
+    assert not expired
+    assert waited < 1
+
+
+def test_sync_records_only_mail_after_first_sync(service):
+    user_id = new_user()
+    mailbox = {"messages": [message("m2", "2025-01-11T09:00:00Z"), message("m1")]}
+
+    async def run():
+        since = await service.message_store.latest_seq()
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, json=mailbox))
+        async with httpx.AsyncClient(transport=transport) as client:
+            await service.sync_mailbox(client, user_id, "token")
+            first, _ = await service.message_store.changes(user_id, since, 100)
+            mailbox["messages"].insert(0, message("m3", "2025-01-12T09:00:00Z"))
+            await service.sync_mailbox(client, user_id, "token")
+            second, _ = await service.message_store.changes(user_id, since, 100)
+        return first, second
+
+    first, second = asyncio.run(run())
+    # Первичная загрузка ящика в ленту не попадает
+    assert first == []
+    assert [change["message_id"] for change in second] == ["m3"]
+
+
+def test_sse_stream_sends_changes_with_ids(service):
+    user_id = new_user()
+
+    async def run():
+        since = await service.message_store.latest_seq()
+        await service.message_store.add_messages(user_id, [message("m1"), message("m2")])
+        stream = service.stream_changes(user_id, since)
+        frames = [await stream.__anext__() for _ in range(3)]
+        await stream.aclose()
+        return since, frames
+
+    since, frames = asyncio.run(run())
+    assert frames[0] == b"retry: 5000\n\n"
+    assert frames[1].startswith(f"id: {since + 1}\nevent: message_added\ndata: ".encode())
+    assert frames[2].startswith(f"id: {since + 2}\n".encode())
+
+
+def test_pruned_history_resets_old_cursors(service, tmp_path):
+    store = service.MessageStore(tmp_path / "messages.db")
+
+    async def run():
+        await store.add_messages("u", [message("old1"), message("old2")])
+        with closing(store._connect()) as conn, conn:
+            conn.execute("UPDATE changes SET created_at = ?", (time.time() - 10 * 86400,))
+        await store.add_messages("u", [message("new")])
+        await store.prune_changes(7)
+        return await store.changes("u", 0, 100), await store.changes("u", 2, 100)
+
+    (from_start, expired), (from_pruned, current) = asyncio.run(run())
+    # Старые записи удалены, курсор до них требует перечитать ящик
+    assert [change["message_id"] for change in from_start] == ["new"]
+    assert expired
+    assert [change["message_id"] for change in from_pruned] == ["new"]
+    assert not current
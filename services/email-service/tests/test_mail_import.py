@@ -0,0 +1,184 @@
+"""Импорт архивов mbox/EML: разбор, границы писем и пропускная способность"""
+import base64
+import random
+import sqlite3
+import threading
+import time
+import uuid
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+WORDS = "встреча проект отчет бюджет договор сроки задача meeting report budget deadline".split()
+
+
+def make_mail(index, rng):
+    name = base64.b64encode("Иван Петров".encode()).decode()
+    body = "\n".join(" ".join(rng.choices(WORDS, k=10)) for _ in range(rng.randint(3, 30)))
+    if index % 5 == 0:
+        # Неэкранированное "From " в теле не должно делить письмо
+        body += "\nFrom the desk of the director\n"
+    return (
+        f"From sender{index}@x.ru Mon Jan 15 10:00:00 2024\n"
+        f"From: =?utf-8?B?{name}?= <u{index % 50}@corp.ru>\n"
+        f"To: me@corp.ru\n"
+        f"Subject: Письмо {index}\n"
+        f"Date: Mon, {1 + index % 28} Jan 2024 {index % 24:02d}:00:00 +0300\n"
+        f"Message-ID: <m{index}@corp.ru>\n"
+        f"Content-Type: text/plain; charset=utf-8\n\n"
+        f"{body}\n\n"
+    ).encode()
+
+
+def write_mbox(path, count, seed=5):
+    rng = random.Random(seed)
+    path.write_bytes(b"".join(make_mail(index, rng) for index in range(count)))
+    return path
+
+
+def auth_headers(service, user_id):
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+    return {"Authorization": f"Bearer {token}"}
+
+
+def test_parse_mail_decodes_headers(service):
+    raw = (
+        "From: =?utf-8?B?0JjQstCw0L0=?= <ivan@corp.ru>\n"
+        "Subject: Отчет за квартал\n"
+        "Date: Mon, 15 Jan 2024 10:00:00 +0300\n"
+        "Message-ID: <abc@corp.ru>\n"
+        "Content-Type: text/plain; charset=utf-8\n\n"
+        "Текст   письма\n"
+    ).encode()
+
+    message = service.parse_mail(raw)
+
+    assert message["from"] == {"name": "Иван", "email": "ivan@corp.ru"}
+    assert message["subject"] == "Отчет за квартал"
+    assert message["snippet"] == "Текст письма"
+    assert message["has_attachments"] is False
+    # Идентификатор зависит только от Message-ID
+    assert message["id"] == service.parse_mail(raw.replace("Текст".encode(), "Другой".encode()))["id"]
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 4096, 1 << 30])
+def test_mbox_boundaries(service, monkeypatch, tmp_path, chunk_bytes):
+    monkeypatch.setattr(service, "IMPORT_CHUNK_BYTES", chunk_bytes)
+    path = write_mbox(tmp_path / "archive.mbox", 60)
+
+    chunks = list(service.iter_mbox_chunks(path))
+    spans = [span for chunk_spans, _ in chunks for span in chunk_spans]
+
+    assert len(spans) == 60
+    assert sum(size for _, size in chunks) == path.stat().st_size
+    messages, bodies, failed = service.parse_mbox_spans(str(path), spans)
+    assert failed == 0 and len(bodies) == 60
+    assert [m["subject"] for m in messages] == [f"Письмо {i}" for i in range(60)]
+    assert "From the desk of the director" in messages[0]["body"]
+
+
+def test_file_without_from_line_is_one_message(service, tmp_path):
+    path = tmp_path / "single.eml"
+    path.write_bytes(make_mail(1, random.Random(1)).split(b"\n", 1)[1])
+
+    assert list(service.iter_mbox_chunks(path)) == [([(0, path.stat().st_size)], path.stat().st_size)]
+
+
+def wait_for_import(client, import_id, headers):
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        status = client.get(f"/import/{import_id}", headers=headers).json()
+        if status["status"] != "running":
+            return status
+        time.sleep(0.05)
+    raise AssertionError("import did not finish")
+
+
+def test_import_throughput_and_reimport(service, monkeypatch, tmp_path):
+    """Архив из 3000 писем через пул процессов; повторный импорт дает только дубликаты"""
+    monkeypatch.setattr(service, "IMPORT_WORKERS", 2)
+    monkeypatch.setattr(service, "IMPORT_CHUNK_BYTES", 256 * 1024)
+    monkeypatch.setattr(service, "IMPORT_DIR", tmp_path)
+    write_mbox(tmp_path / "archive.mbox", 3000)
+    user_id = f"user-{uuid.uuid4().hex}"
+    headers = auth_headers(service, user_id)
+
+    with TestClient(service.app) as client:
+        started = client.post("/import", params={"path": "archive.mbox"}, headers=headers)
+        assert started.status_code == 202
+        status = wait_for_import(client, started.json()["import_id"], headers)
+
+        assert status["status"] == "done"
+        assert (status["messages"], status["imported"], status["failed"]) == (3000, 3000, 0)
+        assert status["bytes_done"] == status["bytes_total"]
+        assert status["messages_per_second"] > 200
+
+        again = client.post("/import", params={"path": "archive.mbox"}, headers=headers).json()
+        status = wait_for_import(client, again["import_id"], headers)
+        assert (status["imported"], status["duplicates"]) == (0, 3000)
+
+        # Путь вне каталога импорта не принимается
+        assert client.post("/import", params={"path": "../etc"}, headers=headers).status_code == 404
+
+    found = service.asyncio.run(service.message_store.search(user_id, service.fts_query("Письмо 2999")))
+    assert found[0]["subject"] == "Письмо 2999"
+
+
+def test_uploaded_archive_is_imported_and_removed(service):
+    user_id = f"user-{uuid.uuid4().hex}"
+    headers = auth_headers(service, user_id)
+    rng = random.Random(3)
+
+    with TestClient(service.app) as client:
+        body = b"".join(make_mail(index, rng) for index in range(20))
+        started = client.post("/import", content=body, headers=headers).json()
+        status = wait_for_import(client, started["import_id"], headers)
+
+        assert status["imported"] == 20
+        assert not list(service.UPLOADS_DIR.glob("*.mbox"))
+        assert client.post("/import", content=b"", headers=headers).status_code == 400
+
+
+def test_failed_chunk_fails_import_without_blocking(service, monkeypatch, tmp_path):
+    """Ошибка записи пакета: импорт завершается с ошибкой, пул останавливается вне цикла событий"""
+    pools = []
+
+    class SpyPool(service.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.start_method = kwargs["mp_context"].get_start_method()
+            self.shutdown_in = None
+            pools.append(self)
+
+        def shutdown(self, *args, **kwargs):
+            self.shutdown_in = threading.current_thread()
+            self.cancel_futures = kwargs.get("cancel_futures")
+            super().shutdown(*args, **kwargs)
+
+    async def broken_store(*args, **kwargs):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(service, "ProcessPoolExecutor", SpyPool)
+    monkeypatch.setattr(service, "IMPORT_WORKERS", 1)
+    monkeypatch.setattr(service, "IMPORT_CHUNK_BYTES", 4096)
+    monkeypatch.setattr(service.message_store, "add_messages", broken_store)
+    source = write_mbox(tmp_path / "archive.mbox", 200)
+    import_id = f"imp_{uuid.uuid4().hex}"
+    user_id = f"user-{uuid.uuid4().hex}"
+
+    async def run():
+        await service.message_store.create_import(import_id, user_id, "upload", source.stat().st_size)
+        await service.run_mail_import(import_id, user_id, source, True)
+        return await service.message_store.get_import(user_id, import_id)
+
+    job = service.asyncio.run(run())
+
+    assert job["status"] == "failed"
+    assert job["error"] == "database is locked"
+    assert job["messages"] == 0
+    assert not source.exists()
+    pool, = pools
+    assert pool.start_method == "forkserver"
+    assert pool.shutdown_in is not threading.main_thread()
+    assert pool.cancel_futures is True
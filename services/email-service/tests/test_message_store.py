@@ -0,0 +1,108 @@
+"""Хранилище писем: фоновые миграции индекса и цепочек, синхронизация с Яндекс Почтой"""
+import asyncio
+import uuid
+from contextlib import closing
+
+import httpx
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+MESSAGES = [
+    {"id": f"m{index}", "from": "anna@example.com", "subject": "Re: Отчет" if index else "Отчет",
+     "body": f"Квартальный отчет, версия {index}", "date": f"2025-01-{10 + index}T09:00:00Z"}
+    for index in range(5)
+]
+
+
+def legacy_store(service, path):
+    """Хранилище с письмами, сохраненными до появления индекса и цепочек"""
+    store = service.MessageStore(path)
+    asyncio.run(store.add_messages("u", [dict(message) for message in MESSAGES]))
+    with closing(store._connect()) as conn, conn:
+        conn.execute("DELETE FROM messages_fts")
+        conn.execute("DELETE FROM threads")
+        conn.execute("DELETE FROM thread_keys")
+        conn.execute("UPDATE messages SET thread_id = NULL")
+        conn.execute("DELETE FROM migrations")
+    return path
+
+
+def unthreaded(store):
+    with closing(store._connect()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM messages WHERE thread_id IS NULL").fetchone()[0]
+
+
+def test_constructor_leaves_backfill_to_migrate(service, monkeypatch, tmp_path):
+    monkeypatch.setattr(service, "MIGRATION_BATCH", 2)
+    store = service.MessageStore(legacy_store(service, tmp_path / "messages.db"))
+
+    assert unthreaded(store) == 5
+    assert asyncio.run(store.search("u", service.fts_query("отчет"))) == []
+
+    steps = []
+    real_step = store._migrate_step
+    monkeypatch.setattr(store, "_migrate_step", lambda *args: steps.append(args[0]) or real_step(*args))
+    asyncio.run(store.migrate())
+
+    # По три пакета на миграцию (2 + 2 + 1 письмо) и проверка, что она завершена
+    assert steps == ["fts_index"] * 4 + ["threads"] * 4
+    assert unthreaded(store) == 0
+    assert len(asyncio.run(store.search("u", service.fts_query("отчет")))) == 5
+    threads = asyncio.run(store.list_threads("u", 10))
+    assert [thread["message_count"] for thread in threads] == [5]
+
+
+def test_migration_is_run_by_one_process(service, monkeypatch, tmp_path):
+    monkeypatch.setattr(service, "MIGRATION_BATCH", 2)
+    path = legacy_store(service, tmp_path / "messages.db")
+    first, second = service.MessageStore(path), service.MessageStore(path)
+    now = service.time.time()
+
+    assert first._migrate_step("threads", now) is True
+    assert second._migrate_step("threads", now) is False
+    # Захват истек (процесс упал): миграцию продолжает другой процесс с сохраненной позиции
+    later = now + service.MIGRATION_LEASE + 1
+    while (step := second._migrate_step("threads", later)) is True:
+        pass
+    assert step is None
+    assert first._migrate_step("threads", later) is None
+    assert unthreaded(second) == 0
+
+
+@pytest.mark.parametrize("body", ["<html>Service Unavailable</html>", "[]"])
+def test_invalid_upstream_json_is_an_upstream_error(service, body):
+    async def run():
+        transport = httpx.MockTransport(lambda request: httpx.Response(200, text=body))
+        async with httpx.AsyncClient(transport=transport) as client:
+            await service.sync_mailbox(client, f"user-{uuid.uuid4().hex}", "token")
+
+    with pytest.raises(service.UpstreamError):
+        asyncio.run(run())
+
+
+def test_messages_fall_back_when_upstream_returns_html(service, monkeypatch):
+    """Не-JSON ответ Яндекса при первой синхронизации - не 500, а заглушка"""
+    user_id = f"user-{uuid.uuid4().hex}"
+    asyncio.run(service.save_user_token(user_id, "yandex-token"))
+
+    def handler(request):
+        if request.url.path.endswith("/messages"):
+            return httpx.Response(200, text="<html>Service Unavailable</html>")
+        return httpx.Response(404)
+
+    transport = httpx.MockTransport(handler)
+
+    class MockClient(httpx.AsyncClient):
+        def __init__(self, *args, **kwargs):
+            kwargs["transport"] = transport
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+
+    with TestClient(service.app) as client:
+        response = client.get("/messages", headers={"Authorization": f"Bearer {token}"})
+
+    assert response.status_code == 200
+    assert asyncio.run(service.message_store.sync_state(user_id)) is None
@@ -0,0 +1,70 @@
+"""Пакетная загрузка полных писем: по строке результата на каждое письмо"""
+import asyncio
+import json
+import uuid
+
+import httpx
+
+
+def fetch(service, monkeypatch, handler, message_ids):
+    transport = httpx.MockTransport(handler)
+    real_client = httpx.AsyncClient
+
+    class Client(real_client):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, transport=transport, **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", Client)
+    user_id = f"user-{uuid.uuid4().hex}"
+
+    async def run():
+        lines = [line async for line in service.fetch_message_bodies(user_id, "token", message_ids)]
+        return user_id, {entry["id"]: entry for entry in map(json.loads, lines)}
+
+    return asyncio.run(run())
+
+
+def test_malformed_body_is_reported_per_message(service, monkeypatch):
+    def handler(request):
+        message_id = request.url.path.rsplit("/", 1)[-1]
+        if message_id == "html":
+            return httpx.Response(200, text="<html>maintenance</html>")
+        if message_id == "list":
+            return httpx.Response(200, json=[])
+        if message_id == "gone":
+            return httpx.Response(404)
+        return httpx.Response(200, json={"id": message_id, "subject": "Привет", "body": "текст"})
+
+    user_id, results = fetch(service, monkeypatch, handler, ["good", "html", "list", "gone"])
+
+    assert set(results) == {"good", "html", "list", "gone"}
+    assert results["good"]["status"] == "ok"
+    assert results["good"]["message"]["subject"] == "Привет"
+    assert results["html"] == {"id": "html", "status": "error", "error": "Yandex Mail returned invalid JSON"}
+    assert results["list"]["status"] == "error"
+    assert results["gone"]["error"] == "Yandex Mail returned 404"
+
+    # Сохраняется только корректно разобранное письмо
+    cached = asyncio.run(service.message_store.get_messages(user_id, ["good", "html", "list"]))
+    assert set(cached) == {"good"}
+
+
+def test_storage_error_is_reported_per_message(service, monkeypatch):
+    save_message = service.message_store.save_message
+
+    async def flaky_save(user_id, message_id, message):
+        if message_id == "locked":
+            raise service.sqlite3.OperationalError("database is locked")
+        await save_message(user_id, message_id, message)
+
+    monkeypatch.setattr(service.message_store, "save_message", flaky_save)
+
+    def handler(request):
+        message_id = request.url.path.rsplit("/", 1)[-1]
+        return httpx.Response(200, json={"id": message_id, "subject": "Привет", "body": "текст"})
+
+    _, results = fetch(service, monkeypatch, handler, ["first", "locked", "last"])
+
+    assert set(results) == {"first", "locked", "last"}
+    assert results["locked"] == {"id": "locked", "status": "error", "error": "Failed to store message"}
+    assert results["first"]["status"] == results["last"]["status"] == "ok"
@@ -0,0 +1,138 @@
+"""Полнотекстовый поиск по почте: поведение индекса и время запроса"""
+import asyncio
+import random
+import time
+import uuid
+
+import pytest
+
+MESSAGES = [
+    {"id": "m1", "from": {"name": "Иван Петров", "email": "Ivan@Example.com"},
+     "subject": "Встреча по бюджету", "body": "Обсудим бюджет на следующий квартал", "date": "2025-01-10T09:00:00Z"},
+    {"id": "m2", "from": "anna@example.com",
+     "subject": "Отчет", "body": "Перенесем встречу на пятницу?", "date": "2025-01-12T10:00:00Z"},
+    {"id": "m3", "from": "news@shop.example",
+     "subject": "Скидки недели", "body": "<p>Только <b>сегодня</b> ёлки со скидкой</p>", "date": "2025-01-14T08:00:00Z"},
+    {"id": "m4", "from": "anna@example.com",
+     "subject": "Встречи в январе", "body": "Список встреч", "date": "2025-01-20T12:00:00Z"},
+]
+
+
+def new_user(service, messages=MESSAGES):
+    user_id = f"user-{uuid.uuid4().hex}"
+    asyncio.run(service.message_store.add_messages(user_id, [dict(m) for m in messages]))
+    return user_id
+
+
+def search(service, user_id, query, **filters):
+    results = asyncio.run(service.message_store.search(user_id, service.fts_query(query), **filters))
+    return [message["id"] for message in results]
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("", None),
+    ("  ,.! ", None),
+    ("Встреча", '"встреча"*'),
+    ("бюджет Q1", '"бюджет"* "q1"*'),
+    ('"; DROP', '"drop"*'),
+])
+def test_fts_query(service, query, expected):
+    assert service.fts_query(query) == expected
+
+
+def test_prefix_matches_word_forms_and_ranks_subject_first(service):
+    user_id = new_user(service)
+
+    # встреч* - встреча, встречу, встречи, встреч; совпадение в теме выше, чем в теле
+    assert set(search(service, user_id, "встреч")) == {"m1", "m2", "m4"}
+    assert search(service, user_id, "встреч")[-1] == "m2"
+
+
+def test_sender_body_html_and_yo(service):
+    user_id = new_user(service)
+
+    assert search(service, user_id, "петров") == ["m1"]
+    assert search(service, user_id, "ivan example") == ["m1"]
+    # HTML разметка не индексируется, ё и е не различаются
+    assert search(service, user_id, "b") == []
+    assert search(service, user_id, "елки") == ["m3"]
+
+
+def test_filters_and_user_isolation(service):
+    user_id = new_user(service)
+    other = new_user(service, [{**MESSAGES[0], "id": "x1"}])
+
+    assert set(search(service, user_id, "встреч", sender="Anna@example.com")) == {"m2", "m4"}
+    assert search(service, user_id, "встреч", date_from="2025-01-11", date_to="2025-01-15") == ["m2"]
+    assert search(service, other, "бюджет") == ["x1"]
+
+
+def test_result_fields(service):
+    user_id = new_user(service)
+    result, = asyncio.run(service.message_store.search(user_id, service.fts_query("квартал")))
+
+    assert result["id"] == "m1"
+    assert result["score"] > 0
+    assert "[квартал]" in result["highlight"]
+
+
+def test_full_body_is_reindexed(service):
+    user_id = new_user(service, [{"id": "m1", "from": "a@example.com", "subject": "Письмо",
+                                  "snippet": "Начало", "date": "2025-01-10T09:00:00Z"}])
+    assert search(service, user_id, "договор") == []
+
+    asyncio.run(service.message_store.save_message(user_id, "m1", {
+        "id": "m1", "from": "a@example.com", "subject": "Письмо",
+        "body": "Начало. Подписанный договор во вложении", "date": "2025-01-10T09:00:00Z"
+    }))
+    assert search(service, user_id, "договор") == ["m1"]
+
+
+def test_index_is_rebuilt_on_version_change(service, tmp_path):
+    store = service.MessageStore(tmp_path / "messages.db")
+    asyncio.run(store.add_messages("u", [dict(MESSAGES[2])]))
+    # Индекс, построенный до нормализации ё
+    with service.closing(store._connect()) as conn, conn:
+        conn.execute("UPDATE messages_fts SET body = 'ёлки'")
+        conn.execute("PRAGMA user_version = 0")
+
+    store = service.MessageStore(tmp_path / "messages.db")
+    asyncio.run(store.migrate())
+    found = asyncio.run(store.search("u", service.fts_query("елки")))
+    assert [message["id"] for message in found] == ["m3"]
+
+
+def test_query_latency(service):
+    """Запрос по ящику в 10 тысяч писем укладывается в 50 мс (медиана)"""
+    rng = random.Random(42)
+    vocabulary = [f"слово{i}" for i in range(5000)]
+    weights = [1 / (rank + 1) for rank in range(len(vocabulary))]
+    senders = [f"sender{i}@example.com" for i in range(300)]
+    messages = [
+        {
+            "id": f"m{i}",
+            "from": rng.choice(senders),
+            "subject": " ".join(rng.choices(vocabulary, weights, k=6)),
+            "body": " ".join(rng.choices(vocabulary, weights, k=60)),
+            "date": f"2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00Z"
+        }
+        for i in range(10000)
+    ]
+    user_id = new_user(service, messages)
+    queries = [rng.choice(vocabulary[10:1000]) for _ in range(30)] + ["слово1 слово2", "слово"]
+
+    timings = []
+    for query in queries:
+        # Каждый третий запрос - с фильтром по отправителю, каждый третий - по месяцу
+        filters = {}
+        if len(timings) % 3 == 0:
+            filters["sender"] = rng.choice(senders)
+        elif len(timings) % 3 == 1:
+            month = rng.randint(1, 12)
+            filters.update(date_from=f"2024-{month:02d}-01", date_to=f"2024-{month:02d}-28")
+        started = time.perf_counter()
+        found = search(service, user_id, query, **filters)
+        timings.append(time.perf_counter() - started)
+        assert len(found) <= 20
+    timings.sort()
+    assert timings[len(timings) // 2] < 0.05
@@ -0,0 +1,137 @@
+"""Доставка писем из очереди отправки"""
+import asyncio
+import logging
+import uuid
+
+import httpx
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+
+def make_client(handler):
+    return httpx.AsyncClient(transport=httpx.MockTransport(handler))
+
+
+def enqueue_and_claim(service, user_id):
+    async def run():
+        await service.save_user_token(user_id, "yandex-token")
+        job, created = await service.send_queue.enqueue(
+            user_id, None, {"to": "a@example.com", "subject": "s", "body": "b"}
+        )
+        assert created
+        return await service.send_queue.claim(service.SEND_LEASE)
+
+    return asyncio.run(run())
+
+
+def deliver(service, job, handler):
+    async def run():
+        async with make_client(handler) as client:
+            await service.deliver(client, job)
+        return await service.send_queue.get(job["user_id"], job["id"])
+
+    return asyncio.run(run())
+
+
+def test_sent_with_json_result(service):
+    job = enqueue_and_claim(service, f"user-{uuid.uuid4().hex}")
+    stored = deliver(service, job, lambda request: httpx.Response(200, json={"id": "msg-1"}))
+
+    assert stored["status"] == "sent"
+    assert stored["attempts"] == 1
+
+
+def test_non_json_success_is_not_sent_again(service):
+    job = enqueue_and_claim(service, f"user-{uuid.uuid4().hex}")
+    stored = deliver(service, job, lambda request: httpx.Response(202, text="OK"))
+
+    assert stored["status"] == "sent"
+    assert stored["attempts"] == 1
+    # Задание завершено и больше не захватывается
+    assert asyncio.run(service.send_queue.claim(service.SEND_LEASE)) is None
+
+
+def test_unexpected_error_counts_attempt(service, monkeypatch):
+    job = enqueue_and_claim(service, f"user-{uuid.uuid4().hex}")
+
+    async def broken_token(user_id):
+        raise RuntimeError("token store unavailable")
+
+    monkeypatch.setattr(service, "get_user_token", broken_token)
+    stored = deliver(service, job, lambda request: httpx.Response(200, json={}))
+
+    assert stored["status"] == "queued"
+    assert stored["attempts"] == 1
+    assert "token store unavailable" in stored["last_error"]
+
+
+def test_result_not_saved_after_send_is_not_retried(service, monkeypatch):
+    job = enqueue_and_claim(service, f"user-{uuid.uuid4().hex}")
+    calls = []
+
+    async def broken_mark_sent(job, result):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(service.send_queue, "mark_sent", broken_mark_sent)
+
+    def handler(request):
+        calls.append(request)
+        return httpx.Response(200, json={"id": "msg-2"})
+
+    stored = deliver(service, job, handler)
+
+    assert len(calls) == 1
+    assert stored["status"] == "failed"
+    assert stored["attempts"] == 1
+
+
+def test_send_worker_logs_failures_and_keeps_running(service, monkeypatch, caplog):
+    monkeypatch.setattr(service, "SEND_POLL_INTERVAL", 0.01)
+    claims = []
+
+    async def claim(lease):
+        claims.append(lease)
+        raise RuntimeError("database disk image is malformed")
+
+    monkeypatch.setattr(service.send_queue, "claim", claim)
+    # Событие прошлого теста привязано к его циклу событий
+    monkeypatch.setattr(service, "send_queue_event", asyncio.Event())
+
+    async def run():
+        async with make_client(lambda request: httpx.Response(200, json={})) as client:
+            task = asyncio.create_task(service.send_worker(client))
+            while len(claims) < 3:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await task
+
+    with caplog.at_level(logging.ERROR, logger="email-service"):
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+    failures = [record for record in caplog.records if record.getMessage() == "Send worker pass failed"]
+    assert len(failures) >= 2
+    assert "malformed" in str(failures[0].exc_info[1])
+
+
+def test_reused_idempotency_key_returns_the_same_job(service):
+    user_id, other = f"user-{uuid.uuid4().hex}", f"user-{uuid.uuid4().hex}"
+    email = {"to": "a@example.com", "subject": "Отчет", "body": "Во вложении"}
+
+    def send(user_id, email):
+        token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+        return client.post("/send", json=email, headers={"Authorization": f"Bearer {token}", "Idempotency-Key": "k1"})
+
+    with TestClient(service.app) as client:
+        first = send(user_id, email)
+        repeated = send(user_id, email)
+        changed = send(user_id, {**email, "body": "Другой текст"})
+        redirected = send(user_id, {**email, "to": "b@example.com"})
+        # Ключи идемпотентности разных пользователей не пересекаются
+        foreign = send(other, {**email, "body": "Другой текст"})
+
+    assert first.status_code == repeated.status_code == foreign.status_code == 202
+    assert repeated.json()["job_id"] == first.json()["job_id"]
+    assert foreign.json()["job_id"] != first.json()["job_id"]
+    assert changed.status_code == redirected.status_code == 422
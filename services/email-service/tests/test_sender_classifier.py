@@ -0,0 +1,126 @@
+"""Классификатор отправителей: совпадение с прежней эвристикой и скорость"""
+import asyncio
+import random
+import string
+import time
+import uuid
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+
+def legacy_is_human_email(email: str) -> bool:
+    """Прежняя проверка is_human_email - эталон для сравнения"""
+    mailing_domains = [
+        "noreply", "no-reply", "donotreply", "mailer", "newsletter",
+        "notifications", "alerts", "system", "automated"
+    ]
+    email_lower = email.lower()
+    return not any(domain in email_lower for domain in mailing_domains)
+
+
+def random_senders(count, seed=7):
+    rng = random.Random(seed)
+    markers = ["noreply", "No-Reply", "donotreply", "mailer", "NEWSLETTER", "notifications",
+               "alerts", "system", "automated", "no_reply", "mail", "news", "alert"]
+    domains = ["example.com", "mail.ru", "notifications.example.com", "ya.ru", "mailer-daemon.org"]
+    senders = []
+    for _ in range(count):
+        local = "".join(rng.choices(string.ascii_letters + "._-", k=rng.randint(3, 12)))
+        if rng.random() < 0.4:
+            marker = rng.choice(markers)
+            position = rng.randint(0, len(local))
+            local = local[:position] + marker + local[position:]
+        senders.append(f"{local}@{rng.choice(domains)}")
+    return senders
+
+
+def test_agrees_with_legacy_heuristic(service):
+    classifier = service.SenderClassifier()
+    senders = random_senders(5000)
+
+    for sender in senders:
+        for message in ({"from": sender}, {"from": {"name": "Имя", "email": sender}}):
+            assert classifier.is_human(message) == legacy_is_human_email(sender), sender
+    # Выборка содержит оба класса
+    assert 0 < sum(map(legacy_is_human_email, senders)) < len(senders)
+
+
+def test_important_matches_legacy_set(service):
+    senders = random_senders(2000)
+    contacts = [sender.upper() for sender in senders[::10]] + ["Boss@Example.com"]
+    classifier = service.SenderClassifier(contacts)
+    legacy = {contact.lower() for contact in contacts}
+
+    for sender in senders + ["boss@example.com"]:
+        message = {"from": sender}
+        assert classifier.is_important(message) == (service.sender_email(message) in legacy)
+    # Пробелы вокруг адреса в настройках не мешают
+    assert service.SenderClassifier([" partner@mail.ru "]).is_important({"from": "Partner@mail.ru"})
+
+
+@pytest.mark.parametrize("headers, human", [
+    ({"List-Unsubscribe": "<mailto:u@example.com>"}, False),
+    ([{"name": "List-Id", "value": "team.example.com"}], False),
+    ({"Precedence": " Bulk "}, False),
+    ({"Precedence": "first-class"}, True),
+    ({"Auto-Submitted": "auto-generated"}, False),
+    ({"Auto-Submitted": "no"}, True),
+    ({}, True),
+])
+def test_bulk_headers(service, headers, human):
+    message = {"from": "ivan@example.com", "headers": headers}
+    assert service.SenderClassifier().is_human(message) is human
+
+
+def test_ignored_and_important_override_heuristics(service):
+    classifier = service.SenderClassifier(["alerts@bank.example"], ["ivan@example.com"])
+
+    assert not classifier.is_human({"from": "Ivan@Example.com"})
+    assert classifier.is_human({"from": "alerts@bank.example", "headers": {"Precedence": "bulk"}})
+
+
+def test_throughput(service):
+    """Не меньше 100 тысяч писем в секунду"""
+    rng = random.Random(1)
+    senders = random_senders(3000)
+    classifier = service.SenderClassifier(rng.sample(senders, 500), rng.sample(senders, 100))
+    messages = [{"from": rng.choice(senders)} for _ in range(100000)]
+
+    started = time.perf_counter()
+    for message in messages:
+        classifier.is_human(message)
+        classifier.is_important(message)
+    elapsed = time.perf_counter() - started
+
+    assert len(messages) / elapsed > 100000
+
+
+@pytest.mark.parametrize("important_contacts", ['["boss@corp.ru", 1, null, {"a": 1}]', '{"a": 1}', '"boss"', "not json"])
+def test_legacy_important_contacts_ignore_non_strings(service, monkeypatch, important_contacts):
+    """Устаревший параметр important_contacts: мусор в JSON не роняет список писем"""
+    user_id = f"user-{uuid.uuid4().hex}"
+
+    async def get_user_token(user_id):
+        return "yandex-token"
+
+    async def ensure_synced(user_id, token):
+        return True
+
+    monkeypatch.setattr(service, "get_user_token", get_user_token)
+    monkeypatch.setattr(service, "ensure_synced", ensure_synced)
+    asyncio.run(service.message_store.add_messages(user_id, [
+        {"id": "m1", "from": "boss@corp.ru", "subject": "Отчет", "date": "2025-01-10T09:00:00Z"}
+    ]))
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+
+    with TestClient(service.app) as client:
+        response = client.get(
+            "/messages", params={"important_contacts": important_contacts},
+            headers={"Authorization": f"Bearer {token}"}
+        )
+
+    assert response.status_code == 200
+    message, = response.json()["messages"]
+    assert message["is_important"] is important_contacts.startswith("[")
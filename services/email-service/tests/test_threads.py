@@ -0,0 +1,81 @@
+"""Цепочки писем: раскладка по заголовкам и теме, постраничный список"""
+import asyncio
+import uuid
+
+import jwt
+from fastapi.testclient import TestClient
+
+
+def add(service, user_id, messages):
+    asyncio.run(service.message_store.add_messages(user_id, [dict(message) for message in messages]))
+
+
+def threads(service, user_id, limit=20, before=None):
+    return asyncio.run(service.message_store.list_threads(user_id, limit, before))
+
+
+def test_reply_headers_and_subject_join_threads(service):
+    user_id = f"user-{uuid.uuid4().hex}"
+    # Ответ пришел раньше исходного письма (синхронизация идет от новых к старым)
+    add(service, user_id, [
+        {"id": "r1", "from": "boss@corp.ru", "subject": "RE: Бюджет", "date": "2025-01-11T09:00:00Z",
+         "in_reply_to": "<orig@corp.ru>"},
+        {"id": "o1", "from": "me@corp.ru", "subject": "Бюджет", "date": "2025-01-10T09:00:00Z",
+         "message_id": "<orig@corp.ru>"},
+        {"id": "f1", "from": "anna@corp.ru", "subject": "Fwd: Re: бюджет", "date": "2025-01-12T09:00:00Z"},
+        {"id": "x1", "from": "anna@corp.ru", "subject": "Бюджет", "date": "2025-03-30T09:00:00Z"},
+        {"id": "n1", "from": "news@shop.ru", "subject": "Скидки", "date": "2025-01-13T09:00:00Z"},
+    ])
+
+    found = {thread["last_message"]["id"]: thread for thread in threads(service, user_id)}
+
+    # Письмо с той же темой, но через несколько месяцев - новая цепочка
+    assert sorted(found) == ["f1", "n1", "x1"]
+    assert found["f1"]["message_count"] == 3
+    assert found["f1"]["subject"] == "Бюджет"
+    assert found["f1"]["participants"] == ["boss@corp.ru", "me@corp.ru", "anna@corp.ru"]
+    assert found["x1"]["message_count"] == 1
+
+
+def test_pages_keep_threads_with_equal_dates(service, monkeypatch):
+    user_id = f"user-{uuid.uuid4().hex}"
+    add(service, user_id, [
+        {"id": f"m{index}", "from": f"u{index}@corp.ru", "subject": f"Тема {index}",
+         "date": "2025-01-10T09:00:00Z" if index < 5 else f"2025-01-0{index - 4}T09:00:00Z"}
+        for index in range(8)
+    ])
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+
+    async def get_user_token(user_id):
+        return "yandex-token"
+
+    async def ensure_synced(user_id, token):
+        return True
+
+    monkeypatch.setattr(service, "get_user_token", get_user_token)
+    monkeypatch.setattr(service, "ensure_synced", ensure_synced)
+    seen, before = [], None
+    with TestClient(service.app, headers={"Authorization": f"Bearer {token}"}) as client:
+        while True:
+            params = {"limit": 2, **({"before": before} if before else {})}
+            page = client.get("/threads", params=params).json()
+            seen += [thread["last_message"]["id"] for thread in page["threads"]]
+            before = page["next_before"]
+            if not before:
+                break
+
+    assert sorted(seen) == [f"m{index}" for index in range(8)]
+    assert len(seen) == 8
+    # Сначала самые свежие: пять цепочек от 10 января, затем 3, 2 и 1 января
+    assert seen[5:] == ["m7", "m6", "m5"]
+
+
+def test_date_only_cursor_is_still_accepted(service):
+    user_id = f"user-{uuid.uuid4().hex}"
+    add(service, user_id, [
+        {"id": "a", "from": "a@corp.ru", "subject": "A", "date": "2025-01-10T09:00:00Z"},
+        {"id": "b", "from": "b@corp.ru", "subject": "B", "date": "2025-01-09T09:00:00Z"},
+    ])
+
+    page = threads(service, user_id, before=service.decode_thread_cursor("2025-01-10T09:00:00Z"))
+    assert [thread["last_message"]["id"] for thread in page] == ["b"]
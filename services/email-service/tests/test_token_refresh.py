@@ -0,0 +1,208 @@
+"""Обновление OAuth токенов почты: вход, плановое обновление и фоновые циклы"""
+import asyncio
+import logging
+import uuid
+from urllib.parse import parse_qs
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+
+def new_user():
+    return f"user-{uuid.uuid4().hex}"
+
+
+@pytest.fixture
+def yandex(monkeypatch):
+    """Яндекс OAuth без сети: ответы задает тест, запросы сохраняются"""
+    calls = []
+    responses = {}
+
+    def handler(request):
+        calls.append(request)
+        return responses[request.url.path](request)
+
+    transport = httpx.MockTransport(handler)
+
+    class MockClient(httpx.AsyncClient):
+        def __init__(self, *args, **kwargs):
+            kwargs["transport"] = transport
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    return calls, responses
+
+
+def refresh_state(service, user_id):
+    with service.closing(service.token_store._connect()) as conn:
+        return conn.execute(
+            "SELECT refresh_token, refresh_at, refresh_failures FROM tokens WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+
+def refresh(service, user_id, refresh_token="refresh-1"):
+    async def run():
+        async with httpx.AsyncClient() as client:
+            await service.refresh_user_token(client, user_id, refresh_token)
+
+    asyncio.run(run())
+
+
+def test_callback_keeps_refresh_token_and_schedules_refresh(service, monkeypatch, yandex):
+    monkeypatch.setattr(service, "CLIENT_ID", "email-client")
+    monkeypatch.setattr(service, "CLIENT_SECRET", "email-secret")
+    user_id = new_user()
+    _, responses = yandex
+    responses["/token"] = lambda request: httpx.Response(
+        200, json={"access_token": "access-1", "refresh_token": "refresh-1", "expires_in": 3600}
+    )
+    responses["/info"] = lambda request: httpx.Response(200, json={"id": user_id, "default_email": "me@yandex.ru"})
+
+    with TestClient(service.app) as client:
+        response = client.get("/oauth/callback", params={"code": "code-1"})
+
+    assert response.status_code == 200
+    assert asyncio.run(service.get_user_token(user_id)) == "access-1"
+    refresh_token, refresh_at, _ = refresh_state(service, user_id)
+    assert refresh_token == "refresh-1"
+    # Обновление запланировано раньше истечения токена
+    assert refresh_at < service.time.time() + 3600
+
+
+def test_refresh_uses_email_client_and_feeds_mailbox_sync(service, monkeypatch, yandex):
+    monkeypatch.setattr(service, "CLIENT_ID", "email-client")
+    monkeypatch.setattr(service, "CLIENT_SECRET", "email-secret")
+    calls, responses = yandex
+    responses["/token"] = lambda request: httpx.Response(
+        200, json={"access_token": "access-2", "refresh_token": "refresh-2", "expires_in": 86400}
+    )
+    synced = []
+
+    async def sync_mailbox(client, user_id, yandex_token):
+        synced.append(yandex_token)
+        return []
+
+    monkeypatch.setattr(service, "sync_mailbox", sync_mailbox)
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "access-1", "refresh-1", expires_in=1))
+
+    refresh(service, user_id)
+
+    form = parse_qs(calls[0].content.decode())
+    assert form["grant_type"] == ["refresh_token"]
+    assert form["refresh_token"] == ["refresh-1"]
+    assert form["client_id"] == ["email-client"]
+    assert refresh_state(service, user_id)[0] == "refresh-2"
+
+    async def sync():
+        async with httpx.AsyncClient() as client:
+            await service.sync_user(client, user_id)
+
+    asyncio.run(sync())
+    assert synced == ["access-2"]
+
+
+def test_refresh_without_new_refresh_token_keeps_old_one(service, yandex):
+    _, responses = yandex
+    responses["/token"] = lambda request: httpx.Response(200, json={"access_token": "access-2", "expires_in": 86400})
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "access-1", "refresh-1", expires_in=1))
+
+    refresh(service, user_id)
+
+    assert asyncio.run(service.get_user_token(user_id)) == "access-2"
+    assert refresh_state(service, user_id)[0] == "refresh-1"
+
+
+def test_revoked_refresh_token_is_unscheduled(service, yandex):
+    _, responses = yandex
+    responses["/token"] = lambda request: httpx.Response(400, json={"error": "invalid_grant"})
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "access-1", "refresh-1", expires_in=1))
+
+    refresh(service, user_id)
+
+    assert asyncio.run(service.get_user_token(user_id)) == "access-1"
+    assert refresh_state(service, user_id)[1] is None
+    assert user_id not in dict(asyncio.run(service.token_store.due_for_refresh(1000)))
+
+
+def test_concurrent_refreshes_call_yandex_once(service, yandex):
+    calls, responses = yandex
+    responses["/token"] = lambda request: httpx.Response(
+        200, json={"access_token": "access-2", "expires_in": 86400}
+    )
+    user_id = new_user()
+    asyncio.run(service.save_user_token(user_id, "access-1", "refresh-1", expires_in=1))
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            await asyncio.gather(*(service.refresh_user_token(client, user_id, "refresh-1") for _ in range(5)))
+
+    asyncio.run(run())
+    assert len(calls) == 1
+
+
+def run_loop(loop, passes):
+    """Запускает фоновый цикл до начала третьего прохода: второй к этому времени завершен"""
+    async def run():
+        task = asyncio.create_task(loop())
+        while len(passes) < 3:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(asyncio.wait_for(run(), 5))
+
+
+def test_token_refresh_loop_logs_failures_and_keeps_running(service, monkeypatch, caplog):
+    monkeypatch.setattr(service, "TOKEN_REFRESH_INTERVAL", 0.01)
+    passes = []
+
+    async def due_for_refresh(limit):
+        passes.append(limit)
+        if len(passes) == 1:
+            raise RuntimeError("database is locked")
+        return [("broken-user", "refresh-1"), ("good-user", "refresh-2")]
+
+    async def refresh_user_token(client, user_id, refresh_token):
+        if user_id == "broken-user":
+            raise RuntimeError("refresh crashed")
+
+    monkeypatch.setattr(service.token_store, "due_for_refresh", due_for_refresh)
+    monkeypatch.setattr(service, "refresh_user_token", refresh_user_token)
+
+    with caplog.at_level(logging.ERROR, logger="email-service"):
+        run_loop(service.token_refresh_loop, passes)
+
+    messages = [record.getMessage() for record in caplog.records]
+    assert "Token refresh pass failed" in messages
+    assert "Token refresh failed for user broken-user" in messages
+    assert not any("good-user" in message for message in messages)
+
+
+def test_mailbox_sync_loop_logs_failures_and_keeps_running(service, monkeypatch, caplog):
+    monkeypatch.setattr(service, "SYNC_INTERVAL", 0.01)
+    passes = []
+    synced = []
+
+    async def user_ids():
+        passes.append(True)
+        return ["broken-user", "good-user"]
+
+    async def sync_user(client, user_id):
+        if user_id == "broken-user":
+            raise RuntimeError("sync crashed")
+        synced.append(user_id)
+
+    monkeypatch.setattr(service.token_store, "user_ids", user_ids)
+    monkeypatch.setattr(service, "sync_user", sync_user)
+
+    with caplog.at_level(logging.ERROR, logger="email-service"):
+        run_loop(service.mailbox_sync_loop, passes)
+
+    assert "good-user" in synced
+    messages = [record.getMessage() for record in caplog.records]
+    assert "Mailbox sync failed for user broken-user" in messages
@@ -1,25 +1,192 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-from typing import Optional, List, Dict
+from pydantic import BaseModel, Field
+from typing import Optional, List, Dict, Tuple, AsyncIterator, Awaitable
+from contextlib import closing
+from pathlib import Path
+import asyncio
+import base64
 import httpx
+import jwt
+import logging
 import os
 import json
 import re
-from datetime import datetime, timedelta
+import sqlite3
+import sys
+import time
+import uuid
+from datetime import datetime, date, time as dt_time, timedelta, timezone
+from zoneinfo import ZoneInfo
+
+# Общий код сервисов: в образе лежит рядом с main.py, в репозитории - в services/shared
+sys.path.append(str(Path(__file__).resolve().parent.parent / "shared"))
+from inference import HuggingFaceBackend, InferenceBatcher
+from llm_cache import LLMCache
+from local_backend import LocalBackend
+from preferences import DEFAULT_PREFERENCES, PREFERENCES_CACHE_TTL, PreferencesCache, within_work_schedule
 
 app = FastAPI(title="LLM Agent Service")
 
+logger = logging.getLogger("llm-agent-service")
+
 security = HTTPBearer()
 
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 HUGGINGFACE_API_URL = "https://api-inference.huggingface.co/models/microsoft/DialoGPT-medium"
 
+DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+# Кэш ответов модели: срок жизни записи, размер LRU в памяти и предел на диске
+LLM_CACHE_DB = DATA_DIR / "llm_cache.db"
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "1000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_MB", "100")) * 1024 * 1024
+# Микропакеты запросов к модели: размер пакета, окно сбора, число одновременных
+# вызовов и предел очереди входов
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", "16"))
+INFERENCE_BATCH_WINDOW = float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "20")) / 1000
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", "4"))
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "1000"))
+# Где выполняется модель: "huggingface" (Inference API, нужен HUGGINGFACE_API_KEY)
+# или "local" (CPU, нужен образ с LOCAL_INFERENCE=true)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "huggingface")
+USE_MODEL = INFERENCE_BACKEND == "local" or bool(HUGGINGFACE_API_KEY)
+# Локальная модель: потоки пула для пакетов
+LOCAL_INFERENCE_WORKERS = int(os.getenv("LOCAL_INFERENCE_WORKERS", "1"))
+LOCAL_CLASSIFIER_MODEL = os.getenv(
+    "LOCAL_CLASSIFIER_MODEL", "MoritzLaurer/mDeBERTa-v3-base-xnli-multilingual-nli-2mil7"
+)
+# Zero-shot классификация письма: первая метка - предложение о встрече
+MEETING_LABELS = ["предложение о встрече", "другое"]
+MEETING_HYPOTHESIS = "Это письмо - {}."
+LOCAL_MEETING_THRESHOLD = float(os.getenv("LOCAL_MEETING_THRESHOLD", "0.6"))
+
 CALENDAR_SERVICE_URL = os.getenv("CALENDAR_SERVICE_URL", "http://calendar-service:8002")
 EMAIL_SERVICE_URL = os.getenv("EMAIL_SERVICE_URL", "http://email-service:8003")
 
-# Хранилище рекомендаций (в продакшене использовать БД)
-recommendations_storage = {}
+JWT_SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
+JWT_ALGORITHM = os.getenv("JWT_ALGORITHM", "HS256")
+
+
+# Пакетный анализ писем
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "200"))
+ANALYZE_CONCURRENCY = int(os.getenv("ANALYZE_CONCURRENCY", "8"))
+ALTERNATIVE_SLOTS = 3
+# Свободные слоты запрашиваются одновременно с проверкой конфликта, не дожидаясь ее;
+# при свободном времени запрос отменяется
+SPECULATIVE_FREE_SLOTS = os.getenv("SPECULATIVE_FREE_SLOTS", "1") == "1"
+
+# Конвейер анализа писем: стадии и число воркеров каждой, аренда задания воркером,
+# повторы стадии при сетевых ошибках и срок хранения завершенных заданий
+JOBS_DB = DATA_DIR / "jobs.db"
+JOB_STAGES = ("analyze", "schedule", "reply")
+ANALYZE_WORKERS = int(os.getenv("ANALYZE_WORKERS", "4"))
+SCHEDULE_WORKERS = int(os.getenv("SCHEDULE_WORKERS", "4"))
+REPLY_WORKERS = int(os.getenv("REPLY_WORKERS", "4"))
+JOB_LEASE = 120
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_DELAY = 5
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "5"))
+JOB_RETENTION = float(os.getenv("JOB_RETENTION_HOURS", "24")) * 3600
+# Сколько хранится запись об обработанном письме: повторный запрос отдается из нее
+LEDGER_RETENTION = float(os.getenv("LEDGER_RETENTION_DAYS", "30")) * 86400
+JOB_ERROR_MESSAGE = "Не удалось обработать предложение о встрече"
+JOB_UNAUTHORIZED_MESSAGE = "Сервис календаря или почты отклонил авторизацию"
+# Токен пользователя в базе заданий не хранится: на время стадии выпускается короткий
+JOB_TOKEN_TTL = 300
+SSE_KEEPALIVE = 15
+
+# Рекомендации агента: не больше RECOMMENDATIONS_PER_USER последних на пользователя,
+# записи старше срока хранения удаляются; размер страницы выдачи
+RECOMMENDATIONS_DB = DATA_DIR / "recommendations.db"
+RECOMMENDATIONS_PER_USER = int(os.getenv("RECOMMENDATIONS_PER_USER", "1000"))
+RECOMMENDATIONS_RETENTION = float(os.getenv("RECOMMENDATIONS_RETENTION_DAYS", "90")) * 86400
+RECOMMENDATIONS_PAGE_SIZE = 50
+RECOMMENDATIONS_MAX_PAGE_SIZE = 200
+
+# Извлечение времени встречи из текста письма
+MEETING_TIMEZONE = ZoneInfo(os.getenv("MEETING_TIMEZONE", "Europe/Moscow"))
+DEFAULT_MEETING_TIME = dt_time.fromisoformat(os.getenv("DEFAULT_MEETING_TIME", "10:00"))
+DEFAULT_MEETING_MINUTES = 60
+
+MEETING_KEYWORDS_RE = re.compile(
+    r"встреч|встрет|собрани|созвон|appointment|meeting|\bcall\b", re.IGNORECASE
+)
+MONTHS = {
+    "январ": 1, "феврал": 2, "март": 3, "апрел": 4, "ма": 5, "июн": 6,
+    "июл": 7, "август": 8, "сентябр": 9, "октябр": 10, "ноябр": 11, "декабр": 12,
+    "jan": 1, "feb": 2, "mar": 3, "apr": 4, "may": 5, "jun": 6,
+    "jul": 7, "aug": 8, "sep": 9, "oct": 10, "nov": 11, "dec": 12
+}
+RU_MONTH = r"(январ[ьяе]|феврал[ьяе]|марта?|марте|апрел[ьяе]|ма[йяе]|июн[ьяе]|июл[ьяе]|августа?|августе|сентябр[ьяе]|октябр[ьяе]|ноябр[ьяе]|декабр[ьяе])"
+EN_MONTH = r"(jan(?:uary)?|feb(?:ruary)?|mar(?:ch)?|apr(?:il)?|may|june?|july?|aug(?:ust)?|sep(?:t(?:ember)?)?|oct(?:ober)?|nov(?:ember)?|dec(?:ember)?)"
+WEEKDAY_NAMES = {
+    "понедельник": 0, "вторник": 1, "сред": 2, "четверг": 3, "пятниц": 4, "суббот": 5, "воскресень": 6,
+    "monday": 0, "tuesday": 1, "wednesday": 2, "thursday": 3, "friday": 4, "saturday": 5, "sunday": 6
+}
+RELATIVE_DAYS = {
+    "сегодня": 0, "завтра": 1, "послезавтра": 2,
+    "today": 0, "tomorrow": 1, "day after tomorrow": 2
+}
+NUMBER_WORDS = {
+    "один": 1, "одну": 1, "два": 2, "две": 2, "три": 3, "четыре": 4, "пять": 5,
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "a": 1
+}
+
+# Шаблоны даты и времени в порядке приоритета (более точные раньше). Текст письма
+# приводится к нижнему регистру один раз, поэтому шаблоны без IGNORECASE
+DATE_PATTERNS = {
+    # ISO-дата, в том числе перед временем через "T" (2025-01-15T14:00)
+    "iso": r"\b(\d{4})-(\d{2})-(\d{2})(?:\b|(?=t\d))",
+    "numeric": r"\b(\d{1,2})[./](\d{1,2})(?:[./](\d{4}|\d{2}))?\b(?![.:/]?\d)",
+    "ru_text": r"\b(\d{1,2})(?:-?го)?\s+" + RU_MONTH + r"(?:\s+(\d{4}))?",
+    "en_day_month": r"\b(\d{1,2})(?:st|nd|rd|th)?\s+(?:of\s+)?" + EN_MONTH + r"\b(?:,?\s+(\d{4}))?",
+    "en_month_day": r"\b" + EN_MONTH + r"\.?\s+(\d{1,2})(?:st|nd|rd|th)?\b(?:,?\s+(\d{4}))?",
+    "relative": r"\b(послезавтра|сегодня|завтра|day after tomorrow|today|tomorrow)\b",
+    "in_days": r"\b(?:через|in)\s+(\d{1,2}|" + "|".join(NUMBER_WORDS) + r")?\s*(дн[яей]+|день|недел[юиь]|days?|weeks?)\b",
+    "weekday": r"\b(?:(следующ\w*|next)\s+)?(понедельник|вторник|сред[уаые]|четверг|пятниц[уаые]|суббот[уаые]|"
+               r"воскресень[ея]|monday|tuesday|wednesday|thursday|friday|saturday|sunday)\b",
+}
+TIME_PATTERNS = {
+    "range": r"(?:\b|(?<=\dt))([01]?\d|2[0-3]):([0-5]\d)\s*(?:-|–|—|до|to|till|until)\s*([01]?\d|2[0-3]):([0-5]\d)\b",
+    "ampm": r"\b(1[0-2]|0?[1-9])(?::([0-5]\d))?\s*([ap])\.?m\b\.?",
+    "clock": r"(?:\b|(?<=\dt))([01]?\d|2[0-3]):([0-5]\d)\b",
+    "ru_hour": r"\b(?:в|к)\s+([01]?\d|2[0-3])\s*(?:час\w*|ч\b)\.?(?:\s+(утра|дня|вечера|ночи))?",
+    "ru_period": r"\b(1[0-2]|0?[1-9])\s+(?:час\w*\s+)?(утра|дня|вечера|ночи)\b",
+    "noon": r"\b(?:в\s+)?(полдень|noon|midday)\b",
+}
+DATE_PATTERNS = {kind: re.compile(pattern) for kind, pattern in DATE_PATTERNS.items()}
+TIME_PATTERNS = {kind: re.compile(pattern) for kind, pattern in TIME_PATTERNS.items()}
+
+# Запрос к модели для анализа письма
+ANALYSIS_PROMPT = """Проанализируй следующее письмо и определи, является ли оно предложением о встрече.
+Если да, извлеки дату, время и тему встречи.
+
+Письмо:
+{email_body}
+
+Ответ в формате JSON:
+{{
+    "is_meeting_proposal": true/false,
+    "extracted_date": "дата если есть",
+    "extracted_time": "время если есть",
+    "topic": "тема встречи"
+}}"""
+
+# Служебные строки пересылки и цитирования, которые не меняют смысл письма для модели
+FORWARD_MARKER_RE = re.compile(
+    r"^\s*-{2,}\s*(?:forwarded message|original message|пересылаемое сообщение|исходное сообщение)\s*-{2,}\s*$",
+    re.IGNORECASE | re.MULTILINE
+)
+FORWARD_HEADER_RE = re.compile(
+    r"^\s*(?:from|to|cc|date|sent|subject|от|кому|копия|дата|отправлено|тема)\s*:.*$",
+    re.IGNORECASE | re.MULTILINE
+)
+QUOTE_PREFIX_RE = re.compile(r"^(?:\s*>)+\s?", re.MULTILINE)
+SUBJECT_PREFIX_RE = re.compile(r"^\s*(?:(?:fwd?|re|пересл|отв)\s*:\s*)+", re.IGNORECASE)
+WHITESPACE_RE = re.compile(r"\s+")
 
 class EmailAnalysis(BaseModel):
     message_id: str
@@ -28,6 +195,9 @@ class EmailAnalysis(BaseModel):
     body: str
     user_id: str
 
+class EmailBatchAnalysis(BaseModel):
+    emails: List[EmailAnalysis] = Field(..., min_length=1, max_length=MAX_BATCH_SIZE)
+
 class Recommendation(BaseModel):
     id: str
     type: str  # "meeting_created", "email_sent", "conflict_detected", etc.
@@ -35,247 +205,1394 @@ class Recommendation(BaseModel):
     timestamp: str
     details: Dict
 
-def save_recommendation(user_id: str, recommendation: Recommendation):
+# Кэш пользовательских настроек
+preferences_cache = PreferencesCache(PREFERENCES_CACHE_TTL)
+
+class AnalysisJobs:
+    """Задания конвейера анализа писем (SQLite).
+
+    Задание проходит стадии analyze -> schedule -> reply; у каждой стадии свой
+    пул воркеров. Воркер захватывает задание на JOB_LEASE секунд, поэтому
+    задание, брошенное упавшим процессом, подхватывается заново. Промежуточный
+    результат стадии хранится в state и передается следующей. Токен
+    пользователя в базе не хранится (колонка token осталась от прежних версий
+    и очищается при старте).
+
+    Реестр processed_messages помнит письма пользователя, уже взятые в работу,
+    и их итог: повторное письмо не ставится в конвейер, а получает существующее
+    задание или сохраненный результат. Письмо, не дошедшее до действий в
+    календаре и почте (ошибка на стадиях analyze и schedule), из реестра
+    удаляется и может быть обработано снова. Пакетный анализ резервирует письма
+    в реестре на JOB_LEASE секунд и продлевает резервацию, пока обрабатывает их.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS analysis_jobs (
+                    id TEXT PRIMARY KEY,
+                    user_id TEXT NOT NULL,
+                    token TEXT,
+                    payload TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    state TEXT,
+                    result TEXT,
+                    last_error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    claimed_until REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS analysis_jobs_due ON analysis_jobs (stage, status, next_attempt_at)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS analysis_jobs_updated ON analysis_jobs (updated_at)")
+            conn.execute("UPDATE analysis_jobs SET token = NULL WHERE token IS NOT NULL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS processed_messages (
+                    user_id TEXT NOT NULL,
+                    message_id TEXT NOT NULL,
+                    job_id TEXT,
+                    stage TEXT,
+                    status TEXT NOT NULL,
+                    result TEXT,
+                    reserved_until REAL,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL,
+                    PRIMARY KEY (user_id, message_id)
+                ) WITHOUT ROWID"""
+            )
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS processed_messages_job ON processed_messages (user_id, job_id)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS processed_messages_updated ON processed_messages (updated_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> Dict:
+        job = dict(row)
+        for field in ("payload", "state", "result"):
+            job[field] = json.loads(job[field]) if job[field] else None
+        return job
+
+    @staticmethod
+    def _ledger_job(row: sqlite3.Row) -> Dict:
+        """Запись реестра в виде задания (само задание уже удалено или его не было)"""
+        return {
+            "id": row["job_id"],
+            "status": row["status"],
+            "stage": row["stage"],
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "last_error": None,
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"]
+        }
+
+    @staticmethod
+    def _reserve(conn: sqlite3.Connection, user_id: str, message_id: str, job_id: Optional[str],
+                 reserved_until: Optional[float], now: float) -> bool:
+        """Запись письма в реестр; False - письмо уже в нем.
+
+        Истекшая резервация пакетного анализа (его процесс упал) перехватывается.
+        """
+        cursor = conn.execute(
+            """INSERT INTO processed_messages
+            (user_id, message_id, job_id, status, reserved_until, created_at, updated_at)
+            VALUES (?, ?, ?, 'pending', ?, ?, ?)
+            ON CONFLICT (user_id, message_id) DO UPDATE SET
+                job_id = excluded.job_id, reserved_until = excluded.reserved_until,
+                created_at = excluded.created_at, updated_at = excluded.updated_at
+            WHERE processed_messages.status = 'pending' AND processed_messages.reserved_until < excluded.created_at""",
+            (user_id, message_id, job_id, reserved_until, now, now)
+        )
+        return cursor.rowcount == 1
+
+    def _processed(self, conn: sqlite3.Connection, user_id: str, message_id: str) -> Dict:
+        """Задание или сохраненный итог письма, уже записанного в реестр"""
+        entry = conn.execute(
+            "SELECT * FROM processed_messages WHERE user_id = ? AND message_id = ?", (user_id, message_id)
+        ).fetchone()
+        row = conn.execute("SELECT * FROM analysis_jobs WHERE id = ?", (entry["job_id"],)).fetchone() \
+            if entry["job_id"] else None
+        return self._job(row) if row else self._ledger_job(entry)
+
+    @staticmethod
+    def _settle(conn: sqlite3.Connection, user_id: str, message_id: str, stage: str, status: str,
+                result: Optional[str], now: float):
+        """Итог письма в реестре; неудача до стадии reply снимает письмо с реестра"""
+        if status == "failed" and stage != JOB_STAGES[-1]:
+            conn.execute(
+                "DELETE FROM processed_messages WHERE user_id = ? AND message_id = ? AND status = 'pending'",
+                (user_id, message_id)
+            )
+            return
+        conn.execute(
+            """UPDATE processed_messages SET stage = ?, status = ?, result = ?, reserved_until = NULL, updated_at = ?
+            WHERE user_id = ? AND message_id = ?""",
+            (stage, status, result, now, user_id, message_id)
+        )
+
+    def _insert(self, user_id: str, payload: Dict) -> Tuple[Dict, bool]:
+        job_id = f"job_{uuid.uuid4().hex}"
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            if not self._reserve(conn, user_id, payload["message_id"], job_id, None, now):
+                return self._processed(conn, user_id, payload["message_id"]), False
+            conn.execute(
+                """INSERT INTO analysis_jobs
+                (id, user_id, payload, stage, status, next_attempt_at, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 'queued', ?, ?, ?)""",
+                (job_id, user_id, json.dumps(payload, ensure_ascii=False), JOB_STAGES[0], now, now, now)
+            )
+            row = conn.execute("SELECT * FROM analysis_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job(row), True
+
+    def _select(self, user_id: str, job_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT * FROM analysis_jobs WHERE user_id = ? AND id = ?", (user_id, job_id)
+            ).fetchone()
+            if row:
+                return self._job(row)
+            # Завершенное задание уже удалено, итог остался в реестре
+            entry = conn.execute(
+                "SELECT * FROM processed_messages WHERE user_id = ? AND job_id = ?", (user_id, job_id)
+            ).fetchone()
+        return self._ledger_job(entry) if entry else None
+
+    def _reserve_batch(self, user_id: str, message_ids: List[str], until: float) -> List[Optional[Dict]]:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            return [
+                None if self._reserve(conn, user_id, message_id, None, until, now)
+                else self._processed(conn, user_id, message_id)
+                for message_id in message_ids
+            ]
+
+    def _renew_batch(self, user_id: str, message_ids: List[str], until: float):
+        with closing(self._connect()) as conn, conn:
+            conn.executemany(
+                """UPDATE processed_messages SET reserved_until = ?
+                WHERE user_id = ? AND message_id = ? AND status = 'pending' AND job_id IS NULL""",
+                [(until, user_id, message_id) for message_id in message_ids]
+            )
+
+    def _settle_batch(self, user_id: str, outcomes: List[Tuple[str, str, str, Optional[Dict]]]):
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            for message_id, stage, status, result in outcomes:
+                self._settle(
+                    conn, user_id, message_id, stage, status,
+                    json.dumps(result, ensure_ascii=False) if result is not None else None, now
+                )
+
+    def _finish(self, job: Dict, status: str, result: Dict, error: Optional[str]):
+        now = time.time()
+        result = json.dumps(result, ensure_ascii=False)
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """UPDATE analysis_jobs SET status = ?, result = ?, last_error = ?, claimed_until = NULL,
+                updated_at = ? WHERE id = ?""",
+                (status, result, error, now, job["id"])
+            )
+            self._settle(conn, job["user_id"], job["payload"]["message_id"], job["stage"], status, result, now)
+
+    def _claim(self, stage: str, now: float, until: float) -> Optional[Dict]:
+        with closing(self._connect()) as conn, conn:
+            candidates = conn.execute(
+                """SELECT id FROM analysis_jobs
+                WHERE stage = ? AND status IN ('queued', 'running') AND next_attempt_at <= ?
+                AND (claimed_until IS NULL OR claimed_until < ?)
+                ORDER BY next_attempt_at LIMIT 10""",
+                (stage, now, now)
+            ).fetchall()
+            for (job_id,) in candidates:
+                # Задание мог перехватить воркер другого процесса
+                cursor = conn.execute(
+                    """UPDATE analysis_jobs SET status = 'running', claimed_until = ?, updated_at = ?
+                    WHERE id = ? AND stage = ? AND (claimed_until IS NULL OR claimed_until < ?)""",
+                    (until, now, job_id, stage, now)
+                )
+                if cursor.rowcount == 1:
+                    return self._job(conn.execute("SELECT * FROM analysis_jobs WHERE id = ?", (job_id,)).fetchone())
+        return None
+
+    def _update(self, job_id: str, **fields):
+        for field in ("state", "result"):
+            if fields.get(field) is not None:
+                fields[field] = json.dumps(fields[field], ensure_ascii=False)
+        fields["updated_at"] = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                f"UPDATE analysis_jobs SET {', '.join(f'{name} = ?' for name in fields)} WHERE id = ?",
+                (*fields.values(), job_id)
+            )
+
+    def _prune(self, before: float, ledger_before: float) -> int:
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "DELETE FROM processed_messages WHERE status != 'pending' AND updated_at < ?", (ledger_before,)
+            )
+            return conn.execute(
+                "DELETE FROM analysis_jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (before,)
+            ).rowcount
+
+    async def create(self, user_id: str, payload: Dict) -> Tuple[Dict, bool]:
+        """Новое задание для письма или, если письмо уже в реестре, его задание или итог"""
+        return await asyncio.to_thread(self._insert, user_id, payload)
+
+    async def get(self, user_id: str, job_id: str) -> Optional[Dict]:
+        return await asyncio.to_thread(self._select, user_id, job_id)
+
+    async def claim(self, stage: str, lease: float) -> Optional[Dict]:
+        """Захват ближайшего готового задания стадии"""
+        now = time.time()
+        return await asyncio.to_thread(self._claim, stage, now, now + lease)
+
+    async def advance(self, job: Dict, stage: str, state: Dict):
+        """Передача задания следующей стадии"""
+        await asyncio.to_thread(
+            self._update, job["id"], stage=stage, status="queued", state=state, attempts=0,
+            next_attempt_at=time.time(), claimed_until=None
+        )
+
+    async def finish(self, job: Dict, status: str, result: Dict, error: Optional[str] = None):
+        """Завершение задания"""
+        await asyncio.to_thread(self._finish, job, status, result, error)
+
+    async def retry(self, job: Dict, error: str) -> Optional[float]:
+        """Повтор стадии после сетевой ошибки или окончательная ошибка.
+
+        Возвращает задержку до повтора или None, если попытки исчерпаны.
+        """
+        attempts = job["attempts"] + 1
+        if attempts >= JOB_MAX_ATTEMPTS:
+            await self.finish(job, "failed", {"action": "error", "message": JOB_ERROR_MESSAGE}, error)
+            return None
+        delay = JOB_RETRY_DELAY * 2 ** (attempts - 1)
+        await asyncio.to_thread(
+            self._update, job["id"], status="queued", attempts=attempts, last_error=error,
+            next_attempt_at=time.time() + delay, claimed_until=None
+        )
+        return delay
+
+    async def reserve_batch(self, user_id: str, message_ids: List[str]) -> List[Optional[Dict]]:
+        """Резервация писем пакета: None - письмо взято в работу, иначе его задание или итог"""
+        return await asyncio.to_thread(self._reserve_batch, user_id, message_ids, time.time() + JOB_LEASE)
+
+    async def renew_batch(self, user_id: str, message_ids: List[str]):
+        """Продление резервации писем пакета, который еще обрабатывается"""
+        await asyncio.to_thread(self._renew_batch, user_id, message_ids, time.time() + JOB_LEASE)
+
+    async def settle_batch(self, user_id: str, outcomes: List[Tuple[str, str, str, Optional[Dict]]]):
+        """Итоги писем пакета: (message_id, стадия, статус, результат)"""
+        await asyncio.to_thread(self._settle_batch, user_id, outcomes)
+
+    async def prune(self) -> int:
+        now = time.time()
+        return await asyncio.to_thread(self._prune, now - JOB_RETENTION, now - LEDGER_RETENTION)
+
+analysis_jobs = AnalysisJobs(JOBS_DB)
+
+class RecommendationStore:
+    """Рекомендации агента (SQLite).
+
+    Записи пользователя отдаются от новых к старым страницами: курсор - номер
+    последней отданной записи, поэтому страница читается по индексу и не
+    смещается, когда появляются новые рекомендации. У пользователя хранится
+    не больше per_user последних записей; записи старше retention удаляются.
+    """
+
+    def __init__(self, path: Path, per_user: int, retention: float):
+        self.path = path
+        self.per_user = per_user
+        self.retention = retention
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS recommendations (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT NOT NULL,
+                    user_id TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    details TEXT NOT NULL,
+                    created_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS recommendations_user ON recommendations (user_id, seq)")
+            conn.execute(
+                "CREATE INDEX IF NOT EXISTS recommendations_user_type ON recommendations (user_id, type, seq)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS recommendations_created ON recommendations (created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def encode_cursor(seq: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps({"before": seq}).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor: str) -> int:
+        try:
+            return int(json.loads(base64.urlsafe_b64decode(cursor.encode()))["before"])
+        except (ValueError, KeyError, TypeError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    def _insert(self, user_id: str, recommendation: Dict):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """INSERT INTO recommendations (id, user_id, type, message, timestamp, details, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    recommendation["id"], user_id, recommendation["type"], recommendation["message"],
+                    recommendation["timestamp"], json.dumps(recommendation["details"], ensure_ascii=False),
+                    time.time()
+                )
+            )
+            # Сверх лимита удаляются самые старые записи пользователя
+            conn.execute(
+                """DELETE FROM recommendations WHERE user_id = ? AND seq <= (
+                    SELECT seq FROM recommendations WHERE user_id = ? ORDER BY seq DESC LIMIT 1 OFFSET ?
+                )""",
+                (user_id, user_id, self.per_user)
+            )
+
+    def _select(self, user_id: str, types: List[str], before: Optional[int], limit: int) -> Tuple[List[Dict], Optional[int]]:
+        query = "SELECT * FROM recommendations WHERE user_id = ?"
+        params: List = [user_id]
+        if types:
+            query += f" AND type IN ({', '.join('?' * len(types))})"
+            params += types
+        if before is not None:
+            query += " AND seq < ?"
+            params.append(before)
+        # Лишняя запись показывает, есть ли следующая страница
+        query += " ORDER BY seq DESC LIMIT ?"
+        params.append(limit + 1)
+        with closing(self._connect()) as conn:
+            rows = conn.execute(query, params).fetchall()
+        page = [
+            {
+                "id": row["id"],
+                "type": row["type"],
+                "message": row["message"],
+                "timestamp": row["timestamp"],
+                "details": json.loads(row["details"])
+            }
+            for row in rows[:limit]
+        ]
+        return page, rows[limit - 1]["seq"] if len(rows) > limit else None
+
+    def _prune(self, before: float) -> int:
+        with closing(self._connect()) as conn, conn:
+            return conn.execute("DELETE FROM recommendations WHERE created_at < ?", (before,)).rowcount
+
+    async def add(self, user_id: str, recommendation: Dict):
+        await asyncio.to_thread(self._insert, user_id, recommendation)
+
+    async def page(self, user_id: str, types: List[str], cursor: Optional[str], limit: int) -> Dict:
+        """Страница рекомендаций пользователя от новых к старым"""
+        before = self.decode_cursor(cursor) if cursor else None
+        items, last = await asyncio.to_thread(self._select, user_id, types, before, limit)
+        return {"recommendations": items, "next_cursor": self.encode_cursor(last) if last is not None else None}
+
+    async def prune(self) -> int:
+        return await asyncio.to_thread(self._prune, time.time() - self.retention)
+
+recommendations_store = RecommendationStore(RECOMMENDATIONS_DB, RECOMMENDATIONS_PER_USER, RECOMMENDATIONS_RETENTION)
+
+# Кэш ответов модели
+llm_cache = LLMCache(LLM_CACHE_DB, LLM_CACHE_TTL, LLM_CACHE_MEMORY_ITEMS, LLM_CACHE_MAX_BYTES)
+
+# Модель для анализа писем
+if INFERENCE_BACKEND == "local":
+    inference_backend = LocalBackend(
+        "zero-shot-classification", LOCAL_CLASSIFIER_MODEL, LOCAL_INFERENCE_WORKERS,
+        candidate_labels=MEETING_LABELS, hypothesis_template=MEETING_HYPOTHESIS
+    )
+else:
+    inference_backend = HuggingFaceBackend(HUGGINGFACE_API_URL, HUGGINGFACE_API_KEY)
+
+# Очередь запросов к модели
+inference_batcher = InferenceBatcher(
+    inference_backend, INFERENCE_BATCH_SIZE, INFERENCE_BATCH_WINDOW, INFERENCE_CONCURRENCY, INFERENCE_MAX_QUEUE
+)
+
+def get_user_id(credentials: HTTPAuthorizationCredentials) -> str:
+    """Получение user_id из JWT токена"""
+    try:
+        payload = jwt.decode(credentials.credentials, JWT_SECRET_KEY, algorithms=[JWT_ALGORITHM])
+    except jwt.ExpiredSignatureError:
+        raise HTTPException(status_code=401, detail="Token expired")
+    except jwt.InvalidTokenError:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user_id = payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return str(user_id)
+
+def issue_job_token(user_id: str) -> str:
+    """Короткий токен пользователя для запросов стадии задания к другим сервисам"""
+    now = datetime.now(timezone.utc)
+    payload = {"user_id": user_id, "iat": now, "exp": now + timedelta(seconds=JOB_TOKEN_TTL)}
+    return jwt.encode(payload, JWT_SECRET_KEY, algorithm=JWT_ALGORITHM)
+
+class DownstreamUnauthorized(Exception):
+    """Calendar или Email Service отклонил токен стадии (401)"""
+
+def check_authorized(response: httpx.Response) -> httpx.Response:
+    if response.status_code == 401:
+        raise DownstreamUnauthorized(f"{response.request.url.path} returned 401")
+    return response
+
+def meeting_interval(analysis: Dict) -> Tuple[str, str]:
+    """Время предложенной встречи (ISO начало и конец) по результату анализа письма"""
+    if analysis.get("meeting_start"):
+        return analysis["meeting_start"], analysis["meeting_end"]
+    # Время в письме не найдено - текущее время следующего дня
+    tomorrow = datetime.now(MEETING_TIMEZONE).replace(microsecond=0) + timedelta(days=1)
+    return tomorrow.isoformat(), (tomorrow + timedelta(minutes=DEFAULT_MEETING_MINUTES)).isoformat()
+
+def meeting_details(email_body: str) -> Dict:
+    """Поля анализа письма с найденным временем встречи"""
+    extracted = extract_meeting_time(email_body)
+    if not extracted:
+        return {"extracted_date": None, "extracted_time": None, "confidence": 0.0}
+    return {
+        "extracted_date": extracted["date_text"],
+        "extracted_time": extracted["time_text"],
+        "meeting_start": extracted["start"].isoformat(),
+        "meeting_end": extracted["end"].isoformat(),
+        "confidence": extracted["confidence"]
+    }
+
+def resolve_date(kind: str, match: re.Match, today: date) -> Optional[date]:
+    """Дата по совпадению шаблона; дата без года - ближайшая не в прошлом"""
+    groups = match.groups()
+    if kind == "relative":
+        return today + timedelta(days=RELATIVE_DAYS[groups[0]])
+    if kind == "in_days":
+        count = groups[0] or "1"
+        count = int(count) if count.isdigit() else NUMBER_WORDS[count]
+        return today + timedelta(days=count * 7 if groups[1].startswith(("недел", "week")) else count)
+    if kind == "weekday":
+        weekday = next(number for prefix, number in WEEKDAY_NAMES.items() if groups[1].startswith(prefix))
+        return today + timedelta(days=(weekday - today.weekday() - 1) % 7 + 1)
+    
+    if kind == "iso":
+        year, month, day = groups
+    elif kind == "numeric":
+        day, month, year = groups
+    elif kind in ("ru_text", "en_day_month"):
+        day, month, year = groups[0], groups[1], groups[2]
+    else:
+        month, day, year = groups
+    if not month.isdigit():
+        month = next(number for prefix, number in MONTHS.items() if month.startswith(prefix))
+    try:
+        if year:
+            year = int(year)
+            return date(year + 2000 if year < 100 else year, int(month), int(day))
+        resolved = date(today.year, int(month), int(day))
+        return resolved if resolved >= today else date(today.year + 1, int(month), int(day))
+    except ValueError:
+        return None
+
+def resolve_hour(hour: int, period: Optional[str]) -> int:
+    """Час с учетом "утра/дня/вечера/ночи" и am/pm"""
+    period = period or ""
+    if period in ("дня", "вечера", "p") and hour < 12:
+        return hour + 12
+    if period in ("ночи", "a") and hour == 12:
+        return 0
+    return hour
+
+def extract_meeting_time(text: str, now: Optional[datetime] = None) -> Optional[Dict]:
+    """Извлечение даты и времени встречи из текста письма (русский и английский).
+
+    Возвращает начало и конец встречи в MEETING_TIMEZONE, найденные фрагменты
+    текста и уверенность 0..1: явные дата и время - около 0.95, только дата
+    или только время - 0.65. Если ни даты, ни времени нет - None.
+    """
+    now = now.astimezone(MEETING_TIMEZONE) if now else datetime.now(MEETING_TIMEZONE)
+    today = now.date()
+    text = text.lower()
+    
+    found_date, date_text, date_kind = None, None, None
+    for kind, pattern in DATE_PATTERNS.items():
+        for match in pattern.finditer(text):
+            found_date = resolve_date(kind, match, today)
+            if found_date:
+                date_text, date_kind = match.group(0).strip(), kind
+                break
+        if found_date:
+            break
+    
+    start_time, end_time, time_text = None, None, None
+    for kind, pattern in TIME_PATTERNS.items():
+        match = pattern.search(text)
+        if match:
+            break
+    if match:
+        groups = match.groups()
+        if kind in ("range", "clock"):
+            start_time = dt_time(int(groups[0]), int(groups[1]))
+            if kind == "range":
+                end_time = dt_time(int(groups[2]), int(groups[3]))
+        elif kind == "ampm":
+            start_time = dt_time(resolve_hour(int(groups[0]), groups[2]), int(groups[1] or 0))
+        elif kind == "noon":
+            start_time = dt_time(12)
+        else:
+            start_time = dt_time(resolve_hour(int(groups[0]), groups[1]))
+        time_text = match.group(0).strip()
+    
+    if not found_date and not start_time:
+        return None
+    if not found_date:
+        # Только время: сегодня, если оно еще не прошло, иначе завтра
+        found_date = today if start_time > now.time() else today + timedelta(days=1)
+    
+    start = datetime.combine(found_date, start_time or DEFAULT_MEETING_TIME, MEETING_TIMEZONE)
+    end = datetime.combine(found_date, end_time, MEETING_TIMEZONE) if end_time else None
+    if not end or end <= start:
+        end = start + timedelta(minutes=DEFAULT_MEETING_MINUTES)
+    
+    confidence = (0.45 if date_kind in ("relative", "in_days", "weekday") else 0.5 if date_kind else 0.2) + \
+        (0.45 if start_time else 0.15)
+    return {
+        "start": start,
+        "end": end,
+        "date_text": date_text,
+        "time_text": time_text,
+        "confidence": round(confidence, 2)
+    }
+
+def parse_event_time(value) -> Optional[datetime]:
+    """Время события календаря; время без часового пояса считается UTC"""
+    if isinstance(value, dict):
+        value = value.get("dateTime") or value.get("date")
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+def overlaps(start: datetime, end: datetime, busy: List[Tuple[datetime, datetime]]) -> bool:
+    """Пересекается ли интервал хотя бы с одним занятым"""
+    return any(busy_start < end and start < busy_end for busy_start, busy_end in busy)
+
+def clean_email_body(email_body: str) -> str:
+    """Текст письма без обвязки пересылки и цитирования.
+
+    Пересланное или повторно присланное письмо дает тот же текст, а значит
+    и тот же ключ в кэше ответов модели; заголовки пересылки (Date: ...)
+    не принимаются за время встречи.
+    """
+    text = FORWARD_MARKER_RE.sub(" ", email_body)
+    text = FORWARD_HEADER_RE.sub(" ", text)
+    text = QUOTE_PREFIX_RE.sub("", text)
+    return WHITESPACE_RE.sub(" ", SUBJECT_PREFIX_RE.sub("", text)).strip()
+
+async def save_recommendation(user_id: str, recommendation: Recommendation):
     """Сохранение рекомендации"""
-    if user_id not in recommendations_storage:
-        recommendations_storage[user_id] = []
-    recommendations_storage[user_id].append(recommendation.dict())
+    await recommendations_store.add(user_id, recommendation.dict())
+
+def is_meeting_result(result) -> bool:
+    """Решение модели: предлагается ли в письме встреча"""
+    if isinstance(result, dict) and "labels" in result:
+        # Zero-shot классификатор: метка с наибольшей оценкой и ее уверенность
+        return result["labels"][0] == MEETING_LABELS[0] and result["scores"][0] >= LOCAL_MEETING_THRESHOLD
+    # Удаленная модель: любой ответ считается предложением о встрече (упрощенная версия)
+    return True
+
+def heuristic_analysis(text: str) -> Dict:
+    """Анализ письма по ключевым словам, без модели"""
+    if MEETING_KEYWORDS_RE.search(text):
+        return {
+            "is_meeting_proposal": True,
+            **meeting_details(text),
+            "topic": text[:100]  # Первые 100 символов как тема
+        }
+    
+    return {"is_meeting_proposal": False}
 
 async def analyze_email_with_llm(email_body: str) -> Dict:
     """Анализ письма с помощью LLM для определения предложения о встрече"""
-    if not HUGGINGFACE_API_KEY:
+    text = clean_email_body(email_body)
+    if not USE_MODEL:
         # Заглушка: простая эвристика
-        meeting_keywords = ["встреча", "встретиться", "собрание", "встречаемся", "appointment", "meeting"]
-        email_lower = email_body.lower()
-        is_meeting_proposal = any(keyword in email_lower for keyword in meeting_keywords)
-        
-        if is_meeting_proposal:
-            # Простое извлечение даты/времени
-            date_patterns = [
-                r'\d{1,2}[./]\d{1,2}[./]\d{2,4}',
-                r'\d{1,2}\s+(январ|феврал|март|апрел|май|июн|июл|август|сентябр|октябр|ноябр|декабр)',
-            ]
-            time_patterns = [
-                r'\d{1,2}:\d{2}',
-                r'\d{1,2}\s+(час|часа|часов)',
-            ]
-            
-            dates = []
-            times = []
-            for pattern in date_patterns:
-                dates.extend(re.findall(pattern, email_body, re.IGNORECASE))
-            for pattern in time_patterns:
-                times.extend(re.findall(pattern, email_body, re.IGNORECASE))
-            
-            return {
-                "is_meeting_proposal": True,
-                "extracted_date": dates[0] if dates else None,
-                "extracted_time": times[0] if times else None,
-                "topic": email_body[:100]  # Первые 100 символов как тема
-            }
-        
-        return {"is_meeting_proposal": False}
+        return heuristic_analysis(text)
     
     # Использование LLM для анализа
-    prompt = f"""Проанализируй следующее письмо и определи, является ли оно предложением о встрече.
-Если да, извлеки дату, время и тему встречи.
+    if INFERENCE_BACKEND == "local":
+        # Локальный классификатор получает сам текст, метки заданы в пайплайне
+        template = MEETING_HYPOTHESIS + json.dumps(MEETING_LABELS, ensure_ascii=False)
+        model_input = text[:500]
+    else:
+        template = ANALYSIS_PROMPT
+        model_input = ANALYSIS_PROMPT.format(email_body=text[:500])
+    
+    async def request_model():
+        # Запрос уходит в модель вместе с другими, пришедшими одновременно
+        return await inference_batcher.submit(model_input)
+    
+    try:
+        # Пересланные и повторные письма берутся из кэша, не доходя до модели.
+        # Повторы и отключение недоступной модели выполняет inference_batcher
+        result = await llm_cache.get_or_compute(
+            llm_cache.key(inference_backend.name, template, text[:500]),
+            request_model
+        )
+        if result is not None:
+            if not is_meeting_result(result):
+                return {"is_meeting_proposal": False}
+            # Парсинг ответа LLM
+            # Упрощенная версия: дата и время берутся из текста письма
+            return {"is_meeting_proposal": True, **meeting_details(text), "topic": None}
+    except Exception:
+        pass
+    # Fallback на эвристику
+    return heuristic_analysis(text)
 
-Письмо:
-{email_body[:500]}
+# Будит воркеры стадии после появления в ней заданий
+job_events = {stage: asyncio.Event() for stage in JOB_STAGES}
+# Будит ожидающие запросы статуса заданий этого процесса
+jobs_condition = asyncio.Condition()
 
-Ответ в формате JSON:
-{{
-    "is_meeting_proposal": true/false,
-    "extracted_date": "дата если есть",
-    "extracted_time": "время если есть",
-    "topic": "тема встречи"
-}}"""
+async def notify_jobs():
+    async with jobs_condition:
+        jobs_condition.notify_all()
+
+async def wait_for_jobs(timeout: float) -> bool:
+    """Ожидание изменения заданий в этом процессе; False - вышел timeout"""
+    async with jobs_condition:
+        try:
+            await asyncio.wait_for(jobs_condition.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+async def run_analyze_stage(client: httpx.AsyncClient, job: Dict) -> Tuple[Optional[str], Dict]:
+    """Анализ письма; письмо без предложения о встрече завершает задание"""
+    analysis = await analyze_email_with_llm(job["payload"]["body"])
+    if not analysis.get("is_meeting_proposal"):
+        return None, {
+            "action": "no_action",
+            "message": "Письмо не содержит предложения о встрече"
+        }
+    meeting_start, meeting_end = meeting_interval(analysis)
+    return "schedule", {"analysis": analysis, "meeting_start": meeting_start, "meeting_end": meeting_end}
+
+def request_free_slots(client: httpx.AsyncClient, headers: Dict) -> Awaitable[httpx.Response]:
+    """Запрос свободных часовых слотов на неделю вперед"""
+    now = datetime.now(MEETING_TIMEZONE)
+    return client.get(
+        f"{CALENDAR_SERVICE_URL}/free-slots",
+        headers=headers,
+        params={
+            "start_date": now.isoformat(),
+            "end_date": (now + timedelta(days=7)).isoformat(),
+            "duration_minutes": 60
+        }
+    )
+
+def reply_message(email: Dict, analysis: Dict, templates: Dict, alternatives: Optional[List[Dict]] = None) -> Dict:
+    """Ответ отправителю: согласие или, если переданы альтернативы, отказ с ними"""
+    if alternatives is None:
+        body = f"{templates['accept']}\nДата: {analysis.get('extracted_date') or 'предложенное время'}."
+    else:
+        alternatives_text = "\n".join([f"- {slot['start']}" for slot in alternatives])
+        body = f"{templates['decline']} Могу предложить следующие альтернативы:\n{alternatives_text}"
+    return {"to": email["from_email"], "subject": f"Re: {email['subject']}", "body": body}
+
+async def timed(name: str, timings: Dict[str, float], awaitable: Awaitable):
+    """Результат awaitable; время ожидания записывается в timings[name]"""
+    started = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        timings[name] = time.perf_counter() - started
+
+async def run_schedule_stage(client: httpx.AsyncClient, job: Dict) -> Tuple[Optional[str], Dict]:
+    """Проверка конфликта и создание встречи или подбор альтернативных слотов.
+
+    Настройки пользователя, проверка конфликта и (при SPECULATIVE_FREE_SLOTS)
+    свободные слоты запрашиваются одновременно; ответ отправителю готовится,
+    пока создается встреча, и передается стадии reply.
+    """
+    email, state = job["payload"], job["state"]
+    headers = {"Authorization": f"Bearer {job['token']}"}
+    error = {"action": "error", "message": JOB_ERROR_MESSAGE}
+    timings = {}
+    started = time.perf_counter()
     
+    prefs_task = asyncio.create_task(
+        timed("preferences", timings, preferences_cache.get(job["user_id"], job["token"]))
+    )
+    # Проверка конфликта через Calendar Service
+    check_task = asyncio.create_task(timed("check_conflict", timings, client.get(
+        f"{CALENDAR_SERVICE_URL}/check-conflict",
+        headers=headers,
+        params={"start": state["meeting_start"], "end": state["meeting_end"]}
+    )))
+    slots_task = asyncio.create_task(timed("free_slots", timings, request_free_slots(client, headers))) \
+        if SPECULATIVE_FREE_SLOTS else None
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                HUGGINGFACE_API_URL,
-                headers={
-                    "Authorization": f"Bearer {HUGGINGFACE_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={"inputs": prompt},
-                timeout=30.0
+        prefs = await prefs_task
+        templates = {**DEFAULT_PREFERENCES["response_templates"], **prefs.get("response_templates", {})}
+        # Встреча вне рабочего графика пользователя - занятое время, проверять календарь не нужно
+        has_conflict = not within_work_schedule(
+            datetime.fromisoformat(state["meeting_start"]),
+            datetime.fromisoformat(state["meeting_end"]),
+            prefs.get("work_schedule", DEFAULT_PREFERENCES["work_schedule"])
+        )
+        if not has_conflict:
+            check_response = check_authorized(await check_task)
+            if check_response.status_code != 200:
+                return None, error
+            has_conflict = check_response.json().get("has_conflict", False)
+        
+        if not has_conflict:
+            # Время свободно - создаем встречу, слоты не понадобятся
+            if slots_task:
+                slots_task.cancel()
+            create_task = asyncio.create_task(timed("create_event", timings, client.post(
+                f"{CALENDAR_SERVICE_URL}/events",
+                headers=headers,
+                json={
+                    "summary": state["analysis"].get("topic") or email["subject"],
+                    "description": f"Встреча предложена в письме от {email['from_email']}",
+                    "start": state["meeting_start"],
+                    "end": state["meeting_end"]
+                }
+            )))
+            reply = reply_message(email, state["analysis"], templates)
+            create_response = check_authorized(await create_task)
+            if create_response.status_code not in [200, 201]:
+                return None, error
+            next_state = {**state, "event": create_response.json(), "reply": reply}
+        else:
+            # Время занято - предлагаем альтернативы
+            slots_response = check_authorized(
+                await (slots_task or timed("free_slots", timings, request_free_slots(client, headers)))
             )
-            
-            if response.status_code == 200:
-                result = response.json()
-                # Парсинг ответа LLM
-                # Упрощенная версия
-                return {"is_meeting_proposal": True, "extracted_date": None, "extracted_time": None, "topic": None}
+            if slots_response.status_code != 200:
+                return None, error
+            free_slots = slots_response.json().get("free_slots", [])[:ALTERNATIVE_SLOTS]
+            next_state = {
+                **state,
+                "alternatives": free_slots,
+                "reply": reply_message(email, state["analysis"], templates, free_slots)
+            }
+    finally:
+        # Ненужные запросы отменяются; ошибка неиспользованного ответа не логируется
+        for task in (prefs_task, check_task, slots_task):
+            if task and not task.done():
+                task.cancel()
+            elif task and not task.cancelled():
+                task.exception()
+    
+    schedule_stats.record(time.perf_counter() - started, timings, has_conflict, slots_task is not None)
+    return "reply", next_state
+
+async def run_reply_stage(client: httpx.AsyncClient, job: Dict) -> Tuple[Optional[str], Dict]:
+    """Ответ отправителю через очередь Email Service и рекомендация"""
+    email, state, user_id = job["payload"], job["state"], job["user_id"]
+    topic = state["analysis"].get("topic") or email["subject"]
+    
+    # Ответ подготовлен стадией schedule; у заданий, начатых до этого, собирается здесь
+    reply = state.get("reply")
+    if reply is None:
+        prefs = await preferences_cache.get(user_id, job["token"])
+        templates = {**DEFAULT_PREFERENCES["response_templates"], **prefs.get("response_templates", {})}
+        reply = reply_message(email, state["analysis"], templates, state.get("alternatives"))
+    
+    # Ключ идемпотентности защищает от второго письма при повторе стадии
+    send_response = await client.post(
+        f"{EMAIL_SERVICE_URL}/send",
+        headers={
+            "Authorization": f"Bearer {job['token']}",
+            "Idempotency-Key": f"reply:{email['message_id']}"
+        },
+        json=reply
+    )
+    check_authorized(send_response)
+    email_sent = send_response.status_code in [200, 201, 202]
+    
+    if "event" in state:
+        event = state["event"]
+        await save_recommendation(user_id, Recommendation(
+            id=f"rec_{datetime.now().timestamp()}",
+            type="meeting_created",
+            message=f"Встреча '{topic}' создана и ответ отправлен",
+            timestamp=datetime.now().isoformat(),
+            details={"event_id": event.get("id"), "email_to": email["from_email"]}
+        ))
+        return None, {
+            "action": "meeting_created",
+            "event_id": event.get("id"),
+            "email_sent": email_sent,
+            "message": "Встреча создана и ответ отправлен"
+        }
+    
+    await save_recommendation(user_id, Recommendation(
+        id=f"rec_{datetime.now().timestamp()}",
+        type="alternative_proposed",
+        message=f"Предложены альтернативные временные слоты для встречи '{topic}'",
+        timestamp=datetime.now().isoformat(),
+        details={"email_to": email["from_email"], "slots": state["alternatives"]}
+    ))
+    return None, {
+        "action": "alternatives_proposed",
+        "alternatives": state["alternatives"],
+        "email_sent": email_sent,
+        "message": "Предложены альтернативные временные слоты"
+    }
+
+class SchedulingStats:
+    """Время стадии schedule: сколько заняла на деле и сколько заняли бы те же
+    запросы (настройки, проверка конфликта, слоты или создание встречи) по очереди.
+    """
+
+    def __init__(self):
+        self.runs = 0
+        self.conflicts = 0
+        self.speculative_hits = 0
+        self.speculative_wasted = 0
+        self.wall = 0.0
+        self.serial = 0.0
+
+    def record(self, wall: float, timings: Dict[str, float], has_conflict: bool, speculated: bool):
+        self.runs += 1
+        self.conflicts += has_conflict
+        if speculated:
+            if has_conflict:
+                self.speculative_hits += 1
             else:
-                # Fallback на эвристику
-                return await analyze_email_with_llm(email_body)  # Рекурсивный вызов без API
-    except Exception:
-        # Fallback на эвристику
-        meeting_keywords = ["встреча", "встретиться", "собрание"]
-        is_meeting = any(kw in email_body.lower() for kw in meeting_keywords)
-        return {"is_meeting_proposal": is_meeting, "extracted_date": None, "extracted_time": None, "topic": None}
+                self.speculative_wasted += 1
+        needed = ("preferences", "check_conflict", "free_slots" if has_conflict else "create_event")
+        self.wall += wall
+        self.serial += sum(timings.get(name, 0.0) for name in needed)
+
+    def metrics(self) -> Dict:
+        return {
+            "runs": self.runs,
+            "conflicts": self.conflicts,
+            "speculative_hits": self.speculative_hits,
+            "speculative_wasted": self.speculative_wasted,
+            "avg_ms": round(self.wall / self.runs * 1000, 1) if self.runs else None,
+            "avg_serial_ms": round(self.serial / self.runs * 1000, 1) if self.runs else None,
+            "saved_ms_total": round((self.serial - self.wall) * 1000, 1)
+        }
+
+schedule_stats = SchedulingStats()
+
+STAGE_HANDLERS = {
+    "analyze": run_analyze_stage,
+    "schedule": run_schedule_stage,
+    "reply": run_reply_stage
+}
 
-@app.post("/analyze-email")
+async def process_job(stage: str, client: httpx.AsyncClient, job: Dict):
+    """Выполнение стадии задания и передача следующей стадии"""
+    # Токен выпускается на каждую стадию: повтор может случиться позже, чем истек бы токен запроса
+    job = {**job, "token": issue_job_token(job["user_id"])}
+    try:
+        next_stage, data = await STAGE_HANDLERS[stage](client, job)
+    except DownstreamUnauthorized as e:
+        await analysis_jobs.finish(
+            job, "failed", {"action": "unauthorized", "message": JOB_UNAUTHORIZED_MESSAGE}, str(e)
+        )
+    except httpx.RequestError as e:
+        delay = await analysis_jobs.retry(job, str(e) or type(e).__name__)
+        if delay is not None:
+            # Разбудить воркеры стадии к моменту повтора
+            asyncio.get_running_loop().call_later(delay, job_events[stage].set)
+    except Exception as e:
+        logger.exception("Analysis job %s failed at stage %s", job["id"], stage)
+        await analysis_jobs.finish(job, "failed", {"action": "error", "message": JOB_ERROR_MESSAGE}, repr(e))
+    else:
+        if next_stage:
+            await analysis_jobs.advance(job, next_stage, data)
+            job_events[next_stage].set()
+        else:
+            await analysis_jobs.finish(job, "failed" if data["action"] == "error" else "done", data)
+    await notify_jobs()
+
+async def job_worker(stage: str, client: httpx.AsyncClient):
+    """Воркер стадии: забирает готовые задания, пока они есть, затем ждет сигнала или опроса"""
+    while True:
+        job_events[stage].clear()
+        try:
+            job = await analysis_jobs.claim(stage, JOB_LEASE)
+            if job:
+                await process_job(stage, client, job)
+                continue
+        except Exception:
+            # Задание, которое не удалось завершить, подхватит воркер после истечения аренды
+            logger.exception("Job worker for stage %s failed", stage)
+        
+        try:
+            await asyncio.wait_for(job_events[stage].wait(), JOB_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def job_cleanup_loop():
+    """Удаление завершенных заданий и рекомендаций старше срока хранения"""
+    while True:
+        try:
+            await analysis_jobs.prune()
+            await recommendations_store.prune()
+        except Exception:
+            logger.exception("Job cleanup failed")
+        await asyncio.sleep(3600)
+
+@app.on_event("startup")
+async def start_job_workers():
+    """Запуск пулов воркеров стадий конвейера"""
+    app.state.jobs_client = httpx.AsyncClient(timeout=30.0)
+    app.state.job_workers = [
+        asyncio.create_task(job_worker(stage, app.state.jobs_client))
+        for stage, workers in zip(JOB_STAGES, (ANALYZE_WORKERS, SCHEDULE_WORKERS, REPLY_WORKERS))
+        for _ in range(workers)
+    ]
+    app.state.job_workers.append(asyncio.create_task(job_cleanup_loop()))
+
+@app.on_event("shutdown")
+async def stop_job_workers():
+    """Остановка воркеров; незавершенные задания подхватит следующий запуск по истечении аренды"""
+    for task in getattr(app.state, "job_workers", []):
+        task.cancel()
+    client = getattr(app.state, "jobs_client", None)
+    if client:
+        await client.aclose()
+
+def job_status(job: Dict) -> Dict:
+    return {
+        "job_id": job["id"],
+        "status": job["status"],
+        "stage": job["stage"],
+        "result": job["result"],
+        "error": job["last_error"],
+        "created_at": datetime.fromtimestamp(job["created_at"], timezone.utc).isoformat(),
+        "updated_at": datetime.fromtimestamp(job["updated_at"], timezone.utc).isoformat()
+    }
+
+async def stream_job(user_id: str, job: Dict) -> AsyncIterator[bytes]:
+    """Ход задания в формате Server-Sent Events: progress при смене стадии, в конце done или failed"""
+    yield b"retry: 5000\n\n"
+    last = None
+    while True:
+        status = job_status(job)
+        if (status["status"], status["stage"]) != last:
+            last = (status["status"], status["stage"])
+            event = status["status"] if status["status"] in ("done", "failed") else "progress"
+            yield f"event: {event}\ndata: {json.dumps(status, ensure_ascii=False)}\n\n".encode()
+            if event != "progress":
+                return
+        if not await wait_for_jobs(min(SSE_KEEPALIVE, JOB_POLL_INTERVAL)):
+            # Комментарий не дает прокси закрыть простаивающее соединение
+            yield b": keepalive\n\n"
+        job = await analysis_jobs.get(user_id, job["id"])
+        if not job:
+            return
+
+@app.post("/analyze-email", status_code=202)
 async def analyze_email(
     email_data: EmailAnalysis,
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
-    """Анализ письма и автоматические действия"""
-    token = credentials.credentials
+    """Постановка письма в конвейер анализа и автоматических действий.
+
+    Отвечает сразу идентификатором задания; анализ, работа с календарем и
+    ответ отправителю идут в фоне. Статус и результат - GET /analyze-email/jobs/{job_id}.
+    Повторный запрос с тем же message_id не запускает анализ заново, а возвращает
+    уже существующее задание или его результат.
+    """
+    user_id = get_user_id(credentials)
+    
+    job, created = await analysis_jobs.create(user_id, email_data.dict())
+    if created:
+        job_events[JOB_STAGES[0]].set()
+    elif job["status"] == "pending":
+        raise HTTPException(status_code=409, detail="Email is being analyzed in a batch")
+    return job_status(job)
+
+@app.get("/analyze-email/jobs/{job_id}")
+async def get_analysis_job(
+    job_id: str,
+    request: Request,
+    wait: float = Query(0, ge=0, le=60, description="Ждать завершения задания до стольких секунд"),
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Статус задания: queued или running на стадии analyze/schedule/reply, затем done или failed.
+
+    result после завершения - те же поля, что возвращал синхронный анализ:
+    action (no_action, meeting_created, alternatives_proposed, error, unauthorized) и детали.
+    С wait ответ приходит после завершения задания или по истечении wait секунд.
+    С заголовком Accept: text/event-stream отдает поток событий до завершения задания.
+    """
+    user_id = get_user_id(credentials)
     
-    # Анализ письма
-    analysis = await analyze_email_with_llm(email_data.body)
+    job = await analysis_jobs.get(user_id, job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Analysis job not found")
     
-    if not analysis.get("is_meeting_proposal"):
-        return {
-            "action": "no_action",
-            "message": "Письмо не содержит предложения о встрече"
-        }
+    if "text/event-stream" in request.headers.get("accept", ""):
+        return StreamingResponse(
+            stream_job(user_id, job),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
     
-    # Извлечение данных о встрече
-    extracted_date = analysis.get("extracted_date")
-    extracted_time = analysis.get("extracted_time")
-    topic = analysis.get("topic") or email_data.subject
+    deadline = time.monotonic() + wait
+    while job["status"] not in ("done", "failed") and time.monotonic() < deadline:
+        await wait_for_jobs(min(deadline - time.monotonic(), JOB_POLL_INTERVAL))
+        job = await analysis_jobs.get(user_id, job_id) or job
+    return job_status(job)
+
+async def analyze_email_batch(
+    user_id: str, token: str, prefs: Dict, emails: List[EmailAnalysis]
+) -> AsyncIterator[bytes]:
+    """Пакетный анализ писем: строки NDJSON по мере готовности результатов.
+
+    Письма, уже записанные в реестр обработанных, отдаются сразу из него, без
+    модели, календаря и почты; остальные резервируются в реестре и после
+    обработки получают в нем свой итог.
+    """
+    def render(index: int, result: Dict) -> bytes:
+        line = {"index": index, "message_id": emails[index].message_id, **result}
+        return json.dumps(line, ensure_ascii=False).encode() + b"\n"
     
-    # Проверка конфликта через Calendar Service
-    async with httpx.AsyncClient() as client:
-        # Формируем дату/время для проверки
-        # Упрощенная версия - используем текущую дату + 1 день, если дата не указана
-        if not extracted_date:
-            meeting_start = (datetime.now() + timedelta(days=1)).isoformat()
-            meeting_end = (datetime.now() + timedelta(days=1, hours=1)).isoformat()
+    fresh = []
+    for index, processed in enumerate(
+        await analysis_jobs.reserve_batch(user_id, [email.message_id for email in emails])
+    ):
+        if processed is None:
+            fresh.append(index)
+        elif processed["status"] in ("done", "failed"):
+            yield render(index, processed["result"])
         else:
-            # Парсинг даты (упрощенная версия)
-            meeting_start = datetime.now().isoformat()
-            meeting_end = (datetime.now() + timedelta(hours=1)).isoformat()
-        
-        # Проверка конфликта
-        check_response = await client.get(
-            f"{CALENDAR_SERVICE_URL}/check-conflict",
-            headers={"Authorization": f"Bearer {token}"},
-            params={"start": meeting_start, "end": meeting_end}
-        )
-        
-        if check_response.status_code == 200:
-            conflict_data = check_response.json()
-            has_conflict = conflict_data.get("has_conflict", False)
-            
-            if not has_conflict:
-                # Время свободно - создаем встречу
-                event_data = {
-                    "summary": topic,
-                    "description": f"Встреча предложена в письме от {email_data.from_email}",
-                    "start": meeting_start,
-                    "end": meeting_end
-                }
-                
-                create_response = await client.post(
+            yield render(index, {
+                "action": "in_progress",
+                "job_id": processed["id"],
+                "message": "Письмо уже обрабатывается"
+            })
+    
+    async def heartbeat():
+        # Пакет может идти дольше JOB_LEASE (таймауты календаря и почты, повторы модели):
+        # без продления его письма перехватил бы повторный запрос
+        message_ids = [emails[index].message_id for index in fresh]
+        while True:
+            await asyncio.sleep(JOB_LEASE / 3)
+            try:
+                await analysis_jobs.renew_batch(user_id, message_ids)
+            except Exception:
+                logger.exception("Failed to renew batch reservation")
+    
+    outcomes = {}
+    renewal = asyncio.create_task(heartbeat()) if fresh else None
+    try:
+        async for index, result in process_email_batch(user_id, token, prefs, emails, fresh):
+            outcomes[index] = result
+            yield render(index, result)
+    finally:
+        if renewal:
+            renewal.cancel()
+        # Письма с ошибкой и необработанные (клиент отключился) снимаются с реестра;
+        # письма с уже созданной встречей записаны в него до ответов и остаются
+        settled = []
+        for index in fresh:
+            result = outcomes.get(index, {"action": "error"})
+            if result["action"] == "error":
+                settled.append((emails[index].message_id, "schedule", "failed", None))
+            else:
+                stage = JOB_STAGES[0] if result["action"] == "no_action" else JOB_STAGES[-1]
+                settled.append((emails[index].message_id, stage, "done", result))
+        await analysis_jobs.settle_batch(user_id, settled)
+
+async def process_email_batch(
+    user_id: str, token: str, prefs: Dict, emails: List[EmailAnalysis], indexes: List[int]
+) -> AsyncIterator[Tuple[int, Dict]]:
+    """Анализ писем пакета с номерами indexes: пары (номер, результат) по мере готовности.
+
+    Письма классифицируются параллельно (не более ANALYZE_CONCURRENCY одновременно).
+    Календарь запрашивается один раз на весь пакет: события за окно, покрывающее
+    все предложенные встречи, затем при необходимости свободные слоты и одно
+    пакетное создание событий. Предложения разбираются в порядке писем, так что
+    встреча, принятая из одного письма, занимает время для следующих.
+    """
+    templates = {**DEFAULT_PREFERENCES["response_templates"], **prefs.get("response_templates", {})}
+    schedule = prefs.get("work_schedule", DEFAULT_PREFERENCES["work_schedule"])
+    headers = {"Authorization": f"Bearer {token}"}
+    semaphore = asyncio.Semaphore(ANALYZE_CONCURRENCY)
+    
+    error = {"action": "error", "message": JOB_ERROR_MESSAGE}
+    
+    async def classify(index: int) -> Tuple[int, Dict]:
+        async with semaphore:
+            return index, await analyze_email_with_llm(emails[index].body)
+    
+    # 1. Классификация: письма без предложения о встрече отдаются сразу
+    proposals = []
+    pending = {asyncio.create_task(classify(index)) for index in indexes}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                index, analysis = task.result()
+                if analysis.get("is_meeting_proposal"):
+                    meeting_start, meeting_end = meeting_interval(analysis)
+                    proposals.append((index, analysis, meeting_start, meeting_end))
+                else:
+                    yield index, {
+                        "action": "no_action",
+                        "message": "Письмо не содержит предложения о встрече"
+                    }
+    finally:
+        for task in pending:
+            task.cancel()
+    if not proposals:
+        return
+    proposals.sort(key=lambda proposal: proposal[0])
+    
+    async with httpx.AsyncClient(timeout=30.0) as client:
+        # Слоты для писем с конфликтом запрашиваются сразу, параллельно с событиями
+        slots_task = asyncio.create_task(request_free_slots(client, headers)) if SPECULATIVE_FREE_SLOTS else None
+        try:
+            # 2. Один запрос событий на окно, покрывающее все предложенные встречи
+            try:
+                events_response = await client.get(
                     f"{CALENDAR_SERVICE_URL}/events",
-                    headers={"Authorization": f"Bearer {token}"},
-                    json=event_data
-                )
-                
-                if create_response.status_code in [200, 201]:
-                    event = create_response.json()
-                    
-                    # Отправка ответа согласия
-                    response_email = {
-                        "to": email_data.from_email,
-                        "subject": f"Re: {email_data.subject}",
-                        "body": f"Спасибо за предложение! Я подтверждаю встречу на {extracted_date or 'предложенное время'}."
+                    headers=headers,
+                    params={
+                        "start_date": min(proposal[2] for proposal in proposals),
+                        "end_date": max(proposal[3] for proposal in proposals)
                     }
-                    
-                    send_response = await client.post(
-                        f"{EMAIL_SERVICE_URL}/send",
-                        headers={"Authorization": f"Bearer {token}"},
-                        json=response_email
+                )
+            except httpx.RequestError:
+                events_response = None
+            if events_response is None or events_response.status_code != 200:
+                for index, *_ in proposals:
+                    yield index, error
+                return
+            
+            busy = []
+            for event in events_response.json().get("events", []):
+                busy_start, busy_end = parse_event_time(event.get("start")), parse_event_time(event.get("end"))
+                if busy_start and busy_end:
+                    busy.append((busy_start, busy_end))
+            
+            accepted, conflicted = [], []
+            for proposal in proposals:
+                start, end = datetime.fromisoformat(proposal[2]), datetime.fromisoformat(proposal[3])
+                interval = (parse_event_time(proposal[2]), parse_event_time(proposal[3]))
+                # Встреча вне рабочего графика пользователя тоже считается занятым временем
+                if overlaps(*interval, busy) or not within_work_schedule(start, end, schedule):
+                    conflicted.append(proposal)
+                else:
+                    accepted.append(proposal)
+                    busy.append(interval)
+            
+            # 3. Свободные слоты - один запрос на все письма с конфликтом
+            free_slots = None
+            if conflicted:
+                try:
+                    slots_response = await (slots_task or request_free_slots(client, headers))
+                except httpx.RequestError:
+                    slots_response = None
+                if slots_response is not None and slots_response.status_code == 200:
+                    # Слоты, занятые встречами из этого же пакета, не предлагаем
+                    free_slots = [
+                        slot for slot in slots_response.json().get("free_slots", [])
+                        if not overlaps(parse_event_time(slot["start"]), parse_event_time(slot["end"]), busy)
+                    ][:ALTERNATIVE_SLOTS]
+                else:
+                    for index, *_ in conflicted:
+                        yield index, error
+                    conflicted = []
+            
+            # 4. Все принятые встречи создаются одним пакетным запросом
+            created = {}
+            if accepted:
+                try:
+                    create_response = await client.post(
+                        f"{CALENDAR_SERVICE_URL}/events/batch",
+                        headers=headers,
+                        json={"events": [
+                            {
+                                "summary": analysis.get("topic") or emails[index].subject,
+                                "description": f"Встреча предложена в письме от {emails[index].from_email}",
+                                "start": meeting_start,
+                                "end": meeting_end
+                            }
+                            for index, analysis, meeting_start, meeting_end in accepted
+                        ]}
                     )
-                    
-                    # Сохранение рекомендации
-                    recommendation = Recommendation(
+                except httpx.RequestError:
+                    create_response = None
+                if create_response is not None and create_response.status_code in [200, 201]:
+                    for result in create_response.json().get("results", []):
+                        if result.get("status") == "created":
+                            created[accepted[result["index"]][0]] = result.get("event", {})
+                for index, *_ in accepted:
+                    if index not in created:
+                        yield index, error
+            if created:
+                # Созданные встречи сразу записываются в реестр: если пакет прервется
+                # до ответов, повторный запуск не создаст их второй раз
+                await analysis_jobs.settle_batch(user_id, [
+                    (emails[index].message_id, JOB_STAGES[-1], "done", {
+                        "action": "meeting_created",
+                        "event_id": event.get("id"),
+                        "email_sent": False,
+                        "message": "Встреча создана, ответ не отправлен"
+                    })
+                    for index, event in created.items()
+                ])
+            
+            # 5. Ответы уходят в очередь Email Service параллельно
+            async def reply(index: int, analysis: Dict) -> Tuple[int, Dict]:
+                email = emails[index]
+                topic = analysis.get("topic") or email.subject
+                if index in created:
+                    event = created[index]
+                    body = f"{templates['accept']}\nДата: {analysis.get('extracted_date') or 'предложенное время'}."
+                else:
+                    alternatives_text = "\n".join([f"- {slot['start']}" for slot in free_slots])
+                    body = f"{templates['decline']} Могу предложить следующие альтернативы:\n{alternatives_text}"
+                async with semaphore:
+                    try:
+                        send_response = await client.post(
+                            f"{EMAIL_SERVICE_URL}/send",
+                            headers={**headers, "Idempotency-Key": f"reply:{email.message_id}"},
+                            json={"to": email.from_email, "subject": f"Re: {email.subject}", "body": body}
+                        )
+                        email_sent = send_response.status_code in [200, 201, 202]
+                    except httpx.RequestError:
+                        email_sent = False
+            
+                if index in created:
+                    await save_recommendation(user_id, Recommendation(
                         id=f"rec_{datetime.now().timestamp()}",
                         type="meeting_created",
                         message=f"Встреча '{topic}' создана и ответ отправлен",
                         timestamp=datetime.now().isoformat(),
-                        details={"event_id": event.get("id"), "email_to": email_data.from_email}
-                    )
-                    save_recommendation(email_data.user_id, recommendation)
-                    
-                    return {
+                        details={"event_id": event.get("id"), "email_to": email.from_email}
+                    ))
+                    return index, {
                         "action": "meeting_created",
                         "event_id": event.get("id"),
-                        "email_sent": send_response.status_code in [200, 201],
+                        "email_sent": email_sent,
                         "message": "Встреча создана и ответ отправлен"
                     }
-            else:
-                # Время занято - предлагаем альтернативы
-                # Получаем свободные слоты
-                end_date = (datetime.now() + timedelta(days=7)).isoformat()
-                slots_response = await client.get(
-                    f"{CALENDAR_SERVICE_URL}/free-slots",
-                    headers={"Authorization": f"Bearer {token}"},
-                    params={
-                        "start_date": datetime.now().isoformat(),
-                        "end_date": end_date,
-                        "duration_minutes": 60
-                    }
-                )
-                
-                if slots_response.status_code == 200:
-                    slots_data = slots_response.json()
-                    free_slots = slots_data.get("free_slots", [])[:3]  # Берем первые 3
-                    
-                    # Формируем ответ с альтернативами
-                    alternatives_text = "\n".join([
-                        f"- {slot['start']}" for slot in free_slots
-                    ])
-                    
-                    response_email = {
-                        "to": email_data.from_email,
-                        "subject": f"Re: {email_data.subject}",
-                        "body": f"Спасибо за предложение! К сожалению, в предложенное время я занят. Могу предложить следующие альтернативы:\n{alternatives_text}"
-                    }
-                    
-                    send_response = await client.post(
-                        f"{EMAIL_SERVICE_URL}/send",
-                        headers={"Authorization": f"Bearer {token}"},
-                        json=response_email
-                    )
-                    
-                    recommendation = Recommendation(
-                        id=f"rec_{datetime.now().timestamp()}",
-                        type="alternative_proposed",
-                        message=f"Предложены альтернативные временные слоты для встречи '{topic}'",
-                        timestamp=datetime.now().isoformat(),
-                        details={"email_to": email_data.from_email, "slots": free_slots}
-                    )
-                    save_recommendation(email_data.user_id, recommendation)
-                    
-                    return {
-                        "action": "alternatives_proposed",
-                        "alternatives": free_slots,
-                        "email_sent": send_response.status_code in [200, 201],
-                        "message": "Предложены альтернативные временные слоты"
-                    }
+                await save_recommendation(user_id, Recommendation(
+                    id=f"rec_{datetime.now().timestamp()}",
+                    type="alternative_proposed",
+                    message=f"Предложены альтернативные временные слоты для встречи '{topic}'",
+                    timestamp=datetime.now().isoformat(),
+                    details={"email_to": email.from_email, "slots": free_slots}
+                ))
+                return index, {
+                    "action": "alternatives_proposed",
+                    "alternatives": free_slots,
+                    "email_sent": email_sent,
+                    "message": "Предложены альтернативные временные слоты"
+                }
+            
+            replies = [proposal for proposal in accepted if proposal[0] in created] + conflicted
+            pending = {asyncio.create_task(reply(index, analysis)) for index, analysis, *_ in replies}
+            try:
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+            finally:
+                for task in pending:
+                    task.cancel()
+        finally:
+            # Слоты не понадобились (нет конфликтов или пакет прерван)
+            if slots_task and not slots_task.done():
+                slots_task.cancel()
+            elif slots_task and not slots_task.cancelled():
+                slots_task.exception()
+
+@app.post("/analyze-emails")
+async def analyze_emails(
+    batch: EmailBatchAnalysis,
+    credentials: HTTPAuthorizationCredentials = Depends(security)
+):
+    """Пакетный анализ писем и автоматические действия.
+
+    Ответ - NDJSON, по строке на письмо в порядке готовности: {"index", "message_id", "action", ...}
+    с теми же полями, что и у /analyze-email.
+    """
+    token = credentials.credentials
+    user_id = get_user_id(credentials)
+    prefs = await preferences_cache.get(user_id, token)
     
-    return {
-        "action": "error",
-        "message": "Не удалось обработать предложение о встрече"
-    }
+    return StreamingResponse(
+        analyze_email_batch(user_id, token, prefs, batch.emails),
+        media_type="application/x-ndjson"
+    )
 
 @app.get("/recommendations")
 async def get_recommendations(
+    limit: int = Query(RECOMMENDATIONS_PAGE_SIZE, ge=1, le=RECOMMENDATIONS_MAX_PAGE_SIZE),
+    cursor: Optional[str] = Query(None),
+    type: Optional[str] = Query(None, description="Типы рекомендаций через запятую"),
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
-    """Получение всех рекомендаций агента"""
-    token = credentials.credentials
-    # В реальности нужно получить user_id из токена
-    user_id = "default"
-    
-    recommendations = recommendations_storage.get(user_id, [])
-    return {"recommendations": recommendations}
+    """Рекомендации агента от новых к старым; следующая страница - по next_cursor"""
+    user_id = get_user_id(credentials)
+    types = [value.strip() for value in type.split(",") if value.strip()] if type else []
+    return await recommendations_store.page(user_id, types, cursor, limit)
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Метрики кэша ответов модели"""
+    return await llm_cache.metrics()
+
+@app.on_event("startup")
+async def warm_up_model():
+    if INFERENCE_BACKEND == "local":
+        app.state.model_warm_up = asyncio.create_task(load_local_model())
+
+async def load_local_model():
+    """Загрузка локальной модели в фоне, чтобы первый запрос не ждал ее"""
+    try:
+        await inference_backend.warm_up()
+    except Exception:
+        # Модель попробует загрузиться при первом запросе, до тех пор - fallback
+        pass
+
+@app.get("/inference/stats")
+async def inference_stats():
+    """Метрики очереди запросов к модели"""
+    return inference_batcher.metrics()
+
+@app.get("/scheduling/stats")
+async def scheduling_stats():
+    """Время стадии schedule и экономия от параллельных запросов к календарю"""
+    return schedule_stats.metrics()
 
 @app.get("/health")
 async def health():
@@ -0,0 +1,19 @@
+"""Фикстуры тестов llm-agent-service: сервис загружается с данными во временном каталоге"""
+import importlib.util
+import os
+from pathlib import Path
+
+import pytest
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def service(tmp_path_factory):
+    """Модуль main.py сервиса без ключа Hugging Face (модель - заглушка)"""
+    os.environ["DATA_DIR"] = str(tmp_path_factory.mktemp("data"))
+    os.environ.pop("HUGGINGFACE_API_KEY", None)
+    spec = importlib.util.spec_from_file_location("llm_agent_main", SERVICE_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,58 @@
+"""Кэш анализа писем: пересланные и повторные письма не доходят до модели"""
+import asyncio
+
+import pytest
+
+BODY = "Предлагаю встретиться 15.12.2025 в 14:00 и обсудить план релиза."
+FORWARDED = f"""---------- Forwarded message ----------
+From: Анна <anna@example.com>
+Date: Mon, 1 Dec 2025 09:00:00 +0000
+Subject: Релиз
+
+> {BODY}
+"""
+
+
+class Batcher:
+    """Модель за пакетировщиком: считает тексты, которые до нее дошли"""
+
+    def __init__(self):
+        self.inputs = []
+
+    async def submit(self, text):
+        self.inputs.append(text)
+        return [{"generated_text": "да"}]
+
+
+@pytest.fixture
+def model(service, monkeypatch, tmp_path):
+    batcher = Batcher()
+    monkeypatch.setattr(service, "USE_MODEL", True)
+    monkeypatch.setattr(service, "inference_batcher", batcher)
+    monkeypatch.setattr(service, "llm_cache", service.LLMCache(tmp_path / "cache.db", 3600, 100, 1024 * 1024))
+    return batcher
+
+
+def test_forwarded_copy_is_served_from_cache(service, model):
+    async def run():
+        return [await service.analyze_email_with_llm(body) for body in (BODY, FORWARDED, BODY)]
+
+    results = asyncio.run(run())
+
+    assert len(model.inputs) == 1
+    assert all(result["is_meeting_proposal"] for result in results)
+    # Дата заголовка пересылки не принимается за время встречи
+    assert results[0] == results[1]
+
+
+def test_different_emails_reach_the_model(service, model):
+    async def run():
+        await asyncio.gather(
+            service.analyze_email_with_llm(BODY),
+            service.analyze_email_with_llm(BODY),
+            service.analyze_email_with_llm("Созвонимся завтра в 10:00?"),
+        )
+
+    asyncio.run(run())
+
+    assert len(model.inputs) == 2
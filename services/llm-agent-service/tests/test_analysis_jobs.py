@@ -0,0 +1,238 @@
+"""Конвейер заданий анализа: стадии, повторы, аренда и токены"""
+import asyncio
+import json
+import logging
+import uuid
+from collections import Counter
+
+import httpx
+import jwt
+import pytest
+
+
+class Services:
+    """Calendar, Email и Auth Service для стадий задания"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.tokens = []
+        self.status = {}
+        self.down = set()
+
+    def __call__(self, request):
+        path = request.url.path
+        self.calls[path] += 1
+        self.tokens.append(request.headers.get("authorization", "").removeprefix("Bearer "))
+        if path in self.down:
+            raise httpx.ConnectError("refused")
+        if path in self.status:
+            return httpx.Response(self.status[path])
+        if path == "/check-conflict":
+            return httpx.Response(200, json={"has_conflict": False})
+        if path == "/events":
+            return httpx.Response(201, json={"id": "ev1"})
+        if path == "/send":
+            return httpx.Response(202, json={"job_id": "send"})
+        if path == "/free-slots":
+            return httpx.Response(200, json={"free_slots": []})
+        return httpx.Response(404)
+
+
+@pytest.fixture
+def services(service, monkeypatch, tmp_path):
+    services = Services()
+    monkeypatch.setattr(service, "analysis_jobs", service.AnalysisJobs(tmp_path / "jobs.db"))
+    real_client = httpx.AsyncClient
+
+    class MockClient(real_client):
+        def __init__(self, *args, **kwargs):
+            kwargs.pop("transport", None)
+            super().__init__(*args, transport=httpx.MockTransport(services), **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    monkeypatch.setattr(service, "within_work_schedule", lambda *args: True)
+    monkeypatch.setattr(service, "JOB_RETRY_DELAY", 0)
+    return services
+
+
+def create_job(service, user_id):
+    payload = service.EmailAnalysis(
+        message_id=uuid.uuid4().hex, from_email="a@example.com", subject="Встреча",
+        body="Давайте встретимся 10 декабря в 14:00", user_id=user_id
+    ).dict()
+    job, created = asyncio.run(service.analysis_jobs.create(user_id, payload))
+    assert created
+    return job
+
+
+def run_stages(service, job_id, user_id):
+    """Проход задания по стадиям тем же путем, что у воркеров"""
+    async def run():
+        async with httpx.AsyncClient() as client:
+            for _ in range(10):
+                job = await service.analysis_jobs.get(user_id, job_id)
+                if job["status"] in ("done", "failed"):
+                    return job
+                claimed = await service.analysis_jobs.claim(job["stage"], 60)
+                assert claimed["id"] == job_id
+                await service.process_job(job["stage"], client, claimed)
+        raise AssertionError("job did not finish")
+
+    return asyncio.run(run())
+
+
+def job_payload(service, job_id):
+    with service.closing(service.analysis_jobs._connect()) as conn:
+        return json.loads(conn.execute("SELECT payload FROM analysis_jobs WHERE id = ?", (job_id,)).fetchone()[0])
+
+
+def stored_tokens(service):
+    with service.closing(service.analysis_jobs._connect()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM analysis_jobs WHERE token IS NOT NULL").fetchone()[0]
+
+
+def test_stages_create_meeting_with_issued_tokens(service, services):
+    user_id = f"user-{uuid.uuid4().hex}"
+    job = create_job(service, user_id)
+
+    job = run_stages(service, job["id"], user_id)
+
+    assert job["status"] == "done"
+    assert job["result"]["action"] == "meeting_created"
+    assert services.calls["/events"] == 1 and services.calls["/send"] == 1
+    assert stored_tokens(service) == 0
+    for token in services.tokens:
+        claims = jwt.decode(token, service.JWT_SECRET_KEY, algorithms=[service.JWT_ALGORITHM])
+        assert claims["user_id"] == user_id
+        assert claims["exp"] - claims["iat"] == service.JOB_TOKEN_TTL
+
+
+def test_unauthorized_downstream_is_a_distinct_result(service, services):
+    user_id = f"user-{uuid.uuid4().hex}"
+    services.status["/check-conflict"] = 401
+    job = create_job(service, user_id)
+
+    job = run_stages(service, job["id"], user_id)
+
+    assert job["status"] == "failed"
+    assert job["result"]["action"] == "unauthorized"
+    assert job["last_error"] == "/check-conflict returned 401"
+    assert services.calls["/events"] == 0
+    # Письмо не дошло до действий и может быть отправлено на анализ снова
+    _, created = asyncio.run(service.analysis_jobs.create(user_id, job_payload(service, job["id"])))
+    assert created
+
+
+def test_network_errors_are_retried_then_fail(service, services):
+    user_id = f"user-{uuid.uuid4().hex}"
+    services.down.add("/check-conflict")
+    job = create_job(service, user_id)
+
+    job = run_stages(service, job["id"], user_id)
+
+    assert job["status"] == "failed"
+    assert job["result"]["action"] == "error"
+    assert services.calls["/check-conflict"] == service.JOB_MAX_ATTEMPTS
+
+
+def test_expired_lease_is_reclaimed(service, services):
+    """Задание, захваченное упавшим воркером, подхватывается по истечении аренды"""
+    user_id = f"user-{uuid.uuid4().hex}"
+    job = create_job(service, user_id)
+
+    async def run():
+        first = await service.analysis_jobs.claim("analyze", 0.2)
+        assert first["id"] == job["id"]
+        assert await service.analysis_jobs.claim("analyze", 0.2) is None
+        await asyncio.sleep(0.25)
+        second = await service.analysis_jobs.claim("analyze", 60)
+        assert second["id"] == job["id"]
+        assert second["status"] == "running"
+
+    asyncio.run(run())
+
+
+def test_workers_take_job_through_pipeline(service, services):
+    user_id = f"user-{uuid.uuid4().hex}"
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            workers = [asyncio.create_task(service.job_worker(stage, client)) for stage in service.JOB_STAGES]
+            try:
+                job, _ = await service.analysis_jobs.create(user_id, service.EmailAnalysis(
+                    message_id=uuid.uuid4().hex, from_email="a@example.com", subject="Встреча",
+                    body="Давайте встретимся 11 декабря в 15:00", user_id=user_id
+                ).dict())
+                service.job_events["analyze"].set()
+                for _ in range(200):
+                    job = await service.analysis_jobs.get(user_id, job["id"])
+                    if job["status"] == "done":
+                        return job
+                    await asyncio.sleep(0.01)
+            finally:
+                for worker in workers:
+                    worker.cancel()
+        raise AssertionError("job did not finish")
+
+    job = asyncio.run(run())
+    assert job["result"]["action"] == "meeting_created"
+
+
+def test_job_worker_logs_failures_and_keeps_running(service, services, monkeypatch, caplog):
+    monkeypatch.setattr(service, "JOB_POLL_INTERVAL", 0.01)
+    claims = []
+
+    async def claim(stage, lease):
+        claims.append(stage)
+        raise RuntimeError("database is locked")
+
+    monkeypatch.setattr(service.analysis_jobs, "claim", claim)
+    # Событие прошлого теста привязано к его циклу событий
+    monkeypatch.setitem(service.job_events, "analyze", asyncio.Event())
+
+    async def run():
+        async with httpx.AsyncClient() as client:
+            worker = asyncio.create_task(service.job_worker("analyze", client))
+            while len(claims) < 3:
+                await asyncio.sleep(0.01)
+            worker.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await worker
+
+    with caplog.at_level(logging.ERROR, logger="llm-agent-service"):
+        asyncio.run(asyncio.wait_for(run(), 5))
+
+    failures = [record for record in caplog.records if record.getMessage() == "Job worker for stage analyze failed"]
+    assert len(failures) >= 2
+
+
+def test_job_cleanup_failure_is_logged(service, monkeypatch, caplog):
+    async def prune():
+        raise RuntimeError("database is locked")
+
+    async def sleep(delay):
+        raise asyncio.CancelledError
+
+    monkeypatch.setattr(service.analysis_jobs, "prune", prune)
+    monkeypatch.setattr(service.asyncio, "sleep", sleep)
+
+    with caplog.at_level(logging.ERROR, logger="llm-agent-service"):
+        with pytest.raises(asyncio.CancelledError):
+            asyncio.run(service.job_cleanup_loop())
+
+    assert [record.getMessage() for record in caplog.records] == ["Job cleanup failed"]
+
+
+def test_stage_error_is_logged_with_the_job(service, services, monkeypatch, caplog):
+    user_id = f"user-{uuid.uuid4().hex}"
+    job = create_job(service, user_id)
+
+    async def broken_stage(client, job):
+        raise KeyError("meeting_start")
+
+    monkeypatch.setitem(service.STAGE_HANDLERS, "analyze", broken_stage)
+    with caplog.at_level(logging.ERROR, logger="llm-agent-service"):
+        job = run_stages(service, job["id"], user_id)
+
+    assert job["status"] == "failed"
+    assert f"Analysis job {job['id']} failed at stage analyze" in [record.getMessage() for record in caplog.records]
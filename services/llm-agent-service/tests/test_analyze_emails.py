@@ -0,0 +1,199 @@
+"""Пакетный анализ писем: порядок разбора конфликтов и общие запросы к календарю"""
+import asyncio
+import json
+import uuid
+from collections import Counter
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+# Предложенные в письмах встречи (UTC) и задержка классификации каждого письма
+SLOT_A = ("2025-12-10T10:00:00+00:00", "2025-12-10T11:00:00+00:00")
+SLOT_B = ("2025-12-11T10:00:00+00:00", "2025-12-11T11:00:00+00:00")
+SLOT_C = ("2025-12-12T10:00:00+00:00", "2025-12-12T11:00:00+00:00")
+
+
+class Calendar:
+    """Calendar и Email Service: занятые интервалы и свободные слоты задает тест"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.busy = []
+        self.free_slots = []
+        self.events_status = 200
+        self.events_params = None
+        self.created = []
+        self.sent = []
+
+    def __call__(self, request):
+        path = request.url.path
+        self.calls[path] += 1
+        if path == "/events" and request.method == "GET":
+            self.events_params = dict(request.url.params)
+            return httpx.Response(self.events_status, json={"events": [
+                {"id": f"busy{i}", "start": start, "end": end} for i, (start, end) in enumerate(self.busy)
+            ]})
+        if path == "/free-slots":
+            return httpx.Response(200, json={"free_slots": [
+                {"start": start, "end": end} for start, end in self.free_slots
+            ]})
+        if path == "/events/batch":
+            events = json.loads(request.content)["events"]
+            self.created.extend(events)
+            return httpx.Response(200, json={"results": [
+                {"index": index, "status": "created", "event": {"id": f"ev-{event['start']}"}}
+                for index, event in enumerate(events)
+            ]})
+        if path == "/send":
+            self.sent.append(json.loads(request.content))
+            return httpx.Response(202, json={"job_id": "send"})
+        return httpx.Response(404)
+
+
+@pytest.fixture
+def calendar(service, monkeypatch):
+    calendar = Calendar()
+    real_client = httpx.AsyncClient
+
+    class MockClient(real_client):
+        def __init__(self, *args, **kwargs):
+            kwargs.pop("transport", None)
+            super().__init__(*args, transport=httpx.MockTransport(calendar), **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    monkeypatch.setattr(service, "within_work_schedule", lambda *args: True)
+    return calendar
+
+
+@pytest.fixture
+def classify(service, monkeypatch):
+    """Классификация по телу письма: "meeting <слот> <задержка>" или обычное письмо"""
+    slots = {"A": SLOT_A, "B": SLOT_B, "C": SLOT_C}
+
+    async def analyze(body):
+        if not body.startswith("meeting"):
+            return {"is_meeting_proposal": False}
+        _, slot, delay = body.split()
+        await asyncio.sleep(float(delay))
+        start, end = slots[slot]
+        return {"is_meeting_proposal": True, "topic": f"Встреча {slot}", "extracted_date": slot,
+                "meeting_start": start, "meeting_end": end}
+
+    monkeypatch.setattr(service, "analyze_email_with_llm", analyze)
+
+
+def make_emails(service, *bodies):
+    prefix = uuid.uuid4().hex
+    return [
+        service.EmailAnalysis(
+            message_id=f"{prefix}-{index}", from_email=f"sender{index}@example.com",
+            subject=f"Письмо {index}", body=body, user_id="1"
+        )
+        for index, body in enumerate(bodies)
+    ]
+
+
+def collect(service, emails):
+    async def run():
+        return [
+            json.loads(line)
+            async for line in service.analyze_email_batch(
+                f"batch-{uuid.uuid4().hex}", "token", service.DEFAULT_PREFERENCES, emails
+            )
+        ]
+
+    return asyncio.run(run())
+
+
+def by_index(lines):
+    return {line["index"]: line for line in lines}
+
+
+def test_earlier_email_wins_the_slot(service, calendar, classify):
+    """Второе письмо классифицировано раньше, но время достается первому"""
+    emails = make_emails(service, "meeting A 0.1", "meeting A 0")
+
+    results = by_index(collect(service, emails))
+
+    assert results[0]["action"] == "meeting_created"
+    assert results[1]["action"] == "alternatives_proposed"
+    assert [event["summary"] for event in calendar.created] == ["Встреча A"]
+    assert {mail["to"] for mail in calendar.sent} == {"sender0@example.com", "sender1@example.com"}
+
+
+def test_existing_event_conflicts(service, calendar, classify):
+    calendar.busy = [("2025-12-11T10:30:00+00:00", "2025-12-11T12:00:00+00:00")]
+    emails = make_emails(service, "meeting A 0", "meeting B 0", "meeting C 0")
+
+    results = by_index(collect(service, emails))
+
+    assert [results[index]["action"] for index in range(3)] == [
+        "meeting_created", "alternatives_proposed", "meeting_created"
+    ]
+
+
+def test_slots_taken_by_the_batch_are_not_offered(service, calendar, classify):
+    calendar.busy = [SLOT_C]
+    calendar.free_slots = [SLOT_A, SLOT_B, ("2025-12-13T10:00:00+00:00", "2025-12-13T11:00:00+00:00")]
+    emails = make_emails(service, "meeting A 0", "meeting C 0")
+
+    results = by_index(collect(service, emails))
+
+    # Слот A занят встречей из первого письма этого же пакета
+    assert [slot["start"] for slot in results[1]["alternatives"]] == [SLOT_B[0], "2025-12-13T10:00:00+00:00"]
+
+
+def test_calendar_is_queried_once_per_batch(service, calendar, classify):
+    emails = make_emails(service, "meeting B 0", "meeting A 0", "meeting C 0", "привет")
+
+    lines = collect(service, emails)
+
+    assert len(lines) == 4
+    assert calendar.calls["/events"] == 1
+    assert calendar.calls["/events/batch"] == 1
+    # Окно запроса событий покрывает все предложенные встречи
+    assert calendar.events_params["start_date"] == SLOT_A[0]
+    assert calendar.events_params["end_date"] == SLOT_C[1]
+    assert [event["start"] for event in calendar.created] == [SLOT_B[0], SLOT_A[0], SLOT_C[0]]
+
+
+def test_non_meeting_is_streamed_before_slow_proposals(service, calendar, classify):
+    emails = make_emails(service, "meeting A 0.2", "привет")
+
+    lines = collect(service, emails)
+
+    assert lines[0] == {
+        "index": 1, "message_id": emails[1].message_id,
+        "action": "no_action", "message": "Письмо не содержит предложения о встрече"
+    }
+    assert lines[1]["index"] == 0
+
+
+def test_calendar_failure_fails_only_proposals(service, calendar, classify):
+    calendar.events_status = 503
+    emails = make_emails(service, "meeting A 0", "привет", "meeting B 0")
+
+    results = by_index(collect(service, emails))
+
+    assert results[0]["action"] == results[2]["action"] == "error"
+    assert results[1]["action"] == "no_action"
+    assert calendar.calls["/events/batch"] == 0
+
+
+def test_endpoint_streams_ndjson(service, calendar, classify):
+    emails = make_emails(service, "meeting A 0", "привет")
+    token = service.jwt.encode({"user_id": f"user-{uuid.uuid4().hex}"}, service.JWT_SECRET_KEY,
+                               algorithm=service.JWT_ALGORITHM)
+
+    with TestClient(service.app) as client:
+        response = client.post(
+            "/analyze-emails", json={"emails": [email.dict() for email in emails]},
+            headers={"Authorization": f"Bearer {token}"}
+        )
+
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert {line["message_id"]: line["action"] for line in lines} == {
+        emails[0].message_id: "meeting_created", emails[1].message_id: "no_action"
+    }
@@ -0,0 +1,97 @@
+"""INFERENCE_BACKEND=local: письма классифицирует локальная zero-shot модель"""
+import asyncio
+import importlib.util
+import sys
+import time
+import types
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+
+MEETING = "Предлагаю встретиться 15.12.2025 в 14:00 и обсудить план релиза."
+
+
+class Classifier:
+    """Поддельный пайплайн zero-shot: оценка метки "встреча" задается тестом"""
+
+    def __init__(self):
+        self.score = 0.9
+        self.loads = []
+        self.calls = []
+
+    def pipeline(self, task, model, device):
+        self.loads.append((task, model))
+
+        def run(inputs, candidate_labels, hypothesis_template):
+            self.calls.append((list(inputs), candidate_labels, hypothesis_template))
+            labels = candidate_labels if self.score >= 0.5 else candidate_labels[::-1]
+            scores = [max(self.score, 1 - self.score), min(self.score, 1 - self.score)]
+            return [{"sequence": text, "labels": labels, "scores": scores} for text in inputs]
+
+        return run
+
+
+@pytest.fixture
+def classifier(monkeypatch):
+    fake = Classifier()
+    monkeypatch.setitem(sys.modules, "transformers", types.SimpleNamespace(pipeline=fake.pipeline))
+    monkeypatch.setitem(sys.modules, "torch", types.SimpleNamespace(set_num_threads=lambda threads: None))
+    return fake
+
+
+@pytest.fixture
+def local_service(service, classifier, monkeypatch, tmp_path):
+    """Отдельная копия main.py, загруженная с локальной моделью и своим каталогом данных"""
+    monkeypatch.setenv("INFERENCE_BACKEND", "local")
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    spec = importlib.util.spec_from_file_location("llm_agent_local_main", SERVICE_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_default_backend_is_hugging_face(service):
+    assert isinstance(service.inference_backend, service.HuggingFaceBackend)
+    # Без ключа модель не используется
+    assert not service.USE_MODEL
+
+
+def test_local_backend_is_selected(local_service):
+    backend = local_service.inference_backend
+
+    assert isinstance(backend, local_service.LocalBackend)
+    assert local_service.USE_MODEL
+    assert backend.task == "zero-shot-classification"
+    assert backend.name == local_service.LOCAL_CLASSIFIER_MODEL
+    assert backend.call_kwargs == {
+        "candidate_labels": local_service.MEETING_LABELS, "hypothesis_template": local_service.MEETING_HYPOTHESIS
+    }
+    assert local_service.inference_batcher.backend is backend
+
+
+def test_meeting_is_detected_by_local_model(local_service, classifier):
+    result = asyncio.run(local_service.analyze_email_with_llm(f"Fwd: {MEETING}"))
+
+    assert result["is_meeting_proposal"]
+    # Модель получает очищенный текст письма, а не промпт для Inference API
+    assert classifier.calls[0][0] == [MEETING]
+
+
+@pytest.mark.parametrize("score", [0.55, 0.1])
+def test_low_confidence_is_not_a_meeting(local_service, classifier, score):
+    classifier.score = score
+
+    assert asyncio.run(local_service.analyze_email_with_llm(MEETING)) == {"is_meeting_proposal": False}
+
+
+def test_model_is_loaded_on_startup(local_service, classifier):
+    with TestClient(local_service.app):
+        deadline = time.monotonic() + 5
+        while not classifier.loads and time.monotonic() < deadline:
+            time.sleep(0.01)
+        # Модель загружается в фоне сразу после старта, до первого письма
+        assert classifier.calls == []
+        assert classifier.loads == [("zero-shot-classification", local_service.LOCAL_CLASSIFIER_MODEL)]
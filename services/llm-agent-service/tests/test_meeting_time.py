@@ -0,0 +1,97 @@
+"""Извлечение даты и времени встречи из текста письма"""
+import time
+from datetime import datetime
+
+import pytest
+
+# Пятница, полдень: относительные даты считаются от этого момента
+NOW = (2025, 1, 10, 12, 0)
+
+# Размеченный корпус: текст письма и ожидаемое начало встречи ("YYYY-MM-DD HH:MM" или None)
+CORPUS = [
+    ("Давайте встретимся 15 января в 14:00", "2025-01-15 14:00"),
+    ("Предлагаю встречу завтра в 14:00", "2025-01-11 14:00"),
+    ("Встреча 15.01.2025 в 10:30", "2025-01-15 10:30"),
+    ("Созвон 20.01 в 16:00", "2025-01-20 16:00"),
+    ("Собрание послезавтра в 11:00", "2025-01-12 11:00"),
+    ("Встретимся через 3 дня в 15:00", "2025-01-13 15:00"),
+    ("Встреча через неделю", "2025-01-17 10:00"),
+    ("Давайте в понедельник в 12:00", "2025-01-13 12:00"),
+    ("Встреча в следующую среду в 9:30", "2025-01-15 09:30"),
+    ("Встреча в пятницу", "2025-01-17 10:00"),
+    ("Встретимся 3 февраля в 3 часа дня", "2025-02-03 15:00"),
+    ("Созвон сегодня в 5 вечера", "2025-01-10 17:00"),
+    ("Созвон сегодня в 18 часов", "2025-01-10 18:00"),
+    ("Встреча 1-го марта", "2025-03-01 10:00"),
+    ("Встреча 5 января", "2026-01-05 10:00"),
+    ("Встреча 12 мая 2025 года с 14:00 до 15:30", "2025-05-12 14:00"),
+    ("Встреча в 15:00", "2025-01-10 15:00"),
+    ("Встреча в 09:00", "2025-01-11 09:00"),
+    ("Давайте в полдень завтра", "2025-01-11 12:00"),
+    ("Встреча 7/02/25 в 13:15", "2025-02-07 13:15"),
+    ("Встреча в среду в 11 утра", "2025-01-15 11:00"),
+    ("Созвон в четверг к 10 часам", "2025-01-16 10:00"),
+    ("Встреча через 2 часа", None),
+    ("Встреча 31.02", None),
+    ("Встреча по поводу бюджета", None),
+    ("Let's have a meeting on January 15 at 3pm", "2025-01-15 15:00"),
+    ("Meeting tomorrow at 10:00", "2025-01-11 10:00"),
+    ("Can we meet on 20th of February at 2:30 pm?", "2025-02-20 14:30"),
+    ("Call next Monday at 9 am", "2025-01-13 09:00"),
+    ("Meeting on 2025-03-04 11:00-12:00", "2025-03-04 11:00"),
+    ("Meeting in 2 days", "2025-01-12 10:00"),
+    ("Meeting in a week at noon", "2025-01-17 12:00"),
+    ("Meeting the day after tomorrow at 16:30", "2025-01-12 16:30"),
+    ("Appointment Feb 3rd, 2025 at 11 a.m.", "2025-02-03 11:00"),
+    # 12/31 - не день и месяц, остается день недели
+    ("Meeting on Friday 12/31", "2025-01-17 10:00"),
+    ("Meeting about the roadmap", None),
+    # ISO-время через "T", как в приглашениях из календарей
+    ("Meeting at 2025-01-15T14:00", "2025-01-15 14:00"),
+    ("Встреча 2025-01-15T14:00:00+03:00", "2025-01-15 14:00"),
+    ("Слот 2025-01-16T09:30-10:00", "2025-01-16 09:30"),
+]
+
+
+@pytest.fixture(scope="module")
+def now(service):
+    return datetime(*NOW, tzinfo=service.MEETING_TIMEZONE)
+
+
+@pytest.mark.parametrize("text, expected", CORPUS)
+def test_corpus(service, now, text, expected):
+    result = service.extract_meeting_time(text, now)
+    assert (result["start"].strftime("%Y-%m-%d %H:%M") if result else None) == expected
+
+
+def test_range_sets_end(service, now):
+    result = service.extract_meeting_time("Слот 2025-01-16T09:30-10:00", now)
+    assert result["end"].strftime("%H:%M") == "10:00"
+
+
+def test_default_duration(service, now):
+    result = service.extract_meeting_time("Встреча завтра в 14:00", now)
+    assert result["end"] - result["start"] == service.timedelta(minutes=service.DEFAULT_MEETING_MINUTES)
+
+
+def test_throughput(service, now):
+    """Разбор не должен становиться узким местом пакетного анализа"""
+    texts = [text for text, _ in CORPUS] * 50
+    started = time.perf_counter()
+    for text in texts:
+        service.extract_meeting_time(text, now)
+    assert len(texts) / (time.perf_counter() - started) > 2000
+
+
+def test_long_email_throughput(service, now):
+    """Длинное письмо с цитатой и подписью: дата находится, разбор остается быстрым"""
+    filler = "Коллеги, напоминаю про отчеты за квартал и сроки согласования документов. " * 30
+    text = f"{filler}Предлагаю встречу 15 января в 14:00.\n\n-- \nС уважением, Иван\n> {filler}"
+    assert len(text.encode()) > 4000
+    assert service.extract_meeting_time(text, now)["start"].strftime("%Y-%m-%d %H:%M") == "2025-01-15 14:00"
+
+    started = time.perf_counter()
+    for _ in range(200):
+        service.extract_meeting_time(text, now)
+    # Нижняя граница с большим запасом: на рабочей машине около 2 тысяч писем/с
+    assert 200 / (time.perf_counter() - started) > 200
@@ -0,0 +1,128 @@
+"""Реестр обработанных писем: повторные письма не обрабатываются заново"""
+import asyncio
+import json
+import uuid
+from collections import Counter
+
+import httpx
+import pytest
+
+
+class Calendar:
+    """Calendar и Email Service: свободный календарь, отправку можно задержать"""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.send_blocked = False
+        self.events_delay = 0
+
+    async def __call__(self, request):
+        path = request.url.path
+        self.calls[path] += 1
+        if path == "/events" and request.method == "GET":
+            await asyncio.sleep(self.events_delay)
+            return httpx.Response(200, json={"events": []})
+        if path == "/events/batch":
+            events = json.loads(request.content)["events"]
+            return httpx.Response(200, json={"results": [
+                {"index": index, "status": "created", "event": {"id": f"ev{index}"}}
+                for index in range(len(events))
+            ]})
+        if path == "/send":
+            if self.send_blocked:
+                await asyncio.sleep(3600)
+            return httpx.Response(202, json={"job_id": "send"})
+        return httpx.Response(404)
+
+
+@pytest.fixture
+def calendar(service, monkeypatch):
+    calendar = Calendar()
+    real_client = httpx.AsyncClient
+
+    class MockClient(real_client):
+        def __init__(self, *args, **kwargs):
+            kwargs.pop("transport", None)
+            super().__init__(*args, transport=httpx.MockTransport(calendar), **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    monkeypatch.setattr(service, "within_work_schedule", lambda *args: True)
+    return calendar
+
+
+def make_emails(service, count):
+    prefix = uuid.uuid4().hex
+    # Встречи в разные дни, чтобы они не конфликтовали друг с другом
+    return [
+        service.EmailAnalysis(
+            message_id=f"{prefix}-{index}", from_email="a@example.com", subject="Встреча",
+            body=f"Давайте встретимся {10 + index} декабря в 14:00", user_id="1"
+        )
+        for index in range(count)
+    ]
+
+
+async def collect(service, user_id, emails):
+    return [
+        json.loads(line)
+        async for line in service.analyze_email_batch(user_id, "token", service.DEFAULT_PREFERENCES, emails)
+    ]
+
+
+def test_repeated_batch_is_served_from_ledger(service, calendar):
+    emails = make_emails(service, 3)
+
+    first = asyncio.run(collect(service, "ledger-user", emails))
+    assert Counter(line["action"] for line in first) == {"meeting_created": 3}
+    assert calendar.calls["/events/batch"] == 1
+
+    second = asyncio.run(collect(service, "ledger-user", emails))
+    assert sorted(line["message_id"] for line in second) == sorted(line["message_id"] for line in first)
+    assert all(line["action"] == "meeting_created" for line in second)
+    assert calendar.calls["/events/batch"] == 1
+    assert calendar.calls["/send"] == 3
+
+
+def test_disconnect_after_events_created_keeps_ledger(service, calendar):
+    """Клиент отключился, пока уходили ответы: встречи не создаются повторно"""
+    emails = make_emails(service, 2)
+    calendar.send_blocked = True
+
+    async def interrupted():
+        task = asyncio.create_task(collect(service, "disconnect-user", emails))
+        while calendar.calls["/send"] < 2:
+            await asyncio.sleep(0.01)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(interrupted())
+    assert calendar.calls["/events/batch"] == 1
+
+    calendar.send_blocked = False
+    repeated = asyncio.run(collect(service, "disconnect-user", emails))
+    assert calendar.calls["/events/batch"] == 1
+    assert [line["action"] for line in repeated] == ["meeting_created", "meeting_created"]
+    assert all(line["email_sent"] is False for line in repeated)
+
+
+def test_batch_longer_than_lease_keeps_reservation(service, calendar, monkeypatch):
+    """Пакет дольше JOB_LEASE продлевает резервацию: письма не перехватываются"""
+    monkeypatch.setattr(service, "JOB_LEASE", 0.3)
+    email = make_emails(service, 1)[0]
+    calendar.events_delay = 1
+
+    async def run():
+        batch = asyncio.create_task(collect(service, "lease-user", [email]))
+        await asyncio.sleep(0.8)
+        job, created = await service.analysis_jobs.create("lease-user", email.dict())
+        assert not created
+        assert job["status"] == "pending"
+        again = await collect(service, "lease-user", [email])
+        assert again[0]["action"] == "in_progress"
+        return await batch
+
+    first = asyncio.run(run())
+    assert first[0]["action"] == "meeting_created"
+    assert calendar.calls["/events/batch"] == 1
+    assert calendar.calls["/send"] == 1
@@ -0,0 +1,140 @@
+"""Рекомендации агента: страницы по курсору, фильтр по типу, лимит и срок хранения"""
+import asyncio
+import time
+import uuid
+from contextlib import closing
+
+import jwt
+import pytest
+from fastapi.testclient import TestClient
+
+
+def recommendation(index, type="meeting_created"):
+    return {
+        "id": f"r{index}", "type": type, "message": f"Рекомендация {index}",
+        "timestamp": f"2025-01-10T09:{index:02d}:00", "details": {"index": index}
+    }
+
+
+def fill(store, user_id, count, types=("meeting_created",)):
+    async def run():
+        for index in range(count):
+            await store.add(user_id, recommendation(index, types[index % len(types)]))
+
+    asyncio.run(run())
+
+
+def ids(page):
+    return [item["id"] for item in page["recommendations"]]
+
+
+@pytest.fixture
+def store(service, tmp_path):
+    return service.RecommendationStore(tmp_path / "recommendations.db", 100, 3600)
+
+
+def read_all(store, user_id, limit, types=()):
+    pages, cursor = [], None
+    while True:
+        page = asyncio.run(store.page(user_id, list(types), cursor, limit))
+        pages.append(ids(page))
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return pages
+
+
+def test_pages_go_from_newest_to_oldest(store):
+    fill(store, "u", 5)
+
+    assert read_all(store, "u", 2) == [["r4", "r3"], ["r2", "r1"], ["r0"]]
+    first = asyncio.run(store.page("u", [], None, 5))
+    assert first["next_cursor"] is None
+    assert first["recommendations"][0] == {
+        "id": "r4", "type": "meeting_created", "message": "Рекомендация 4",
+        "timestamp": "2025-01-10T09:04:00", "details": {"index": 4}
+    }
+
+
+def test_exact_last_page_has_no_cursor(store):
+    fill(store, "u", 4)
+    assert read_all(store, "u", 2) == [["r3", "r2"], ["r1", "r0"]]
+
+
+def test_new_recommendations_do_not_shift_pages(store):
+    fill(store, "u", 4)
+    first = asyncio.run(store.page("u", [], None, 2))
+    asyncio.run(store.add("u", recommendation(10)))
+
+    second = asyncio.run(store.page("u", [], first["next_cursor"], 2))
+
+    # Новая запись не сдвигает уже начатый обход: без пропусков и повторов
+    assert ids(first) == ["r3", "r2"]
+    assert ids(second) == ["r1", "r0"]
+
+
+def test_type_filter(store):
+    fill(store, "u", 6, types=("meeting_created", "conflict_detected", "email_sent"))
+
+    assert read_all(store, "u", 1, ["conflict_detected"]) == [["r4"], ["r1"]]
+    assert read_all(store, "u", 10, ["meeting_created", "email_sent"]) == [["r5", "r3", "r2", "r0"]]
+    assert read_all(store, "u", 10, ["unknown"]) == [[]]
+
+
+def test_users_are_isolated(store):
+    fill(store, "alice", 3)
+    asyncio.run(store.add("bob", recommendation(7)))
+
+    assert read_all(store, "bob", 10) == [["r7"]]
+    assert read_all(store, "alice", 10) == [["r2", "r1", "r0"]]
+
+
+def test_only_latest_per_user_are_kept(service, tmp_path):
+    store = service.RecommendationStore(tmp_path / "recommendations.db", 3, 3600)
+    fill(store, "alice", 5)
+    fill(store, "bob", 2)
+
+    assert read_all(store, "alice", 10) == [["r4", "r3", "r2"]]
+    # Лимит одного пользователя не удаляет записи другого
+    assert read_all(store, "bob", 10) == [["r1", "r0"]]
+
+
+def test_old_recommendations_are_pruned(store):
+    fill(store, "u", 3)
+    with closing(store._connect()) as conn, conn:
+        conn.execute("UPDATE recommendations SET created_at = ? WHERE id IN ('r0', 'r1')", (time.time() - 7200,))
+
+    assert asyncio.run(store.prune()) == 2
+    assert read_all(store, "u", 10) == [["r2"]]
+    assert asyncio.run(store.prune()) == 0
+
+
+@pytest.mark.parametrize("cursor", ["garbage", "bm90IGpzb24=", "NQ==", "eyJhZnRlciI6IDF9"])
+def test_invalid_cursor_is_400(service, store, cursor):
+    with pytest.raises(service.HTTPException) as error:
+        asyncio.run(store.page("u", [], cursor, 10))
+    assert error.value.status_code == 400
+
+
+def test_endpoint(service):
+    user_id = f"user-{uuid.uuid4().hex}"
+    fill(service.recommendations_store, user_id, 5, types=("meeting_created", "conflict_detected"))
+    token = jwt.encode({"user_id": user_id}, service.JWT_SECRET_KEY, algorithm=service.JWT_ALGORITHM)
+    headers = {"Authorization": f"Bearer {token}"}
+
+    with TestClient(service.app) as client:
+        first = client.get("/recommendations", params={"limit": 2}, headers=headers).json()
+        second = client.get(
+            "/recommendations", params={"limit": 2, "cursor": first["next_cursor"]}, headers=headers
+        ).json()
+        filtered = client.get(
+            "/recommendations", params={"type": "conflict_detected, email_sent"}, headers=headers
+        ).json()
+        too_large = client.get("/recommendations", params={"limit": 1000}, headers=headers)
+        bad_cursor = client.get("/recommendations", params={"cursor": "garbage"}, headers=headers)
+
+    assert ids(first) == ["r4", "r3"]
+    assert ids(second) == ["r2", "r1"]
+    assert ids(filtered) == ["r3", "r1"]
+    assert filtered["next_cursor"] is None
+    assert too_large.status_code == 422
+    assert bad_cursor.status_code == 400
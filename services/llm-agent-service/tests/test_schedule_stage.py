@@ -0,0 +1,172 @@
+"""Стадия schedule: параллельные запросы к календарю и отмена ненужных слотов"""
+import asyncio
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+FREE_SLOTS = [{"start": f"2025-12-1{day}T10:00:00+03:00", "end": f"2025-12-1{day}T11:00:00+03:00"} for day in range(5)]
+
+
+class Calendar:
+    """Calendar Service с задержками ответов; журнал начала и конца запросов"""
+
+    def __init__(self):
+        self.has_conflict = False
+        self.delays = {"/check-conflict": 0.2, "/free-slots": 0.2, "/events": 0.0}
+        self.status = {}
+        self.log = []
+
+    async def __call__(self, request):
+        path = request.url.path
+        self.log.append(("start", path))
+        try:
+            await asyncio.sleep(self.delays.get(path, 0))
+        except asyncio.CancelledError:
+            self.log.append(("cancelled", path))
+            raise
+        self.log.append(("end", path))
+        if path in self.status:
+            return httpx.Response(self.status[path])
+        if path == "/check-conflict":
+            return httpx.Response(200, json={"has_conflict": self.has_conflict})
+        if path == "/free-slots":
+            return httpx.Response(200, json={"free_slots": FREE_SLOTS})
+        if path == "/events":
+            return httpx.Response(201, json={"id": "ev1"})
+        return httpx.Response(404)
+
+    def paths(self, event):
+        return [path for kind, path in self.log if kind == event]
+
+
+@pytest.fixture
+def calendar(service, monkeypatch):
+    async def preferences(user_id, token):
+        return {}
+
+    monkeypatch.setattr(service.preferences_cache, "get", preferences)
+    monkeypatch.setattr(service, "within_work_schedule", lambda *args: True)
+    monkeypatch.setattr(service, "schedule_stats", service.SchedulingStats())
+    return Calendar()
+
+
+def job():
+    return {
+        "user_id": "u", "token": "token",
+        "payload": {"message_id": "m1", "from_email": "anna@example.com", "subject": "План релиза"},
+        "state": {
+            "analysis": {"is_meeting_proposal": True, "topic": "Релиз", "extracted_date": "15.12.2025"},
+            "meeting_start": "2025-12-15T14:00:00+03:00", "meeting_end": "2025-12-15T15:00:00+03:00"
+        }
+    }
+
+
+def run_stage(service, calendar):
+    async def run():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(calendar)) as client:
+            started = time.perf_counter()
+            result = await service.run_schedule_stage(client, job())
+            elapsed = time.perf_counter() - started
+            # Отмененные запросы успевают завершиться до закрытия клиента
+            await asyncio.sleep(0.01)
+            return result, elapsed
+
+    return asyncio.run(run())
+
+
+def test_conflict_uses_slots_requested_in_parallel(service, calendar):
+    calendar.has_conflict = True
+
+    (stage, state), elapsed = run_stage(service, calendar)
+
+    assert stage == "reply"
+    assert state["alternatives"] == FREE_SLOTS[:service.ALTERNATIVE_SLOTS]
+    assert "- 2025-12-10T10:00:00+03:00" in state["reply"]["body"]
+    # Слоты запрошены до ответа на проверку конфликта, а не после него
+    assert calendar.log.index(("start", "/free-slots")) < calendar.log.index(("end", "/check-conflict"))
+    assert calendar.paths("start").count("/free-slots") == 1
+    # По очереди оба запроса заняли бы 0.4 с
+    assert elapsed < 0.35
+    metrics = service.schedule_stats.metrics()
+    assert (metrics["conflicts"], metrics["speculative_hits"], metrics["speculative_wasted"]) == (1, 1, 0)
+    assert metrics["saved_ms_total"] > 100
+
+
+def test_free_time_cancels_slots_request(service, calendar):
+    calendar.delays["/free-slots"] = 5
+
+    (stage, state), elapsed = run_stage(service, calendar)
+
+    assert stage == "reply"
+    assert state["event"] == {"id": "ev1"}
+    assert "alternatives" not in state
+    assert state["reply"]["subject"] == "Re: План релиза"
+    # Стадия не ждет ненужные слоты: запрос отменен
+    assert elapsed < 1
+    assert calendar.paths("cancelled") == ["/free-slots"]
+    metrics = service.schedule_stats.metrics()
+    assert (metrics["conflicts"], metrics["speculative_hits"], metrics["speculative_wasted"]) == (0, 0, 1)
+
+
+def test_without_speculation_slots_are_requested_only_on_conflict(service, calendar, monkeypatch):
+    monkeypatch.setattr(service, "SPECULATIVE_FREE_SLOTS", False)
+
+    (_, state), _ = run_stage(service, calendar)
+    assert state["event"] == {"id": "ev1"}
+    assert "/free-slots" not in calendar.paths("start")
+
+    calendar.log.clear()
+    calendar.has_conflict = True
+    (_, state), _ = run_stage(service, calendar)
+
+    assert state["alternatives"] == FREE_SLOTS[:service.ALTERNATIVE_SLOTS]
+    assert calendar.log.index(("end", "/check-conflict")) < calendar.log.index(("start", "/free-slots"))
+    metrics = service.schedule_stats.metrics()
+    assert (metrics["runs"], metrics["speculative_hits"], metrics["speculative_wasted"]) == (2, 0, 0)
+
+
+def test_outside_work_schedule_does_not_wait_for_conflict_check(service, calendar, monkeypatch):
+    monkeypatch.setattr(service, "within_work_schedule", lambda *args: False)
+    calendar.delays["/check-conflict"] = 5
+
+    (_, state), elapsed = run_stage(service, calendar)
+
+    assert state["alternatives"] == FREE_SLOTS[:service.ALTERNATIVE_SLOTS]
+    assert elapsed < 1
+    assert calendar.paths("cancelled") == ["/check-conflict"]
+    assert "/events" not in calendar.paths("start")
+
+
+def test_failed_conflict_check_cancels_slots_request(service, calendar):
+    calendar.status["/check-conflict"] = 500
+    calendar.delays["/free-slots"] = 5
+
+    (stage, result), elapsed = run_stage(service, calendar)
+
+    assert stage is None
+    assert result == {"action": "error", "message": service.JOB_ERROR_MESSAGE}
+    assert elapsed < 1
+    assert calendar.paths("cancelled") == ["/free-slots"]
+    assert service.schedule_stats.metrics()["runs"] == 0
+
+
+def test_unauthorized_conflict_check_is_raised(service, calendar):
+    calendar.status["/check-conflict"] = 401
+    calendar.delays["/free-slots"] = 5
+
+    with pytest.raises(service.DownstreamUnauthorized):
+        run_stage(service, calendar)
+    assert calendar.paths("cancelled") == ["/free-slots"]
+
+
+def test_stats_endpoint(service, calendar):
+    calendar.has_conflict = True
+    run_stage(service, calendar)
+
+    with TestClient(service.app) as client:
+        metrics = client.get("/scheduling/stats").json()
+
+    assert metrics["runs"] == metrics["speculative_hits"] == 1
+    assert metrics["avg_ms"] < metrics["avg_serial_ms"]
@@ -1,12 +1,21 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from typing import List, Dict
+from typing import List, Dict, Optional
+from pathlib import Path
+import asyncio
 import httpx
 import os
+import sys
 import feedparser
 from datetime import datetime
 import json
 
+# Общий код вызова моделей: в образе лежит рядом с main.py, в репозитории - в services/shared
+sys.path.append(str(Path(__file__).resolve().parent.parent / "shared"))
+from inference import HuggingFaceBackend, InferenceBatcher
+from llm_cache import LLMCache
+from local_backend import LocalBackend
+
 app = FastAPI(title="News Service")
 
 security = HTTPBearer()
@@ -14,6 +23,41 @@ security = HTTPBearer()
 HUGGINGFACE_API_KEY = os.getenv("HUGGINGFACE_API_KEY")
 HUGGINGFACE_API_URL = "https://api-inference.huggingface.co/models/facebook/bart-large-cnn"
 
+DATA_DIR = Path(os.getenv("DATA_DIR", "/app/data"))
+DATA_DIR.mkdir(parents=True, exist_ok=True)
+# Кэш ответов модели: срок жизни записи, размер LRU в памяти и предел на диске
+LLM_CACHE_DB = DATA_DIR / "llm_cache.db"
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600)))
+LLM_CACHE_MEMORY_ITEMS = int(os.getenv("LLM_CACHE_MEMORY_ITEMS", "1000"))
+LLM_CACHE_MAX_BYTES = int(os.getenv("LLM_CACHE_MAX_MB", "100")) * 1024 * 1024
+# Микропакеты запросов к модели: размер пакета, окно сбора, число одновременных
+# вызовов и предел очереди входов
+INFERENCE_BATCH_SIZE = int(os.getenv("INFERENCE_BATCH_SIZE", "16"))
+INFERENCE_BATCH_WINDOW = float(os.getenv("INFERENCE_BATCH_WINDOW_MS", "20")) / 1000
+INFERENCE_CONCURRENCY = int(os.getenv("INFERENCE_CONCURRENCY", "4"))
+INFERENCE_MAX_QUEUE = int(os.getenv("INFERENCE_MAX_QUEUE", "1000"))
+# Где выполняется модель: "huggingface" (Inference API, нужен HUGGINGFACE_API_KEY)
+# или "local" (CPU, нужен образ с LOCAL_INFERENCE=true)
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "huggingface")
+USE_MODEL = INFERENCE_BACKEND == "local" or bool(HUGGINGFACE_API_KEY)
+# Локальная модель: потоки пула для пакетов
+LOCAL_INFERENCE_WORKERS = int(os.getenv("LOCAL_INFERENCE_WORKERS", "1"))
+LOCAL_SUMMARY_MODEL = os.getenv("LOCAL_SUMMARY_MODEL", "IlyaGusev/rut5_base_sum_gazeta")
+
+# Кэш ответов модели
+llm_cache = LLMCache(LLM_CACHE_DB, LLM_CACHE_TTL, LLM_CACHE_MEMORY_ITEMS, LLM_CACHE_MAX_BYTES)
+
+# Модель для саммари
+if INFERENCE_BACKEND == "local":
+    inference_backend = LocalBackend("summarization", LOCAL_SUMMARY_MODEL, LOCAL_INFERENCE_WORKERS, truncation=True)
+else:
+    inference_backend = HuggingFaceBackend(HUGGINGFACE_API_URL, HUGGINGFACE_API_KEY)
+
+# Очередь запросов к модели
+inference_batcher = InferenceBatcher(
+    inference_backend, INFERENCE_BATCH_SIZE, INFERENCE_BATCH_WINDOW, INFERENCE_CONCURRENCY, INFERENCE_MAX_QUEUE
+)
+
 def fetch_rbc_news() -> List[Dict]:
     """Парсинг новостей с RBC.ru через RSS"""
     try:
@@ -46,31 +90,24 @@ def fetch_rbc_news() -> List[Dict]:
 
 async def generate_summary(text: str) -> str:
     """Генерация краткого саммари с помощью LLM"""
-    if not HUGGINGFACE_API_KEY:
+    if not USE_MODEL:
         # Если нет API ключа, возвращаем первые 100 символов
         return text[:100] + "..." if len(text) > 100 else text
     
+    async def request_model() -> Optional[str]:
+        # Запрос уходит в модель вместе с другими, пришедшими одновременно
+        result = await inference_batcher.submit(text[:512])  # Ограничение длины
+        if isinstance(result, list) and len(result) > 0:
+            result = result[0]
+        if isinstance(result, dict):
+            return result.get("summary_text", text[:100])
+        return None
+    
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                HUGGINGFACE_API_URL,
-                headers={
-                    "Authorization": f"Bearer {HUGGINGFACE_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={"inputs": text[:512]},  # Ограничение длины
-                timeout=30.0
-            )
-            
-            if response.status_code == 200:
-                result = response.json()
-                if isinstance(result, list) and len(result) > 0:
-                    return result[0].get("summary_text", text[:100])
-                elif isinstance(result, dict):
-                    return result.get("summary_text", text[:100])
-            else:
-                # При ошибке возвращаем первые 100 символов
-                return text[:100] + "..."
+        # Саммари неизменившихся новостей берется из кэша, не доходя до модели
+        summary = await llm_cache.get_or_compute(llm_cache.key(inference_backend.name, "summary", text[:512]), request_model)
+        # При ошибке возвращаем первые 100 символов
+        return summary if summary is not None else text[:100] + "..."
     except Exception:
         # При ошибке возвращаем первые 100 символов
         return text[:100] + "..."
@@ -86,14 +123,17 @@ async def get_news(
     # Получаем новости
     news_items = fetch_rbc_news()
     
-    # Генерируем саммари для каждой новости
-    result = []
-    for item in news_items[:limit]:
+    # Генерируем саммари для всех новостей одновременно: запросы к модели
+    # объединяются в пакеты
+    news_items = news_items[:limit]
+    summaries = await asyncio.gather(*(
         # Используем description или summary для генерации саммари
-        text_to_summarize = item.get("description") or item.get("summary") or item.get("title", "")
-        
-        summary = await generate_summary(text_to_summarize)
-        
+        generate_summary(item.get("description") or item.get("summary") or item.get("title", ""))
+        for item in news_items
+    ))
+    
+    result = []
+    for item, summary in zip(news_items, summaries):
         result.append({
             "title": item.get("title", ""),
             "summary": summary,
@@ -103,6 +143,29 @@ async def get_news(
     
     return {"news": result}
 
+@app.get("/cache/stats")
+async def cache_stats():
+    """Метрики кэша ответов модели"""
+    return await llm_cache.metrics()
+
+@app.on_event("startup")
+async def warm_up_model():
+    if INFERENCE_BACKEND == "local":
+        app.state.model_warm_up = asyncio.create_task(load_local_model())
+
+async def load_local_model():
+    """Загрузка локальной модели в фоне, чтобы первый запрос не ждал ее"""
+    try:
+        await inference_backend.warm_up()
+    except Exception:
+        # Модель попробует загрузиться при первом запросе, до тех пор - fallback
+        pass
+
+@app.get("/inference/stats")
+async def inference_stats():
+    """Метрики очереди запросов к модели"""
+    return inference_batcher.metrics()
+
 @app.get("/health")
 async def health():
     """Проверка здоровья сервиса"""
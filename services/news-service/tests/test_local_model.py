@@ -0,0 +1,78 @@
+"""INFERENCE_BACKEND=local: саммари пишет локальная модель summarization"""
+import importlib.util
+import sys
+import types
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+SERVICE_DIR = Path(__file__).resolve().parent.parent
+AUTH = {"Authorization": "Bearer token"}
+
+
+class Summarizer:
+    """Поддельный пайплайн summarization: запоминает загрузки и пакеты"""
+
+    def __init__(self):
+        self.loads = []
+        self.batches = []
+
+    def pipeline(self, task, model, device):
+        self.loads.append((task, model))
+
+        def run(inputs, truncation):
+            self.batches.append(list(inputs))
+            return [{"summary_text": f"кратко: {text[:10]}"} for text in inputs]
+
+        return run
+
+
+@pytest.fixture
+def summarizer(monkeypatch):
+    fake = Summarizer()
+    monkeypatch.setitem(sys.modules, "transformers", types.SimpleNamespace(pipeline=fake.pipeline))
+    monkeypatch.setitem(sys.modules, "torch", types.SimpleNamespace(set_num_threads=lambda threads: None))
+    return fake
+
+
+@pytest.fixture
+def local_service(service, summarizer, monkeypatch, tmp_path):
+    """Отдельная копия main.py, загруженная с локальной моделью и своим каталогом данных"""
+    monkeypatch.setenv("INFERENCE_BACKEND", "local")
+    monkeypatch.setenv("DATA_DIR", str(tmp_path))
+    spec = importlib.util.spec_from_file_location("news_service_local_main", SERVICE_DIR / "main.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_default_backend_is_hugging_face(service):
+    assert isinstance(service.inference_backend, service.HuggingFaceBackend)
+    assert not service.USE_MODEL
+
+
+def test_local_backend_is_selected(local_service):
+    backend = local_service.inference_backend
+
+    assert isinstance(backend, local_service.LocalBackend)
+    assert local_service.USE_MODEL
+    assert backend.task == "summarization"
+    assert backend.name == local_service.LOCAL_SUMMARY_MODEL
+    assert backend.call_kwargs == {"truncation": True}
+
+
+def test_news_are_summarized_by_local_model(local_service, summarizer, monkeypatch):
+    descriptions = [f"Новость номер {i}. " * 5 for i in range(3)]
+    monkeypatch.setattr(local_service, "fetch_rbc_news", lambda: [
+        {"title": f"Новость {i}", "link": "", "published": "", "description": description}
+        for i, description in enumerate(descriptions)
+    ])
+
+    with TestClient(local_service.app) as client:
+        news = client.get("/news", headers=AUTH).json()["news"]
+
+    assert [item["summary"] for item in news] == [f"кратко: {text[:10]}" for text in descriptions]
+    # Модель загружена один раз, все саммари пришли одним пакетом
+    assert summarizer.loads == [("summarization", local_service.LOCAL_SUMMARY_MODEL)]
+    assert sorted(summarizer.batches[0]) == sorted(descriptions)
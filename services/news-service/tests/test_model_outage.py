@@ -0,0 +1,106 @@
+"""/news при недоступной модели: запасной текст без ожидания и автомат отключения"""
+import time
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+AUTH = {"Authorization": "Bearer token"}
+DESCRIPTION = "Описание новости, которое длиннее ста символов, чтобы запасной текст был заметно короче исходного."
+
+
+class OutageBackend:
+    """Модель, которая падает с сетевой ошибкой, пока down=True"""
+
+    name = "outage-test"
+
+    def __init__(self):
+        self.down = True
+        self.calls = 0
+
+    async def infer(self, inputs):
+        self.calls += 1
+        if self.down:
+            raise httpx.ConnectError("refused")
+        return [[{"summary_text": "саммари"}] for _ in inputs]
+
+
+@pytest.fixture
+def client(service, monkeypatch, tmp_path):
+    monkeypatch.setattr(service, "USE_MODEL", True)
+    monkeypatch.setattr(service, "fetch_rbc_news", lambda: [
+        {"title": "Новость", "link": "", "published": "", "summary": "", "description": DESCRIPTION}
+    ])
+    monkeypatch.setattr(service, "llm_cache", service.LLMCache(tmp_path / "cache.db", 3600, 100, 1024 * 1024))
+    with TestClient(service.app) as client:
+        yield client
+
+
+def use_backend(service, monkeypatch, backend, failures=2, cooldown=0.2):
+    batcher = service.InferenceBatcher(backend, 16, 0.001, 1, 100)
+    batcher.max_attempts = 2
+    batcher.retry_base = 0.001
+    batcher.breaker.failures = failures
+    batcher.breaker.cooldown = cooldown
+    monkeypatch.setattr(service, "inference_backend", backend)
+    monkeypatch.setattr(service, "inference_batcher", batcher)
+    return batcher
+
+
+def get_summary(client):
+    response = client.get("/news", headers=AUTH)
+    assert response.status_code == 200
+    return response.json()["news"][0]["summary"]
+
+
+def test_outage_opens_breaker_and_skips_model(service, monkeypatch, client):
+    backend = OutageBackend()
+    batcher = use_backend(service, monkeypatch, backend, cooldown=10)
+
+    for _ in range(2):
+        assert get_summary(client) == DESCRIPTION[:100] + "..."
+    assert backend.calls == 4
+    assert client.get("/inference/stats").json()["breaker"] == "open"
+
+    # Пока автомат открыт, новости отдаются сразу с запасным текстом
+    assert get_summary(client) == DESCRIPTION[:100] + "..."
+    assert backend.calls == 4
+    assert batcher.stats["short_circuited"] == 1
+
+
+def test_model_is_used_again_after_cooldown(service, monkeypatch, client):
+    backend = OutageBackend()
+    use_backend(service, monkeypatch, backend, cooldown=0.1)
+    for _ in range(2):
+        get_summary(client)
+
+    backend.down = False
+    time.sleep(0.15)
+
+    assert get_summary(client) == "саммари"
+    assert client.get("/inference/stats").json()["breaker"] == "closed"
+
+
+def test_loading_model_is_not_waited_for(service, monkeypatch, client):
+    """503 с долгой оценкой загрузки модели сразу дает запасной текст"""
+    requests = []
+
+    def handler(request):
+        requests.append(request)
+        return httpx.Response(503, json={"error": "loading", "estimated_time": 120})
+
+    transport = httpx.MockTransport(handler)
+
+    class MockClient(httpx.AsyncClient):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, transport=transport, **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    batcher = use_backend(service, monkeypatch, service.HuggingFaceBackend("https://hf.test/model", "hf-key"))
+
+    started = time.monotonic()
+    assert get_summary(client) == DESCRIPTION[:100] + "..."
+    assert time.monotonic() - started < 5
+    assert len(requests) == 1
+    assert requests[0].headers["authorization"] == "Bearer hf-key"
+    assert batcher.stats["retries"] == 0
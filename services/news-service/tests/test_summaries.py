@@ -0,0 +1,128 @@
+"""Саммари новостей в /news: пакеты запросов к модели, кэш и запасной текст"""
+import pytest
+from fastapi.testclient import TestClient
+
+AUTH = {"Authorization": "Bearer token"}
+LONG = "Длинное описание новости. " * 10
+
+
+class SummaryBackend:
+    """Модель саммари: запоминает пакеты, отвечает как Hugging Face summarization"""
+
+    name = "summary-test"
+
+    def __init__(self, error=None):
+        self.error = error
+        self.batches = []
+
+    async def infer(self, inputs):
+        self.batches.append(list(inputs))
+        if self.error:
+            raise self.error
+        return [[{"summary_text": f"кратко: {text[:10]}"}] for text in inputs]
+
+
+def news(*descriptions):
+    return [
+        {"title": f"Новость {i}", "link": f"https://www.rbc.ru/{i}", "published": "",
+         "summary": "", "description": description}
+        for i, description in enumerate(descriptions)
+    ]
+
+
+@pytest.fixture
+def feed(service, monkeypatch):
+    """Лента RBC без сети: тест задает ее содержимое"""
+    items = []
+    monkeypatch.setattr(service, "fetch_rbc_news", lambda: list(items))
+    return items
+
+
+@pytest.fixture
+def model(service, monkeypatch, tmp_path):
+    """Включенная модель с отдельными кэшем и очередью на каждый тест"""
+    backend = SummaryBackend()
+    monkeypatch.setattr(service, "USE_MODEL", True)
+    monkeypatch.setattr(service, "inference_backend", backend)
+    monkeypatch.setattr(service, "inference_batcher", service.InferenceBatcher(backend, 16, 0.01, 1, 100))
+    monkeypatch.setattr(service, "llm_cache", service.LLMCache(tmp_path / "cache.db", 3600, 100, 1024 * 1024))
+    return backend
+
+
+def get_summaries(service, limit=10):
+    with TestClient(service.app) as client:
+        response = client.get("/news", params={"limit": limit}, headers=AUTH)
+    assert response.status_code == 200
+    return [item["summary"] for item in response.json()["news"]]
+
+
+def test_without_model_summary_is_truncated_text(service, feed):
+    feed.extend(news("Коротко", LONG))
+
+    assert get_summaries(service) == ["Коротко", LONG[:100] + "..."]
+
+
+def test_news_are_summarized_in_one_batch(service, feed, model):
+    feed.extend(news("первая новость", "вторая новость", "третья новость"))
+
+    summaries = get_summaries(service)
+
+    assert summaries == ["кратко: первая нов", "кратко: вторая нов", "кратко: третья нов"]
+    # Порядок входов в пакете зависит от того, в каком порядке завершились проверки кэша
+    assert len(model.batches) == 1
+    assert sorted(model.batches[0]) == sorted(["первая новость", "вторая новость", "третья новость"])
+
+
+def test_only_limit_news_reach_the_model(service, feed, model):
+    feed.extend(news("раз", "два", "три"))
+
+    assert len(get_summaries(service, limit=2)) == 2
+    assert [sorted(batch) for batch in model.batches] == [["два", "раз"]]
+
+
+def test_model_input_falls_back_to_summary_and_title(service, feed, model):
+    feed.extend([
+        {"title": "Заголовок", "link": "", "published": "", "summary": "", "description": ""},
+        {"title": "Заголовок", "link": "", "published": "", "summary": "Анонс", "description": ""},
+    ])
+
+    get_summaries(service)
+
+    assert [sorted(batch) for batch in model.batches] == [["Анонс", "Заголовок"]]
+
+
+def test_model_input_is_cut_to_512_chars(service, feed, model):
+    feed.extend(news("я" * 600))
+
+    get_summaries(service)
+
+    assert model.batches == [["я" * 512]]
+
+
+def test_model_error_falls_back_to_truncated_text(service, feed, model):
+    model.error = RuntimeError("model crashed")
+    feed.extend(news(LONG, "Коротко"))
+
+    # Запасной текст всегда с многоточием, даже для короткой новости
+    assert get_summaries(service) == [LONG[:100] + "...", "Коротко..."]
+
+
+def test_unchanged_news_are_served_from_cache(service, feed, model):
+    feed.extend(news("первая новость", "вторая новость"))
+    first = get_summaries(service)
+
+    feed.extend(news("первая новость", "вторая новость", "новая новость")[2:])
+    second = get_summaries(service)
+
+    assert second[:2] == first
+    assert [sorted(batch) for batch in model.batches] == [["вторая новость", "первая новость"], ["новая новость"]]
+
+
+def test_failed_summary_is_not_cached(service, feed, model):
+    model.error = RuntimeError("model crashed")
+    feed.extend(news("новость"))
+    get_summaries(service)
+
+    model.error = None
+    assert get_summaries(service) == ["кратко: новость"]
+    assert len(model.batches) == 2
@@ -0,0 +1,71 @@
+"""Ограниченные повторы и автомат отключения модели для news-service и llm-agent-service.
+
+Настройки одинаковы для обоих сервисов и читаются из окружения здесь;
+применяет их InferenceBatcher.
+"""
+from typing import Optional
+import os
+import time
+
+# Устойчивость вызовов модели: попытки на пакет, база экспоненциальной задержки,
+# максимальная пауза (в том числе по Retry-After), после которой пакет уходит в fallback,
+# и автомат отключения: число ошибок подряд и время, на которое модель отключается
+MODEL_MAX_ATTEMPTS = int(os.getenv("MODEL_MAX_ATTEMPTS", "3"))
+MODEL_RETRY_BASE = float(os.getenv("MODEL_RETRY_BASE", "0.5"))
+MODEL_RETRY_MAX_DELAY = float(os.getenv("MODEL_RETRY_MAX_DELAY", "10"))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))
+
+class ModelError(Exception):
+    """Ошибка вызова модели.
+
+    retryable - имеет ли смысл повтор; retry_after - сколько ждать перед ним,
+    если модель сама сообщила срок (Retry-After, estimated_time загрузки).
+    """
+
+    def __init__(self, message: str, retryable: bool = True, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Автомат отключения модели.
+
+    После failures неудачных пакетов подряд модель считается недоступной на
+    cooldown секунд (или дольше, если она сама назвала срок), и запросы сразу
+    уходят в fallback. По истечении срока пропускается один пробный пакет:
+    успех возвращает модель в работу, ошибка снова отключает ее.
+    """
+
+    def __init__(self, failures: int, cooldown: float):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failed = 0
+        self._open_until = 0.0
+        self._probing = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self._failed < self.failures:
+            return "closed"
+        return "open" if time.monotonic() < self._open_until or self._probing else "half_open"
+
+    def allow(self) -> bool:
+        """Можно ли отправить пакет в модель"""
+        state = self.state
+        if state == "half_open":
+            self._probing = True
+        return state != "open"
+
+    def success(self):
+        self._failed = 0
+        self._probing = False
+
+    def failure(self, retry_after: Optional[float] = None):
+        self._failed += 1
+        self._probing = False
+        if self._failed >= self.failures:
+            if self._open_until <= time.monotonic():
+                self.opened += 1
+            self._open_until = time.monotonic() + max(self.cooldown, retry_after or 0)
@@ -0,0 +1,185 @@
+"""Общий код вызова моделей для news-service и llm-agent-service.
+
+Backend Hugging Face Inference API и микропакеты запросов; кэш ответов -
+в llm_cache.py, локальная модель - в local_backend.py, повторы и автомат
+отключения - в circuit_breaker.py. Настройки размеров пакетов задает сервис.
+"""
+from typing import List, Dict, Optional, Tuple
+import asyncio
+import httpx
+import os
+import random
+
+from circuit_breaker import (
+    BREAKER_COOLDOWN, BREAKER_FAILURES, MODEL_MAX_ATTEMPTS, MODEL_RETRY_BASE, MODEL_RETRY_MAX_DELAY,
+    CircuitBreaker, ModelError
+)
+
+INFERENCE_TIMEOUT = float(os.getenv("INFERENCE_TIMEOUT", "60"))
+
+class HuggingFaceBackend:
+    """Модель в Hugging Face Inference API"""
+
+    def __init__(self, url: str, api_key: Optional[str]):
+        self.name = url
+        self.api_key = api_key
+
+    async def infer(self, inputs: List) -> Optional[List]:
+        """Результаты модели по входам пакета; ответ с ошибкой - ModelError"""
+        async with httpx.AsyncClient() as client:
+            response = await client.post(
+                self.name,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+                json={"inputs": inputs},
+                timeout=INFERENCE_TIMEOUT
+            )
+        if response.status_code == 200:
+            return response.json()
+        
+        retry_after = None
+        if response.headers.get("retry-after", "").isdigit():
+            retry_after = float(response.headers["retry-after"])
+        elif response.status_code == 503:
+            # Модель загружается: API сообщает оценку времени загрузки
+            try:
+                retry_after = float(response.json().get("estimated_time"))
+            except (ValueError, TypeError, AttributeError):
+                pass
+        raise ModelError(
+            f"Hugging Face returned {response.status_code}",
+            retryable=response.status_code in (408, 429) or response.status_code >= 500,
+            retry_after=retry_after
+        )
+
+class InferenceBatcher:
+    """Микропакеты запросов к модели.
+
+    Запросы, пришедшие в пределах окна, отправляются в backend одним
+    пакетом (список входов), ответ раскладывается по ожидающим корутинам. Одновременно выполняется не больше concurrency
+    пакетов; если в очереди уже max_queue входов или модель отключена
+    автоматом, новый запрос сразу получает None и вызывающий код уходит
+    в fallback. Пакет с ошибкой повторяется не больше max_attempts раз.
+    """
+
+    def __init__(self, backend, max_batch: int, window: float, concurrency: int, max_queue: int):
+        self.backend = backend
+        self.breaker = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN)
+        self.max_attempts = MODEL_MAX_ATTEMPTS
+        self.retry_base = MODEL_RETRY_BASE
+        self.retry_max_delay = MODEL_RETRY_MAX_DELAY
+        self.max_batch = max_batch
+        self.window = window
+        self.max_queue = max_queue
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._pending: List[Tuple[object, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._tasks = set()
+        self.queued = 0
+        self.in_flight = 0
+        self.stats = {
+            "requests": 0, "rejected": 0, "short_circuited": 0, "batches": 0, "batched_inputs": 0,
+            "retries": 0, "errors": 0
+        }
+
+    async def submit(self, item):
+        """Результат модели для одного входа или None при ошибке"""
+        if self.queued >= self.max_queue:
+            self.stats["rejected"] += 1
+            return None
+        if self.breaker.state == "open":
+            self.stats["short_circuited"] += 1
+            return None
+        self.stats["requests"] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((item, future))
+        self.queued += 1
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        while self._pending:
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            task = asyncio.create_task(self._send(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: List[Tuple[object, asyncio.Future]]):
+        async with self._semaphore:
+            self.queued -= len(batch)
+            # Входы, чьи запросы уже отменены, в модель не отправляются
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                return
+            self.in_flight += len(batch)
+            try:
+                results = await self._infer([item for item, _ in batch])
+            finally:
+                self.in_flight -= len(batch)
+            for (_, future), result in zip(batch, results or [None] * len(batch)):
+                if not future.done():
+                    future.set_result(result)
+
+    async def _infer(self, inputs: List) -> Optional[List]:
+        """Пакет в модель с повторами; None - модель недоступна, нужен fallback"""
+        # Автомат спрашивается один раз на пакет: повторы пробного пакета идут без него
+        if not self.breaker.allow():
+            self.stats["short_circuited"] += len(inputs)
+            return None
+        healthy = False
+        retry_after = None
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                self.stats["batches"] += 1
+                self.stats["batched_inputs"] += len(inputs)
+                retry_after = None
+                try:
+                    results = await self.backend.infer(inputs)
+                    if isinstance(results, list) and len(results) == len(inputs):
+                        healthy = True
+                        return results
+                    retryable = False
+                except ModelError as e:
+                    retryable, retry_after = e.retryable, e.retry_after
+                except httpx.RequestError:
+                    retryable = True
+                except Exception:
+                    # Ошибка локальной модели при повторе не исчезнет
+                    retryable = False
+                
+                self.stats["errors"] += 1
+                # Экспоненциальная задержка со случайным разбросом, если модель не назвала свою
+                if retry_after is None:
+                    delay = self.retry_base * 2 ** (attempt - 1) * random.uniform(0.5, 1.5)
+                else:
+                    delay = retry_after
+                if not retryable or attempt == self.max_attempts or delay > self.retry_max_delay:
+                    return None
+                self.stats["retries"] += 1
+                await asyncio.sleep(delay)
+            return None
+        finally:
+            # Любой исход пакета, в том числе прерванного, закрывает пробу автомата
+            if healthy:
+                self.breaker.success()
+            else:
+                self.breaker.failure(retry_after)
+
+    def metrics(self) -> Dict:
+        return {
+            **self.stats,
+            "breaker": self.breaker.state,
+            "breaker_opened": self.breaker.opened,
+            "queue_depth": self.queued,
+            "in_flight": self.in_flight,
+            "avg_batch_size": round(self.stats["batched_inputs"] / self.stats["batches"], 2)
+            if self.stats["batches"] else None
+        }
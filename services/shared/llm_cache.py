@@ -0,0 +1,162 @@
+"""Кэш ответов модели для news-service и llm-agent-service.
+
+Повторные и пересланные тексты берутся из кэша, не доходя до модели;
+размеры и срок жизни записей задает сервис.
+"""
+from typing import Dict, Optional, Tuple, Awaitable, Callable
+from collections import OrderedDict
+from contextlib import closing
+from pathlib import Path
+import asyncio
+import hashlib
+import json
+import sqlite3
+import time
+
+class LLMCache:
+    """Кэш ответов модели: ключ - хэш модели, шаблона запроса и входного текста.
+
+    Два уровня: LRU в памяти процесса и SQLite на диске, который переживает
+    перезапуск. Записи старше TTL не отдаются; при превышении размера на диске
+    удаляются давно не запрашивавшиеся записи. Одинаковые запросы, пришедшие
+    одновременно, уходят в модель один раз. Ответ None (ошибка модели) не кэшируется.
+    """
+
+    def __init__(self, path: Path, ttl: float, memory_items: int, max_bytes: int):
+        self.path = path
+        self.ttl = ttl
+        self.memory_items = memory_items
+        self.max_bytes = max_bytes
+        self._memory: "OrderedDict[str, Tuple[object, float]]" = OrderedDict()
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.stats = {
+            "memory_hits": 0, "disk_hits": 0, "misses": 0, "coalesced": 0,
+            "stores": 0, "memory_evictions": 0, "disk_evictions": 0, "expired": 0
+        }
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS llm_cache (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_accessed ON llm_cache (accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS llm_cache_created ON llm_cache (created_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    @staticmethod
+    def key(model: str, template: str, text: str) -> str:
+        return hashlib.sha256(json.dumps([model, template, text], ensure_ascii=False).encode()).hexdigest()
+
+    def _remember(self, key: str, value, expires_at: float):
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_items:
+            self._memory.popitem(last=False)
+            self.stats["memory_evictions"] += 1
+
+    def _load(self, key: str) -> Optional[Tuple[str, float]]:
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ? AND created_at > ?",
+                (key, now - self.ttl)
+            ).fetchone()
+            if row:
+                conn.execute("UPDATE llm_cache SET accessed_at = ? WHERE key = ?", (now, key))
+        return row
+
+    def _store(self, key: str, value: str) -> Tuple[int, int]:
+        """Запись на диск и вытеснение: возвращает число удаленных устаревших и лишних записей"""
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, value, len(value.encode()), now, now)
+            )
+            expired = conn.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl,)).rowcount
+            excess = (conn.execute("SELECT SUM(size) FROM llm_cache").fetchone()[0] or 0) - self.max_bytes
+            victims = []
+            if excess > 0:
+                for victim, size in conn.execute("SELECT key, size FROM llm_cache ORDER BY accessed_at"):
+                    victims.append((victim,))
+                    excess -= size
+                    if excess <= 0:
+                        break
+                conn.executemany("DELETE FROM llm_cache WHERE key = ?", victims)
+        return expired, len(victims)
+
+    async def get(self, key: str):
+        """Значение из кэша или None"""
+        entry = self._memory.get(key)
+        if entry and entry[1] > time.time():
+            self._memory.move_to_end(key)
+            self.stats["memory_hits"] += 1
+            return entry[0]
+        if entry:
+            del self._memory[key]
+        row = await asyncio.to_thread(self._load, key)
+        if row is None:
+            return None
+        value = json.loads(row[0])
+        self._remember(key, value, row[1] + self.ttl)
+        self.stats["disk_hits"] += 1
+        return value
+
+    async def put(self, key: str, value):
+        self._remember(key, value, time.time() + self.ttl)
+        expired, evicted = await asyncio.to_thread(self._store, key, json.dumps(value, ensure_ascii=False))
+        self.stats["stores"] += 1
+        self.stats["expired"] += expired
+        self.stats["disk_evictions"] += evicted
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable]):
+        """Значение из кэша или результат compute() с сохранением в кэш"""
+        value = await self.get(key)
+        if value is not None:
+            return value
+        task = self._inflight.get(key)
+        if task:
+            self.stats["coalesced"] += 1
+        else:
+            self.stats["misses"] += 1
+            task = asyncio.create_task(self._compute(key, compute))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        # Отмена одного из ожидающих запросов не прерывает обращение к модели
+        return await asyncio.shield(task)
+
+    async def _compute(self, key: str, compute: Callable[[], Awaitable]):
+        value = await compute()
+        if value is not None:
+            await self.put(key, value)
+        return value
+
+    def _finish(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            # Ошибку получают ожидающие запросы; здесь она лишь помечается полученной
+            task.exception()
+
+    def _disk_usage(self) -> Tuple[int, int]:
+        with closing(self._connect()) as conn:
+            count, size = conn.execute("SELECT COUNT(*), SUM(size) FROM llm_cache").fetchone()
+        return count, size or 0
+
+    async def metrics(self) -> Dict:
+        disk_items, disk_bytes = await asyncio.to_thread(self._disk_usage)
+        hits = self.stats["memory_hits"] + self.stats["disk_hits"] + self.stats["coalesced"]
+        lookups = hits + self.stats["misses"]
+        return {
+            **self.stats,
+            "hit_rate": round(hits / lookups, 4) if lookups else None,
+            "memory_items": len(self._memory),
+            "disk_items": disk_items,
+            "disk_bytes": disk_bytes
+        }
@@ -0,0 +1,49 @@
+"""Локальная модель на CPU для news-service и llm-agent-service.
+
+Вызывается через тот же InferenceBatcher, что и Hugging Face Inference API;
+transformers и torch ставятся только в образ с LOCAL_INFERENCE=true.
+"""
+from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import os
+import threading
+
+# Потоки torch для локальной модели (0 - по умолчанию)
+LOCAL_INFERENCE_THREADS = int(os.getenv("LOCAL_INFERENCE_THREADS", "0"))
+
+class LocalBackend:
+    """Локальная модель на CPU (пайплайн transformers).
+
+    Модель загружается один раз на процесс при первом обращении (или прогреве
+    на старте) и общая для всех запросов; пакеты выполняются в отдельном пуле
+    потоков, не занимая цикл событий.
+    """
+
+    def __init__(self, task: str, model: str, workers: int, **call_kwargs):
+        self.task = task
+        self.name = model
+        self.call_kwargs = call_kwargs
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="inference")
+        self._pipeline = None
+        self._load_lock = threading.Lock()
+
+    def _load(self):
+        with self._load_lock:
+            if self._pipeline is None:
+                # transformers ставится только в образ с локальной моделью
+                import torch
+                from transformers import pipeline
+                if LOCAL_INFERENCE_THREADS:
+                    torch.set_num_threads(LOCAL_INFERENCE_THREADS)
+                self._pipeline = pipeline(self.task, model=self.name, device=-1)
+        return self._pipeline
+
+    def _run(self, inputs: List) -> List:
+        return list(self._load()(inputs, **self.call_kwargs))
+
+    async def warm_up(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._load)
+
+    async def infer(self, inputs: List) -> Optional[List]:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._run, inputs)
@@ -0,0 +1,92 @@
+"""Настройки пользователя из Auth Service для calendar-, email- и llm-agent-service.
+
+Кэш настроек с перепроверкой по ETag, настройки по умолчанию и проверка
+рабочего расписания. Адрес Auth Service и TTL кэша одинаковы для всех
+сервисов и читаются из окружения здесь.
+"""
+from typing import Dict, Optional, Tuple
+from datetime import datetime
+import asyncio
+import httpx
+import os
+import time
+
+AUTH_SERVICE_URL = os.getenv("AUTH_SERVICE_URL", "http://auth-service:8001")
+# Через сколько секунд перепроверять закэшированные настройки пользователя
+PREFERENCES_CACHE_TTL = float(os.getenv("PREFERENCES_CACHE_TTL", "30"))
+# Настройки на случай, если Auth Service недоступен
+DEFAULT_PREFERENCES = {
+    "important_contacts": [],
+    "ignored_senders": [],
+    "work_schedule": {
+        "days": ["Пн", "Вт", "Ср", "Чт", "Пт"],
+        "start_time": "10:00",
+        "end_time": "18:00"
+    },
+    "response_templates": {
+        "accept": "Спасибо за предложение! Я подтверждаю встречу.",
+        "decline": "К сожалению, в это время я занят."
+    }
+}
+WEEKDAYS = {"Пн": 0, "Вт": 1, "Ср": 2, "Чт": 3, "Пт": 4, "Сб": 5, "Вс": 6}
+
+class PreferencesCache:
+    """Кэш пользовательских настроек из Auth Service.
+
+    По истечении TTL запись перепроверяется условным запросом (If-None-Match):
+    пока настройки не менялись, Auth Service отвечает 304 без тела.
+    """
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.auth_url = AUTH_SERVICE_URL
+        self._entries: Dict[str, Tuple[Dict, Optional[str], float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    @staticmethod
+    def _parse(response: httpx.Response) -> Optional[Dict]:
+        """Настройки из ответа 200; None, если тело не объект JSON (например, HTML прокси)"""
+        try:
+            prefs = response.json()
+        except ValueError:
+            return None
+        return prefs if isinstance(prefs, dict) else None
+
+    async def get(self, user_id: str, token: str) -> Dict:
+        entry = self._entries.get(user_id)
+        if entry and entry[2] > time.monotonic():
+            return entry[0]
+        async with self._locks.setdefault(user_id, asyncio.Lock()):
+            entry = self._entries.get(user_id)
+            if entry and entry[2] > time.monotonic():
+                return entry[0]
+
+            headers = {"Authorization": f"Bearer {token}"}
+            if entry and entry[1]:
+                headers["If-None-Match"] = entry[1]
+            try:
+                async with httpx.AsyncClient(timeout=5.0) as client:
+                    response = await client.get(f"{self.auth_url}/preferences", headers=headers)
+            except httpx.RequestError:
+                response = None
+
+            prefs = None
+            if response is not None and response.status_code == 200:
+                prefs = self._parse(response)
+            if prefs is not None:
+                etag = response.headers.get("etag")
+            elif entry:
+                # 304, Auth Service недоступен или ответил не JSON: остаемся на известных настройках
+                prefs, etag = entry[0], entry[1]
+            else:
+                prefs, etag = DEFAULT_PREFERENCES, None
+            self._entries[user_id] = (prefs, etag, time.monotonic() + self.ttl)
+            return prefs
+
+def within_work_schedule(start: datetime, end: datetime, schedule: Dict) -> bool:
+    """Попадает ли интервал целиком в рабочие дни и часы пользователя"""
+    days = {WEEKDAYS[day] for day in schedule.get("days", []) if day in WEEKDAYS}
+    if start.weekday() not in days or start.date() != end.date():
+        return False
+    return schedule.get("start_time", "00:00") <= start.strftime("%H:%M") and \
+        end.strftime("%H:%M") <= schedule.get("end_time", "23:59")
@@ -0,0 +1,50 @@
+"""Фикстуры тестов общего кода: модули импортируются из services/shared"""
+import importlib
+import sys
+from pathlib import Path
+
+import pytest
+
+SHARED_DIR = Path(__file__).resolve().parent.parent
+
+
+def import_shared(name):
+    if str(SHARED_DIR) not in sys.path:
+        sys.path.append(str(SHARED_DIR))
+    return importlib.import_module(name)
+
+
+@pytest.fixture(scope="session")
+def inference():
+    """Модуль inference.py, общий для news-service и llm-agent-service"""
+    return import_shared("inference")
+
+
+@pytest.fixture(scope="session")
+def llm_cache():
+    """Модуль llm_cache.py: кэш ответов модели"""
+    return import_shared("llm_cache")
+
+
+@pytest.fixture(scope="session")
+def local_backend():
+    """Модуль local_backend.py: локальная модель на CPU"""
+    return import_shared("local_backend")
+
+
+@pytest.fixture(scope="session")
+def circuit_breaker():
+    """Модуль circuit_breaker.py: ошибки модели и автомат отключения"""
+    return import_shared("circuit_breaker")
+
+
+@pytest.fixture(scope="session")
+def token_store():
+    """Модуль token_store.py, общий для calendar-service и email-service"""
+    return import_shared("token_store")
+
+
+@pytest.fixture(scope="session")
+def preferences():
+    """Модуль preferences.py: настройки пользователя из Auth Service"""
+    return import_shared("preferences")
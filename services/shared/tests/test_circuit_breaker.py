@@ -0,0 +1,92 @@
+"""Повторы и автомат отключения в очереди запросов к модели"""
+import asyncio
+import time
+
+import httpx
+
+
+class FlakyBackend:
+    """Backend, который падает, пока healthy=False"""
+
+    name = "flaky"
+
+    def __init__(self, error):
+        self.error = error
+        self.healthy = False
+        self.calls = 0
+
+    async def infer(self, inputs):
+        self.calls += 1
+        if not self.healthy:
+            raise self.error
+        return [{"ok": item} for item in inputs]
+
+
+def make_batcher(inference, circuit_breaker, backend, failures=2, cooldown=0.2):
+    batcher = inference.InferenceBatcher(backend, 8, 0.001, 2, 100)
+    batcher.max_attempts = 3
+    batcher.retry_base = 0.001
+    batcher.breaker = circuit_breaker.CircuitBreaker(failures, cooldown)
+    return batcher
+
+
+def test_retryable_error_is_retried_then_falls_back(inference, circuit_breaker):
+    backend = FlakyBackend(httpx.ConnectError("refused"))
+    batcher = make_batcher(inference, circuit_breaker, backend, failures=5)
+
+    assert asyncio.run(batcher.submit("x")) is None
+    assert backend.calls == 3
+    assert batcher.stats["retries"] == 2
+
+
+def test_retry_after_longer_than_limit_is_not_waited(inference, circuit_breaker):
+    backend = FlakyBackend(circuit_breaker.ModelError("loading", retryable=True, retry_after=120))
+    batcher = make_batcher(inference, circuit_breaker, backend, failures=5)
+
+    started = time.monotonic()
+    assert asyncio.run(batcher.submit("x")) is None
+    assert time.monotonic() - started < 1
+    assert backend.calls == 1
+
+
+def test_breaker_opens_and_short_circuits(inference, circuit_breaker):
+    backend = FlakyBackend(httpx.ConnectError("refused"))
+    batcher = make_batcher(inference, circuit_breaker, backend, cooldown=10)
+
+    async def run():
+        for _ in range(2):
+            assert await batcher.submit("x") is None
+        calls = backend.calls
+        assert batcher.breaker.state == "open"
+        assert await batcher.submit("x") is None
+        assert backend.calls == calls
+
+    asyncio.run(run())
+    assert batcher.stats["short_circuited"] == 1
+
+
+def test_failed_probe_with_retries_then_recovery(inference, circuit_breaker):
+    """Пробный пакет с повторяемой ошибкой снова отключает модель, а не зависает в пробе"""
+    backend = FlakyBackend(httpx.ConnectError("refused"))
+    batcher = make_batcher(inference, circuit_breaker, backend)
+
+    async def run():
+        for _ in range(2):
+            await batcher.submit("x")
+        assert batcher.breaker.state == "open"
+
+        await asyncio.sleep(0.25)
+        assert batcher.breaker.state == "half_open"
+        calls = backend.calls
+        assert await batcher.submit("probe") is None
+        # Проба прошла все попытки, а не оборвалась после первой
+        assert backend.calls == calls + 3
+        assert batcher.breaker.state == "open"
+
+        backend.healthy = True
+        await asyncio.sleep(0.25)
+        assert await batcher.submit("y") == {"ok": "y"}
+        assert batcher.breaker.state == "closed"
+        assert await batcher.submit("z") == {"ok": "z"}
+
+    asyncio.run(run())
@@ -0,0 +1,116 @@
+"""Микропакеты запросов к модели: раскладка ответов, ограничения и пропускная способность"""
+import asyncio
+import time
+
+
+class EchoBackend:
+    """Модель с задержкой на вызов и на вход пакета; считает вызовы и их одновременность"""
+
+    name = "echo"
+
+    def __init__(self, latency=0.0, per_input=0.0):
+        self.latency = latency
+        self.per_input = per_input
+        self.batches = []
+        self.active = 0
+        self.peak = 0
+
+    async def infer(self, inputs):
+        self.batches.append(list(inputs))
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.latency + self.per_input * len(inputs))
+        finally:
+            self.active -= 1
+        return [{"echo": item} for item in inputs]
+
+
+def run_concurrently(batcher, items):
+    async def run():
+        return await asyncio.gather(*(batcher.submit(item) for item in items))
+
+    return asyncio.run(run())
+
+
+def test_results_reach_their_callers(inference):
+    backend = EchoBackend(latency=0.005)
+    batcher = inference.InferenceBatcher(backend, 8, 0.01, 2, 1000)
+
+    results = run_concurrently(batcher, list(range(50)))
+
+    assert results == [{"echo": item} for item in range(50)]
+    assert all(len(batch) <= 8 for batch in backend.batches)
+    assert len(backend.batches) == 7
+    assert backend.peak <= 2
+    metrics = batcher.metrics()
+    assert metrics["requests"] == 50 and metrics["queue_depth"] == 0 and metrics["in_flight"] == 0
+    assert metrics["avg_batch_size"] > 7
+
+
+def test_lone_request_is_sent_after_window(inference):
+    backend = EchoBackend()
+    batcher = inference.InferenceBatcher(backend, 16, 0.02, 1, 1000)
+
+    started = time.monotonic()
+    assert run_concurrently(batcher, ["a"]) == [{"echo": "a"}]
+    assert 0.015 <= time.monotonic() - started < 1
+    assert backend.batches == [["a"]]
+
+
+def test_full_queue_rejects_immediately(inference):
+    backend = EchoBackend(latency=0.05)
+    batcher = inference.InferenceBatcher(backend, 4, 0.001, 1, 6)
+
+    results = run_concurrently(batcher, list(range(10)))
+
+    assert results[:6] == [{"echo": item} for item in range(6)]
+    assert results[6:] == [None] * 4
+    assert batcher.stats["rejected"] == 4
+
+
+def test_cancelled_requests_are_not_sent(inference):
+    backend = EchoBackend(latency=0.05)
+    batcher = inference.InferenceBatcher(backend, 2, 0.001, 1, 100)
+
+    async def run():
+        first = asyncio.ensure_future(batcher.submit("first"))
+        await asyncio.sleep(0.01)
+        waiting = [asyncio.ensure_future(batcher.submit(item)) for item in ("gone", "kept")]
+        await asyncio.sleep(0)
+        waiting[0].cancel()
+        return await first, await waiting[1]
+
+    assert asyncio.run(run()) == ({"echo": "first"}, {"echo": "kept"})
+    assert backend.batches == [["first"], ["kept"]]
+
+
+def test_wrong_result_count_falls_back(inference):
+    class ShortBackend(EchoBackend):
+        async def infer(self, inputs):
+            return (await super().infer(inputs))[:-1]
+
+    batcher = inference.InferenceBatcher(ShortBackend(), 4, 0.001, 1, 100)
+    batcher.max_attempts = 1
+    assert run_concurrently(batcher, ["a", "b", "c"]) == [None, None, None]
+
+
+def test_batching_beats_per_request_calls(inference):
+    """При одинаковом числе одновременных вызовов пакеты дают кратный выигрыш"""
+    items = [f"text {i}" for i in range(120)]
+
+    def measure(max_batch):
+        backend = EchoBackend(latency=0.02, per_input=0.0005)
+        batcher = inference.InferenceBatcher(backend, max_batch, 0.005, 4, 1000)
+        started = time.perf_counter()
+        results = run_concurrently(batcher, items)
+        elapsed = time.perf_counter() - started
+        assert results == [{"echo": item} for item in items]
+        return len(items) / elapsed, len(backend.batches)
+
+    per_request, per_request_calls = measure(1)
+    batched, batched_calls = measure(16)
+
+    assert per_request_calls == 120
+    assert batched_calls <= 10
+    assert batched > per_request * 3
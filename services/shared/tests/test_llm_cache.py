@@ -0,0 +1,180 @@
+"""Кэш ответов модели: память и диск, срок жизни, вытеснение, объединение запросов"""
+import asyncio
+import sqlite3
+from contextlib import closing
+
+import pytest
+
+
+def make_cache(llm_cache, tmp_path, ttl=3600, memory_items=100, max_bytes=1024 * 1024):
+    return llm_cache.LLMCache(tmp_path / "cache.db", ttl, memory_items, max_bytes)
+
+
+class Model:
+    """Модель, которая считает обращения и может отвечать с задержкой"""
+
+    def __init__(self, result="ответ", delay=0.0):
+        self.result = result
+        self.delay = delay
+        self.calls = 0
+
+    async def __call__(self):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.result
+
+
+def test_key_depends_on_model_template_and_text(llm_cache):
+    key = llm_cache.LLMCache.key("model", "summary", "текст")
+
+    assert key == llm_cache.LLMCache.key("model", "summary", "текст")
+    assert len({
+        key,
+        llm_cache.LLMCache.key("other", "summary", "текст"),
+        llm_cache.LLMCache.key("model", "analysis", "текст"),
+        llm_cache.LLMCache.key("model", "summary", "текст 2"),
+    }) == 4
+
+
+def test_second_request_is_served_from_memory(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path)
+    model = Model({"summary_text": "кратко"})
+
+    async def run():
+        return [await cache.get_or_compute("k", model) for _ in range(3)]
+
+    assert asyncio.run(run()) == [{"summary_text": "кратко"}] * 3
+    assert model.calls == 1
+    assert cache.stats["misses"] == 1
+    assert cache.stats["memory_hits"] == 2
+
+
+def test_disk_tier_survives_restart(llm_cache, tmp_path):
+    asyncio.run(make_cache(llm_cache, tmp_path).put("k", "ответ"))
+    restarted = make_cache(llm_cache, tmp_path)
+    model = Model()
+
+    assert asyncio.run(restarted.get_or_compute("k", model)) == "ответ"
+    assert model.calls == 0
+    assert restarted.stats["disk_hits"] == 1
+
+
+def test_expired_entries_are_not_served(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path, ttl=0.05)
+
+    async def run():
+        await cache.put("k", "старый ответ")
+        assert await cache.get("k") == "старый ответ"
+        await asyncio.sleep(0.1)
+        return await cache.get("k")
+
+    assert asyncio.run(run()) is None
+    # После перезапуска устаревшая запись на диске тоже не отдается
+    assert asyncio.run(make_cache(llm_cache, tmp_path, ttl=0.05).get("k")) is None
+
+
+def test_expired_rows_are_deleted_on_store(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path, ttl=0.05)
+
+    async def run():
+        await cache.put("old", "ответ")
+        await asyncio.sleep(0.1)
+        await cache.put("new", "ответ")
+
+    asyncio.run(run())
+    assert cache.stats["expired"] == 1
+    with closing(sqlite3.connect(tmp_path / "cache.db")) as conn:
+        assert [row[0] for row in conn.execute("SELECT key FROM llm_cache")] == ["new"]
+
+
+def test_memory_tier_is_lru(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path, memory_items=2)
+
+    async def run():
+        await cache.put("a", 1)
+        await cache.put("b", 2)
+        await cache.get("a")
+        await cache.put("c", 3)
+        # "b" вытеснен из памяти, но остается на диске
+        return await cache.get("b")
+
+    assert asyncio.run(run()) == 2
+    assert cache.stats["memory_evictions"] >= 1
+    assert cache.stats["disk_hits"] == 1
+
+
+def test_disk_tier_evicts_least_recently_used(llm_cache, tmp_path):
+    value = "x" * 100
+    size = len(f'"{value}"'.encode())
+    cache = make_cache(llm_cache, tmp_path, memory_items=1, max_bytes=size * 2)
+
+    async def run():
+        await cache.put("a", value)
+        await cache.put("b", value)
+        cache._memory.clear()
+        await cache.get("a")
+        await cache.put("c", value)
+        cache._memory.clear()
+        return await cache.get("a"), await cache.get("b"), await cache.get("c")
+
+    assert asyncio.run(run()) == (value, None, value)
+    assert cache.stats["disk_evictions"] == 1
+
+
+def test_concurrent_requests_reach_model_once(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path)
+    model = Model(delay=0.05)
+
+    async def run():
+        return await asyncio.gather(*(cache.get_or_compute("k", model) for _ in range(10)))
+
+    assert asyncio.run(run()) == ["ответ"] * 10
+    assert model.calls == 1
+    assert cache.stats["coalesced"] == 9
+
+
+def test_cancelled_waiter_does_not_cancel_the_model_call(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path)
+    model = Model(delay=0.05)
+
+    async def run():
+        first = asyncio.create_task(cache.get_or_compute("k", model))
+        second = asyncio.create_task(cache.get_or_compute("k", model))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(run()) == "ответ"
+    assert model.calls == 1
+
+
+def test_failures_are_not_cached(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path)
+    unavailable = Model(result=None)
+
+    async def failing():
+        raise RuntimeError("model crashed")
+
+    async def run():
+        assert await cache.get_or_compute("k", unavailable) is None
+        with pytest.raises(RuntimeError):
+            await cache.get_or_compute("k", failing)
+        return await cache.get_or_compute("k", Model())
+
+    assert asyncio.run(run()) == "ответ"
+    assert unavailable.calls == 1
+    assert cache.stats["stores"] == 1
+
+
+def test_metrics(llm_cache, tmp_path):
+    cache = make_cache(llm_cache, tmp_path)
+
+    async def run():
+        await cache.get_or_compute("a", Model())
+        await cache.get_or_compute("a", Model())
+        return await cache.metrics()
+
+    metrics = asyncio.run(run())
+    assert metrics["hit_rate"] == 0.5
+    assert metrics["disk_items"] == metrics["memory_items"] == 1
+    assert metrics["disk_bytes"] == len('"ответ"'.encode())
@@ -0,0 +1,110 @@
+"""Локальная модель: одна загрузка на процесс, пакеты в пуле потоков"""
+import asyncio
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+
+class Transformers:
+    """Поддельные transformers и torch: считают загрузки и вызовы пайплайна"""
+
+    def __init__(self, load_delay=0.0, error=None):
+        self.load_delay = load_delay
+        self.error = error
+        self.loads = []
+        self.calls = []
+        self.threads = []
+
+    def pipeline(self, task, model, device):
+        time.sleep(self.load_delay)
+        if self.error:
+            raise self.error
+        self.loads.append((task, model, device))
+
+        def run(inputs, **kwargs):
+            self.calls.append((list(inputs), kwargs, threading.current_thread().name))
+            return iter([{"summary_text": f"кратко: {text}"} for text in inputs])
+
+        return run
+
+
+@pytest.fixture
+def transformers(monkeypatch):
+    fake = Transformers()
+    monkeypatch.setitem(sys.modules, "transformers", types.SimpleNamespace(pipeline=fake.pipeline))
+    monkeypatch.setitem(sys.modules, "torch", types.SimpleNamespace(set_num_threads=fake.threads.append))
+    return fake
+
+
+def test_model_is_loaded_once_for_concurrent_batches(local_backend, transformers):
+    transformers.load_delay = 0.05
+    backend = local_backend.LocalBackend("summarization", "rut5", 4, truncation=True)
+
+    async def run():
+        return await asyncio.gather(*(backend.infer([f"новость {i}"]) for i in range(4)))
+
+    results = asyncio.run(run())
+
+    assert transformers.loads == [("summarization", "rut5", -1)]
+    assert results == [[{"summary_text": f"кратко: новость {i}"}] for i in range(4)]
+
+
+def test_batch_runs_in_worker_thread_with_call_kwargs(local_backend, transformers):
+    backend = local_backend.LocalBackend(
+        "zero-shot-classification", "mdeberta", 1, candidate_labels=["встреча", "другое"]
+    )
+
+    assert asyncio.run(backend.infer(["a", "b"])) == [
+        {"summary_text": "кратко: a"}, {"summary_text": "кратко: b"}
+    ]
+    inputs, kwargs, thread = transformers.calls[0]
+    assert inputs == ["a", "b"]
+    assert kwargs == {"candidate_labels": ["встреча", "другое"]}
+    # Цикл событий не выполняет модель сам
+    assert thread.startswith("inference")
+
+
+def test_warm_up_loads_before_first_request(local_backend, transformers):
+    backend = local_backend.LocalBackend("summarization", "rut5", 1)
+
+    asyncio.run(backend.warm_up())
+    assert len(transformers.loads) == 1
+    asyncio.run(backend.infer(["текст"]))
+    assert len(transformers.loads) == 1
+
+
+def test_torch_threads_are_limited_when_configured(local_backend, transformers, monkeypatch):
+    monkeypatch.setattr(local_backend, "LOCAL_INFERENCE_THREADS", 2)
+    asyncio.run(local_backend.LocalBackend("summarization", "rut5", 1).warm_up())
+    assert transformers.threads == [2]
+
+
+def test_torch_threads_are_left_alone_by_default(local_backend, transformers):
+    asyncio.run(local_backend.LocalBackend("summarization", "rut5", 1).warm_up())
+    assert transformers.threads == []
+
+
+def test_failed_load_is_retried_on_next_request(local_backend, transformers):
+    transformers.error = OSError("model not found")
+    backend = local_backend.LocalBackend("summarization", "rut5", 1)
+
+    with pytest.raises(OSError):
+        asyncio.run(backend.warm_up())
+    transformers.error = None
+
+    assert asyncio.run(backend.infer(["текст"])) == [{"summary_text": "кратко: текст"}]
+    assert len(transformers.loads) == 1
+
+
+def test_batcher_sends_one_list_to_local_model(inference, local_backend, transformers):
+    backend = local_backend.LocalBackend("summarization", "rut5", 1)
+    batcher = inference.InferenceBatcher(backend, 16, 0.01, 1, 100)
+
+    async def run():
+        return await asyncio.gather(*(batcher.submit(f"новость {i}") for i in range(3)))
+
+    assert asyncio.run(run()) == [{"summary_text": f"кратко: новость {i}"} for i in range(3)]
+    assert [sorted(call[0]) for call in transformers.calls] == [["новость 0", "новость 1", "новость 2"]]
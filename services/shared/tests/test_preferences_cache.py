@@ -0,0 +1,108 @@
+"""Кэш настроек пользователя: перепроверка по ETag и работа без Auth Service; рабочее расписание"""
+import asyncio
+from datetime import datetime
+
+import httpx
+import pytest
+
+PREFS = {"important_contacts": ["boss@example.com"], "version": 3}
+
+
+class Auth:
+    """Auth Service: настройки с ETag, 304 на совпавший If-None-Match"""
+
+    def __init__(self):
+        self.requests = []
+        self.down = False
+        self.body = None
+
+    def __call__(self, request):
+        self.requests.append(request)
+        if self.down:
+            raise httpx.ConnectError("refused")
+        if self.body is not None:
+            return httpx.Response(200, content=self.body, headers={"ETag": '"4"'})
+        if request.headers.get("if-none-match") == '"3"':
+            return httpx.Response(304, headers={"ETag": '"3"'})
+        return httpx.Response(200, json=PREFS, headers={"ETag": '"3"'})
+
+
+@pytest.fixture
+def auth(monkeypatch):
+    auth = Auth()
+    real_client = httpx.AsyncClient
+
+    class MockClient(real_client):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, transport=httpx.MockTransport(auth), **kwargs)
+
+    monkeypatch.setattr(httpx, "AsyncClient", MockClient)
+    return auth
+
+
+def test_revalidates_with_etag_after_ttl(preferences, auth):
+    cache = preferences.PreferencesCache(ttl=0.05)
+
+    async def run():
+        first = await cache.get("u", "token")
+        assert await cache.get("u", "token") is first
+        assert len(auth.requests) == 1
+        await asyncio.sleep(0.06)
+        assert await cache.get("u", "token") is first
+        return first
+
+    assert asyncio.run(run()) == PREFS
+    assert "if-none-match" not in auth.requests[0].headers
+    assert auth.requests[1].headers["if-none-match"] == '"3"'
+
+
+def test_concurrent_misses_make_one_request(preferences, auth):
+    cache = preferences.PreferencesCache(ttl=60)
+
+    async def run():
+        return await asyncio.gather(*(cache.get("u", "token") for _ in range(10)))
+
+    assert all(prefs == PREFS for prefs in asyncio.run(run()))
+    assert len(auth.requests) == 1
+
+
+def test_auth_service_down(preferences, auth):
+    cache = preferences.PreferencesCache(ttl=0)
+    auth.down = True
+    assert asyncio.run(cache.get("u", "token")) is preferences.DEFAULT_PREFERENCES
+
+    auth.down = False
+    assert asyncio.run(cache.get("u", "token")) == PREFS
+    auth.down = True
+    # Известные настройки остаются в силе
+    assert asyncio.run(cache.get("u", "token")) == PREFS
+
+
+@pytest.mark.parametrize("body", [b"<html>Bad Gateway</html>", b"[]", b"null"])
+def test_invalid_body_keeps_known_preferences(preferences, auth, body):
+    cache = preferences.PreferencesCache(ttl=0)
+    auth.body = body
+    assert asyncio.run(cache.get("u", "token")) is preferences.DEFAULT_PREFERENCES
+
+    auth.body = None
+    assert asyncio.run(cache.get("u", "token")) == PREFS
+    auth.body = body
+    assert asyncio.run(cache.get("u", "token")) == PREFS
+    # ETag непрочитанного ответа не сохраняется: перепроверка идет по известной версии
+    assert asyncio.run(cache.get("u", "token")) == PREFS
+    assert auth.requests[-1].headers["if-none-match"] == '"3"'
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    ("2025-12-15T10:00", "2025-12-15T11:00", True),
+    ("2025-12-15T17:00", "2025-12-15T18:00", True),
+    ("2025-12-15T09:00", "2025-12-15T10:00", False),
+    ("2025-12-15T17:30", "2025-12-15T18:30", False),
+    ("2025-12-13T10:00", "2025-12-13T11:00", False),
+    ("2025-12-15T17:00", "2025-12-16T10:00", False),
+])
+def test_within_work_schedule(preferences, start, end, expected):
+    schedule = preferences.DEFAULT_PREFERENCES["work_schedule"]
+    assert preferences.within_work_schedule(
+        datetime.fromisoformat(start), datetime.fromisoformat(end), schedule
+    ) is expected
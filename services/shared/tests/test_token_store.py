@@ -0,0 +1,131 @@
+"""Хранилище OAuth токенов: SQLite, кэш в памяти, блокировка на пользователя, расписание обновления"""
+import asyncio
+import sqlite3
+import time
+from contextlib import closing
+
+
+def test_token_survives_restart_and_is_shared(token_store, tmp_path):
+    path = tmp_path / "tokens.db"
+    worker = token_store.TokenStore(path, 30)
+    asyncio.run(worker.set("alice", "alice-token"))
+
+    # Другой воркер или перезапущенный процесс читает ту же базу
+    assert asyncio.run(token_store.TokenStore(path, 30).get("alice")) == "alice-token"
+
+
+def test_tokens_are_per_user(token_store, tmp_path):
+    store = token_store.TokenStore(tmp_path / "tokens.db", 30)
+
+    async def run():
+        await store.set("alice", "alice-token")
+        await store.set("bob", "bob-token")
+        return await store.get("alice"), await store.get("bob"), await store.get("carol")
+
+    assert asyncio.run(run()) == ("alice-token", "bob-token", None)
+
+
+def test_cache_hides_other_workers_until_ttl(token_store, tmp_path):
+    path = tmp_path / "tokens.db"
+    cached = token_store.TokenStore(path, 30)
+    uncached = token_store.TokenStore(path, 0)
+    other = token_store.TokenStore(path, 30)
+
+    async def run():
+        await other.set("alice", "old-token")
+        before = await cached.get("alice"), await uncached.get("alice")
+        await other.set("alice", "new-token")
+        return before, (await cached.get("alice"), await uncached.get("alice"))
+
+    before, after = asyncio.run(run())
+    assert before == ("old-token", "old-token")
+    assert after == ("old-token", "new-token")
+
+
+def test_missing_token_is_cached_too(token_store, tmp_path):
+    store = token_store.TokenStore(tmp_path / "tokens.db", 30)
+    selects = []
+    select = store._select
+    store._select = lambda user_id: selects.append(user_id) or select(user_id)
+
+    async def run():
+        for _ in range(3):
+            assert await store.get("nobody") is None
+
+    asyncio.run(run())
+    assert selects == ["nobody"]
+
+
+def test_concurrent_reads_load_once(token_store, tmp_path):
+    store = token_store.TokenStore(tmp_path / "tokens.db", 30)
+    asyncio.run(token_store.TokenStore(store.path, 30).set("alice", "alice-token"))
+    selects = []
+    select = store._select
+    store._select = lambda user_id: selects.append(user_id) or select(user_id)
+
+    async def run():
+        return await asyncio.gather(*(store.get("alice") for _ in range(20)))
+
+    assert asyncio.run(run()) == ["alice-token"] * 20
+    assert selects == ["alice"]
+
+
+def test_old_table_gets_refresh_columns(token_store, tmp_path):
+    path = tmp_path / "tokens.db"
+    with closing(sqlite3.connect(path)) as conn, conn:
+        conn.execute("CREATE TABLE tokens (user_id TEXT PRIMARY KEY, access_token TEXT NOT NULL, updated_at REAL NOT NULL)")
+        conn.execute("INSERT INTO tokens VALUES ('alice', 'alice-token', 0)")
+
+    store = token_store.TokenStore(path, 30)
+
+    assert asyncio.run(store.get("alice")) == "alice-token"
+    with closing(sqlite3.connect(path)) as conn:
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(tokens)")}
+    assert {"refresh_token", "expires_at", "refresh_at", "refresh_claimed_until", "refresh_failures"} <= columns
+
+
+def refresh_state(store, user_id):
+    with closing(store._connect()) as conn:
+        return conn.execute(
+            "SELECT refresh_at, refresh_failures FROM tokens WHERE user_id = ?", (user_id,)
+        ).fetchone()
+
+
+def test_refresh_is_scheduled_before_expiry(token_store, tmp_path):
+    store = token_store.TokenStore(tmp_path / "tokens.db", 30)
+    store.refresh_margin, store.refresh_jitter = 600.0, 60.0
+    started = time.time()
+
+    asyncio.run(store.set("alice", "alice-token", "refresh", expires_in=86400))
+
+    refresh_at = refresh_state(store, "alice")[0]
+    assert started + 86400 - 660 <= refresh_at <= time.time() + 86400 - 600
+
+
+def test_postponed_refresh_backs_off_up_to_limit(token_store, tmp_path):
+    store = token_store.TokenStore(tmp_path / "tokens.db", 30)
+    store.retry_base, store.retry_max = 60.0, 200.0
+    asyncio.run(store.set("alice", "alice-token", "refresh", expires_in=1))
+
+    delays = []
+    for _ in range(4):
+        now = time.time()
+        asyncio.run(store.postpone_refresh("alice"))
+        delays.append(refresh_state(store, "alice")[0] - now)
+
+    assert refresh_state(store, "alice")[1] == 4
+    # Задержка удваивается (со случайным сдвигом вниз) и не превышает предел
+    for delay, limit in zip(delays, [60, 120, 200, 200]):
+        assert limit / 2 - 1 <= delay <= limit + 1
+
+
+def test_user_ids_lists_saved_users(token_store, tmp_path):
+    store = token_store.TokenStore(tmp_path / "tokens.db", 30)
+
+    async def run():
+        await store.set("alice", "alice-token")
+        await store.set("bob", "bob-token")
+        await store.set("alice", "alice-token-2")
+        return await store.user_ids()
+
+    assert sorted(asyncio.run(run())) == ["alice", "bob"]
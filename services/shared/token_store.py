@@ -0,0 +1,191 @@
+"""Хранилище OAuth токенов Яндекса для calendar-service и email-service.
+
+Настройки планового обновления одинаковы для обоих сервисов и читаются из
+окружения здесь; период фонового прохода, размер пакета и аренду задает сервис.
+"""
+from typing import List, Dict, Optional, Tuple
+from pathlib import Path
+from contextlib import closing
+import asyncio
+import os
+import random
+import sqlite3
+import time
+
+# За сколько секунд до истечения обновлять токен и разброс момента обновления;
+# база и предел экспоненциальной задержки повтора после временного сбоя OAuth
+TOKEN_REFRESH_MARGIN = float(os.getenv("TOKEN_REFRESH_MARGIN", "3600"))
+TOKEN_REFRESH_JITTER = float(os.getenv("TOKEN_REFRESH_JITTER", "600"))
+TOKEN_REFRESH_RETRY_BASE = float(os.getenv("TOKEN_REFRESH_RETRY_BASE", "60"))
+TOKEN_REFRESH_RETRY_MAX = float(os.getenv("TOKEN_REFRESH_RETRY_MAX", "3600"))
+
+class TokenStore:
+    """Персистентное хранилище OAuth токенов (SQLite), общее для всех воркеров.
+
+    Чтение идет через кэш в памяти процесса, обращения к БД по одному
+    пользователю сериализуются отдельной блокировкой на ключ.
+    """
+
+    def __init__(self, path: Path, cache_ttl: float):
+        self.path = path
+        self.cache_ttl = cache_ttl
+        self._cache: Dict[str, Tuple[Optional[str], float]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.refresh_margin = TOKEN_REFRESH_MARGIN
+        self.refresh_jitter = TOKEN_REFRESH_JITTER
+        self.retry_base = TOKEN_REFRESH_RETRY_BASE
+        self.retry_max = TOKEN_REFRESH_RETRY_MAX
+        with closing(self._connect()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS tokens (
+                    user_id TEXT PRIMARY KEY,
+                    access_token TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            # Метаданные обновления токена (добавлены к существующей таблице)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(tokens)")}
+            for column, column_type in [
+                ("refresh_token", "TEXT"),
+                ("expires_at", "REAL"),
+                ("refresh_at", "REAL"),
+                ("refresh_claimed_until", "REAL"),
+                ("refresh_failures", "INTEGER NOT NULL DEFAULT 0"),
+            ]:
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE tokens ADD COLUMN {column} {column_type}")
+            conn.execute("CREATE INDEX IF NOT EXISTS tokens_refresh_at ON tokens (refresh_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _lock(self, user_id: str) -> asyncio.Lock:
+        return self._locks.setdefault(user_id, asyncio.Lock())
+
+    def _cached(self, user_id: str) -> Tuple[bool, Optional[str]]:
+        entry = self._cache.get(user_id)
+        if entry and entry[1] > time.monotonic():
+            return True, entry[0]
+        return False, None
+
+    def _select(self, user_id: str) -> Optional[str]:
+        with closing(self._connect()) as conn:
+            row = conn.execute(
+                "SELECT access_token FROM tokens WHERE user_id = ?", (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def _upsert(self, user_id: str, token: str, refresh_token: Optional[str],
+                expires_at: Optional[float], refresh_at: Optional[float]):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                """INSERT INTO tokens (user_id, access_token, updated_at, refresh_token,
+                                       expires_at, refresh_at, refresh_claimed_until)
+                VALUES (?, ?, ?, ?, ?, ?, NULL)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    access_token = excluded.access_token,
+                    updated_at = excluded.updated_at,
+                    refresh_token = COALESCE(excluded.refresh_token, tokens.refresh_token),
+                    expires_at = excluded.expires_at,
+                    refresh_at = excluded.refresh_at,
+                    refresh_claimed_until = NULL,
+                    refresh_failures = 0""",
+                (user_id, token, time.time(), refresh_token, expires_at, refresh_at)
+            )
+
+    def _select_due(self, now: float, limit: int) -> List[Tuple[str, str]]:
+        with closing(self._connect()) as conn:
+            return conn.execute(
+                """SELECT user_id, refresh_token FROM tokens
+                WHERE refresh_token IS NOT NULL AND refresh_at <= ?
+                    AND (refresh_claimed_until IS NULL OR refresh_claimed_until < ?)
+                ORDER BY refresh_at LIMIT ?""",
+                (now, now, limit)
+            ).fetchall()
+
+    def _claim(self, user_id: str, now: float, until: float) -> bool:
+        with closing(self._connect()) as conn, conn:
+            cursor = conn.execute(
+                """UPDATE tokens SET refresh_claimed_until = ?
+                WHERE user_id = ? AND refresh_at <= ?
+                AND (refresh_claimed_until IS NULL OR refresh_claimed_until < ?)""",
+                (until, user_id, now, now)
+            )
+            return cursor.rowcount == 1
+
+    def _postpone(self, user_id: str, now: float):
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute(
+                "SELECT refresh_failures FROM tokens WHERE user_id = ?", (user_id,)
+            ).fetchone()
+            if not row:
+                return
+            delay = min(self.retry_max, self.retry_base * 2 ** row[0])
+            conn.execute(
+                """UPDATE tokens SET refresh_at = ?, refresh_claimed_until = NULL,
+                    refresh_failures = refresh_failures + 1
+                WHERE user_id = ?""",
+                (now + delay * random.uniform(0.5, 1.0), user_id)
+            )
+
+    def _drop_refresh(self, user_id: str):
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                "UPDATE tokens SET refresh_at = NULL, refresh_claimed_until = NULL WHERE user_id = ?",
+                (user_id,)
+            )
+
+    async def get(self, user_id: str) -> Optional[str]:
+        hit, token = self._cached(user_id)
+        if hit:
+            return token
+        async with self._lock(user_id):
+            # Пока ждали блокировку, токен мог загрузить другой запрос
+            hit, token = self._cached(user_id)
+            if hit:
+                return token
+            token = await asyncio.to_thread(self._select, user_id)
+            self._cache[user_id] = (token, time.monotonic() + self.cache_ttl)
+            return token
+
+    async def set(self, user_id: str, token: str, refresh_token: Optional[str] = None,
+                  expires_in: Optional[int] = None):
+        expires_at = refresh_at = None
+        if expires_in:
+            expires_at = time.time() + expires_in
+            # Обновляем заранее и со случайным сдвигом, чтобы не обновлять всех разом
+            lead = min(self.refresh_margin, expires_in / 2) + random.uniform(0, self.refresh_jitter)
+            refresh_at = max(time.time(), expires_at - lead)
+        async with self._lock(user_id):
+            await asyncio.to_thread(self._upsert, user_id, token, refresh_token, expires_at, refresh_at)
+            self._cache[user_id] = (token, time.monotonic() + self.cache_ttl)
+
+    def _select_users(self) -> List[str]:
+        with closing(self._connect()) as conn:
+            return [row[0] for row in conn.execute("SELECT user_id FROM tokens")]
+
+    async def user_ids(self) -> List[str]:
+        """Все пользователи с сохраненным токеном"""
+        return await asyncio.to_thread(self._select_users)
+
+    async def due_for_refresh(self, limit: int) -> List[Tuple[str, str]]:
+        """Пользователи, чьи токены пора обновить"""
+        return await asyncio.to_thread(self._select_due, time.time(), limit)
+
+    async def claim_refresh(self, user_id: str, lease: float) -> bool:
+        """Захват обновления токена одним воркером (дедупликация между процессами).
+
+        Токен, который уже обновлен или снят с расписания, не захватывается:
+        иначе воркер со старым списком due повторил бы обновление.
+        """
+        now = time.time()
+        return await asyncio.to_thread(self._claim, user_id, now, now + lease)
+
+    async def postpone_refresh(self, user_id: str):
+        """Повтор обновления позже с экспоненциальной задержкой (временный сбой OAuth)"""
+        await asyncio.to_thread(self._postpone, user_id, time.time())
+
+    async def drop_refresh(self, user_id: str):
+        """Снятие токена с планового обновления: refresh_token отозван, нужен повторный вход"""
+        await asyncio.to_thread(self._drop_refresh, user_id)